@@ -0,0 +1,151 @@
+"""
+Model type benchmark
+Trains each model type with the production defaults on the same synthetic
+dataset and compares training time, inference latency and test accuracy
+
+Usage:
+    python benchmarks/model_benchmark.py --samples 200000 \
+        --models random_forest hist_gradient_boosting --output model_bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Any
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'server'))
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'model_training'))
+
+from run_benchmarks import percentile, peak_rss_mb, environment_info  # noqa: E402
+
+logger = logging.getLogger('benchmarks')
+
+
+def time_per_call_ms(fn, X, n_calls: int) -> Dict[str, float]:
+    """Latency percentiles of fn on single rows of X"""
+    latencies = []
+    for i in range(n_calls):
+        row = X[i % len(X)].reshape(1, -1)
+        start = time.perf_counter()
+        fn(row)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'p50': round(percentile(latencies, 50), 4),
+        'p95': round(percentile(latencies, 95), 4),
+        'p99': round(percentile(latencies, 99), 4),
+    }
+
+
+def benchmark_model(trainer, X_train, y_train, X_test, y_test, work_dir: str,
+                    n_calls: int) -> Dict[str, Any]:
+    from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+    from analyzer.model_artifact import save_artifact, load_artifact
+
+    model_type = trainer.model_type
+    start = time.perf_counter()
+    model = trainer._train_default(X_train, y_train)
+    train_seconds = time.perf_counter() - start
+
+    proba = model.predict_proba(X_test)[:, 1]
+    pred = (proba >= 0.5).astype(int)
+
+    artifact_path = save_artifact(os.path.join(work_dir, f'{model_type}.apkm'), model)
+    artifact_model, _, _ = load_artifact(artifact_path)
+
+    batch = X_test[:min(len(X_test), 10000)]
+    start = time.perf_counter()
+    model.predict_proba(batch)
+    batch_seconds = time.perf_counter() - start
+
+    result = {
+        'model_type': model_type,
+        'train_seconds': round(train_seconds, 3),
+        'n_iterations': int(getattr(model, 'n_iter_', 0)) or None,
+        'accuracy': round(float(accuracy_score(y_test, pred)), 5),
+        'f1': round(float(f1_score(y_test, pred)), 5),
+        'auc_roc': round(float(roc_auc_score(y_test, proba)), 5),
+        'single_row_ms': {
+            'sklearn': time_per_call_ms(model.predict_proba, X_test, n_calls),
+            'artifact': time_per_call_ms(artifact_model.predict_proba, X_test, n_calls),
+        },
+        'batch_rows_per_s': round(len(batch) / batch_seconds, 1),
+        'artifact_bytes': os.path.getsize(artifact_path),
+        'process_peak_rss_mb': peak_rss_mb(),  # lifetime peak: includes the model types run before
+    }
+    logger.info(f"{model_type}: train={result['train_seconds']}s f1={result['f1']} auc={result['auc_roc']} "
+                f"1-row p50 sklearn={result['single_row_ms']['sklearn']['p50']}ms "
+                f"artifact={result['single_row_ms']['artifact']['p50']}ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare model types on synthetic data')
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--correlation', type=float, default=0.9,
+                        help='How strongly binary features of one sample move together (0..1)')
+    parser.add_argument('--label-noise', type=float, default=0.05,
+                        help='Fraction of flipped labels, so accuracy does not saturate')
+    parser.add_argument('--missing-rate', type=float, default=0.0,
+                        help='Fraction of feature values replaced by NaN')
+    parser.add_argument('--models', nargs='+', default=['random_forest', 'hist_gradient_boosting'])
+    parser.add_argument('--calls', type=int, default=500, help='Single-row latency samples')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory(prefix='model_bench_') as work_dir:
+        # The trainer module writes its log file relative to the working directory
+        os.chdir(work_dir)
+        from sklearn.model_selection import train_test_split
+        from train_model_production import DatasetLoader, ProductionModelTrainer
+        logging.getLogger('train_model_production').setLevel(logging.WARNING)
+
+        X, y = DatasetLoader.generate_synthetic_data(n_samples=args.samples, correlation=args.correlation,
+                                                     seed=args.seed)
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.int64)
+        rng = np.random.default_rng(args.seed)
+        if args.label_noise > 0:
+            flip = rng.random(len(y)) < args.label_noise
+            y[flip] = 1 - y[flip]
+        if args.missing_rate > 0:
+            X[rng.random(X.shape) < args.missing_rate] = np.nan
+
+        results = []
+        for model_type in args.models:
+            # Preprocess per model type: only NaN-aware models keep missing values
+            trainer = ProductionModelTrainer(model_type=model_type)
+            X_processed, _ = trainer.preprocess_data(X, y)
+            X_train, X_test, y_train, y_test = train_test_split(
+                X_processed, y, test_size=0.2, random_state=42, stratify=y
+            )
+            results.append(benchmark_model(trainer, X_train, y_train, X_test, y_test,
+                                           work_dir, args.calls))
+
+    report = {
+        'environment': environment_info(),
+        'config': vars(args),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+        logger.info(f"Results written to {output_path}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+"""
+End-to-end benchmark harness
+Drives APKAnalyzer, MalwarePredictor (and model loading), the scan history store and the /api/scan
+endpoint (Flask test client and a real threaded server) over a synthetic APK corpus
+
+Usage:
+    python benchmarks/run_benchmarks.py --apks 20 --size-mb 2 --concurrency 1 4 \
+        --output bench_results.json [--compare previous.json]
+
+The database scenarios use a temporary SQLite file, or PostgreSQL with --database-url.
+worker_fleet runs the scan workers (server/worker.py) with --concurrency worker processes
+standing in for hosts, on a temporary SQLite job queue or the queue at --job-queue-url
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Any, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'server'))
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_apk import generate_corpus, with_unique_comment  # noqa: E402
+
+logger = logging.getLogger('benchmarks')
+
+RESULT_SCHEMA_VERSION = 2
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)
+    A high-water mark over the process lifetime, not a value of any one scenario
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(rss / divisor, 2)
+
+
+def run_scenario(name: str, fn: Callable[[int], Any], n_ops: int, concurrency: int) -> Dict[str, Any]:
+    """Run fn(i) for i in range(n_ops) with the given concurrency and collect latencies"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = fn(i)
+        except Exception as e:
+            logger.debug(f"{name} op {i} failed: {e}")
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if ok is False:
+                errors += 1
+
+    peak_before = peak_rss_mb()
+    wall_start = time.perf_counter()
+    if concurrency <= 1:
+        for i in range(n_ops):
+            worker(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(n_ops)))
+    wall = time.perf_counter() - wall_start
+    return scenario_result(name, concurrency, n_ops, errors, wall, latencies, peak_before)
+
+
+def scenario_result(name: str, concurrency: int, n_ops: int, errors: int, wall: float,
+                    latencies: List[float], peak_before: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Result record of a scenario from its wall time and per-operation latencies (seconds)
+    peak_rss_growth_mb is how far the scenario raised the process peak RSS (0 when an
+    earlier scenario had already used more); process_peak_rss_mb is the lifetime peak
+    """
+    latencies = sorted(latencies)
+    ms = [v * 1000 for v in latencies]
+    result = {
+        'scenario': name,
+        'concurrency': concurrency,
+        'operations': n_ops,
+        'errors': errors,
+        'wall_seconds': round(wall, 4),
+        'throughput_per_s': round(n_ops / wall, 3) if wall > 0 else 0.0,
+        'latency_ms': {
+            'mean': round(sum(ms) / len(ms), 3) if ms else 0.0,
+            'p50': round(percentile(ms, 50), 3),
+            'p95': round(percentile(ms, 95), 3),
+            'p99': round(percentile(ms, 99), 3),
+            'max': round(ms[-1], 3) if ms else 0.0,
+        },
+        'process_peak_rss_mb': peak_rss_mb(),
+    }
+    if peak_before is not None:
+        result['peak_rss_growth_mb'] = round(max(result['process_peak_rss_mb'] - peak_before, 0.0), 2)
+    logger.info(f"{name} c={concurrency}: {result['throughput_per_s']}/s "
+                f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                f"p99={result['latency_ms']['p99']}ms errors={errors}")
+    return result
+
+
+class BenchmarkSuite:
+    """Builds components against temporary state and runs each scenario"""
+
+    def __init__(self, corpus: List[Dict[str, Any]], work_dir: str, ops: int, database_url: Optional[str] = None,
+                 job_queue_url: Optional[str] = None):
+        self.corpus = corpus
+        self.work_dir = work_dir
+        self.ops = ops
+        self.database_url = database_url
+        self.job_queue_url = job_queue_url
+        self.apk_bytes = [open(apk['path'], 'rb').read() for apk in corpus]
+
+    def analyzer(self, concurrency: int) -> Dict[str, Any]:
+        from analyzer.apk_analyzer import APKAnalyzer
+        analyzer = APKAnalyzer()
+        self.features = []
+
+        def op(i):
+            result = analyzer.analyze(self.corpus[i % len(self.corpus)]['path'])
+            if result.get('success'):
+                self.features.append(result['features'])
+            return result.get('success', False)
+
+        return run_scenario('analyzer.analyze', op, self.ops, concurrency)
+
+    def predictor(self, concurrency: int) -> Dict[str, Any]:
+        from analyzer.ml_predictor import MalwarePredictor
+        model_path = os.environ.get(
+            'BENCH_MODEL_PATH', os.path.join(PROJECT_DIR, 'model_training', 'models', 'malwares_model.pkl')
+        )
+        predictor = MalwarePredictor(model_path=model_path)
+        features = getattr(self, 'features', None) or [[0.0] * 50]
+
+        def op(i):
+            return 'error' not in predictor.predict(features[i % len(features)])
+
+        # Inference is cheap - run more operations for stable percentiles
+        return run_scenario('predictor.predict', op, self.ops * 10, concurrency)
+
+    def _bench_model_files(self):
+        """200-tree forest saved both as pickles and as a single artifact (built once)"""
+        if getattr(self, 'model_files', None):
+            return self.model_files
+        import pickle
+        import numpy as np
+        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.preprocessing import StandardScaler
+        from analyzer.model_artifact import save_artifact
+
+        rng = np.random.default_rng(0)
+        X = (rng.random((20000, 50)) > 0.6).astype(np.float64)
+        y = ((X[:, 1] + X[:, 10] + X[:, 20] + rng.random(20000)) > 1.8).astype(int)
+        scaler = StandardScaler().fit(X)
+        model = RandomForestClassifier(n_estimators=200, max_depth=30, n_jobs=-1, random_state=0)
+        model.fit(scaler.transform(X), y)
+
+        pkl_path = os.path.join(self.work_dir, 'bench_model.pkl')
+        with open(pkl_path, 'wb') as f:
+            pickle.dump(model, f)
+        with open(pkl_path.replace('.pkl', '_scaler.pkl'), 'wb') as f:
+            pickle.dump(scaler, f)
+        artifact_path = save_artifact(os.path.join(self.work_dir, 'bench_model.apkm'), model, scaler)
+        self.model_files = {'pickle': pkl_path, 'artifact': artifact_path}
+        return self.model_files
+
+    def model_load_pickle(self, concurrency: int) -> Dict[str, Any]:
+        import pickle
+        path = self._bench_model_files()['pickle']
+
+        def op(i):
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+            with open(path.replace('.pkl', '_scaler.pkl'), 'rb') as f:
+                pickle.load(f)
+            return model is not None
+
+        return run_scenario('model.load.pickle', op, self.ops, concurrency)
+
+    def model_load_artifact(self, concurrency: int) -> Dict[str, Any]:
+        from analyzer.model_artifact import load_artifact
+        path = self._bench_model_files()['artifact']
+
+        def op(i):
+            model, scaler, _ = load_artifact(path)
+            return model is not None
+
+        return run_scenario('model.load.artifact', op, self.ops, concurrency)
+
+    def _scan_store(self, name: str):
+        from database.storage import open_store
+        return open_store(self.database_url or os.path.join(self.work_dir, f'{name}.db'))
+
+    @staticmethod
+    def _bench_scan(run: str, i: int) -> Dict[str, Any]:
+        # Hashes unique per run, so a shared PostgreSQL database measures inserts, not upserts
+        return {
+            'scan_id': f'bench_{run}_{i}', 'filename': 'bench.apk', 'file_hash': f'{run}{i:048x}',
+            'timestamp': '20260101_000000', 'verdict': 'Safe', 'risk_score': 10,
+            'apk_info': {'package_name': 'com.bench', 'app_name': 'Bench'},
+        }
+
+    def database(self, concurrency: int) -> Dict[str, Any]:
+        db = self._scan_store(f'bench_db_c{concurrency}')
+        run = f'{time.time_ns():016x}'
+
+        def op(i):
+            scan = self._bench_scan(run, i)
+            saved = db.save_scan(scan)
+            return saved and db.get_scan_by_hash(scan['file_hash']) is not None
+
+        # SQLite keeps the original scenario name so older baselines still compare
+        name = 'database.save_and_lookup' + ('' if db.backend == 'sqlite' else f'.{db.backend}')
+        return run_scenario(name, op, self.ops * 10, concurrency)
+
+    def database_bulk(self, concurrency: int) -> Dict[str, Any]:
+        """save_scans() of 100 results per operation"""
+        db = self._scan_store(f'bench_db_bulk_c{concurrency}')
+        run = f'{time.time_ns():016x}'
+
+        def op(i):
+            batch = [self._bench_scan(run, i * 100 + j) for j in range(100)]
+            return db.save_scans(batch) == len(batch)
+
+        return run_scenario(f'database.save_bulk_100.{db.backend}', op, self.ops, concurrency)
+
+    def _load_app(self):
+        import app as app_module
+        from database.db_manager import DatabaseManager
+        # Isolated scan history so repeated runs never hit the result cache (uploads are unique per run)
+        app_module.db_manager = (self._scan_store('bench_app') if self.database_url else DatabaseManager(
+            db_path=os.path.join(self.work_dir, f'bench_app_{time.time_ns()}.db')
+        ))
+        # One benchmark client would otherwise be throttled by its token bucket
+        app_module.admission = None
+        return app_module.app
+
+    def _unique_apk(self, i: int) -> bytes:
+        return with_unique_comment(self.apk_bytes[i % len(self.apk_bytes)], f'bench-{time.time_ns()}-{i}')
+
+    def flask_test_client(self, concurrency: int) -> Dict[str, Any]:
+        import io
+        app = self._load_app()
+
+        def op(i):
+            with app.test_client() as client:
+                response = client.post('/api/scan', data={
+                    'file': (io.BytesIO(self._unique_apk(i)), f'bench_{i}.apk')
+                }, content_type='multipart/form-data')
+            return response.status_code == 200
+
+        return run_scenario('api.scan.test_client', op, self.ops, concurrency)
+
+    def flask_server(self, concurrency: int) -> Dict[str, Any]:
+        import requests
+        from werkzeug.serving import make_server
+        app = self._load_app()
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f'http://127.0.0.1:{server.server_port}/api/scan'
+
+        def op(i):
+            response = requests.post(url, files={
+                'file': (f'bench_{i}.apk', self._unique_apk(i), 'application/vnd.android.package-archive')
+            }, timeout=300)
+            return response.status_code == 200
+
+        try:
+            return run_scenario('api.scan.server', op, self.ops, concurrency)
+        finally:
+            server.shutdown()
+
+
+    def worker_fleet(self, concurrency: int) -> Dict[str, Any]:
+        """
+        Scan jobs drained by `concurrency` forked worker processes; latency is from enqueue
+        to the committed result. Throughput should grow with the processes up to the CPU count
+        """
+        import multiprocessing
+        import worker
+        from database.job_queue import job_queue_for, job_key
+        app_module = self._load_app()
+        run = time.time_ns()
+        queue = job_queue_for(app_module.db_manager, self.job_queue_url or os.path.join(
+            self.work_dir, f'bench_jobs_{run}.db'))
+        feed_dir = os.path.join(self.work_dir, f'bench_feed_{run}')
+        os.makedirs(feed_dir)
+        jobs = []
+        for i in range(self.ops):
+            path = os.path.join(feed_dir, f'bench_{i}.apk')
+            with open(path, 'wb') as f:
+                f.write(self._unique_apk(i))
+            jobs.append({'source': path})
+        queue.enqueue(jobs)
+
+        options = dict(batch_size=1, lease_seconds=300, download_dir=feed_dir)
+        context = multiprocessing.get_context('fork')
+        wall_start = time.perf_counter()
+        processes = [context.Process(target=worker.worker_process, args=(queue, app_module, options, 0, True))
+                     for _ in range(concurrency)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        wall = time.perf_counter() - wall_start
+
+        finished = [queue.get(job_key(job['source'])) for job in jobs]
+        latencies = [job['updated_at'] - job['created_at'] for job in finished if job and job['state'] == 'done']
+        return scenario_result(f'worker_fleet.{queue.backend}', concurrency, self.ops,
+                               self.ops - len(latencies), wall, latencies)
+
+
+SCENARIOS = ('analyzer', 'predictor', 'model_load_pickle', 'model_load_artifact', 'database', 'database_bulk',
+             'flask_test_client', 'flask_server', 'worker_fleet')
+
+
+def environment_info() -> Dict[str, Any]:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Return regressions where p95 latency or throughput worsened more than threshold"""
+    previous = {(r['scenario'], r['concurrency']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in current['results']:
+        old = previous.get((result['scenario'], result['concurrency']))
+        if not old:
+            continue
+        old_p95, new_p95 = old['latency_ms']['p95'], result['latency_ms']['p95']
+        if old_p95 > 0 and new_p95 > old_p95 * (1 + threshold):
+            regressions.append(f"{result['scenario']} c={result['concurrency']}: "
+                               f"p95 {old_p95}ms -> {new_p95}ms")
+        old_tp, new_tp = old['throughput_per_s'], result['throughput_per_s']
+        if old_tp > 0 and new_tp < old_tp * (1 - threshold):
+            regressions.append(f"{result['scenario']} c={result['concurrency']}: "
+                               f"throughput {old_tp}/s -> {new_tp}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='APK scanner end-to-end benchmarks')
+    parser.add_argument('--apks', type=int, default=20, help='Synthetic APKs in the corpus')
+    parser.add_argument('--size-mb', type=float, default=2.0, help='Approximate APK size')
+    parser.add_argument('--entries', type=int, default=50, help='ZIP entries per APK')
+    parser.add_argument('--dex', type=int, default=1, help='DEX files per APK')
+    parser.add_argument('--permissions', type=int, default=8, help='Permissions per APK')
+    parser.add_argument('--certs', type=int, default=3, help='Distinct signing certificates')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--ops', type=int, default=40, help='Operations per scenario')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--corpus-dir', help='Reuse/generate the corpus here (default: temp dir)')
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--database-url', help='Run the database and API scenarios against this postgresql:// URL')
+    parser.add_argument('--job-queue-url', help='Run worker_fleet on this redis:// job queue')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Regression threshold (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Keep per-scan INFO lines out of the measurements
+    logging.getLogger('analyzer').setLevel(logging.WARNING)
+    logging.getLogger('database').setLevel(logging.WARNING)
+    logging.getLogger('app').setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    logging.getLogger('worker').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='apk_bench_') as work_dir:
+        corpus_dir = args.corpus_dir or os.path.join(work_dir, 'corpus')
+        config = {
+            'apks': args.apks, 'size_bytes': int(args.size_mb * 1024 * 1024),
+            'entries': args.entries, 'dex': args.dex, 'permissions': args.permissions,
+            'certs': args.certs, 'seed': args.seed, 'ops': args.ops,
+        }
+
+        logger.info(f"Generating corpus in {corpus_dir}: {config}")
+        gen_start = time.perf_counter()
+        corpus = generate_corpus(
+            corpus_dir, n_apks=args.apks, seed=args.seed, size_bytes=config['size_bytes'],
+            n_entries=args.entries, n_dex=args.dex, n_permissions=args.permissions, n_certs=args.certs
+        )
+        config['corpus_generation_seconds'] = round(time.perf_counter() - gen_start, 3)
+
+        # Relative paths (uploads/, logs/) created by the app land in the work dir
+        os.chdir(work_dir)
+        suite = BenchmarkSuite(corpus, work_dir, args.ops, args.database_url, args.job_queue_url)
+        results = []
+        for scenario in SCENARIOS:
+            if scenario not in args.scenarios:
+                continue
+            for concurrency in args.concurrency:
+                results.append(getattr(suite, scenario)(concurrency))
+
+    report = {
+        'schema_version': RESULT_SCHEMA_VERSION,
+        'environment': environment_info(),
+        'config': config,
+        'results': results,
+    }
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(report, json.load(f), args.threshold)
+        report['regressions'] = regressions
+        for line in regressions:
+            logger.warning(f"REGRESSION {line}")
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        logger.info(f"Results written to {args.output}")
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
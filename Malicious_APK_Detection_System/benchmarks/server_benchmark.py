@@ -0,0 +1,538 @@
+"""
+Server launcher benchmark
+Starts run.py as a separate process in each configuration (Werkzeug dev server,
+pre-fork workers x threads) and measures POST /api/scan throughput and latency
+over a synthetic APK corpus, plus the resident memory of the server processes.
+--noisy instead measures a polite client's latency while another client floods
+the server, with and without admission control; --mixed submits small and large
+APKs at a fixed arrival rate (open loop), with and without size-aware scheduling;
+--spike overloads the server, with and without load-aware degradation; --upload
+compares the server I/O of a multipart POST with a chunked resumable upload
+
+Usage:
+    python benchmarks/server_benchmark.py --apks 10 --ops 60 --concurrency 1 4 8 \
+        --configs dev prefork:2x4 prefork:4x2 --output server_bench.json
+    python benchmarks/server_benchmark.py --noisy --configs prefork:2x4 --duration 30
+    python benchmarks/server_benchmark.py --mixed --configs prefork:1x16 --ops 150 --arrival-rate 3
+    python benchmarks/server_benchmark.py --spike --configs prefork:1x16 --duration 20 --arrival-rate 50
+    python benchmarks/server_benchmark.py --upload --configs prefork:1x4 --size-mb 64 --ops 10
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from run_benchmarks import run_scenario, environment_info, percentile  # noqa: E402
+from synthetic_apk import generate_corpus, generate_apk, with_unique_comment  # noqa: E402
+
+logger = logging.getLogger('benchmarks')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _process_tree(pid: int) -> List[int]:
+    """A process and its direct children (Linux /proc only)"""
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def _process_tree_rss_mb(pid: int) -> Optional[float]:
+    """RSS of a process and its direct children (Linux /proc only)"""
+    if not os.path.isdir('/proc'):
+        return None
+    total_kb = 0
+    for p in _process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1)
+
+
+def _process_tree_io(pid: int) -> Optional[Dict[str, int]]:
+    """Bytes passed to read/write calls (files and sockets) by a process and its direct children"""
+    if not os.path.isdir('/proc'):
+        return None
+    totals = {'rchar': 0, 'wchar': 0}
+    for p in _process_tree(pid):
+        try:
+            with open(f'/proc/{p}/io') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in totals:
+                        totals[key] += int(value)
+        except OSError:
+            continue
+    return totals
+
+
+def start_server(config: str, work_dir: str, max_scans: int, admission: bool = False,
+                 extra_env: Optional[Dict[str, str]] = None):
+    """Launch run.py for 'dev' or 'prefork:<workers>x<threads>'; returns (process, base_url)"""
+    port = _free_port()
+    cmd = [sys.executable, os.path.join(PROJECT_DIR, 'run.py'), '--bind', f'127.0.0.1:{port}']
+    if config == 'dev':
+        cmd += ['--mode', 'dev']
+    else:
+        workers, threads = config.split(':', 1)[1].split('x')
+        cmd += ['--mode', 'prefork', '--workers', workers, '--threads', threads,
+                '--max-scans', str(max_scans)]
+    # The clients' API keys are registered so that each gets its own admission bucket
+    env = dict(os.environ, FLASK_DEBUG='0', ADMISSION_ENABLED='1' if admission else '0',
+               ADMISSION_API_KEYS='noisy,polite,bench',
+               DATABASE_PATH=os.path.join(work_dir, f'bench_{config.replace(":", "_")}_{time.time_ns()}.db'))
+    env.update(extra_env or {})
+    log = open(os.path.join(work_dir, f'server_{config.replace(":", "_")}.log'), 'w')
+    process = subprocess.Popen(cmd, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f'http://127.0.0.1:{port}'
+
+
+def wait_ready(process, base_url: str, timeout: float = 120):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(f'{base_url}/api/stats', timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} not ready after {timeout}s")
+
+
+def benchmark_config(config: str, apk_bytes, work_dir: str, ops: int, concurrency: int,
+                     max_scans: int) -> Dict[str, Any]:
+    import requests
+    process, base_url = start_server(config, work_dir, max_scans)
+    try:
+        wait_ready(process, base_url)
+        idle_rss = _process_tree_rss_mb(process.pid)
+
+        def op(i):
+            data = with_unique_comment(apk_bytes[i % len(apk_bytes)], f'server-bench-{time.time_ns()}-{i}')
+            response = requests.post(f'{base_url}/api/scan', files={
+                'file': (f'bench_{i}.apk', data, 'application/vnd.android.package-archive')
+            }, timeout=600)
+            return response.status_code == 200
+
+        result = run_scenario(f'server.{config}', op, ops, concurrency)
+        # Those are the client's
+        result.pop('process_peak_rss_mb', None)
+        result.pop('peak_rss_growth_mb', None)
+        result['server_rss_mb'] = {'idle': idle_rss, 'after': _process_tree_rss_mb(process.pid)}
+        return result
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _post_scan(base_url: str, data: bytes, name: str, api_key: str):
+    import requests
+    return requests.post(f'{base_url}/api/scan', headers={'X-API-Key': api_key}, files={
+        'file': (name, data, 'application/vnd.android.package-archive')
+    }, timeout=600)
+
+
+def noisy_neighbor(config: str, apk_bytes, work_dir: str, duration: float, noisy_threads: int,
+                   polite_interval: float, admission: bool, max_scans: int) -> Dict[str, Any]:
+    """Latency of one polite client while noisy_threads flood the server under another API key"""
+    process, base_url = start_server(config, work_dir, max_scans, admission=admission)
+    stop = threading.Event()
+    lock = threading.Lock()
+    noisy = {'requests': 0, 'accepted': 0, 'throttled': 0, 'errors': 0}
+    polite_ms, polite_status = [], {}
+
+    def flood(t):
+        i = 0
+        while not stop.is_set():
+            data = with_unique_comment(apk_bytes[i % len(apk_bytes)], f'noisy-{t}-{time.time_ns()}')
+            i += 1
+            try:
+                status = _post_scan(base_url, data, f'noisy_{t}.apk', 'noisy').status_code
+                key = 'accepted' if status == 200 else 'throttled' if status == 429 else 'errors'
+            except Exception:
+                key = 'errors'
+            with lock:
+                noisy['requests'] += 1
+                noisy[key] += 1
+
+    try:
+        wait_ready(process, base_url)
+        threads = [threading.Thread(target=flood, args=(t,), daemon=True) for t in range(noisy_threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(2)  # let the flood build up
+        deadline = time.monotonic() + duration
+        i = 0
+        while time.monotonic() < deadline:
+            data = with_unique_comment(apk_bytes[i % len(apk_bytes)], f'polite-{time.time_ns()}')
+            i += 1
+            start = time.perf_counter()
+            try:
+                status = _post_scan(base_url, data, 'polite.apk', 'polite').status_code
+            except Exception:
+                status = 'error'
+            polite_ms.append((time.perf_counter() - start) * 1000)
+            polite_status[str(status)] = polite_status.get(str(status), 0) + 1
+            time.sleep(polite_interval)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=120)
+    finally:
+        stop.set()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    polite_ms.sort()
+    result = {
+        'scenario': f'noisy.{config}',
+        'admission': admission,
+        'polite': {
+            'requests': len(polite_ms),
+            'status': polite_status,
+            'latency_ms': {pct: round(percentile(polite_ms, value), 1)
+                           for pct, value in (('p50', 50), ('p95', 95), ('p99', 99))},
+        },
+        'noisy': noisy,
+    }
+    logger.info(f"{result['scenario']} admission={admission}: polite p50={result['polite']['latency_ms']['p50']}ms "
+                f"p95={result['polite']['latency_ms']['p95']}ms status={polite_status} noisy={noisy}")
+    return result
+
+
+def mixed_workload(config: str, small_apks, large_apks, work_dir: str, ops: int, arrival_rate: float,
+                   large_every: int, scheduler: bool, max_scans: int, seed: int) -> Dict[str, Any]:
+    """
+    Per-size latency and throughput when every large_every-th scan is a large APK
+    Scans arrive as a Poisson process: with a fixed number of clients instead,
+    mean latency is set by throughput alone and reordering cannot show
+    """
+    # One benchmark client: lift its rate limit, keep the analysis-slot queue
+    extra_env = {'SCHEDULER_ENABLED': '1' if scheduler else '0', 'ADMISSION_RATE': '1000',
+                 'ADMISSION_BURST': '1000', 'ADMISSION_MAX_QUEUED': '1024',
+                 'ADMISSION_QUEUE_TIMEOUT': '600', 'ADMISSION_MAX_UPLOAD_MB': '4096'}
+    process, base_url = start_server(config, work_dir, max_scans, admission=True, extra_env=extra_env)
+    latencies = {'small': [], 'large': []}
+    failures = {'small': 0, 'large': 0}
+
+    rng = random.Random(seed)
+    arrivals, t = [], 0.0
+    for _ in range(ops):
+        arrivals.append(t)
+        t += rng.expovariate(arrival_rate)
+
+    def op(i):
+        size = 'large' if i % large_every == 0 else 'small'
+        pool = large_apks if size == 'large' else small_apks
+        data = with_unique_comment(pool[i % len(pool)], f'mixed-{time.time_ns()}-{i}')
+        time.sleep(max(begin + arrivals[i] - time.perf_counter(), 0))
+        start = time.perf_counter()
+        try:
+            ok = _post_scan(base_url, data, f'{size}_{i}.apk', 'bench').status_code == 200
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        return size, ok, elapsed, time.perf_counter()
+
+    try:
+        wait_ready(process, base_url)
+        start = begin = time.perf_counter() + 0.5
+        finished = {'small': start, 'large': start}
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            for size, ok, elapsed, done in pool.map(op, range(ops)):
+                if ok:
+                    latencies[size].append(elapsed * 1000)
+                    finished[size] = max(finished[size], done)
+                else:
+                    failures[size] += 1
+        wall = time.perf_counter() - start
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    result = {'scenario': f'mixed.{config}', 'scheduler': scheduler, 'arrival_rate': arrival_rate,
+              'wall_seconds': round(wall, 2)}
+    for size, values in latencies.items():
+        values.sort()
+        result[size] = {
+            'scans': len(values),
+            'failures': failures[size],
+            'throughput_per_s': round(len(values) / max(finished[size] - start, 1e-9), 2),
+            'latency_ms': {pct: round(percentile(values, value), 1)
+                           for pct, value in (('p50', 50), ('p95', 95), ('p99', 99))},
+        }
+    logger.info(f"{result['scenario']} scheduler={scheduler}: small p50={result['small']['latency_ms']['p50']}ms "
+                f"p95={result['small']['latency_ms']['p95']}ms, large p50={result['large']['latency_ms']['p50']}ms "
+                f"{result['large']['throughput_per_s']}/s, wall {result['wall_seconds']}s")
+    return result
+
+
+def _chunked_upload(base_url: str, data: bytes, name: str, chunk_bytes: int, api_key: str):
+    """Resumable upload protocol: open a session, PUT the chunks in order, finalize"""
+    import requests
+    session = requests.Session()
+    headers = {'X-API-Key': api_key}
+    created = session.post(f'{base_url}/api/uploads', json={'filename': name, 'size': len(data)},
+                           headers=headers, timeout=60).json()
+    offset = 0
+    while offset < len(data):
+        chunk = data[offset:offset + chunk_bytes]
+        response = session.put(base_url + created['upload_url'], data=chunk, headers={
+            'Content-Range': f'bytes {offset}-{offset + len(chunk) - 1}/{len(data)}'
+        }, timeout=600)
+        offset = response.json()['received']
+    return session.post(base_url + created['finalize_url'], headers=headers, timeout=600)
+
+
+def upload_io(config: str, apk_bytes, work_dir: str, ops: int, chunk_mb: float, max_scans: int) -> List[Dict[str, Any]]:
+    """Latency and server read/write volume per scan: one multipart POST vs a chunked upload"""
+    process, base_url = start_server(config, work_dir, max_scans)
+    results = []
+    try:
+        wait_ready(process, base_url)
+        for mode in ('multipart', 'chunked'):
+            latencies = []
+            before = _process_tree_io(process.pid)
+            for i in range(ops):
+                data = with_unique_comment(apk_bytes[i % len(apk_bytes)], f'upload-{mode}-{time.time_ns()}-{i}')
+                start = time.perf_counter()
+                if mode == 'multipart':
+                    response = _post_scan(base_url, data, f'upload_{i}.apk', 'bench')
+                else:
+                    response = _chunked_upload(base_url, data, f'upload_{i}.apk', int(chunk_mb * 1024 * 1024), 'bench')
+                if response.status_code != 200:
+                    raise RuntimeError(f"{mode} scan failed: {response.status_code} {response.text[:200]}")
+                latencies.append((time.perf_counter() - start) * 1000)
+            after = _process_tree_io(process.pid)
+            latencies.sort()
+            result = {
+                'scenario': f'upload.{config}',
+                'mode': mode,
+                'apk_mb': round(sum(len(a) for a in apk_bytes) / len(apk_bytes) / (1024 * 1024), 1),
+                'latency_ms': {pct: round(percentile(latencies, value), 1)
+                               for pct, value in (('p50', 50), ('p95', 95))},
+            }
+            if before and after:
+                result['server_mb_per_scan'] = {
+                    'read': round((after['rchar'] - before['rchar']) / ops / (1024 * 1024), 1),
+                    'written': round((after['wchar'] - before['wchar']) / ops / (1024 * 1024), 1),
+                }
+            logger.info(f"{result['scenario']} {mode}: p50={result['latency_ms']['p50']}ms "
+                        f"server I/O per scan {result.get('server_mb_per_scan')}")
+            results.append(result)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return results
+
+
+def traffic_spike(config: str, apk_bytes, work_dir: str, duration: float, arrival_rate: float,
+                  degrade: bool, max_scans: int, seed: int) -> Dict[str, Any]:
+    """
+    Answers, errors and latency while scans arrive faster than the server analyses them,
+    then how long the provisional results take to be re-analysed once the spike is over
+    """
+    import requests
+    # One benchmark client: lift its rate limit, keep the queue limits and timeout
+    extra_env = {'DEGRADE_ENABLED': '1' if degrade else '0', 'ADMISSION_RATE': '1000',
+                 'ADMISSION_BURST': '1000'}
+    process, base_url = start_server(config, work_dir, max_scans, admission=True, extra_env=extra_env)
+
+    rng = random.Random(seed)
+    arrivals, t = [], 0.0
+    while t < duration:
+        arrivals.append(t)
+        t += rng.expovariate(arrival_rate)
+
+    def op(i):
+        data = with_unique_comment(apk_bytes[i % len(apk_bytes)], f'spike-{time.time_ns()}-{i}')
+        time.sleep(max(begin + arrivals[i] - time.perf_counter(), 0))
+        start = time.perf_counter()
+        try:
+            response = _post_scan(base_url, data, f'spike_{i}.apk', 'bench')
+            status = response.status_code
+            tier = response.json().get('result', {}).get('analysis_tier') if status == 200 else None
+        except Exception:
+            status, tier = 'error', None
+        return status, tier, (time.perf_counter() - start) * 1000
+
+    try:
+        wait_ready(process, base_url)
+        begin = time.perf_counter() + 0.5
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            outcomes = list(pool.map(op, range(len(arrivals))))
+        spike_end = time.perf_counter()
+
+        # Re-analysis starts once the tier is back to full and nothing is queued
+        reanalysis = None
+        deadline = spike_end + 600
+        while degrade and time.perf_counter() < deadline:
+            reanalysis = requests.get(f'{base_url}/api/degradation/status', timeout=10).json()['reanalysis']
+            if reanalysis['pending'] == 0:
+                break
+            time.sleep(1)
+        drained = round(time.perf_counter() - spike_end, 1) if degrade else None
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    latencies = sorted(ms for status, _, ms in outcomes if status == 200)
+    statuses, tiers = {}, {}
+    for status, tier, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if tier:
+            tiers[tier] = tiers.get(tier, 0) + 1
+    result = {
+        'scenario': f'spike.{config}',
+        'degrade': degrade,
+        'arrival_rate': arrival_rate,
+        'requests': len(outcomes),
+        'answered': statuses.get('200', 0),
+        'status': statuses,
+        'tiers': tiers,
+        'latency_ms': {pct: round(percentile(latencies, value), 1)
+                       for pct, value in (('p50', 50), ('p95', 95), ('p99', 99))},
+        'reanalysis': reanalysis,
+        'reanalysis_drained_seconds': drained,
+    }
+    logger.info(f"{result['scenario']} degrade={degrade}: {result['answered']}/{result['requests']} answered, "
+                f"status={statuses} tiers={tiers} p95={result['latency_ms']['p95']}ms, "
+                f"re-analysis drained after {drained}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the dev server with pre-fork configurations')
+    parser.add_argument('--apks', type=int, default=10, help='Synthetic APKs in the corpus')
+    parser.add_argument('--size-mb', type=float, default=2.0, help='Approximate APK size')
+    parser.add_argument('--dex', type=int, default=1, help='DEX files per APK')
+    parser.add_argument('--entries', type=int, default=50, help='ZIP entries per APK (androguard cost grows with them)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--ops', type=int, default=60, help='Scans per configuration and concurrency')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--configs', nargs='+', default=['dev', 'prefork:2x4'],
+                        help="'dev' or 'prefork:<workers>x<threads>'")
+    parser.add_argument('--max-scans', type=int, default=200, help='Worker recycling for prefork configs')
+    parser.add_argument('--noisy', action='store_true',
+                        help='Noisy-neighbor scenario, run with admission control off and on')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Noisy scenario: seconds of polite requests; spike scenario: seconds of arrivals')
+    parser.add_argument('--noisy-threads', type=int, default=8, help='Noisy scenario: flooding connections')
+    parser.add_argument('--polite-interval', type=float, default=0.5,
+                        help='Noisy scenario: pause between the polite client\'s scans')
+    parser.add_argument('--mixed', action='store_true',
+                        help='Small and large APKs together, run with size-aware scheduling off and on')
+    parser.add_argument('--large-mb', type=float, default=64.0, help='Mixed scenario: large APK size')
+    parser.add_argument('--large-entries', type=int, default=2000, help='Mixed scenario: large APK entries')
+    parser.add_argument('--large-every', type=int, default=5, help='Mixed scenario: every Nth scan is large')
+    parser.add_argument('--arrival-rate', type=float, default=3.0, help='Mixed and spike scenarios: scans per second')
+    parser.add_argument('--spike', action='store_true',
+                        help='Arrivals above capacity for --duration seconds, run with degradation off and on')
+    parser.add_argument('--upload', action='store_true',
+                        help='Server I/O of one multipart POST vs a chunked resumable upload per scan')
+    parser.add_argument('--chunk-mb', type=float, default=8.0, help='Upload scenario: chunk size')
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory(prefix='server_bench_') as work_dir:
+        corpus = generate_corpus(os.path.join(work_dir, 'corpus'), n_apks=args.apks, seed=args.seed,
+                                 size_bytes=int(args.size_mb * 1024 * 1024), n_entries=args.entries,
+                                 n_dex=args.dex)
+        apk_bytes = [open(apk['path'], 'rb').read() for apk in corpus]
+
+        large_apks = []
+        if args.mixed:
+            for i in range(2):
+                path = os.path.join(work_dir, f'large_{i}.apk')
+                generate_apk(path, seed=args.seed + 1000 + i, size_bytes=int(args.large_mb * 1024 * 1024),
+                             n_entries=args.large_entries, n_dex=max(args.dex, 4))
+                large_apks.append(open(path, 'rb').read())
+
+        results = []
+        for config in args.configs:
+            if args.mixed:
+                for scheduler in (False, True):
+                    results.append(mixed_workload(config, apk_bytes, large_apks, work_dir, args.ops,
+                                                  args.arrival_rate, args.large_every, scheduler,
+                                                  args.max_scans, args.seed))
+                continue
+            if args.upload:
+                results.extend(upload_io(config, apk_bytes, work_dir, args.ops, args.chunk_mb, args.max_scans))
+                continue
+            if args.spike:
+                for degrade in (False, True):
+                    results.append(traffic_spike(config, apk_bytes, work_dir, args.duration, args.arrival_rate,
+                                                 degrade, args.max_scans, args.seed))
+                continue
+            if args.noisy:
+                for admission in (False, True):
+                    results.append(noisy_neighbor(config, apk_bytes, work_dir, args.duration,
+                                                  args.noisy_threads, args.polite_interval, admission,
+                                                  args.max_scans))
+                continue
+            for concurrency in args.concurrency:
+                results.append(benchmark_config(config, apk_bytes, work_dir, args.ops, concurrency,
+                                                args.max_scans))
+
+    report = {
+        'environment': environment_info(),
+        'config': vars(args),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+        logger.info(f"Results written to {output_path}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
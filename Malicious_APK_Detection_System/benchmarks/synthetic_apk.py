@@ -0,0 +1,316 @@
+"""
+Synthetic APK corpus generator for benchmarks
+Builds structurally valid APKs offline: binary AndroidManifest.xml, DEX files,
+resources, filler entries and (optionally) a v1 signature with a generated certificate
+"""
+import json
+import os
+import random
+import struct
+import zipfile
+from typing import Dict, List, Any, Optional
+
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+
+# Android framework attribute resource ids used in the manifest
+ATTRIBUTE_IDS = {
+    'label': 0x01010001,
+    'name': 0x01010003,
+    'minSdkVersion': 0x0101020c,
+    'versionCode': 0x0101021b,
+    'versionName': 0x0101021c,
+    'targetSdkVersion': 0x01010270,
+}
+
+PERMISSION_POOL = [
+    'INTERNET', 'SEND_SMS', 'RECEIVE_SMS', 'READ_SMS', 'READ_CONTACTS',
+    'WRITE_CONTACTS', 'ACCESS_FINE_LOCATION', 'ACCESS_COARSE_LOCATION',
+    'RECORD_AUDIO', 'CAMERA', 'READ_PHONE_STATE', 'CALL_PHONE',
+    'READ_CALL_LOG', 'WRITE_CALL_LOG', 'REQUEST_INSTALL_PACKAGES',
+    'READ_EXTERNAL_STORAGE', 'WRITE_EXTERNAL_STORAGE', 'SYSTEM_ALERT_WINDOW',
+    'BIND_DEVICE_ADMIN', 'RECEIVE_BOOT_COMPLETED', 'WAKE_LOCK', 'VIBRATE',
+    'ACCESS_WIFI_STATE', 'ACCESS_NETWORK_STATE', 'BLUETOOTH', 'NFC'
+]
+
+URL_HOSTS = [
+    'api.example.com', 'cdn.example.net', 'tracker.adnet.io', 'update.example.org',
+    'c2.badhost.xyz', 'graph.social.com', 'telemetry.vendor.cn', '203.0.113.7'
+]
+
+_TYPE_STRING = 0x03
+_TYPE_INT_DEC = 0x10
+_NO_ENTRY = 0xFFFFFFFF
+
+
+class _AXMLWriter:
+    """Minimal Android binary XML encoder (UTF-16 string pool)"""
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+        self.chunks = []
+
+    def ref(self, value: Optional[str]) -> int:
+        if value is None:
+            return _NO_ENTRY
+        if value not in self.index:
+            self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return self.index[value]
+
+    def start_namespace(self, prefix: str, uri: str):
+        self.chunks.append(struct.pack('<HHIIIII', 0x0100, 16, 24, 1, _NO_ENTRY,
+                                       self.ref(prefix), self.ref(uri)))
+
+    def end_namespace(self, prefix: str, uri: str):
+        self.chunks.append(struct.pack('<HHIIIII', 0x0101, 16, 24, 1, _NO_ENTRY,
+                                       self.ref(prefix), self.ref(uri)))
+
+    def start_element(self, name: str, attributes: List[tuple]):
+        """attributes: (name, value, android_ns) tuples; int values are typed"""
+        body = b''
+        for attr_name, value, namespaced in attributes:
+            ns = self.ref(ANDROID_NS) if namespaced else _NO_ENTRY
+            if isinstance(value, int):
+                raw, data_type, data = _NO_ENTRY, _TYPE_INT_DEC, value
+            else:
+                raw = data = self.ref(value)
+                data_type = _TYPE_STRING
+            body += struct.pack('<IIIHBBI', ns, self.ref(attr_name), raw, 8, 0, data_type, data)
+        header = struct.pack('<HHIII', 0x0102, 16, 36 + len(body), 1, _NO_ENTRY)
+        ext = struct.pack('<IIHHHHHH', _NO_ENTRY, self.ref(name), 0x14, 0x14,
+                          len(attributes), 0, 0, 0)
+        self.chunks.append(header + ext + body)
+
+    def end_element(self, name: str):
+        self.chunks.append(struct.pack('<HHIIIII', 0x0103, 16, 24, 1, _NO_ENTRY,
+                                       _NO_ENTRY, self.ref(name)))
+
+    def to_bytes(self) -> bytes:
+        # Attribute names with framework ids go first so the resource map lines up
+        string_pool = self._string_pool()
+        res_ids = [ATTRIBUTE_IDS.get(s, 0) for s in self.strings]
+        while res_ids and res_ids[-1] == 0:
+            res_ids.pop()
+        res_map = struct.pack('<HHI', 0x0180, 8, 8 + 4 * len(res_ids))
+        res_map += b''.join(struct.pack('<I', r) for r in res_ids)
+        body = string_pool + res_map + b''.join(self.chunks)
+        return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+    def _string_pool(self) -> bytes:
+        offsets = []
+        data = b''
+        for value in self.strings:
+            offsets.append(len(data))
+            encoded = value.encode('utf-16-le')
+            data += struct.pack('<H', len(value)) + encoded + b'\x00\x00'
+        data += b'\x00' * (-len(data) % 4)
+        strings_start = 28 + 4 * len(self.strings)
+        header = struct.pack('<HHIIIIII', 0x0001, 28, strings_start + len(data),
+                             len(self.strings), 0, 0, strings_start, 0)
+        return header + b''.join(struct.pack('<I', o) for o in offsets) + data
+
+
+def build_manifest(package_name: str, permissions: List[str], activities: int = 3,
+                   services: int = 1, receivers: int = 1, boot_receiver: bool = False) -> bytes:
+    """Encode an AndroidManifest.xml in binary XML"""
+    writer = _AXMLWriter()
+    # Reserve low string indexes for framework attributes (resource map order)
+    for attr in ATTRIBUTE_IDS:
+        writer.ref(attr)
+
+    writer.start_namespace('android', ANDROID_NS)
+    writer.start_element('manifest', [
+        ('versionCode', 1, True),
+        ('versionName', '1.0', True),
+        ('package', package_name, False),
+    ])
+    writer.start_element('uses-sdk', [('minSdkVersion', 21, True), ('targetSdkVersion', 33, True)])
+    writer.end_element('uses-sdk')
+    for perm in permissions:
+        writer.start_element('uses-permission', [('name', f'android.permission.{perm}', True)])
+        writer.end_element('uses-permission')
+
+    writer.start_element('application', [('label', 'Synthetic App', True)])
+    components = (
+        [('activity', f'{package_name}.ui.Activity{i}') for i in range(activities)]
+        + [('service', f'{package_name}.svc.Service{i}') for i in range(services)]
+        + [('receiver', f'{package_name}.rx.Receiver{i}') for i in range(receivers)]
+    )
+    if boot_receiver:
+        components.append(('receiver', f'{package_name}.rx.BootReceiver'))
+    for tag, name in components:
+        writer.start_element(tag, [('name', name, True)])
+        writer.end_element(tag)
+    writer.end_element('application')
+    writer.end_element('manifest')
+    writer.end_namespace('android', ANDROID_NS)
+    return writer.to_bytes()
+
+
+def build_dex(rng: random.Random, size: int, strings: List[str]) -> bytes:
+    """DEX-shaped blob: header magic, a string data section, random filler"""
+    header = b'dex\n035\x00' + bytes(104)
+    string_data = b''.join(
+        struct.pack('B', min(len(s), 127)) + s.encode('utf-8') + b'\x00' for s in strings
+    )
+    filler = max(size - len(header) - len(string_data), 0)
+    return header + string_data + rng.randbytes(filler)
+
+
+def generate_certificate(common_name: str, organization: str, days: int = 9125):
+    """
+    Generate a self-signed RSA certificate and key (a new key and serial on every call)
+    Returns None when the cryptography package is unavailable
+    """
+    try:
+        import datetime
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        return None
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, organization),
+    ])
+    now = datetime.datetime(2024, 1, 1)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=days))
+            .sign(key, hashes.SHA256()))
+    return cert, key
+
+
+def _sign_v1(entries: Dict[str, bytes], signer) -> Dict[str, bytes]:
+    """Build META-INF MANIFEST.MF / CERT.SF / CERT.RSA for a v1 (JAR) signature"""
+    import base64
+    import hashlib
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+
+    manifest = 'Manifest-Version: 1.0\r\nCreated-By: synthetic-apk\r\n\r\n'
+    for name, data in entries.items():
+        digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        manifest += f'Name: {name}\r\nSHA-256-Digest: {digest}\r\n\r\n'
+    manifest_bytes = manifest.encode()
+    sf = ('Signature-Version: 1.0\r\nCreated-By: synthetic-apk\r\n'
+          f'SHA-256-Digest-Manifest: {base64.b64encode(hashlib.sha256(manifest_bytes).digest()).decode()}'
+          '\r\n\r\n').encode()
+
+    cert, key = signer
+    signature = (pkcs7.PKCS7SignatureBuilder()
+                 .set_data(sf)
+                 .add_signer(cert, key, hashes.SHA256())
+                 .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature]))
+    return {
+        'META-INF/MANIFEST.MF': manifest_bytes,
+        'META-INF/CERT.SF': sf,
+        'META-INF/CERT.RSA': signature,
+    }
+
+
+def generate_apk(path: str, seed: int = 0, package_name: Optional[str] = None,
+                 size_bytes: int = 2 * 1024 * 1024, n_entries: int = 50, n_dex: int = 1,
+                 permissions: Optional[List[str]] = None, n_permissions: int = 8,
+                 n_urls: int = 10, signer=None) -> Dict[str, Any]:
+    """
+    Write one synthetic APK and return its description
+    size_bytes is approximate: DEX files take half, filler entries the rest
+    """
+    rng = random.Random(seed)
+    package_name = package_name or f'com.synthetic.app{seed}'
+    if permissions is None:
+        permissions = rng.sample(PERMISSION_POOL, min(n_permissions, len(PERMISSION_POOL)))
+
+    urls = [f'https://{rng.choice(URL_HOSTS)}/v{rng.randint(1, 3)}/{rng.getrandbits(32):08x}'
+            for _ in range(n_urls)]
+    dex_strings = urls + ['Ldalvik/system/DexClassLoader;', 'Ljava/lang/reflect/Method;']
+
+    entries = {
+        'AndroidManifest.xml': build_manifest(
+            package_name, permissions,
+            activities=rng.randint(2, 20), services=rng.randint(0, 5),
+            receivers=rng.randint(0, 5), boot_receiver='RECEIVE_BOOT_COMPLETED' in permissions
+        ),
+        'res/xml/network_config.xml': ''.join(
+            f'<domain>{u}</domain>\n' for u in urls[:3]
+        ).encode(),
+        'resources.arsc': ''.join(urls[3:6]).encode('utf-16-le') + rng.randbytes(4096),
+    }
+
+    dex_budget = size_bytes // 2
+    for i in range(max(n_dex, 1)):
+        name = 'classes.dex' if i == 0 else f'classes{i + 1}.dex'
+        entries[name] = build_dex(rng, dex_budget // max(n_dex, 1), dex_strings)
+
+    filler_count = max(n_entries - len(entries), 0)
+    filler_budget = max(size_bytes - dex_budget, 0)
+    for i in range(filler_count):
+        folder = rng.choice(['res/drawable', 'res/layout', 'assets', 'lib/arm64-v8a'])
+        ext = '.so' if folder.startswith('lib') else ('.xml' if folder == 'res/layout' else '.bin')
+        entries[f'{folder}/file_{i}{ext}'] = rng.randbytes(filler_budget // max(filler_count, 1))
+
+    if signer is not None:
+        entries.update(_sign_v1(entries, signer))
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries.items():
+            # Random filler is incompressible - store it to keep generation fast
+            compress = zipfile.ZIP_DEFLATED if len(data) < 65536 else zipfile.ZIP_STORED
+            zf.writestr(name, data, compress_type=compress)
+
+    return {
+        'path': path,
+        'package_name': package_name,
+        'size_bytes': os.path.getsize(path),
+        'entries': len(entries),
+        'dex_files': max(n_dex, 1),
+        'permissions': permissions,
+        'signed': signer is not None,
+    }
+
+
+def generate_corpus(out_dir: str, n_apks: int = 20, seed: int = 42,
+                    size_bytes: int = 2 * 1024 * 1024, n_entries: int = 50, n_dex: int = 1,
+                    n_permissions: int = 8, n_certs: int = 3) -> List[Dict[str, Any]]:
+    """
+    Generate a corpus whose content is fixed by the seed (manifests, DEX, resources, sizes).
+    Signing certificates, their keys and serials, and so the signatures, are new on every run.
+    APKs share n_certs signing certificates, like many versions from few developers
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    signers = []
+    for i in range(n_certs):
+        signer = generate_certificate(f'Synthetic Developer {i}', f'Synthetic Org {i}')
+        if signer is None:
+            break
+        signers.append(signer)
+
+    corpus = []
+    for i in range(n_apks):
+        path = os.path.join(out_dir, f'synthetic_{i:04d}.apk')
+        corpus.append(generate_apk(
+            path, seed=seed + i, size_bytes=size_bytes, n_entries=n_entries, n_dex=n_dex,
+            n_permissions=n_permissions, signer=signers[i % len(signers)] if signers else None
+        ))
+
+    with open(os.path.join(out_dir, 'corpus.json'), 'w') as f:
+        json.dump({'seed': seed, 'apks': corpus}, f, indent=2)
+    return corpus
+
+
+def with_unique_comment(apk_bytes: bytes, tag: str) -> bytes:
+    """
+    Give an APK a distinct SHA-256 without touching its entries
+    Rewrites the (empty) ZIP end-of-central-directory comment
+    """
+    comment = tag.encode()[:65535]
+    return apk_bytes[:-2] + struct.pack('<H', len(comment)) + comment
@@ -16,6 +16,11 @@ const uploadForm = document.getElementById('uploadForm');
 
 let selectedFile = null;
 
+// Larger files use the resumable chunked upload protocol (/api/uploads)
+const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
+const maxUploadMB = Number(uploadForm.dataset.maxUploadMb) || 100;
+
 // Drag and drop handlers
 uploadArea.addEventListener('dragover', (e) => {
     e.preventDefault();
@@ -55,10 +60,9 @@ function handleFileSelect(file) {
         return;
     }
     
-    // Validate file size (100 MB max)
-    const maxSize = 100 * 1024 * 1024;
-    if (file.size > maxSize) {
-        alert('File size exceeds 100 MB limit');
+    // Validate file size
+    if (file.size > maxUploadMB * 1024 * 1024) {
+        alert(`File size exceeds ${maxUploadMB} MB limit`);
         return;
     }
     
@@ -97,72 +101,56 @@ uploadForm.addEventListener('submit', async (e) => {
     scanningStatus.style.display = 'block';
     scanResult.style.display = 'none';
     
-    // Simulate scanning progress
-    simulateScanProgress();
+    // Progress is driven by the server's stage events
+    setScanStage(0, 5, 'Uploading APK...');
     
     // Upload and scan file
     await uploadAndScan(selectedFile);
 });
 
-// Simulate scan progress animation
-function simulateScanProgress() {
-    const steps = ['step1', 'step2', 'step3', 'step4'];
-    const texts = [
-        'Extracting APK...',
-        'Analyzing permissions and components...',
-        'Running AI malware detection...',
-        'Checking VirusTotal database...'
-    ];
-    const progressFill = document.getElementById('progressFill');
-    const progressText = document.getElementById('progressText');
-    
-    let currentStep = 0;
-    
-    const interval = setInterval(() => {
-        if (currentStep < steps.length) {
-            // Update active step
-            steps.forEach((step, index) => {
-                const element = document.getElementById(step);
-                if (index <= currentStep) {
-                    element.classList.add('active');
-                } else {
-                    element.classList.remove('active');
-                }
-            });
-            
-            // Update progress bar
-            progressFill.style.width = `${(currentStep + 1) * 25}%`;
-            progressText.textContent = texts[currentStep];
-            
-            currentStep++;
-        } else {
-            clearInterval(interval);
-        }
-    }, 1500);
+// Stage events of a streamed scan: [step index, progress %, text]
+const SCAN_STAGES = {
+    uploaded: [0, 15, () => 'Upload received - computing file hash...'],
+    hashed: [0, 25, () => 'Checking previous scans...'],
+    queued: [1, 30, (data) => data.queued > 0
+        ? `Waiting for an analysis slot (${data.queued} scan${data.queued === 1 ? '' : 's'} queued)...`
+        : 'Starting analysis...'],
+    analysis_started: [1, 35, (data) => data.tier === 'full'
+        ? 'Analyzing permissions and components...'
+        : `Analyzing permissions and components (${data.tier} analysis under high load)...`],
+    manifest_parsed: [1, 50, (data) => `Parsed ${data.package_name}: ${data.permissions} permissions, `
+        + `${data.dangerous_permissions.length} dangerous`],
+    analyzed: [1, 65, (data) => `Static analysis done: ${data.suspicious_features.length} suspicious features`],
+    ml_scored: [2, 75, (data) => `AI detection: ${data.ml_prediction.is_malware ? 'malware' : 'no malware'} `
+        + `(${(data.ml_prediction.confidence * 100).toFixed(0)}% confidence) - checking VirusTotal...`],
+    vt_done: [3, 90, () => 'VirusTotal check done - saving results...'],
+    saved: [3, 100, () => 'Scan complete'],
+    cache_hit: [3, 100, () => 'This APK was scanned before - loading the stored result']
+};
+
+// Highlight steps up to stepIndex and move the progress bar
+function setScanStage(stepIndex, percent, text) {
+    ['step1', 'step2', 'step3', 'step4'].forEach((step, index) => {
+        document.getElementById(step).classList.toggle('active', index <= stepIndex);
+    });
+    document.getElementById('progressFill').style.width = `${percent}%`;
+    document.getElementById('progressText').textContent = text;
 }
 
-// Upload and scan file
+// Upload the file, then follow the scan's event stream until it completes
 async function uploadAndScan(file) {
-    const formData = new FormData();
-    formData.append('file', file);
-    
     try {
-        const response = await fetch('/api/scan', {
-            method: 'POST',
-            body: formData
-        });
+        const response = file.size > CHUNKED_UPLOAD_THRESHOLD
+            ? await uploadInChunks(file)
+            : await uploadInOneRequest(file);
         
+        const data = await response.json();
         if (!response.ok) {
-            throw new Error('Scan failed');
+            throw new Error(data.error || 'Scan failed');
         }
         
-        const data = await response.json();
-        
-        // Small delay for better UX
-        await new Promise(resolve => setTimeout(resolve, 1000));
-        
-        // Display results
-        displayResults(data.result, data.cached);
+        const result = await followScanEvents(data.events_url);
+        displayResults(result.result, result.cached);
         
     } catch (error) {
         console.error('Scan error:', error);
@@ -170,6 +158,96 @@ async function uploadAndScan(file) {
     }
 }
 
+function uploadInOneRequest(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+    
+    return fetch('/api/scan?stream=1', {
+        method: 'POST',
+        // Scans from the web page are scheduled ahead of bulk API ingestion
+        headers: { 'X-Scan-Priority': 'interactive' },
+        body: formData
+    });
+}
+
+// Resumable upload: a failed chunk is retried from the offset the server already has
+async function uploadInChunks(file) {
+    const created = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    const session = await created.json();
+    if (!created.ok) {
+        throw new Error(session.error || 'Upload failed');
+    }
+    
+    let received = session.received;
+    let failures = 0;
+    while (received < file.size) {
+        const end = Math.min(received + session.chunk_size, file.size);
+        try {
+            const response = await fetch(session.upload_url, {
+                method: 'PUT',
+                headers: { 'Content-Range': `bytes ${received}-${end - 1}/${file.size}` },
+                body: file.slice(received, end)
+            });
+            const data = await response.json();
+            // 409 means the server is at another offset: continue from there
+            if (!response.ok && response.status !== 409) {
+                throw new Error(data.error || 'Upload failed');
+            }
+            received = data.received;
+            failures = 0;
+        } catch (error) {
+            if (++failures > CHUNK_RETRIES) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+            // Part of the failed chunk may have been stored
+            received = await fetch(session.upload_url)
+                .then(r => r.ok ? r.json() : { received })
+                .then(data => data.received)
+                .catch(() => received);
+        }
+        setScanStage(0, Math.round(15 * received / file.size),
+            `Uploading APK... ${formatFileSize(received)} of ${formatFileSize(file.size)}`);
+    }
+    
+    return fetch(`${session.finalize_url}?stream=1`, {
+        method: 'POST',
+        headers: { 'X-Scan-Priority': 'interactive' }
+    });
+}
+
+// Resolves with the /api/scan response body carried by the 'complete' event
+function followScanEvents(eventsUrl) {
+    return new Promise((resolve, reject) => {
+        // Reconnects by itself (with Last-Event-ID) when the server ends a long stream
+        const source = new EventSource(eventsUrl);
+        
+        Object.entries(SCAN_STAGES).forEach(([event, [stepIndex, percent, text]]) => {
+            source.addEventListener(event, (e) => setScanStage(stepIndex, percent, text(JSON.parse(e.data))));
+        });
+        
+        source.addEventListener('complete', (e) => {
+            source.close();
+            resolve(JSON.parse(e.data));
+        });
+        
+        source.addEventListener('error', (e) => {
+            // Events sent by the server carry data; connection errors do not
+            if (e.data) {
+                source.close();
+                const data = JSON.parse(e.data);
+                reject(new Error(data.details || data.error || 'Scan failed'));
+            } else if (source.readyState === EventSource.CLOSED) {
+                reject(new Error('Lost connection to the server'));
+            }
+        });
+    });
+}
+
 // Display scan results
 function displayResults(result, cached) {
     scanningStatus.style.display = 'none';
@@ -189,6 +267,7 @@ function displayResults(result, cached) {
             <div>
                 <h2>Scan Results</h2>
                 ${cached ? '<p style="color: var(--text-muted)"><i class="fas fa-database"></i> Cached result</p>' : ''}
+                ${result.provisional ? `<p style="color: var(--warning-color)"><i class="fas fa-hourglass-half"></i> Provisional result (${result.analysis_tier} analysis under high load)</p>` : ''}
             </div>
             <div style="display: flex; gap: 2rem; align-items: center;">
                 <span class="verdict-badge verdict-${verdictClass}">
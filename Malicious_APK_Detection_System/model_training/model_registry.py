@@ -0,0 +1,188 @@
+"""
+Local Model Registry
+Versioned training artifacts plus an atomically switched "current" pointer
+
+Layout (read by server/analyzer/ml_predictor.py):
+    <root>/versions/<version>/model.apkm     model + scaler artifact (server/analyzer/model_artifact.py)
+    <root>/versions/<version>/student.apkm   optional distilled student (same artifact format)
+    <root>/versions/<version>/model.pkl      pickle fallback for models the artifact cannot express
+    <root>/versions/<version>/scaler.pkl
+    <root>/versions/<version>/metadata.json
+    <root>/CURRENT        version id served by MalwarePredictor
+    <root>/history.json   promotion and rollback log; replayed as a stack for rollback
+"""
+import json
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_FILE = 'model.apkm'
+STUDENT_FILE = 'student.apkm'
+MODEL_FILE = 'model.pkl'
+SCALER_FILE = 'scaler.pkl'
+METADATA_FILE = 'metadata.json'
+CURRENT_FILE = 'CURRENT'
+HISTORY_FILE = 'history.json'
+
+
+class ModelRegistry:
+    """Stores each training run as an immutable version directory"""
+
+    def __init__(self, root='models/registry'):
+        self.root = root
+        self.versions_dir = os.path.join(root, 'versions')
+
+    def register(self, write_artifacts: Callable[[str], None], metadata: Dict[str, Any],
+                 version: Optional[str] = None) -> str:
+        """
+        Create a new version
+        write_artifacts(directory) writes the model files; the directory only becomes
+        visible under versions/ once everything (including metadata.json) is written
+        """
+        os.makedirs(self.versions_dir, exist_ok=True)
+        version = version or self._new_version_id(metadata.get('model_type', 'model'))
+        final_dir = os.path.join(self.versions_dir, version)
+        if os.path.exists(final_dir):
+            raise ValueError(f"Version already exists: {version}")
+
+        staging_dir = tempfile.mkdtemp(prefix=f'.{version}.', dir=self.versions_dir)
+        try:
+            write_artifacts(staging_dir)
+            metadata = dict(metadata, version=version,
+                            created_at=metadata.get('created_at') or datetime.now().isoformat(),
+                            files=sorted(os.listdir(staging_dir)))
+            _write_json(os.path.join(staging_dir, METADATA_FILE), metadata)
+            os.replace(staging_dir, final_dir)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        logger.info(f"✓ Registered model version {version}")
+        return version
+
+    def list_versions(self) -> List[Dict[str, Any]]:
+        """Metadata of every registered version, oldest first"""
+        if not os.path.isdir(self.versions_dir):
+            return []
+        versions = []
+        for name in sorted(os.listdir(self.versions_dir)):
+            if name.startswith('.'):
+                continue
+            metadata = self.get_metadata(name)
+            if metadata is not None:
+                versions.append(metadata)
+        return versions
+
+    def get_metadata(self, version: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.versions_dir, version, METADATA_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def version_dir(self, version: str) -> str:
+        return os.path.join(self.versions_dir, version)
+
+    def current_version(self) -> Optional[str]:
+        path = os.path.join(self.root, CURRENT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read().strip() or None
+
+    def promote(self, version: str) -> str:
+        """Atomically point CURRENT at a registered version"""
+        if self.get_metadata(version) is None:
+            raise ValueError(f"Unknown model version: {version}")
+        return self._switch(version, 'promote')
+
+    def rollback(self) -> str:
+        """
+        Serve the version promoted before the current one; repeated rollbacks keep
+        going further back through the promotions instead of toggling between two
+        """
+        stack = self.promotion_stack()
+        if len(stack) < 2:
+            raise ValueError("No earlier promoted version to roll back to")
+        return self._switch(stack[-2], 'rollback')
+
+    def promotion_stack(self) -> List[str]:
+        """Served versions, oldest first: the history replayed with promotions pushed and rollbacks popped"""
+        stack = []
+        for entry in self.history():
+            if entry.get('action') == 'rollback':
+                if stack:
+                    stack.pop()
+                continue
+            if not stack and entry.get('previous'):
+                stack.append(entry['previous'])
+            if not stack or stack[-1] != entry['version']:
+                stack.append(entry['version'])
+        return stack
+
+    def _switch(self, version: str, action: str) -> str:
+        previous = self.current_version()
+        _write_text(os.path.join(self.root, CURRENT_FILE), version + '\n')
+
+        history = self.history()
+        history.append({'version': version, 'previous': previous, 'action': action,
+                        'promoted_at': datetime.now().isoformat()})
+        _write_json(os.path.join(self.root, HISTORY_FILE), history)
+
+        logger.info(f"✓ {'Promoted' if action == 'promote' else 'Rolled back to'} model version {version} "
+                    f"(previous: {previous})")
+        return version
+
+    def history(self) -> List[Dict[str, Any]]:
+        path = os.path.join(self.root, HISTORY_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def compare(self, version_a: str, version_b: str) -> Dict[str, Any]:
+        """Side-by-side metrics of two versions"""
+        meta_a = self.get_metadata(version_a)
+        meta_b = self.get_metadata(version_b)
+        if meta_a is None or meta_b is None:
+            raise ValueError(f"Unknown model version: {version_b if meta_a else version_a}")
+        metrics_a = meta_a.get('metrics') or {}
+        metrics_b = meta_b.get('metrics') or {}
+        comparison = {}
+        for name in sorted(set(metrics_a) | set(metrics_b)):
+            a, b = metrics_a.get(name), metrics_b.get(name)
+            delta = b - a if isinstance(a, (int, float)) and isinstance(b, (int, float)) else None
+            comparison[name] = {version_a: a, version_b: b, 'delta': delta}
+        return {
+            'metrics': comparison,
+            'same_dataset': (meta_a.get('dataset') or {}).get('fingerprint')
+                            == (meta_b.get('dataset') or {}).get('fingerprint'),
+            'same_feature_schema': meta_a.get('feature_schema') == meta_b.get('feature_schema')
+        }
+
+    @staticmethod
+    def _new_version_id(model_type: str) -> str:
+        # The random part keeps two runs started within the same second apart
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}-{model_type}"
+
+
+def _write_text(path: str, text: str):
+    """Write via a temporary file + rename so readers never see a partial file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_json(path: str, data: Any):
+    _write_text(path, json.dumps(data, indent=2, default=str))
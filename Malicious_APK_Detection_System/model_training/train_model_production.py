@@ -5,17 +5,34 @@ Supports: Drebin, CICAndMal2017, AndroZoo, and custom datasets
 import numpy as np
 import pandas as pd
 import pickle
+import argparse
+import hashlib
+import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import time
 from pathlib import Path
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
-from sklearn.model_selection import train_test_split, cross_val_score, GridSearchCV
+from sklearn.ensemble import (RandomForestClassifier, GradientBoostingClassifier,
+                              HistGradientBoostingClassifier)
+from sklearn.linear_model import SGDClassifier, LogisticRegression
+from sklearn.model_selection import (train_test_split, cross_val_score, GridSearchCV,
+                                     StratifiedKFold, ParameterSampler)
 from sklearn.metrics import (classification_report, confusion_matrix, 
                             accuracy_score, precision_score, recall_score, 
                             f1_score, roc_auc_score, roc_curve)
-from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import get_scorer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler, PolynomialFeatures
 import joblib
+from joblib import Parallel, delayed, effective_n_jobs
+from model_registry import ModelRegistry, ARTIFACT_FILE, STUDENT_FILE, MODEL_FILE, SCALER_FILE
+
+# The artifact format is shared with the server, which reads it at serving time
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'server'))
+from analyzer.model_artifact import save_artifact, load_artifact, ArtifactError
 
 # Create logs directory if it doesn't exist
 os.makedirs('logs', exist_ok=True)
@@ -31,6 +48,98 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Feature layout produced by APKAnalyzer._build_feature_vector
+PERMISSION_FEATURES = [
+    'INTERNET', 'SEND_SMS', 'RECEIVE_SMS', 'READ_SMS',
+    'READ_CONTACTS', 'WRITE_CONTACTS', 'ACCESS_FINE_LOCATION',
+    'ACCESS_COARSE_LOCATION', 'RECORD_AUDIO', 'CAMERA',
+    'READ_PHONE_STATE', 'CALL_PHONE', 'READ_CALL_LOG',
+    'WRITE_CALL_LOG', 'INSTALL_PACKAGES', 'DELETE_PACKAGES',
+    'READ_EXTERNAL_STORAGE', 'WRITE_EXTERNAL_STORAGE',
+    'SYSTEM_ALERT_WINDOW', 'REQUEST_INSTALL_PACKAGES',
+    'BIND_DEVICE_ADMIN', 'RECEIVE_BOOT_COMPLETED',
+    'WAKE_LOCK', 'DISABLE_KEYGUARD', 'GET_TASKS',
+    'BLUETOOTH', 'BLUETOOTH_ADMIN', 'NFC',
+    'VIBRATE', 'ACCESS_WIFI_STATE', 'CHANGE_WIFI_STATE',
+    'ACCESS_NETWORK_STATE', 'CHANGE_NETWORK_STATE',
+    'WRITE_SETTINGS', 'EXPAND_STATUS_BAR', 'FLASHLIGHT',
+    'KILL_BACKGROUND_PROCESSES', 'REBOOT', 'SET_WALLPAPER',
+    'USE_CREDENTIALS'
+]
+COMPONENT_FEATURES = ['activities', 'services', 'receivers', 'providers']
+SUSPICIOUS_FEATURES = [
+    'dynamic_code_loading', 'encryption', 'native_code',
+    'reflection', 'boot_receiver', 'sms_receiver'
+]
+FEATURE_NAMES = (
+    [f'perm_{p}' for p in PERMISSION_FEATURES]
+    + [f'count_{c}' for c in COMPONENT_FEATURES]
+    + [f'susp_{s}' for s in SUSPICIOUS_FEATURES]
+)
+N_FEATURES = len(FEATURE_NAMES)  # 50
+COMPONENT_FEATURE_IDX = np.arange(40, 44)
+BINARY_FEATURE_IDX = np.concatenate([np.arange(0, 40), np.arange(44, 50)])
+
+# Uniform ranges for the normalized component counts, per class
+COMPONENT_RANGES = {
+    'malicious': (np.array([0.3, 0.4, 0.5, 0.2]), np.array([1.0, 1.0, 1.0, 0.8])),
+    'benign': (np.array([0.1, 0.1, 0.1, 0.0]), np.array([0.5, 0.4, 0.3, 0.3])),
+}
+
+# Malware family templates: feature name -> probability, overriding the generic malware profile
+MALWARE_FAMILY_TEMPLATES = {
+    'generic': {},
+    'sms_trojan': {
+        'perm_SEND_SMS': 0.95, 'perm_RECEIVE_SMS': 0.9, 'perm_READ_SMS': 0.85,
+        'perm_READ_PHONE_STATE': 0.8, 'susp_sms_receiver': 0.9, 'susp_boot_receiver': 0.7,
+    },
+    'banking_trojan': {
+        'perm_SYSTEM_ALERT_WINDOW': 0.9, 'perm_BIND_DEVICE_ADMIN': 0.8,
+        'perm_READ_SMS': 0.7, 'perm_RECEIVE_SMS': 0.7, 'perm_INTERNET': 0.99,
+        'susp_dynamic_code_loading': 0.8, 'susp_reflection': 0.8,
+    },
+    'spyware': {
+        'perm_READ_CONTACTS': 0.9, 'perm_ACCESS_FINE_LOCATION': 0.85, 'perm_RECORD_AUDIO': 0.8,
+        'perm_READ_CALL_LOG': 0.7, 'perm_CAMERA': 0.6, 'perm_INTERNET': 0.99,
+        'susp_boot_receiver': 0.8,
+    },
+    'ransomware': {
+        'perm_BIND_DEVICE_ADMIN': 0.9, 'perm_SYSTEM_ALERT_WINDOW': 0.8,
+        'perm_WRITE_EXTERNAL_STORAGE': 0.9, 'perm_DISABLE_KEYGUARD': 0.6,
+        'susp_encryption': 0.95,
+    },
+    'adware': {
+        'perm_INTERNET': 0.99, 'perm_ACCESS_NETWORK_STATE': 0.95, 'perm_SYSTEM_ALERT_WINDOW': 0.6,
+        'perm_SEND_SMS': 0.05, 'perm_READ_CONTACTS': 0.05, 'susp_native_code': 0.3,
+    },
+    'dropper': {
+        'perm_REQUEST_INSTALL_PACKAGES': 0.9, 'perm_INSTALL_PACKAGES': 0.6, 'perm_INTERNET': 0.99,
+        'susp_dynamic_code_loading': 0.95, 'susp_native_code': 0.7, 'susp_encryption': 0.7,
+    },
+}
+
+
+def _base_binary_probs(malicious):
+    """Generic per-feature probabilities for the binary columns (permissions + suspicious flags)"""
+    perm_idx = np.arange(40)
+    if malicious:
+        perms = np.where(perm_idx < 20, 0.6, 0.3)
+        susp = np.full(6, 0.7)
+    else:
+        perms = np.where(perm_idx < 20, 0.2, 0.1)
+        susp = np.full(6, 0.1)
+    return np.concatenate([perms, susp])
+
+
+def _family_binary_probs(family):
+    """Generic malware profile with a family template applied"""
+    probs = _base_binary_probs(malicious=True)
+    binary_names = [FEATURE_NAMES[i] for i in BINARY_FEATURE_IDX]
+    for name, prob in MALWARE_FAMILY_TEMPLATES[family].items():
+        probs[binary_names.index(name)] = prob
+    return probs
+
+
 class DatasetLoader:
     """Load various malware datasets"""
     
@@ -134,67 +243,551 @@ class DatasetLoader:
             return None, None
     
     @staticmethod
-    def generate_synthetic_data(n_samples=5000):
-        """Generate synthetic data (fallback for testing)"""
+    def load_out_of_core(source, dataset_type='custom', label_column='label',
+                         cache_dir='datasets/cache', chunksize=200000, refresh=False):
+        """
+        Load a large dataset as memory-mapped arrays
+        CSV/Parquet input is parsed once in typed chunks and cached as raw
+        float32 (X) / int8 (y) files; later runs open the cache directly.
+        Args:
+            source: CSV or Parquet file, or CICAndMal2017 directory (benign/, malware/)
+            dataset_type: 'drebin', 'cicandmal2017' or 'custom'
+            label_column: Label column for 'custom' datasets
+            cache_dir: Where binary caches are kept (one sub-directory per dataset fingerprint)
+            refresh: Rebuild the cache even if it is up to date
+        """
+        logger.info(f"Loading {dataset_type} dataset out-of-core from {source}")
+        try:
+            inputs = DatasetLoader._resolve_inputs(source, dataset_type, label_column)
+            if not inputs:
+                logger.error(f"No input files found for {source}")
+                return None, None
+            
+            fingerprint = DatasetLoader.dataset_fingerprint(
+                [path for path, _, _ in inputs],
+                extra=[dataset_type, label_column]
+            )
+            cache_path = os.path.join(cache_dir, fingerprint[:16])
+            
+            if not refresh:
+                X, y = DatasetLoader.open_cache(cache_path, fingerprint)
+                if X is not None:
+                    logger.info(f"✓ Using cached dataset {cache_path} ({len(y)} samples)")
+                    return X, y
+            
+            X, y = DatasetLoader._build_cache(inputs, cache_path, fingerprint, chunksize)
+            logger.info(f"Loaded {len(X)} samples with {X.shape[1]} features")
+            logger.info(f"Malware samples: {int(y.sum())} ({y.mean()*100:.1f}%)")
+            return X, y
+            
+        except Exception as e:
+            logger.error(f"Failed to load dataset out-of-core: {e}")
+            return None, None
+    
+    @staticmethod
+    def dataset_fingerprint(paths, extra=()):
+        """SHA-256 over input paths, sizes and modification times"""
+        digest = hashlib.sha256()
+        for path in sorted(paths):
+            stat = os.stat(path)
+            digest.update(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+        for item in extra:
+            digest.update(f"{item}\n".encode())
+        return digest.hexdigest()
+    
+    @staticmethod
+    def open_cache(cache_path, fingerprint=None):
+        """Open a binary dataset cache, returns (None, None) if missing or stale"""
+        meta_path = os.path.join(cache_path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None, None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if fingerprint is not None and meta.get('fingerprint') != fingerprint:
+            return None, None
+        shape = (meta['n_rows'], meta['n_features'])
+        X = np.memmap(os.path.join(cache_path, 'X.bin'), dtype=np.float32, mode='r', shape=shape)
+        y = np.memmap(os.path.join(cache_path, 'y.bin'), dtype=np.int8, mode='r', shape=(shape[0],))
+        return X, y
+    
+    @staticmethod
+    def _resolve_inputs(source, dataset_type, label_column):
+        """List of (path, label column or None, fixed label or None)"""
+        if dataset_type == 'cicandmal2017':
+            inputs = []
+            for sub, label in (('benign', 0), ('malware', 1)):
+                for pattern in ('*.csv', '*.parquet'):
+                    inputs += [(str(p), None, label) for p in sorted(Path(source).glob(f'{sub}/{pattern}'))]
+            return inputs
+        
+        if dataset_type == 'drebin':
+            columns = DatasetLoader._read_columns(source)
+            if 'malware' in columns:
+                label_column = 'malware'
+            elif 'class' in columns:
+                label_column = 'class'
+            else:
+                raise ValueError("No label column found. Expected 'malware' or 'class'")
+        return [(source, label_column, None)]
+    
+    @staticmethod
+    def _read_columns(path):
+        if str(path).endswith('.parquet'):
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(path).schema_arrow.names
+        return list(pd.read_csv(path, nrows=0).columns)
+    
+    @staticmethod
+    def _numeric_columns(path, exclude):
+        """Columns that parse as numbers (sampled from the head of the file)"""
+        if str(path).endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pq.ParquetFile(path).schema_arrow
+            return [f.name for f in schema if f.name != exclude and
+                    (pa.types.is_integer(f.type) or pa.types.is_floating(f.type) or pa.types.is_boolean(f.type))]
+        
+        sample = pd.read_csv(path, nrows=1000)
+        numeric = []
+        for column in sample.columns:
+            if column == exclude:
+                continue
+            if pd.api.types.is_numeric_dtype(sample[column]) or pd.api.types.is_bool_dtype(sample[column]):
+                numeric.append(column)
+            else:
+                logger.warning(f"Skipping non-numeric column '{column}' in {path}")
+        return numeric
+    
+    @staticmethod
+    def _iter_frames(path, columns, chunksize):
+        """Yield typed DataFrame chunks (features float32, label as read)"""
+        if str(path).endswith('.parquet'):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, usecols=columns, chunksize=chunksize,
+                                   dtype={c: np.float32 for c in columns})
+    
+    @staticmethod
+    def _build_cache(inputs, cache_path, fingerprint, chunksize):
+        """Stream all inputs into X.bin / y.bin and return memory maps over them"""
+        tmp_path = cache_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        
+        feature_columns = None
+        n_rows = 0
+        with open(os.path.join(tmp_path, 'X.bin'), 'wb') as fx, \
+                open(os.path.join(tmp_path, 'y.bin'), 'wb') as fy:
+            for path, label_column, fixed_label in inputs:
+                # The first file defines the features; later files are read by their own header
+                columns = DatasetLoader._numeric_columns(path, exclude=label_column)
+                if feature_columns is None:
+                    feature_columns = columns
+                present = set(columns)
+                missing = [c for c in feature_columns if c not in present]
+                if missing:
+                    logger.warning(f"{path} lacks {len(missing)} feature column(s), filled with 0: "
+                                   f"{', '.join(missing[:5])}{' ...' if len(missing) > 5 else ''}")
+                read_columns = ([c for c in feature_columns if c in present] +
+                                ([label_column] if label_column else []))
+                
+                for chunk in DatasetLoader._iter_frames(path, read_columns, chunksize):
+                    if label_column:
+                        labels = chunk.pop(label_column).to_numpy()
+                    else:
+                        labels = np.full(len(chunk), fixed_label)
+                    X_chunk = chunk.reindex(columns=feature_columns).to_numpy(dtype=np.float32)
+                    X_chunk = np.nan_to_num(X_chunk, nan=0.0, posinf=0.0, neginf=0.0)
+                    fx.write(np.ascontiguousarray(X_chunk).tobytes())
+                    fy.write(labels.astype(np.int8).tobytes())
+                    n_rows += len(chunk)
+                logger.info(f"  Ingested {path} ({n_rows} rows so far)")
+        
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'fingerprint': fingerprint,
+                'n_rows': n_rows,
+                'n_features': len(feature_columns),
+                'feature_columns': feature_columns,
+                'sources': [path for path, _, _ in inputs],
+                'created': pd.Timestamp.now().isoformat()
+            }, f, indent=2)
+        
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"✓ Dataset cached at {cache_path}")
+        return DatasetLoader.open_cache(cache_path, fingerprint)
+    
+    @staticmethod
+    def generate_synthetic_data(n_samples=5000, malware_ratio=0.4, correlation=0.0,
+                                family_weights=None, chunk_size=100000, output_dir=None,
+                                seed=42, dtype=np.float32):
+        """
+        Generate synthetic data (fallback for testing)
+        Vectorized with numpy.random.Generator, produced chunk by chunk.
+        Args:
+            n_samples: Number of rows
+            malware_ratio: Fraction of malicious samples (class balance)
+            correlation: 0..1, how strongly binary features of one sample move together
+            family_weights: {family: weight} over MALWARE_FAMILY_TEMPLATES (default: all equal)
+            chunk_size: Rows generated per chunk
+            output_dir: If set, stream chunks into X.npy / y.npy there and return memory-mapped arrays
+            seed: Random seed (same seed -> same data)
+        """
         logger.info(f"Generating {n_samples} synthetic samples...")
         
-        np.random.seed(42)
-        features = []
-        labels = []
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            X = np.lib.format.open_memmap(os.path.join(output_dir, 'X.npy'), mode='w+',
+                                          dtype=dtype, shape=(n_samples, N_FEATURES))
+            y = np.lib.format.open_memmap(os.path.join(output_dir, 'y.npy'), mode='w+',
+                                          dtype=np.int8, shape=(n_samples,))
+        else:
+            X = np.empty((n_samples, N_FEATURES), dtype=dtype)
+            y = np.empty(n_samples, dtype=np.int8)
         
-        for i in range(n_samples):
-            is_malicious = np.random.random() < 0.4
-            feature_vector = []
+        offset = 0
+        for X_chunk, y_chunk in DatasetLoader.iter_synthetic_chunks(
+                n_samples, chunk_size=chunk_size, malware_ratio=malware_ratio,
+                correlation=correlation, family_weights=family_weights, seed=seed, dtype=dtype):
+            X[offset:offset + len(y_chunk)] = X_chunk
+            y[offset:offset + len(y_chunk)] = y_chunk
+            offset += len(y_chunk)
+        
+        if output_dir:
+            X.flush()
+            y.flush()
+            logger.info(f"Synthetic data written to {output_dir}")
+        
+        return X, y
+    
+    @staticmethod
+    def iter_synthetic_chunks(n_samples, chunk_size=100000, malware_ratio=0.4, correlation=0.0,
+                              family_weights=None, seed=42, dtype=np.float32):
+        """Yield (X_chunk, y_chunk) pairs of synthetic data"""
+        rng = np.random.default_rng(seed)
+        
+        families = list(family_weights or MALWARE_FAMILY_TEMPLATES)
+        weights = np.array([(family_weights or {}).get(f, 1.0) for f in families], dtype=float)
+        weights /= weights.sum()
+        
+        # Per-class / per-family probabilities for the binary feature columns
+        benign_probs = _base_binary_probs(malicious=False)
+        family_probs = np.stack([_family_binary_probs(f) for f in families])
+        
+        for start in range(0, n_samples, chunk_size):
+            n = min(chunk_size, n_samples - start)
+            is_malicious = rng.random(n) < malware_ratio
+            family_idx = rng.choice(len(families), size=n, p=weights)
             
-            # Permission features (40 features)
-            for j in range(40):
-                if is_malicious:
-                    prob = 0.6 if j < 20 else 0.3
-                else:
-                    prob = 0.2 if j < 20 else 0.1
-                feature_vector.append(1 if np.random.random() < prob else 0)
+            probs = np.where(is_malicious[:, None], family_probs[family_idx], benign_probs[None, :])
+            
+            # Correlated uniforms: with probability `correlation` a feature reuses
+            # the sample's shared draw instead of an independent one
+            uniforms = rng.random((n, len(BINARY_FEATURE_IDX)))
+            if correlation > 0:
+                shared = rng.random((n, 1))
+                use_shared = rng.random((n, len(BINARY_FEATURE_IDX))) < correlation
+                uniforms = np.where(use_shared, shared, uniforms)
+            
+            X_chunk = np.empty((n, N_FEATURES), dtype=dtype)
+            X_chunk[:, BINARY_FEATURE_IDX] = uniforms < probs
             
             # Component counts (4 features)
-            if is_malicious:
-                feature_vector.extend([
-                    np.random.uniform(0.3, 1.0),
-                    np.random.uniform(0.4, 1.0),
-                    np.random.uniform(0.5, 1.0),
-                    np.random.uniform(0.2, 0.8)
-                ])
-            else:
-                feature_vector.extend([
-                    np.random.uniform(0.1, 0.5),
-                    np.random.uniform(0.1, 0.4),
-                    np.random.uniform(0.1, 0.3),
-                    np.random.uniform(0.0, 0.3)
-                ])
+            low = np.where(is_malicious[:, None], COMPONENT_RANGES['malicious'][0], COMPONENT_RANGES['benign'][0])
+            high = np.where(is_malicious[:, None], COMPONENT_RANGES['malicious'][1], COMPONENT_RANGES['benign'][1])
+            X_chunk[:, COMPONENT_FEATURE_IDX] = low + (high - low) * rng.random((n, len(COMPONENT_FEATURE_IDX)))
             
-            # Suspicious features (6 features)
-            for j in range(6):
-                prob = 0.7 if is_malicious else 0.1
-                feature_vector.append(1 if np.random.random() < prob else 0)
+            yield X_chunk, is_malicious.astype(np.int8)
+
+
+class SuccessiveHalvingSearch:
+    """
+    Budgeted hyperparameter search with successive halving
+    Candidates are sampled from a parameter space and evaluated on shared,
+    precomputed stratified folds. Each rung keeps the best 1/factor candidates
+    and gives them factor x more training samples. Fold scores are checkpointed
+    after every batch of fits so an interrupted run resumes where it stopped; the
+    checkpoint is tied to the data and the search space, and removed once the
+    search returns. The time budget is checked before every batch of fits.
+    """
+    
+    def __init__(self, model_factory, param_space, n_candidates=24, factor=3, cv=3,
+                 min_resources=None, scoring='f1', time_budget=None, n_jobs=-1,
+                 checkpoint_path=None, random_state=42):
+        self.model_factory = model_factory
+        self.param_space = param_space
+        self.n_candidates = n_candidates
+        self.factor = factor
+        self.cv = cv
+        self.min_resources = min_resources
+        self.scoring = scoring
+        self.time_budget = time_budget
+        self.n_jobs = n_jobs
+        self.checkpoint_path = checkpoint_path
+        self.random_state = random_state
+        self.report = None
+        self.best_params_ = None
+        self.best_score_ = None
+    
+    def fit(self, X, y):
+        """Run the search; returns best parameters (refitting is left to the caller)"""
+        start = time.monotonic()
+        rng = np.random.default_rng(self.random_state)
+        y = np.asarray(y)
+        
+        # Shared folds: one fold id per sample, and a fixed stratified sample order
+        # so that each rung's subset contains the previous one
+        fold_of = np.empty(len(y), dtype=np.int8)
+        skf = StratifiedKFold(n_splits=self.cv, shuffle=True, random_state=self.random_state)
+        for k, (_, test_idx) in enumerate(skf.split(np.zeros(len(y)), y)):
+            fold_of[test_idx] = k
+        order = self._stratified_order(y, rng)
+        
+        candidates = [dict(p) for p in ParameterSampler(
+            self.param_space, n_iter=self._n_candidates(), random_state=self.random_state
+        )]
+        fingerprint = self._search_fingerprint(X, y)
+        scores = self._load_checkpoint(candidates, fingerprint)
+        
+        n_rungs = max(int(np.floor(np.log(len(candidates)) / np.log(self.factor))), 0) + 1
+        min_resources = self.min_resources or max(len(y) // (self.factor ** (n_rungs - 1)), 50 * self.cv)
+        alive = list(range(len(candidates)))
+        rungs = []
+        
+        for rung in range(n_rungs):
+            resources = min(int(min_resources * self.factor ** rung), len(y))
+            if rung == n_rungs - 1:
+                resources = len(y)
+            if self._budget_exhausted(start) and rungs:
+                logger.warning(f"Search budget exhausted before rung {rung}")
+                break
+            
+            subset = np.sort(order[:resources])
+            pending = [(c, k) for c in alive for k in range(self.cv)
+                       if self._score_key(c, resources, k) not in scores]
+            logger.info(f"Rung {rung}: {len(alive)} candidates x {resources} samples "
+                        f"({len(pending)} fits, {len(alive) * self.cv - len(pending)} from checkpoint)")
+            
+            # One batch of fits per round of workers; candidates are in rank order, so a rung
+            # cut short by the budget has scored the most promising ones
+            batch_size = max(effective_n_jobs(self.n_jobs), 1)
+            stopped = False
+            for first in range(0, len(pending), batch_size):
+                if self._budget_exhausted(start) and (rungs or self._scored(scores, alive, resources)):
+                    stopped = True
+                    break
+                batch = pending[first:first + batch_size]
+                results = Parallel(n_jobs=self.n_jobs)(
+                    delayed(_fit_and_score)(self.model_factory, candidates[c], X, y, subset,
+                                            fold_of, k, self.scoring)
+                    for c, k in batch
+                )
+                for (c, k), score in zip(batch, results):
+                    scores[self._score_key(c, resources, k)] = score
+                self._save_checkpoint(candidates, scores, fingerprint)
+            
+            evaluated = self._scored(scores, alive, resources)
+            if stopped:
+                logger.warning(f"Search budget exhausted during rung {rung} "
+                               f"({len(evaluated)} of {len(alive)} candidates scored)")
+                if not evaluated:
+                    break
+            mean_scores = {c: float(np.mean([scores[self._score_key(c, resources, k)]
+                                             for k in range(self.cv)])) for c in evaluated}
+            rungs.append({
+                'rung': rung,
+                'resources': resources,
+                'candidates': [{'params': candidates[c], 'mean_score': mean_scores[c]}
+                               for c in sorted(evaluated, key=lambda c: -mean_scores[c])],
+                'partial': stopped,
+                'elapsed_seconds': round(time.monotonic() - start, 2)
+            })
+            if stopped:
+                break
             
-            features.append(feature_vector)
-            labels.append(1 if is_malicious else 0)
+            keep = max(int(np.ceil(len(alive) / self.factor)), 1)
+            alive = sorted(alive, key=lambda c: -mean_scores[c])[:keep]
+            if len(alive) == 1 and resources == len(y):
+                break
         
-        return np.array(features), np.array(labels)
+        best_rung = rungs[-1]
+        best = best_rung['candidates'][0]
+        self.best_params_ = best['params']
+        self.best_score_ = best['mean_score']
+        self.report = {
+            'method': 'successive_halving' if n_rungs > 1 else 'random_search',
+            'scoring': self.scoring,
+            'cv': self.cv,
+            'factor': self.factor,
+            'n_candidates': len(candidates),
+            'time_budget_seconds': self.time_budget,
+            'elapsed_seconds': round(time.monotonic() - start, 2),
+            'best_params': self.best_params_,
+            'best_score': self.best_score_,
+            'best_score_resources': best_rung['resources'],
+            'rungs': rungs
+        }
+        self._remove_checkpoint()
+        return self.best_params_
+    
+    def _n_candidates(self):
+        # Finite grids cannot yield more candidates than they contain
+        sizes = [len(v) for v in self.param_space.values() if hasattr(v, '__len__')]
+        if len(sizes) == len(self.param_space):
+            return min(self.n_candidates, int(np.prod(sizes)))
+        return self.n_candidates
+    
+    @staticmethod
+    def _stratified_order(y, rng):
+        """Interleave shuffled class members so every prefix keeps the class balance"""
+        keys = np.empty(len(y))
+        for label in np.unique(y):
+            idx = np.flatnonzero(y == label)
+            keys[idx] = (rng.permutation(len(idx)) + rng.random(len(idx))) / len(idx)
+        return np.argsort(keys, kind='stable')
+    
+    def _budget_exhausted(self, start):
+        return self.time_budget is not None and time.monotonic() - start >= self.time_budget
+    
+    @staticmethod
+    def _score_key(candidate, resources, fold):
+        return f"{candidate}|{resources}|{fold}"
+    
+    def _scored(self, scores, candidates, resources):
+        """Candidates with a score for every fold at this resource level"""
+        return [c for c in candidates
+                if all(self._score_key(c, resources, k) in scores for k in range(self.cv))]
+    
+    def _search_fingerprint(self, X, y, sample_rows=1024):
+        """
+        SHA-256 over the data (shape, all labels, an evenly spaced sample of rows) and
+        the search settings, so that a checkpoint is only reused by the same search
+        """
+        digest = hashlib.sha256()
+        X = np.asarray(X)
+        digest.update(f"{X.shape}|{X.dtype}|{self.scoring}|{self.cv}|{self.factor}|"
+                      f"{self.min_resources}|{self.random_state}\n".encode())
+        # Grids by value; distributions by name and arguments (their repr has a memory address)
+        space = {name: list(values) if hasattr(values, '__len__') else
+                 [getattr(getattr(values, 'dist', None), 'name', type(values).__name__),
+                  list(getattr(values, 'args', ()))]
+                 for name, values in self.param_space.items()}
+        digest.update(json.dumps(space, sort_keys=True, default=str).encode())
+        digest.update(np.ascontiguousarray(y).tobytes())
+        rows = np.unique(np.linspace(0, len(X) - 1, num=min(sample_rows, len(X)), dtype=np.int64))
+        digest.update(np.ascontiguousarray(X[rows]).tobytes())
+        return digest.hexdigest()
+    
+    def _load_checkpoint(self, candidates, fingerprint):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if (checkpoint.get('fingerprint') != fingerprint
+                or checkpoint.get('candidates') != json.loads(json.dumps(candidates))):
+            logger.warning("Checkpoint does not match this data and search - starting fresh")
+            return {}
+        logger.info(f"Resuming search from {self.checkpoint_path} ({len(checkpoint['scores'])} fold scores)")
+        return checkpoint['scores']
+    
+    def _save_checkpoint(self, candidates, scores, fingerprint):
+        if not self.checkpoint_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'candidates': candidates, 'scores': scores}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+    
+    def _remove_checkpoint(self):
+        """A finished search leaves no checkpoint behind for a later run to pick up"""
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def _fit_and_score(model_factory, params, X, y, subset, fold_of, fold, scoring):
+    """Fit one candidate on one fold of the rung subset and return its score"""
+    train_idx = subset[fold_of[subset] != fold]
+    test_idx = subset[fold_of[subset] == fold]
+    model = model_factory(params)
+    model.fit(X[train_idx], y[train_idx])
+    return float(get_scorer(scoring)(model, X[test_idx], y[test_idx]))
 
 
 class ProductionModelTrainer:
     """Train production-grade malware detection model"""
     
-    def __init__(self, model_type='random_forest'):
+    # Search spaces for hyperparameter tuning
+    PARAM_SPACES = {
+        'random_forest': {
+            'n_estimators': [100, 200, 300],
+            'max_depth': [20, 30, 40, None],
+            'min_samples_split': [2, 5, 10],
+            'min_samples_leaf': [1, 2, 4],
+            'max_features': ['sqrt', 'log2']
+        },
+        'gradient_boosting': {
+            'n_estimators': [100, 200],
+            'max_depth': [5, 10, 15],
+            'learning_rate': [0.01, 0.1, 0.2]
+        },
+        'hist_gradient_boosting': {
+            'learning_rate': [0.03, 0.1, 0.2],
+            'max_leaf_nodes': [15, 31, 63],
+            'min_samples_leaf': [10, 20, 50],
+            'l2_regularization': [0.0, 0.1, 1.0]
+        },
+        'sgd': {
+            'alpha': [1e-6, 1e-5, 1e-4, 1e-3],
+            'penalty': ['l2', 'l1', 'elasticnet']
+        }
+    }
+    
+    # Model types that handle NaN natively (missing values are kept instead of zero-filled)
+    NATIVE_MISSING_MODELS = ('hist_gradient_boosting',)
+    
+    # Compact distillation students; all of them export to the model artifact
+    STUDENT_TYPES = ('shallow_forest', 'small_gbdt', 'logistic')
+    
+    def __init__(self, model_type='random_forest', search_mode='halving', search_candidates=24,
+                 search_time_budget=None, search_n_jobs=-1, search_checkpoint=None,
+                 search_report_path=None):
+        """
+        Args:
+            search_mode: 'halving' (successive halving), 'random' or 'grid' (exhaustive GridSearchCV)
+            search_time_budget: Seconds after which no further fits are started
+            search_n_jobs: Parallel fits during the search (CPU budget)
+            search_checkpoint: JSON file for resumable searches
+            search_report_path: Where to write the structured search report
+        """
         self.model_type = model_type
         self.model = None
         self.scaler = None
+        self.search_mode = search_mode
+        self.search_candidates = search_candidates
+        self.search_time_budget = search_time_budget
+        self.search_n_jobs = search_n_jobs
+        self.search_checkpoint = search_checkpoint
+        self.search_report_path = search_report_path
+        self.search_report = None
+        self.cv_score = None
+        self.metrics = {}
+        self.train_data = None  # (X_train, y_train) of the last in-memory run, used by distill()
+        self.test_data = None
+        self.student = None
+        self.distillation = None
         
     def preprocess_data(self, X, y):
         """Preprocess and validate data"""
         logger.info("Preprocessing data...")
         
         # Handle missing values
-        X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
+        X = self._clean_batch(X)
         
         # Feature scaling for tree-based models (optional but can help)
         self.scaler = StandardScaler()
@@ -203,6 +796,85 @@ class ProductionModelTrainer:
         logger.info("✓ Preprocessing completed")
         return X_scaled, y
     
+    def preprocess_data_streaming(self, X, batch_size=100000):
+        """
+        Fit the scaler incrementally (StandardScaler.partial_fit) over row batches
+        X may be a memory-mapped array; it is never densified or copied as a whole
+        """
+        logger.info("Fitting scaler in streaming mode...")
+        self.scaler = StandardScaler()
+        for start in range(0, len(X), batch_size):
+            self.scaler.partial_fit(self._clean_batch(X[start:start + batch_size]))
+        logger.info("✓ Streaming preprocessing completed")
+        return self.scaler
+    
+    def train_out_of_core(self, X, y, strategy='subsample', batch_size=100000, n_epochs=3,
+                          max_samples=500000, max_test_samples=200000, test_size=0.2):
+        """
+        Train on data larger than memory
+        strategy='incremental': partial_fit an SGD learner over shuffled batches (model_type 'sgd')
+        strategy='subsample': fit the configured model on a random subsample of max_samples rows
+        """
+        logger.info(f"Training {self.model_type} model out-of-core (strategy: {strategy})...")
+        if self.scaler is None:
+            self.preprocess_data_streaming(X, batch_size)
+        
+        rng = np.random.default_rng(42)
+        order = rng.permutation(len(y))
+        n_test = min(int(len(y) * test_size), max_test_samples)
+        # Sorted indices keep memory-mapped reads mostly sequential
+        test_idx = np.sort(order[:n_test])
+        train_idx = np.sort(order[n_test:])
+        del order
+        
+        logger.info(f"Training set: {len(train_idx)} samples")
+        logger.info(f"Test set: {len(test_idx)} samples")
+        
+        if strategy == 'incremental':
+            self.model = self._train_incremental(X, y, train_idx, batch_size, n_epochs, rng)
+        elif strategy == 'subsample':
+            if len(train_idx) > max_samples:
+                train_idx = np.sort(rng.choice(train_idx, size=max_samples, replace=False))
+                logger.info(f"Subsampled training set to {max_samples} samples")
+            self.model = self._train_default(self._scaled_rows(X, train_idx), np.asarray(y[train_idx]))
+        else:
+            raise ValueError(f"Unknown out-of-core strategy: {strategy}")
+        
+        self._evaluate_model(self._scaled_rows(X, test_idx), np.asarray(y[test_idx]))
+        return self.model
+    
+    def _train_incremental(self, X, y, train_idx, batch_size, n_epochs, rng):
+        """partial_fit over shuffled batches for n_epochs"""
+        if self.model_type != 'sgd':
+            raise ValueError(f"Model type '{self.model_type}' does not support incremental training; use 'sgd'")
+        
+        model = SGDClassifier(loss='log_loss', alpha=1e-5, random_state=42)
+        classes = np.array([0, 1])
+        n_batches = max(int(np.ceil(len(train_idx) / batch_size)), 1)
+        
+        for epoch in range(n_epochs):
+            for b in rng.permutation(n_batches):
+                idx = train_idx[b * batch_size:(b + 1) * batch_size]
+                X_batch = self._scaled_rows(X, idx)
+                y_batch = np.asarray(y[idx])
+                shuffle = rng.permutation(len(idx))
+                model.partial_fit(X_batch[shuffle], y_batch[shuffle], classes=classes)
+            logger.info(f"  Epoch {epoch + 1}/{n_epochs} completed")
+        
+        logger.info("✓ Incremental training completed")
+        return model
+    
+    def _scaled_rows(self, X, idx):
+        """Gather rows from a (memory-mapped) array, clean and scale them"""
+        return self.scaler.transform(self._clean_batch(X[idx]))
+    
+    def _clean_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float64)
+        if self.model_type in self.NATIVE_MISSING_MODELS:
+            # Keep NaN for the model's missing-value splits; infinities become missing too
+            return np.where(np.isinf(batch), np.nan, batch)
+        return np.nan_to_num(batch, nan=0.0, posinf=0.0, neginf=0.0)
+    
     def train_model(self, X, y, hyperparameter_tuning=False):
         """Train the model with optional hyperparameter tuning"""
         logger.info(f"Training {self.model_type} model...")
@@ -215,7 +887,10 @@ class ProductionModelTrainer:
         logger.info(f"Training set: {len(X_train)} samples")
         logger.info(f"Test set: {len(X_test)} samples")
         logger.info(f"Malicious: {sum(y_train)} ({sum(y_train)/len(y_train)*100:.1f}%)")
+        self.train_data = (X_train, y_train)
+        self.test_data = (X_test, y_test)
         
+        self.cv_score = None
         if hyperparameter_tuning:
             self.model = self._train_with_tuning(X_train, y_train)
         else:
@@ -224,8 +899,11 @@ class ProductionModelTrainer:
         # Evaluate
         self._evaluate_model(X_test, y_test)
         
-        # Cross-validation
-        self._cross_validate(X_train, y_train)
+        # Cross-validation (the search already cross-validated the chosen parameters)
+        if self.cv_score is None:
+            self._cross_validate(X_train, y_train)
+        else:
+            logger.info(f"\nSearch CV F1-Score of selected parameters: {self.cv_score*100:.2f}%")
         
         return self.model
     
@@ -249,42 +927,93 @@ class ProductionModelTrainer:
                 learning_rate=0.1,
                 random_state=42
             )
+        elif self.model_type == 'hist_gradient_boosting':
+            # Multi-threaded histogram boosting; stops once the validation loss plateaus
+            model = HistGradientBoostingClassifier(
+                max_iter=500,
+                learning_rate=0.1,
+                max_leaf_nodes=31,
+                min_samples_leaf=20,
+                early_stopping=True,
+                validation_fraction=0.1,
+                n_iter_no_change=20,
+                class_weight='balanced',
+                random_state=42
+            )
+        elif self.model_type == 'sgd':
+            model = SGDClassifier(
+                loss='log_loss',
+                alpha=1e-5,
+                random_state=42,
+                class_weight='balanced'
+            )
         else:
             raise ValueError(f"Unknown model type: {self.model_type}")
         
         model.fit(X_train, y_train)
+        if hasattr(model, 'n_iter_') and self.model_type == 'hist_gradient_boosting':
+            logger.info(f"Early stopping after {model.n_iter_} boosting iterations")
         logger.info("✓ Model training completed")
         return model
     
+    def _build_model(self, params=None, n_jobs=-1):
+        """Instantiate the configured model type with the given hyperparameters"""
+        params = dict(params or {})
+        if self.model_type == 'random_forest':
+            return RandomForestClassifier(random_state=42, n_jobs=n_jobs,
+                                          class_weight='balanced', **params)
+        elif self.model_type == 'gradient_boosting':
+            return GradientBoostingClassifier(random_state=42, **params)
+        elif self.model_type == 'hist_gradient_boosting':
+            return HistGradientBoostingClassifier(max_iter=500, early_stopping=True, n_iter_no_change=20,
+                                                  class_weight='balanced', random_state=42, **params)
+        elif self.model_type == 'sgd':
+            return SGDClassifier(loss='log_loss', random_state=42, class_weight='balanced', **params)
+        raise ValueError(f"Unknown model type: {self.model_type}")
+    
     def _train_with_tuning(self, X_train, y_train):
         """Train with hyperparameter tuning (takes longer)"""
-        logger.info("Starting hyperparameter tuning (this may take a while)...")
+        logger.info(f"Starting hyperparameter tuning ({self.search_mode})...")
+        param_space = self.PARAM_SPACES[self.model_type]
         
-        if self.model_type == 'random_forest':
-            param_grid = {
-                'n_estimators': [100, 200, 300],
-                'max_depth': [20, 30, 40],
-                'min_samples_split': [2, 5, 10],
-                'min_samples_leaf': [1, 2, 4]
-            }
-            base_model = RandomForestClassifier(random_state=42, n_jobs=-1)
-        else:
-            param_grid = {
-                'n_estimators': [100, 200],
-                'max_depth': [5, 10, 15],
-                'learning_rate': [0.01, 0.1, 0.2]
-            }
-            base_model = GradientBoostingClassifier(random_state=42)
-        
-        grid_search = GridSearchCV(
-            base_model, param_grid, cv=3, scoring='f1', n_jobs=-1, verbose=2
+        if self.search_mode == 'grid':
+            grid_search = GridSearchCV(
+                self._build_model(), param_space, cv=3, scoring='f1', n_jobs=-1, verbose=2
+            )
+            grid_search.fit(X_train, y_train)
+            
+            logger.info(f"Best parameters: {grid_search.best_params_}")
+            logger.info(f"Best CV score: {grid_search.best_score_:.4f}")
+            self.cv_score = grid_search.best_score_
+            return grid_search.best_estimator_
+        
+        search = SuccessiveHalvingSearch(
+            # Parallelism is across fits, so each model stays single-threaded
+            model_factory=lambda params: self._build_model(params, n_jobs=1),
+            param_space=param_space,
+            n_candidates=self.search_candidates,
+            factor=3 if self.search_mode == 'halving' else self.search_candidates + 1,
+            time_budget=self.search_time_budget,
+            n_jobs=self.search_n_jobs,
+            checkpoint_path=self.search_checkpoint
         )
-        grid_search.fit(X_train, y_train)
+        best_params = search.fit(X_train, y_train)
+        self.search_report = search.report
+        self.cv_score = search.best_score_
+        
+        logger.info(f"Best parameters: {best_params}")
+        logger.info(f"Best CV score: {search.best_score_:.4f} "
+                    f"({search.report['elapsed_seconds']}s, {len(search.report['rungs'])} rungs)")
         
-        logger.info(f"Best parameters: {grid_search.best_params_}")
-        logger.info(f"Best CV score: {grid_search.best_score_:.4f}")
+        if self.search_report_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.search_report_path)), exist_ok=True)
+            with open(self.search_report_path, 'w') as f:
+                json.dump(self.search_report, f, indent=2, default=str)
+            logger.info(f"✓ Search report saved to {self.search_report_path}")
         
-        return grid_search.best_estimator_
+        model = self._build_model(best_params)
+        model.fit(X_train, y_train)
+        return model
     
     def _evaluate_model(self, X_test, y_test):
         """Comprehensive model evaluation"""
@@ -308,6 +1037,15 @@ class ProductionModelTrainer:
         logger.info(f"F1-Score:  {f1*100:.2f}%")
         logger.info(f"AUC-ROC:   {auc*100:.2f}%")
         
+        self.metrics = {
+            'accuracy': float(accuracy),
+            'precision': float(precision),
+            'recall': float(recall),
+            'f1': float(f1),
+            'auc_roc': float(auc),
+            'test_samples': int(len(y_test))
+        }
+        
         # Classification report
         logger.info(f"\nClassification Report:")
         logger.info("\n" + classification_report(y_test, y_pred, 
@@ -331,6 +1069,7 @@ class ProductionModelTrainer:
         cv_scores = cross_val_score(self.model, X_train, y_train, cv=5, 
                                     scoring='f1', n_jobs=-1)
         logger.info(f"CV F1-Scores: {cv_scores}")
+        self.cv_score = float(cv_scores.mean())
         logger.info(f"Average: {cv_scores.mean()*100:.2f}% (+/- {cv_scores.std()*2*100:.2f}%)")
     
     def _log_feature_importance(self):
@@ -342,11 +1081,142 @@ class ProductionModelTrainer:
         for idx in reversed(top_20_idx):
             logger.info(f"  Feature {idx:3d}: {feature_importance[idx]:.4f}")
     
-    def save_model(self, model_path='models/malware_model.pkl'):
-        """Save trained model and scaler"""
+    def distill(self, student_type='small_gbdt', n_synthetic=None, min_confidence=0.8, seed=42):
+        """
+        Train a compact student on the teacher's predict_proba over the training data
+        plus synthetic samples; returns the fidelity / speed-up report
+        
+        Args:
+            student_type: 'shallow_forest', 'small_gbdt' or 'logistic' (pairwise interaction features)
+            n_synthetic: Extra transfer samples (default: as many as training rows)
+            min_confidence: Student confidence below which the predictor asks the teacher
+        """
+        if self.train_data is None:
+            raise ValueError("Distillation needs an in-memory training run (train_model)")
+        if student_type not in self.STUDENT_TYPES:
+            raise ValueError(f"Unknown student type: {student_type}")
+        X_train, _ = self.train_data
+        X_test, y_test = self.test_data
+        if student_type != 'small_gbdt' and np.isnan(X_train).any():
+            raise ValueError(f"{student_type} student cannot handle missing values - use small_gbdt")
+        
+        logger.info(f"\nDistilling {self.model_type} into a {student_type} student...")
+        rng = np.random.default_rng(seed)
+        n_synthetic = len(X_train) if n_synthetic is None else n_synthetic
+        X_transfer = np.vstack([X_train, self._synthetic_transfer_set(X_train, n_synthetic, rng)])
+        soft_labels = self.model.predict_proba(X_transfer)[:, 1]
+        
+        # Soft targets as weighted duplicates: every row once per class, weighted by the teacher
+        X_fit = np.vstack([X_transfer, X_transfer])
+        y_fit = np.repeat([0, 1], len(X_transfer))
+        weights = np.concatenate([1 - soft_labels, soft_labels])
+        keep = weights > 1e-6
+        student = self._build_student(student_type)
+        weight_param = f'{student.steps[-1][0]}__sample_weight' if hasattr(student, 'steps') else 'sample_weight'
+        start = time.perf_counter()
+        student.fit(X_fit[keep], y_fit[keep], **{weight_param: weights[keep]})
+        train_seconds = time.perf_counter() - start
+        
+        report = self._distillation_report(student, X_test, y_test, min_confidence)
+        report.update({'student_type': student_type, 'transfer_samples': int(len(X_transfer)),
+                       'synthetic_samples': int(n_synthetic), 'train_seconds': round(train_seconds, 2)})
+        self.student = student
+        self.distillation = {'student_type': student_type, 'min_confidence': float(min_confidence),
+                             'report': report}
+        
+        logger.info(f"Fidelity: {report['fidelity']['agreement']*100:.2f}% agreement with the teacher, "
+                    f"mean |Δp| {report['fidelity']['mean_abs_proba_diff']:.4f}")
+        logger.info(f"Student F1: {report['student_metrics']['f1']*100:.2f}% "
+                    f"(teacher {report['teacher_metrics']['f1']*100:.2f}%)")
+        logger.info(f"1-row latency: {report['latency_ms']['student_p50']}ms vs "
+                    f"{report['latency_ms']['teacher_p50']}ms ({report['latency_ms']['speedup']}x)")
+        logger.info(f"Teacher fallback below {min_confidence:.0%} confidence: "
+                    f"{report['with_fallback']['fallback_rate']*100:.1f}% of test samples, "
+                    f"F1 {report['with_fallback']['f1']*100:.2f}%")
+        return report
+    
+    @staticmethod
+    def _build_student(student_type):
+        if student_type == 'shallow_forest':
+            return RandomForestClassifier(n_estimators=30, max_depth=8, min_samples_leaf=5,
+                                          random_state=42, n_jobs=-1)
+        elif student_type == 'small_gbdt':
+            return HistGradientBoostingClassifier(max_iter=100, max_leaf_nodes=15, max_depth=4,
+                                                  learning_rate=0.1, early_stopping=False, random_state=42)
+        return make_pipeline(PolynomialFeatures(degree=2, interaction_only=True, include_bias=False),
+                             LogisticRegression(C=1.0, max_iter=1000))
+    
+    @staticmethod
+    def _synthetic_transfer_set(X, n_samples, rng, swap_rate=0.1):
+        """Training rows with ~swap_rate of their features taken from other rows"""
+        if n_samples <= 0:
+            return X[:0]
+        base = X[rng.integers(0, len(X), n_samples)]
+        donor = X[rng.integers(0, len(X), n_samples)]
+        return np.where(rng.random(base.shape) < swap_rate, donor, base)
+    
+    def _distillation_report(self, student, X_test, y_test, min_confidence):
+        """Compare student and teacher on the held-out split, including the fallback policy"""
+        teacher_proba = self.model.predict_proba(X_test)[:, 1]
+        student_proba = student.predict_proba(X_test)[:, 1]
+        teacher_pred = (teacher_proba >= 0.5).astype(int)
+        student_pred = (student_proba >= 0.5).astype(int)
+        confident = np.maximum(student_proba, 1 - student_proba) >= min_confidence
+        served_pred = np.where(confident, student_pred, teacher_pred)
+        
+        def metrics(pred, proba=None):
+            result = {'accuracy': float(accuracy_score(y_test, pred)), 'f1': float(f1_score(y_test, pred))}
+            if proba is not None:
+                result['auc_roc'] = float(roc_auc_score(y_test, proba))
+            return result
+        
+        # Latency as served: both models through the memory-mapped artifact
+        latency = {}
+        sizes = {}
+        with tempfile.TemporaryDirectory(prefix='distill_') as work_dir:
+            for name, model in (('teacher', self.model), ('student', student)):
+                path = os.path.join(work_dir, f'{name}.apkm')
+                try:
+                    save_artifact(path, model)
+                    served_model = load_artifact(path)[0]
+                    sizes[name] = os.path.getsize(path)
+                except ArtifactError:
+                    served_model = model
+                latency[name] = _single_row_latency_ms(served_model.predict_proba, X_test)
+        
+        return {
+            'fidelity': {
+                'agreement': float(np.mean(student_pred == teacher_pred)),
+                'mean_abs_proba_diff': float(np.mean(np.abs(student_proba - teacher_proba))),
+            },
+            'teacher_metrics': metrics(teacher_pred, teacher_proba),
+            'student_metrics': metrics(student_pred, student_proba),
+            'with_fallback': dict(metrics(served_pred), min_confidence=float(min_confidence),
+                                  fallback_rate=float(1 - np.mean(confident)),
+                                  agreement=float(np.mean(served_pred == teacher_pred))),
+            'latency_ms': {
+                'teacher_p50': latency['teacher'],
+                'student_p50': latency['student'],
+                'speedup': round(latency['teacher'] / max(latency['student'], 1e-6), 1),
+            },
+            'artifact_bytes': sizes,
+            'test_samples': int(len(y_test)),
+        }
+    
+    def save_model(self, model_path='models/malwares_model.apkm'):
+        """Save trained model, scaler and metadata as a single memory-mappable artifact"""
         os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        metadata = self.build_metadata()
+        
+        try:
+            save_artifact(model_path, self.model, self.scaler, metadata)
+            logger.info(f"✓ Model artifact saved to {model_path}")
+            return
+        except ArtifactError as e:
+            logger.warning(f"Model cannot be stored as an artifact ({str(e)}) - writing pickles")
         
         # Save model
+        model_path = os.path.splitext(model_path)[0] + '.pkl'
         with open(model_path, 'wb') as f:
             pickle.dump(self.model, f)
         logger.info(f"✓ Model saved to {model_path}")
@@ -358,64 +1228,269 @@ class ProductionModelTrainer:
         logger.info(f"✓ Scaler saved to {scaler_path}")
         
         # Save metadata
-        metadata = {
-            'model_type': self.model_type,
-            'n_features': self.model.n_features_in_ if hasattr(self.model, 'n_features_in_') else None,
-            'training_date': pd.Timestamp.now().isoformat()
-        }
         metadata_path = model_path.replace('.pkl', '_metadata.pkl')
         with open(metadata_path, 'wb') as f:
             pickle.dump(metadata, f)
         logger.info(f"✓ Metadata saved to {metadata_path}")
+    
+    def build_metadata(self, dataset_info=None):
+        """Metadata stored next to the model: schema, parameters, metrics and data provenance"""
+        n_features = self.model.n_features_in_ if hasattr(self.model, 'n_features_in_') else None
+        metrics = dict(self.metrics)
+        if self.cv_score is not None:
+            metrics['cv_f1'] = float(self.cv_score)
+        return {
+            'model_type': self.model_type,
+            'params': self.model.get_params() if hasattr(self.model, 'get_params') else None,
+            'n_features': n_features,
+            'feature_schema': FEATURE_NAMES if n_features == N_FEATURES else None,
+            'metrics': metrics,
+            'dataset': dataset_info,
+            'search': {k: v for k, v in self.search_report.items() if k != 'rungs'}
+                      if self.search_report else None,
+            'distillation': dict(self.distillation, student_file=STUDENT_FILE)
+                            if self.distillation else None,
+            'training_date': pd.Timestamp.now().isoformat()
+        }
+    
+    def save_to_registry(self, registry, dataset_info=None, promote=False):
+        """Write this run as a new registry version; returns the version id"""
+        metadata = self.build_metadata(dataset_info)
+        
+        def write_artifacts(directory):
+            try:
+                save_artifact(os.path.join(directory, ARTIFACT_FILE), self.model, self.scaler, metadata)
+            except ArtifactError as e:
+                logger.warning(f"Model cannot be stored as an artifact ({str(e)}) - writing pickles")
+                with open(os.path.join(directory, MODEL_FILE), 'wb') as f:
+                    pickle.dump(self.model, f)
+                with open(os.path.join(directory, SCALER_FILE), 'wb') as f:
+                    pickle.dump(self.scaler, f)
+            if self.student is not None:
+                save_artifact(os.path.join(directory, STUDENT_FILE), self.student, self.scaler,
+                              {'model_type': self.distillation['student_type'], 'teacher': self.model_type})
+            if self.search_report:
+                with open(os.path.join(directory, 'search_report.json'), 'w') as f:
+                    json.dump(self.search_report, f, indent=2, default=str)
+        
+        version = registry.register(write_artifacts, metadata)
+        if promote:
+            registry.promote(version)
+        return version
 
 
-def main():
-    """Main training pipeline"""
+def _single_row_latency_ms(predict, X, n_calls=300):
+    """Median latency of predict() on single rows, in milliseconds"""
+    latencies = []
+    for i in range(min(n_calls, len(X))):
+        row = X[i:i + 1]
+        start = time.perf_counter()
+        predict(row)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return round(float(np.median(latencies)), 4)
+
+
+def _load_dataset(args):
+    """Load the dataset selected on the command line; returns (X, y, dataset_info)"""
+    loader = DatasetLoader()
+    dataset_type = args.dataset_type
+    
+    if dataset_type == 'synthetic':
+        X, y = loader.generate_synthetic_data(n_samples=args.synthetic_samples, seed=args.seed)
+        fingerprint = DatasetLoader.dataset_fingerprint(
+            [], extra=('synthetic', args.synthetic_samples, args.seed)
+        )
+    else:
+        if args.out_of_core:
+            X, y = loader.load_out_of_core(args.dataset_path, dataset_type=dataset_type,
+                                           cache_dir=args.cache_dir)
+        elif dataset_type == 'drebin':
+            X, y = loader.load_drebin(args.dataset_path)
+        elif dataset_type == 'cicandmal2017':
+            X, y = loader.load_cicandmal2017(args.dataset_path)
+        else:
+            X, y = loader.load_custom_csv(args.dataset_path)
+        
+        if os.path.isdir(args.dataset_path):
+            paths = [str(p) for p in Path(args.dataset_path).rglob('*') if p.is_file()]
+        else:
+            paths = [args.dataset_path] if os.path.exists(args.dataset_path) else []
+        fingerprint = DatasetLoader.dataset_fingerprint(paths, extra=(dataset_type,))
+    
+    if X is None or y is None:
+        return None, None, None
+    
+    dataset_info = {
+        'type': dataset_type,
+        'path': None if dataset_type == 'synthetic' else os.path.abspath(args.dataset_path),
+        'fingerprint': fingerprint,
+        'n_samples': int(len(y)),
+        'malware_ratio': float(np.mean(y)) if len(y) else 0.0
+    }
+    return X, y, dataset_info
+
+
+def train_command(args):
+    """Train a model and register it as a new version"""
     logger.info("="*70)
     logger.info("PRODUCTION MALWARE DETECTION MODEL TRAINING")
     logger.info("="*70)
     
-    # Configuration
-    DATASET_TYPE = 'drebin'  # Options: 'drebin', 'cicandmal2017', 'custom', 'synthetic'
-    DATASET_PATH = r'datasets\drebin.csv'  # Update with your dataset path
-    MODEL_TYPE = 'random_forest'  # Options: 'random_forest', 'gradient_boosting'
-    HYPERPARAMETER_TUNING = False  # Set True for production (takes longer)
-    
     logger.info(f"\nConfiguration:")
-    logger.info(f"  Dataset Type: {DATASET_TYPE}")
-    logger.info(f"  Model Type: {MODEL_TYPE}")
-    logger.info(f"  Hyperparameter Tuning: {HYPERPARAMETER_TUNING}")
-    
-    # Load dataset
-    loader = DatasetLoader()
-    
-    if DATASET_TYPE == 'drebin':
-        X, y = loader.load_drebin(DATASET_PATH)
-    elif DATASET_TYPE == 'cicandmal2017':
-        X, y = loader.load_cicandmal2017(DATASET_PATH)
-    elif DATASET_TYPE == 'custom':
-        X, y = loader.load_custom_csv(DATASET_PATH)
-    else:  # synthetic
-        X, y = loader.generate_synthetic_data(n_samples=10000)
+    logger.info(f"  Dataset Type: {args.dataset_type}")
+    logger.info(f"  Model Type: {args.model_type}")
+    logger.info(f"  Hyperparameter Tuning: {args.tune} ({args.search_mode})")
+    logger.info(f"  Out-of-core: {args.out_of_core}")
+    logger.info(f"  Registry: {args.registry}")
     
-    if X is None or y is None:
+    X, y, dataset_info = _load_dataset(args)
+    if X is None:
         logger.error("Failed to load dataset. Exiting.")
         sys.exit(1)
     
     # Train model
-    trainer = ProductionModelTrainer(model_type=MODEL_TYPE)
-    X_processed, y_processed = trainer.preprocess_data(X, y)
-    model = trainer.train_model(X_processed, y_processed, 
-                               hyperparameter_tuning=HYPERPARAMETER_TUNING)
+    registry = ModelRegistry(args.registry)
+    trainer = ProductionModelTrainer(
+        model_type=args.model_type,
+        search_mode=args.search_mode,
+        search_candidates=args.search_candidates,
+        search_time_budget=args.search_budget,
+        search_n_jobs=args.n_jobs,
+        # One checkpoint per dataset/model so a resumed search never mixes data
+        search_checkpoint=os.path.join(
+            args.registry, 'checkpoints',
+            f"search_{args.model_type}_{dataset_info['fingerprint'][:16]}.json"
+        )
+    )
+    if args.out_of_core:
+        trainer.preprocess_data_streaming(X)
+        trainer.train_out_of_core(X, y, strategy=args.strategy)
+    else:
+        X_processed, y_processed = trainer.preprocess_data(X, y)
+        trainer.train_model(X_processed, y_processed, hyperparameter_tuning=args.tune)
+    
+    if args.distill:
+        if args.out_of_core:
+            logger.warning("Distillation is only supported for in-memory training - skipped")
+        else:
+            trainer.distill(args.distill, n_synthetic=args.distill_synthetic,
+                            min_confidence=args.distill_threshold, seed=args.seed)
     
     # Save model
-    trainer.save_model('models/malwares_model.pkl')
+    version = trainer.save_to_registry(registry, dataset_info, promote=args.promote)
+    if args.output:
+        trainer.save_model(args.output)
     
     logger.info("\n" + "="*70)
-    logger.info("✓ TRAINING COMPLETED SUCCESSFULLY!")
+    logger.info(f"✓ TRAINING COMPLETED SUCCESSFULLY! Version: {version}")
     logger.info("="*70)
-    logger.info("\nModel is ready for production use.")
-    logger.info("Deploy with: python run.py")
+    if args.promote:
+        logger.info("\nModel is promoted and will be served by MalwarePredictor.")
+    else:
+        logger.info(f"\nPromote with: python train_model_production.py promote {version}")
+
+
+def list_command(args):
+    registry = ModelRegistry(args.registry)
+    current = registry.current_version()
+    for metadata in registry.list_versions():
+        metrics = metadata.get('metrics') or {}
+        marker = '*' if metadata['version'] == current else ' '
+        print(f"{marker} {metadata['version']:<40} {metadata.get('model_type', ''):<18} "
+              f"f1={metrics.get('f1', float('nan')):.4f} "
+              f"auc={metrics.get('auc_roc', float('nan')):.4f} "
+              f"data={((metadata.get('dataset') or {}).get('fingerprint') or '')[:12]}")
+
+
+def show_command(args):
+    metadata = ModelRegistry(args.registry).get_metadata(args.version)
+    if metadata is None:
+        logger.error(f"Unknown model version: {args.version}")
+        sys.exit(1)
+    print(json.dumps(metadata, indent=2))
+
+
+def promote_command(args):
+    ModelRegistry(args.registry).promote(args.version)
+
+
+def rollback_command(args):
+    ModelRegistry(args.registry).rollback()
+
+
+def compare_command(args):
+    print(json.dumps(ModelRegistry(args.registry).compare(args.version_a, args.version_b), indent=2))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Train and manage malware detection models')
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY_DIR', 'models/registry'),
+                        help='Model registry directory (default: models/registry)')
+    commands = parser.add_subparsers(dest='command')
+    
+    train = commands.add_parser('train', help='Train a model and register a new version')
+    train.add_argument('--dataset-type', default='drebin',
+                       choices=['drebin', 'cicandmal2017', 'custom', 'synthetic'])
+    train.add_argument('--dataset-path', default=os.path.join('datasets', 'drebin.csv'))
+    train.add_argument('--model-type', default='random_forest',
+                       choices=['random_forest', 'gradient_boosting', 'hist_gradient_boosting', 'sgd'])
+    train.add_argument('--tune', action='store_true', help='Run hyperparameter search')
+    train.add_argument('--search-mode', default='halving', choices=['halving', 'random', 'grid'])
+    train.add_argument('--search-candidates', type=int, default=24)
+    train.add_argument('--search-budget', type=float, default=None,
+                       help='Search time budget in seconds')
+    train.add_argument('--n-jobs', type=int, default=-1, help='CPU budget for parallel search fits')
+    train.add_argument('--out-of-core', action='store_true',
+                       help='Chunked ingestion + memory-mapped cache for very large datasets')
+    train.add_argument('--strategy', default='subsample', choices=['subsample', 'incremental'],
+                       help="Out-of-core strategy ('incremental' requires --model-type sgd)")
+    train.add_argument('--cache-dir', default=os.path.join('datasets', 'cache'))
+    train.add_argument('--synthetic-samples', type=int, default=10000)
+    train.add_argument('--seed', type=int, default=42)
+    train.add_argument('--distill', default=None, choices=ProductionModelTrainer.STUDENT_TYPES,
+                       help='Also train a compact student on the model\'s probabilities')
+    train.add_argument('--distill-threshold', type=float, default=0.8,
+                       help='Student confidence below which the server falls back to the full model')
+    train.add_argument('--distill-synthetic', type=int, default=None,
+                       help='Synthetic transfer samples (default: one per training row)')
+    train.add_argument('--promote', action='store_true', help='Serve this version immediately')
+    train.add_argument('--output', default=None,
+                       help='Also write a standalone artifact to this path (e.g. models/malwares_model.apkm)')
+    train.set_defaults(func=train_command)
+    
+    commands.add_parser('list', help='List registered versions').set_defaults(func=list_command)
+    
+    show = commands.add_parser('show', help='Print metadata of a version')
+    show.add_argument('version')
+    show.set_defaults(func=show_command)
+    
+    promote = commands.add_parser('promote', help='Atomically switch the served version')
+    promote.add_argument('version')
+    promote.set_defaults(func=promote_command)
+    
+    commands.add_parser('rollback', help='Serve the version promoted before the current one') \
+        .set_defaults(func=rollback_command)
+    
+    compare = commands.add_parser('compare', help='Compare metrics of two versions')
+    compare.add_argument('version_a')
+    compare.add_argument('version_b')
+    compare.set_defaults(func=compare_command)
+    return parser
+
+
+def main(argv=None):
+    """Main training pipeline"""
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # Plain `python train_model_production.py` keeps training with defaults
+        args = parser.parse_args(argv + ['train'])
+    try:
+        args.func(args)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
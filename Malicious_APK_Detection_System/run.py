@@ -5,10 +5,10 @@ import os
 import sys
 
 # Add server directory to Python path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
 
-# Import and run the Flask app
-from app import app
+# The launcher imports the Flask app (and preloads the ML model) before forking workers
+from launcher import main
 
 if __name__ == '__main__':
     print("="*60)
@@ -16,7 +16,7 @@ if __name__ == '__main__':
     print("="*60)
     print("\n🌐 Server starting at: http://localhost:5000")
     print("📊 API endpoint: http://localhost:5000/api/scan")
-    print("\n✋ Press CTRL+C to stop the server\n")
+    print("\n✋ Press CTRL+C to stop the server (SIGHUP reloads workers)\n")
     
-    # Run the app
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Pre-fork production server; pass --mode dev for the Werkzeug dev server
+    main()
@@ -3,9 +3,13 @@ APK Static Analysis Engine using Androguard
 """
 import logging
 from typing import Dict, List, Any
-import re
 import hashlib
-from datetime import datetime
+from datetime import datetime, timezone
+from .url_extractor import URLExtractor
+from .threat_intel import ThreatIntel
+from .cert_cache import CertificateVerificationCache
+from monitoring.metrics import timed, FALLBACKS
+from monitoring.progress import report_progress
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +46,10 @@ class APKAnalyzer:
         'KeyStore', 'Cipher'
     ]
     
-    def __init__(self):
+    def __init__(self, url_extractor=None, threat_intel=None, cert_cache=None):
+        self.url_extractor = url_extractor or URLExtractor()
+        self.threat_intel = threat_intel or ThreatIntel()
+        self.cert_cache = cert_cache or CertificateVerificationCache()
         self.androguard_available = False
         try:
             from androguard.core.bytecodes.apk import APK
@@ -56,15 +63,18 @@ class APKAnalyzer:
         except ImportError:
             logger.warning("Androguard not available - using fallback analysis")
     
-    def analyze(self, apk_path: str) -> Dict[str, Any]:
+    def analyze(self, apk_path: str, extract_urls: bool = True) -> Dict[str, Any]:
         """
         Perform comprehensive static analysis on APK
+        extract_urls=False skips the URL scan (reduced analysis under load)
         """
         try:
             if self.androguard_available:
-                return self._analyze_with_androguard(apk_path)
+                return self._analyze_with_androguard(apk_path, extract_urls)
             else:
-                return self._analyze_fallback(apk_path)
+                FALLBACKS.inc(component='analyzer')
+                with timed('analyzer.fallback'):
+                    return self._analyze_fallback(apk_path, extract_urls)
         except Exception as e:
             logger.error(f"Analysis failed: {str(e)}", exc_info=True)
             return {
@@ -72,38 +82,54 @@ class APKAnalyzer:
                 'error': str(e)
             }
     
-    def _analyze_with_androguard(self, apk_path: str) -> Dict[str, Any]:
+    def analyze_quick(self, apk_path: str) -> Dict[str, Any]:
+        """
+        ZIP listing only - no Androguard, no URL scan
+        Used as the cheapest analysis tier when the server is overloaded
+        """
+        with timed('analyzer.quick'):
+            return self._analyze_fallback(apk_path, extract_urls=False)
+    
+    def _analyze_with_androguard(self, apk_path: str, extract_urls: bool = True) -> Dict[str, Any]:
         """Full analysis using Androguard"""
         try:
-            # Load APK
-            apk = self.APK(apk_path)
-            
-            # Extract basic information
-            package_name = apk.get_package()
-            app_name = apk.get_app_name()
-            version_name = apk.get_androidversion_name()
-            version_code = apk.get_androidversion_code()
-            min_sdk = apk.get_min_sdk_version()
-            target_sdk = apk.get_target_sdk_version()
+            # Load APK and parse manifest
+            with timed('analyzer.manifest'):
+                apk = self.APK(apk_path)
+                
+                # Extract basic information
+                package_name = apk.get_package()
+                app_name = apk.get_app_name()
+                version_name = apk.get_androidversion_name()
+                version_code = apk.get_androidversion_code()
+                min_sdk = apk.get_min_sdk_version()
+                target_sdk = apk.get_target_sdk_version()
+                
+                # Extract components
+                activities = apk.get_activities()
+                services = apk.get_services()
+                receivers = apk.get_receivers()
+                providers = apk.get_providers()
             
             # Extract permissions
-            permissions = apk.get_permissions()
-            dangerous_permissions = self._identify_dangerous_permissions(permissions)
-            
-            # Extract components
-            activities = apk.get_activities()
-            services = apk.get_services()
-            receivers = apk.get_receivers()
-            providers = apk.get_providers()
+            with timed('analyzer.permissions'):
+                permissions = apk.get_permissions()
+                dangerous_permissions = self._identify_dangerous_permissions(permissions)
+            report_progress('manifest_parsed', package_name=package_name, app_name=app_name,
+                            version_name=version_name, min_sdk=min_sdk, target_sdk=target_sdk,
+                            permissions=len(permissions), dangerous_permissions=dangerous_permissions)
             
             # Look for suspicious features
-            suspicious_features = self._identify_suspicious_features(apk)
+            with timed('analyzer.suspicious_features'):
+                suspicious_features = self._identify_suspicious_features(apk)
             
-            # Extract URLs
-            urls = self._extract_urls(apk)
+            # Extract URLs and check their hosts against local threat intel
+            with timed('analyzer.urls'):
+                url_summary, url_intel = self._scan_urls(apk_path, extract_urls)
             
             # Verify source and certificate
-            source_verification = self.verify_source(apk)
+            with timed('analyzer.certificate'):
+                source_verification = self.verify_source(apk)
             
             # Build feature vector for ML
             feature_vector = self._build_feature_vector(
@@ -126,7 +152,9 @@ class APKAnalyzer:
                 'receivers': receivers[:10],
                 'providers': providers,
                 'suspicious_features': suspicious_features,
-                'urls': urls[:20],  # Limit URLs
+                'urls': url_summary['urls'][:20],  # Limit URLs
+                'url_summary': self._summarize_urls(url_summary),
+                'url_intel': url_intel,
                 'source_verification': source_verification,  # NEW
                 'features': feature_vector,
                 'total_activities': len(activities),
@@ -135,9 +163,11 @@ class APKAnalyzer:
             }
         except Exception as e:
             logger.error(f"Androguard analysis failed: {str(e)}")
-            return self._analyze_fallback(apk_path)
+            FALLBACKS.inc(component='analyzer')
+            with timed('analyzer.fallback'):
+                return self._analyze_fallback(apk_path, extract_urls)
     
-    def _analyze_fallback(self, apk_path: str) -> Dict[str, Any]:
+    def _analyze_fallback(self, apk_path: str, extract_urls: bool = True) -> Dict[str, Any]:
         """
         Fallback analysis when Androguard is not available
         Uses basic file analysis
@@ -164,6 +194,9 @@ class APKAnalyzer:
                 # Build minimal feature vector
                 feature_vector = self._build_minimal_feature_vector(file_list)
                 
+                # URL scan works on the raw archive, no Androguard needed
+                url_summary, url_intel = self._scan_urls(apk_path, extract_urls)
+                
                 return {
                     'success': True,
                     'package_name': 'Unknown (Androguard not available)',
@@ -177,6 +210,9 @@ class APKAnalyzer:
                     'permissions': [],
                     'dangerous_permissions': [],
                     'suspicious_features': suspicious_files,
+                    'urls': url_summary['urls'][:20],
+                    'url_summary': self._summarize_urls(url_summary),
+                    'url_intel': url_intel,
                     'features': feature_vector,
                     'note': 'Limited analysis - Androguard not available'
                 }
@@ -234,24 +270,40 @@ class APKAnalyzer:
         
         return suspicious
     
-    def _extract_urls(self, apk) -> List[str]:
-        """Extract URLs from APK"""
-        urls = []
-        url_pattern = re.compile(r'https?://[^\s<>"{}|\\^`\[\]]+')
-        
-        try:
-            for file_name in apk.get_files():
-                if file_name.endswith('.xml') or file_name.endswith('.txt'):
-                    try:
-                        content = apk.get_file(file_name).decode('utf-8', errors='ignore')
-                        found_urls = url_pattern.findall(content)
-                        urls.extend(found_urls)
-                    except:
-                        pass
-        except Exception as e:
-            logger.warning(f"Error extracting URLs: {str(e)}")
-        
-        return list(set(urls))  # Remove duplicates
+    def _extract_urls(self, apk_path: str, host_check=None) -> Dict[str, Any]:
+        """
+        Extract URLs from APK
+        Streams XML, text, resource and DEX entries through the bounded URL extractor
+        """
+        return self.url_extractor.extract(apk_path, host_check)
+    
+    def _scan_urls(self, apk_path: str, extract_urls: bool = True):
+        """(url_summary, url_intel); empty and marked skipped when extract_urls is False"""
+        if not extract_urls:
+            url_summary = {'urls': [], 'hosts': {}, 'domains': {}, 'total_urls': 0, 'truncated': False}
+            return url_summary, {'blocked_hosts': [], 'blocked_total': 0, 'allowlisted_hosts': 0,
+                                 'skipped': True}
+        url_summary = self._extract_urls(apk_path, self.threat_intel.host_check())
+        return url_summary, self._check_url_intel(url_summary)
+    
+    def _summarize_urls(self, url_summary: Dict[str, Any]) -> Dict[str, Any]:
+        """Host/domain aggregates for the scan response"""
+        return {
+            'total_urls': url_summary['total_urls'],
+            'unique_hosts': len(url_summary['hosts']),
+            'top_domains': dict(list(url_summary['domains'].items())[:10]),
+            'truncated': url_summary['truncated']
+        }
+    
+    def _check_url_intel(self, url_summary: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Threat intel verdicts for every extracted host, not just the capped report
+        Blocklisted hits are scored on their own (risk component 'blocklisted_hosts')
+        """
+        url_intel = url_summary.pop('intel', None)
+        if url_intel is None:
+            url_intel = self.threat_intel.check_hosts(url_summary['hosts'])
+        return url_intel
     
     def _build_feature_vector(self, permissions, activities, services, 
                                receivers, providers, suspicious_features) -> List[float]:
@@ -312,109 +364,32 @@ class APKAnalyzer:
         Analyzes APK signing certificate to determine trustworthiness
         """
         try:
-            # Import cryptography library
-            from cryptography import x509
-            from cryptography.hazmat.backends import default_backend
-            
-            # Get certificate from APK
-            cert_der = apk.get_certificate_der()
+            # Get certificate from APK (v3, v2 or v1 signature)
+            cert_der, schemes = self._get_signer_certificate(apk)
             if not cert_der:
                 return {
                     'source': 'Unknown',
                     'verified': False,
                     'trust_score': 0.0,
+                    'signature_schemes': schemes,
                     'error': 'No certificate found in APK'
                 }
             
-            # Parse certificate
-            cert = x509.load_der_x509_certificate(cert_der, default_backend())
-            
-            # Extract basic information
-            issuer = cert.issuer.rfc4514_string()
-            subject = cert.subject.rfc4514_string()
-            
-            # Validity checks
-            now = datetime.utcnow()
-            is_expired = now > cert.not_valid_after
-            is_not_yet_valid = now < cert.not_valid_before
-            validity_days = (cert.not_valid_after - cert.not_valid_before).days
-            
-            # Self-signed check
-            is_self_signed = issuer == subject
-            
             # Calculate certificate hash
             cert_hash = hashlib.sha256(cert_der).hexdigest()
             
-            # Check against known certificate patterns
-            is_play_store = self._check_play_store_cert(cert_hash, issuer, subject)
-            is_known_publisher = self._check_known_publisher(issuer, subject)
-            
-            # Determine source and trust level
-            warnings = []
-            
-            if is_expired:
-                warnings.append('Certificate expired')
-            if is_not_yet_valid:
-                warnings.append('Certificate not yet valid')
-            if is_self_signed:
-                warnings.append('Self-signed certificate (not from trusted authority)')
-            if validity_days < 365:
-                warnings.append(f'Short validity period ({validity_days} days)')
-            if validity_days > 3650:  # > 10 years
-                warnings.append('Unusually long validity period')
-            
-            # Determine source
-            if is_play_store:
-                source = 'Google Play Store'
-                verified = True
-                trust_score = 1.0
-            elif is_known_publisher:
-                source = 'Known Publisher'
-                verified = True
-                trust_score = 0.85
-            elif not is_self_signed and validity_days >= 365 and not is_expired:
-                source = 'Third-party (Valid Certificate)'
-                verified = True
-                trust_score = 0.7
-            elif not is_self_signed:
-                source = 'Third-party (Certificate Issues)'
-                verified = False
-                trust_score = 0.4
+            # Many APKs share a signer - reuse the verification result
+            intel_version = self.threat_intel.version
+            result = self.cert_cache.get(cert_hash, intel_version)
+            if result is None:
+                result, not_before, not_after = self._verify_certificate(cert_der, cert_hash)
+                self.cert_cache.put(cert_hash, intel_version, result, not_before, not_after)
+                result['cached'] = False
             else:
-                source = 'Unknown / Untrusted'
-                verified = False
-                trust_score = 0.2
+                result['cached'] = True
             
-            # Extract organization info if available
-            org_name = None
-            try:
-                for attr in cert.subject:
-                    if attr.oid._name == 'organizationName':
-                        org_name = attr.value
-                        break
-            except:
-                pass
-            
-            return {
-                'source': source,
-                'verified': verified,
-                'trust_score': trust_score,
-                'certificate': {
-                    'issuer': issuer,
-                    'subject': subject,
-                    'organization': org_name,
-                    'valid_from': cert.not_valid_before.isoformat(),
-                    'valid_until': cert.not_valid_after.isoformat(),
-                    'is_expired': is_expired,
-                    'is_not_yet_valid': is_not_yet_valid,
-                    'is_self_signed': is_self_signed,
-                    'validity_days': validity_days,
-                    'signature_algorithm': cert.signature_algorithm_oid._name,
-                    'serial_number': str(cert.serial_number),
-                    'fingerprint_sha256': cert_hash
-                },
-                'warnings': warnings
-            }
+            result['signature_schemes'] = schemes
+            return result
             
         except ImportError:
             logger.warning("cryptography library not installed - source verification disabled")
@@ -433,60 +408,160 @@ class APKAnalyzer:
                 'error': str(e)
             }
     
-    def _check_play_store_cert(self, cert_hash: str, issuer: str, subject: str) -> bool:
+    def _get_signer_certificate(self, apk):
         """
-        Check if certificate matches known Google Play Store patterns
-        Note: Google Play certificates vary, but have certain patterns
+        Return (DER bytes of the signing certificate, signature schemes present)
+        Prefers APK Signature Scheme v3, then v2, then the v1 JAR signature
         """
-        # Google Play Store apps are typically signed by developers
-        # but distributed through Play Store with additional verification
-        # This is a simplified check - in production, maintain a database
+        schemes = []
+        for scheme in ('v1', 'v2', 'v3'):
+            checker = getattr(apk, f'is_signed_{scheme}', None)
+            try:
+                if checker is not None and checker():
+                    schemes.append(scheme)
+            except Exception:
+                pass
         
-        # Known Google certificate patterns
-        google_patterns = [
-            'CN=Android',
-            'CN=Google Inc',
-            'O=Google Inc',
-            'OU=Android'
-        ]
+        for getter in ('get_certificates_der_v3', 'get_certificates_der_v2'):
+            try:
+                certs = getattr(apk, getter)() if hasattr(apk, getter) else None
+            except Exception as e:
+                logger.debug("%s failed: %s", getter, e)
+                certs = None
+            if certs:
+                return certs[0], schemes
+        
+        # v1: certificate stored in META-INF/*.RSA|DSA|EC
+        try:
+            for name in apk.get_signature_names():
+                cert_der = apk.get_certificate_der(name)
+                if cert_der:
+                    return cert_der, schemes
+        except Exception as e:
+            logger.debug("v1 certificate lookup failed: %s", e)
+        
+        return None, schemes
+    
+    def _verify_certificate(self, cert_der: bytes, cert_hash: str):
+        """
+        Parse and evaluate a signing certificate
+        Returns (result, not_before epoch, not_after epoch)
+        """
+        # Import cryptography library
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        
+        # Parse certificate
+        cert = x509.load_der_x509_certificate(cert_der, default_backend())
+        
+        # Extract basic information
+        issuer = cert.issuer.rfc4514_string()
+        subject = cert.subject.rfc4514_string()
         
-        # Check if any Google patterns match
-        cert_string = f"{issuer} {subject}".upper()
-        for pattern in google_patterns:
-            if pattern.upper() in cert_string:
-                return True
+        # Validity checks
+        now = datetime.utcnow()
+        is_expired = now > cert.not_valid_after
+        is_not_yet_valid = now < cert.not_valid_before
+        validity_days = (cert.not_valid_after - cert.not_valid_before).days
         
-        # You can add specific certificate hashes of known Google certificates here
-        # GOOGLE_PLAY_CERTS = {'hash1', 'hash2', ...}
-        # return cert_hash in GOOGLE_PLAY_CERTS
+        # Self-signed check
+        is_self_signed = issuer == subject
         
-        return False
+        # Check against local threat intel (fingerprint + publisher indexes)
+        intel = self.threat_intel.check_certificate(cert_hash, issuer, subject)
+        is_play_store = intel['play_store']
+        is_known_publisher = intel['known_publisher'] or intel['allowlisted']
+        
+        # Determine source and trust level
+        warnings = []
+        
+        if intel['blocked']:
+            warnings.append('Certificate on threat-intel blocklist')
+        if is_expired:
+            warnings.append('Certificate expired')
+        if is_not_yet_valid:
+            warnings.append('Certificate not yet valid')
+        if is_self_signed:
+            warnings.append('Self-signed certificate (not from trusted authority)')
+        if validity_days < 365:
+            warnings.append(f'Short validity period ({validity_days} days)')
+        if validity_days > 3650:  # > 10 years
+            warnings.append('Unusually long validity period')
+        
+        # Determine source
+        if intel['blocked']:
+            source = 'Blocklisted Signer'
+            verified = False
+            trust_score = 0.0
+        elif is_play_store:
+            source = 'Google Play Store'
+            verified = True
+            trust_score = 1.0
+        elif is_known_publisher:
+            source = 'Known Publisher'
+            verified = True
+            trust_score = 0.85
+        elif not is_self_signed and validity_days >= 365 and not is_expired:
+            source = 'Third-party (Valid Certificate)'
+            verified = True
+            trust_score = 0.7
+        elif not is_self_signed:
+            source = 'Third-party (Certificate Issues)'
+            verified = False
+            trust_score = 0.4
+        else:
+            source = 'Unknown / Untrusted'
+            verified = False
+            trust_score = 0.2
+        
+        # Extract organization info if available
+        org_name = None
+        try:
+            for attr in cert.subject:
+                if attr.oid._name == 'organizationName':
+                    org_name = attr.value
+                    break
+        except:
+            pass
+        
+        result = {
+            'source': source,
+            'verified': verified,
+            'trust_score': trust_score,
+            'certificate': {
+                'issuer': issuer,
+                'subject': subject,
+                'organization': org_name,
+                'valid_from': cert.not_valid_before.isoformat(),
+                'valid_until': cert.not_valid_after.isoformat(),
+                'is_expired': is_expired,
+                'is_not_yet_valid': is_not_yet_valid,
+                'is_self_signed': is_self_signed,
+                'validity_days': validity_days,
+                'signature_algorithm': cert.signature_algorithm_oid._name,
+                'serial_number': str(cert.serial_number),
+                'fingerprint_sha256': cert_hash
+            },
+            'threat_intel': intel,
+            'warnings': warnings
+        }
+        
+        not_before = cert.not_valid_before.replace(tzinfo=timezone.utc).timestamp()
+        not_after = cert.not_valid_after.replace(tzinfo=timezone.utc).timestamp()
+        return result, not_before, not_after
+    
+    def _check_play_store_cert(self, cert_hash: str, issuer: str, subject: str) -> bool:
+        """
+        Check if certificate matches known Google Play Store patterns
+        Looks up the fingerprint and publisher DN in the threat-intel indexes
+        """
+        return self.threat_intel.check_certificate(cert_hash, issuer, subject)['play_store']
     
     def _check_known_publisher(self, issuer: str, subject: str) -> bool:
         """
         Check if certificate is from a known reputable publisher
         """
-        # List of known reputable publishers/organizations
-        known_publishers = [
-            'CN=Facebook',
-            'CN=Twitter',
-            'CN=Microsoft',
-            'CN=Amazon',
-            'CN=WhatsApp',
-            'O=Facebook',
-            'O=Microsoft Corporation',
-            'O=Amazon',
-            'O=Samsung',
-            'O=Xiaomi',
-            'O=Huawei'
-        ]
-        
-        cert_string = f"{issuer} {subject}".upper()
-        for publisher in known_publishers:
-            if publisher.upper() in cert_string:
-                return True
-        
-        return False
+        return self.threat_intel.check_certificate('', issuer, subject)['known_publisher']
     
     def _build_minimal_feature_vector(self, file_list: List[str]) -> List[float]:
         """Build minimal feature vector when Androguard is not available"""
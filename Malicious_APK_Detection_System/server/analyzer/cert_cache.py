@@ -0,0 +1,76 @@
+"""
+Certificate Verification Cache
+Bounded LRU cache of verify_source results keyed by signer fingerprint
+"""
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CertificateVerificationCache:
+    """
+    Caches full certificate verification results per SHA-256 fingerprint
+    Entries are re-evaluated when a validity boundary passes, the TTL expires
+    or the threat-intel version changes
+    """
+
+    def __init__(self, max_entries=4096, ttl=3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint: str, intel_version: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result, or None if missing or stale"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None or entry['intel_version'] != intel_version or now >= entry['revalidate_at']:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            result = entry['result']
+        return copy.deepcopy(result)
+
+    def put(self, fingerprint: str, intel_version: str, result: Dict[str, Any],
+            not_before: Optional[float] = None, not_after: Optional[float] = None):
+        """
+        Store a verification result
+        not_before/not_after (epoch seconds) bound how long expiry flags stay correct
+        """
+        now = time.time()
+        revalidate_at = now + self.ttl
+        for boundary in (not_before, not_after):
+            if boundary is not None and boundary > now:
+                revalidate_at = min(revalidate_at, boundary)
+
+        with self._lock:
+            self._entries[fingerprint] = {
+                'result': copy.deepcopy(result),
+                'intel_version': intel_version,
+                'revalidate_at': revalidate_at
+            }
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -1,71 +1,411 @@
 """
 Machine Learning based Malware Prediction
 """
+import json
 import logging
 import os
 import pickle
+import random
+import threading
+import time
 import numpy as np
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
+from monitoring.metrics import timed, FALLBACKS, MODEL_RELOADS, MODEL_PREDICTIONS, STUDENT_PREDICTIONS
+from .model_artifact import load_artifact, ARTIFACT_SUFFIX
+from .shadow import ShadowScorer
 
 logger = logging.getLogger(__name__)
 
+# Registry layout written by model_training/model_registry.py
+REGISTRY_CURRENT_FILE = 'CURRENT'
+REGISTRY_ARTIFACT_FILE = 'model' + ARTIFACT_SUFFIX
+REGISTRY_STUDENT_FILE = 'student' + ARTIFACT_SUFFIX
+REGISTRY_MODEL_FILE = 'model.pkl'
+REGISTRY_SCALER_FILE = 'scaler.pkl'
+REGISTRY_METADATA_FILE = 'metadata.json'
+MODEL_INFO_KEYS = ('version', 'model_type', 'n_features', 'training_date')
+
+# Length of the feature vector built by APKAnalyzer._build_feature_vector
+EXPECTED_FEATURES = 50
+
+
+class LoadedModel:
+    """Model, scaler and metadata of one version; replaced as a single reference"""
+    
+    __slots__ = ('model', 'scaler', 'metadata', 'version', 'source', 'student', 'student_threshold')
+    
+    def __init__(self, model, scaler, metadata, version, source):
+        self.model = model
+        self.scaler = scaler
+        self.metadata = metadata
+        self.version = version
+        self.source = source
+        self.student = None  # distilled model tried first (shares the scaler)
+        self.student_threshold = None
+
 
 class MalwarePredictor:
-    """ML-based malware detection using trained model"""
+    """
+    ML-based malware detection using trained model
+    The promoted registry version (or the legacy model file) is polled every
+    reload_interval seconds; a changed model is loaded and validated in a
+    background thread and swapped in without blocking predictions. With a
+    canary percentage, a new version first serves that share of requests for
+    canary_seconds before it replaces the current one. A version trained with
+    distillation serves its compact student and falls back to the full model
+    when the student's confidence is below the threshold.
+    """
     
-    def __init__(self, model_path='../model_training/models/malwares_model.pkl'):
-        self.model = None
-        self.scaler = None
-        self.metadata = None
+    def __init__(self, model_path='../model_training/models/malwares_model.pkl', registry_dir=None,
+                 reload_interval=None, canary_percent=None, canary_seconds=None, shadow_models=None,
+                 serve_student=None, student_min_confidence=None):
         self.model_path = model_path
-        self.model_available = False
+        self.registry_dir = registry_dir or os.environ.get(
+            'MODEL_REGISTRY_DIR', '../model_training/models/registry'
+        )
+        self.reload_interval = float(reload_interval if reload_interval is not None
+                                     else os.environ.get('MODEL_RELOAD_INTERVAL', 10))
+        self.canary_percent = float(canary_percent if canary_percent is not None
+                                    else os.environ.get('MODEL_CANARY_PERCENT', 0))
+        self.canary_seconds = float(canary_seconds if canary_seconds is not None
+                                    else os.environ.get('MODEL_CANARY_SECONDS', 600))
+        self.serve_student = (serve_student if serve_student is not None
+                              else os.environ.get('MODEL_SERVE_STUDENT', '1').lower() not in ('0', 'false', 'no'))
+        # Overrides the threshold chosen at training time (metadata['distillation']['min_confidence'])
+        threshold = (student_min_confidence if student_min_confidence is not None
+                     else os.environ.get('MODEL_STUDENT_MIN_CONFIDENCE'))
+        self.student_min_confidence = float(threshold) if threshold not in (None, '') else None
+        self._active = None  # LoadedModel serving traffic
+        self._canary = None  # (LoadedModel, started_at) while a canary rollout runs
+        self._source = None  # registry version / model file mtime last loaded
+        self._failed_source = None
+        self._reload_lock = threading.Lock()  # held for the whole (slow) load
+        self._swap_lock = threading.Lock()
+        self._next_check = time.monotonic() + self.reload_interval
         self._load_model()
+        self.shadow = self._init_shadow(
+            shadow_models if shadow_models is not None
+            else [m.strip() for m in os.environ.get('SHADOW_MODELS', '').split(',') if m.strip()]
+        )
+    
+    @property
+    def model(self):
+        return self._active.model if self._active else None
+    
+    @property
+    def scaler(self):
+        return self._active.scaler if self._active else None
+    
+    @property
+    def metadata(self):
+        return self._active.metadata if self._active else None
+    
+    @property
+    def model_version(self):
+        return self._active.version if self._active else None
+    
+    @property
+    def model_available(self):
+        return self._active is not None
+    
+    def _current_registry_version(self):
+        """Version id promoted in the model registry, or None"""
+        current_path = os.path.join(self.registry_dir, REGISTRY_CURRENT_FILE)
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path) as f:
+            return f.read().strip() or None
+    
+    def _detect_source(self) -> Optional[Tuple[str, Any]]:
+        """What should be served: ('registry', version), ('path', mtime) or None"""
+        version = self._current_registry_version()
+        if version:
+            return ('registry', version)
+        try:
+            return ('path', os.path.getmtime(self._legacy_model_file()))
+        except OSError:
+            return None
+    
+    def _legacy_model_file(self):
+        """model_path, or the artifact next to it when one has been written"""
+        artifact_path = os.path.splitext(self.model_path)[0] + ARTIFACT_SUFFIX
+        return artifact_path if os.path.exists(artifact_path) else self.model_path
+    
+    def _read_model(self, source) -> LoadedModel:
+        """Load model, scaler and metadata for a source returned by _detect_source"""
+        if source[0] == 'registry':
+            version_dir = os.path.join(self.registry_dir, 'versions', source[1])
+            artifact_path = os.path.join(version_dir, REGISTRY_ARTIFACT_FILE)
+            student_path = os.path.join(version_dir, REGISTRY_STUDENT_FILE)
+            model_path = os.path.join(version_dir, REGISTRY_MODEL_FILE)
+            scaler_path = os.path.join(version_dir, REGISTRY_SCALER_FILE)
+            metadata_path = os.path.join(version_dir, REGISTRY_METADATA_FILE)
+        elif source[0] == 'file':
+            student_path = None
+            artifact_path = model_path = source[1]
+            scaler_path = model_path.replace('.pkl', '_scaler.pkl')
+            metadata_path = model_path.replace('.pkl', '_metadata.pkl')
+        else:
+            student_path = None
+            artifact_path = self._legacy_model_file()
+            model_path = self.model_path
+            scaler_path = self.model_path.replace('.pkl', '_scaler.pkl')
+            metadata_path = self.model_path.replace('.pkl', '_metadata.pkl')
+        
+        if artifact_path.endswith(ARTIFACT_SUFFIX) and os.path.exists(artifact_path):
+            loaded = self._read_artifact(source, artifact_path, metadata_path)
+        else:
+            loaded = self._read_pickles(source, model_path, scaler_path, metadata_path)
+        if student_path is not None and self.serve_student:
+            self._attach_student(loaded, student_path)
+        return loaded
+    
+    def _read_pickles(self, source, model_path, scaler_path, metadata_path) -> LoadedModel:
+        """Load a pickled model with its scaler and metadata files"""
+        # Load main model
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        logger.info(f"✓ ML model loaded from {model_path}")
+        
+        # Load scaler
+        scaler = None
+        if os.path.exists(scaler_path):
+            with open(scaler_path, 'rb') as f:
+                scaler = pickle.load(f)
+            logger.info(f"✓ Scaler loaded from {scaler_path}")
+        else:
+            logger.warning(f"Scaler not found at {scaler_path}")
+        
+        # Load metadata
+        metadata = None
+        if os.path.exists(metadata_path):
+            if metadata_path.endswith('.json'):
+                with open(metadata_path) as f:
+                    metadata = json.load(f)
+            else:
+                with open(metadata_path, 'rb') as f:
+                    metadata = pickle.load(f)
+            logger.info(f"✓ Metadata loaded: {self._describe(metadata)}")
+        else:
+            logger.warning(f"Metadata not found at {metadata_path}")
+        
+        version = self._version_for(source, metadata)
+        return LoadedModel(model, scaler, metadata, version, source)
+    
+    def _read_artifact(self, source, artifact_path, metadata_path) -> LoadedModel:
+        """Memory-map a single-file model artifact (model + scaler + metadata)"""
+        model, scaler, metadata = load_artifact(artifact_path)
+        logger.info(f"✓ ML model artifact mapped from {artifact_path} ({model.estimator})")
+        
+        # The registry's metadata.json carries the version id and file list
+        if metadata_path.endswith('.json') and os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        logger.info(f"✓ Metadata loaded: {self._describe(metadata)}")
+        
+        version = self._version_for(source, metadata)
+        return LoadedModel(model, scaler, metadata, version, source)
+    
+    def _attach_student(self, loaded: LoadedModel, student_path: str):
+        """Load the distilled student of a version; without one the teacher serves alone"""
+        distillation = (loaded.metadata or {}).get('distillation')
+        if not distillation or not os.path.exists(student_path):
+            return
+        try:
+            student, _, _ = load_artifact(student_path)
+            if getattr(student, 'n_features_in_', EXPECTED_FEATURES) != EXPECTED_FEATURES:
+                raise ValueError(f"student expects {student.n_features_in_} features")
+            probe = np.zeros((1, EXPECTED_FEATURES))
+            if loaded.scaler is not None:
+                probe = loaded.scaler.transform(probe)
+            student.predict_proba(probe)
+        except Exception as e:
+            logger.warning(f"Distilled student of {loaded.version} not used: {str(e)}")
+            return
+        loaded.student = student
+        loaded.student_threshold = (self.student_min_confidence if self.student_min_confidence is not None
+                                    else float(distillation.get('min_confidence', 0.8)))
+        logger.info(f"✓ Distilled student loaded ({student.estimator}, "
+                    f"teacher fallback below {loaded.student_threshold:.0%} confidence)")
+    
+    @staticmethod
+    def _version_for(source, metadata) -> str:
+        if source[0] == 'registry':
+            return source[1]
+        if source[0] == 'file':
+            return os.path.basename(source[1])
+        return (metadata or {}).get('version', 'legacy')
+    
+    def load_candidate(self, spec: str) -> LoadedModel:
+        """Load and validate a model by registry version or file path (not served)"""
+        if os.path.isdir(os.path.join(self.registry_dir, 'versions', spec)):
+            source = ('registry', spec)
+        elif os.path.exists(spec):
+            source = ('file', spec)
+        else:
+            raise ValueError(f"Unknown model version or path: {spec}")
+        loaded = self._read_model(source)
+        self._validate(loaded)
+        return loaded
+    
+    def _init_shadow(self, specs: List[str]) -> Optional[ShadowScorer]:
+        """Load shadow candidates; a candidate that fails to load is skipped"""
+        candidates = {}
+        for spec in specs:
+            try:
+                loaded = self.load_candidate(spec)
+                candidates[loaded.version] = loaded
+            except Exception as e:
+                logger.error(f"Shadow model {spec} not loaded: {str(e)}")
+        if not candidates:
+            return None
+        logger.info(f"Shadow scoring enabled for: {', '.join(candidates)}")
+        return ShadowScorer(candidates, log_path=os.environ.get('SHADOW_LOG', 'logs/shadow_predictions.jsonl'))
+    
+    def shadow_report(self) -> Dict[str, Any]:
+        """Agreement / drift / cost summary of shadow models against the primary"""
+        if self.shadow is None:
+            return {'enabled': False}
+        return dict(self.shadow.report(), enabled=True)
+    
+    def _validate(self, loaded: LoadedModel):
+        """Reject models whose feature layout does not match the analyzer's vector"""
+        counts = {
+            'model': getattr(loaded.model, 'n_features_in_', None),
+            'scaler': getattr(loaded.scaler, 'n_features_in_', None),
+            'metadata': (loaded.metadata or {}).get('n_features')
+        }
+        schema = (loaded.metadata or {}).get('feature_schema')
+        if schema is not None:
+            counts['feature_schema'] = len(schema)
+        mismatched = {k: v for k, v in counts.items() if v is not None and v != EXPECTED_FEATURES}
+        if mismatched:
+            raise ValueError(f"feature count mismatch (expected {EXPECTED_FEATURES}): {mismatched}")
+        
+        # A prediction on an empty vector catches models that load but cannot score
+        probe = np.zeros((1, EXPECTED_FEATURES))
+        if loaded.scaler is not None:
+            probe = loaded.scaler.transform(probe)
+        loaded.model.predict(probe)
     
     def _load_model(self):
         """Load trained ML model, scaler, and metadata"""
+        source = None
         try:
-            # Load main model
-            if os.path.exists(self.model_path):
-                with open(self.model_path, 'rb') as f:
-                    self.model = pickle.load(f)
-                logger.info(f"✓ ML model loaded from {self.model_path}")
-                
-                # Load scaler
-                scaler_path = self.model_path.replace('.pkl', '_scaler.pkl')
-                if os.path.exists(scaler_path):
-                    with open(scaler_path, 'rb') as f:
-                        self.scaler = pickle.load(f)
-                    logger.info(f"✓ Scaler loaded from {scaler_path}")
-                else:
-                    logger.warning(f"Scaler not found at {scaler_path}")
-                
-                # Load metadata
-                metadata_path = self.model_path.replace('.pkl', '_metadata.pkl')
-                if os.path.exists(metadata_path):
-                    with open(metadata_path, 'rb') as f:
-                        self.metadata = pickle.load(f)
-                    logger.info(f"✓ Metadata loaded: {self.metadata}")
-                else:
-                    logger.warning(f"Metadata not found at {metadata_path}")
-                
-                self.model_available = True
-                logger.info("ML prediction system ready")
-            else:
+            source = self._detect_source()
+            if source is None:
                 logger.warning(f"ML model not found at {self.model_path}")
                 logger.info("Using rule-based fallback prediction")
+                return
+            loaded = self._read_model(source)
+            self._validate(loaded)
+            self._active = loaded
+            self._source = source
+            logger.info(f"ML prediction system ready (model version {loaded.version})")
         except Exception as e:
             logger.error(f"Failed to load ML model: {str(e)}")
-            self.model_available = False
+            self._failed_source = source
+    
+    def maybe_reload(self, force=False) -> bool:
+        """
+        Start loading a changed model (checked at most every reload_interval)
+        Returns True when a reload was started; with force=True it runs synchronously
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        started = False
+        try:
+            self._next_check = now + self.reload_interval
+            source = self._detect_source()
+            if source is None or source == self._source or source == self._failed_source:
+                return False
+            if force:
+                self._reload(source)
+            else:
+                threading.Thread(target=self._reload_in_background, args=(source,),
+                                 name='model-reload', daemon=True).start()
+                started = True
+            return True
+        finally:
+            if not started:
+                self._reload_lock.release()
+    
+    def _reload_in_background(self, source):
+        try:
+            self._reload(source)
+        finally:
+            self._reload_lock.release()
+    
+    def _reload(self, source):
+        """Load and validate a new model, then swap it in (or start a canary)"""
+        try:
+            loaded = self._read_model(source)
+            self._validate(loaded)
+        except Exception as e:
+            logger.error(f"Rejected ML model {source[1]}: {str(e)} - keeping version {self.model_version}")
+            MODEL_RELOADS.inc(outcome='rejected')
+            self._failed_source = source
+            return
+        
+        self._source = source
+        self._failed_source = None
+        with self._swap_lock:
+            if self._active is not None and self.canary_percent > 0:
+                self._canary = (loaded, time.monotonic())
+                MODEL_RELOADS.inc(outcome='canary')
+                logger.info(f"ML model canary started: {loaded.version} serves {self.canary_percent:g}% "
+                            f"of predictions for {self.canary_seconds:g}s (primary: {self.model_version})")
+            else:
+                self._swap(loaded)
+    
+    def _swap(self, loaded: LoadedModel):
+        """Make a model the primary one (caller holds _swap_lock)"""
+        previous = self.model_version
+        self._active = loaded  # atomic reference swap
+        self._canary = None
+        MODEL_RELOADS.inc(outcome='loaded')
+        logger.info(f"ML model version switched: {previous} -> {loaded.version}")
+    
+    def _abort_canary(self, canary: LoadedModel, reason: str):
+        with self._swap_lock:
+            current = self._canary
+            if current is None or current[0] is not canary:
+                return
+            self._canary = None
+        MODEL_RELOADS.inc(outcome='canary_aborted')
+        logger.error(f"ML model canary {canary.version} aborted: {reason} - "
+                     f"keeping version {self.model_version}")
+    
+    def _select_model(self) -> Tuple[Optional[LoadedModel], bool]:
+        """Pick the model for one prediction; returns (model, is_canary)"""
+        canary = self._canary
+        if canary is not None:
+            loaded, started_at = canary
+            if time.monotonic() - started_at >= self.canary_seconds:
+                with self._swap_lock:
+                    if self._canary is canary:
+                        self._swap(loaded)
+                return self._active, False
+            if random.random() * 100 < self.canary_percent:
+                return loaded, True
+        return self._active, False
     
     def predict(self, features: List[float]) -> Dict[str, Any]:
         """
         Predict if APK is malicious
         """
         try:
-            if self.model_available and self.model:
-                return self._predict_with_model(features)
+            self.maybe_reload()
+            loaded, is_canary = self._select_model()
+            if loaded is not None:
+                return self._predict_with_model(features, loaded, is_canary)
             else:
-                return self._predict_rule_based(features)
+                FALLBACKS.inc(component='ml')
+                with timed('ml.rule_based'):
+                    return self._predict_rule_based(features)
         except Exception as e:
             logger.error(f"Prediction failed: {str(e)}")
             return {
@@ -75,42 +415,98 @@ class MalwarePredictor:
                 'error': str(e)
             }
     
-    def _predict_with_model(self, features: List[float]) -> Dict[str, Any]:
+    def predict_rule_based(self, features: List[float]) -> Dict[str, Any]:
+        """Heuristic scoring without the model (cheapest tier under load)"""
+        with timed('ml.rule_based'):
+            return self._predict_rule_based(features)
+    
+    def _predict_with_model(self, features: List[float], loaded: Optional[LoadedModel] = None,
+                            is_canary: bool = False) -> Dict[str, Any]:
         """Predict using trained ML model"""
+        loaded = loaded or self._active
         try:
+            start = time.perf_counter()
             # Ensure features is numpy array with correct shape
             features_array = np.array(features).reshape(1, -1)
             
             # Apply feature scaling if scaler is available
-            if self.scaler is not None:
-                features_array = self.scaler.transform(features_array)
+            if loaded.scaler is not None:
+                with timed('ml.scaling'):
+                    features_array = loaded.scaler.transform(features_array)
                 logger.debug("Features scaled using trained scaler")
             
-            # Get prediction
-            prediction = self.model.predict(features_array)[0]
+            served_by = 'teacher'
+            with timed('ml.inference'):
+                # Distilled student first; low-confidence samples go to the full model
+                if loaded.student is not None:
+                    probabilities = loaded.student.predict_proba(features_array)[0]
+                    if float(max(probabilities)) >= loaded.student_threshold:
+                        served_by = 'student'
+                        prediction = loaded.student.classes_[int(np.argmax(probabilities))]
+                        confidence = float(max(probabilities))
+                        malware_probability = float(probabilities[-1])
+                    STUDENT_PREDICTIONS.inc(outcome='served' if served_by == 'student' else 'fallback')
+                
+                if served_by == 'teacher':
+                    # Get prediction
+                    prediction = loaded.model.predict(features_array)[0]
+                    
+                    # Get probability if available
+                    if hasattr(loaded.model, 'predict_proba'):
+                        probabilities = loaded.model.predict_proba(features_array)[0]
+                        confidence = float(max(probabilities))
+                        malware_probability = float(probabilities[-1])
+                    else:
+                        confidence = 0.85 if prediction == 1 else 0.15
+                        malware_probability = float(prediction == 1)
+            elapsed = time.perf_counter() - start
             
-            # Get probability if available
-            if hasattr(self.model, 'predict_proba'):
-                probabilities = self.model.predict_proba(features_array)[0]
-                confidence = float(max(probabilities))
-                logger.info(f"ML Prediction: {'Malware' if prediction else 'Benign'} (confidence: {confidence:.2%})")
-            else:
-                confidence = 0.85 if prediction == 1 else 0.15
+            if served_by == 'student' or hasattr(loaded.model, 'predict_proba'):
+                logger.info("ML Prediction: %s (confidence: %.2f%%)", 'Malware' if prediction else 'Benign',
+                            confidence * 100, extra={'log_class': 'ml.prediction'})
+            MODEL_PREDICTIONS.inc(version=loaded.version)
+            if self.shadow is not None and not is_canary:
+                self.shadow.submit(features, loaded.version, bool(prediction), malware_probability, elapsed)
             
             # Determine malware type based on features
             malware_type = self._determine_malware_type(features, prediction)
             
+            model_info = self._model_info(loaded)
+            if is_canary and model_info is not None:
+                model_info['canary'] = True
+            if loaded.student is not None and model_info is not None:
+                model_info['served_by'] = served_by
+            
             return {
                 'is_malware': bool(prediction),
                 'confidence': round(confidence, 2),
                 'malware_type': malware_type,
                 'method': 'ml_model',
-                'model_info': self.metadata if self.metadata else None
+                'model_info': model_info
             }
         except Exception as e:
+            if is_canary and self._active is not None:
+                self._abort_canary(loaded, str(e))
+                return self._predict_with_model(features, self._active)
             logger.error(f"ML prediction failed: {str(e)}")
+            FALLBACKS.inc(component='ml')
             return self._predict_rule_based(features)
     
+    @staticmethod
+    def _describe(metadata):
+        if isinstance(metadata, dict):
+            return {key: metadata.get(key) for key in MODEL_INFO_KEYS if key in metadata}
+        return metadata
+    
+    def _model_info(self, loaded: Optional[LoadedModel] = None):
+        """Compact model description returned with each prediction"""
+        loaded = loaded or self._active
+        if loaded is None:
+            return None
+        info = dict(self._describe(loaded.metadata) or {})
+        info['version'] = loaded.version
+        return info
+    
     def _predict_rule_based(self, features: List[float]) -> Dict[str, Any]:
         """
         Fallback rule-based prediction
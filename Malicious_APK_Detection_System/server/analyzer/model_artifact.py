@@ -0,0 +1,351 @@
+"""
+Model Artifact Format
+Single-file, versioned model package whose arrays can be memory-mapped
+
+Layout:
+    8 bytes   magic b'APKMODEL'
+    4 bytes   format version (little-endian uint32)
+    8 bytes   header length (little-endian uint64)
+    header    UTF-8 JSON: kind, params, metadata and the array table
+    arrays    raw little-endian arrays, each aligned to ARRAY_ALIGNMENT bytes
+
+Loading maps the file read-only, so every worker process serving the same
+artifact shares its pages instead of unpickling a private copy of the model.
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b'APKMODEL'
+FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+ARTIFACT_SUFFIX = '.apkm'
+_PREAMBLE = struct.Struct('<8sIQ')
+
+
+class ArtifactError(ValueError):
+    """Raised for unreadable artifacts or models that cannot be exported"""
+
+
+# ---------------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------------
+
+def _export_trees(trees, value_fn) -> Tuple[Dict[str, np.ndarray], int]:
+    """Flatten fitted sklearn trees into one set of node arrays with global indices"""
+    nodes = []
+    max_depth = 0
+    for tree in trees:
+        t = tree.tree_
+        missing_left = getattr(t, 'missing_go_to_left', None)
+        nodes.append({
+            'left': t.children_left, 'right': t.children_right, 'feature': t.feature,
+            'threshold': t.threshold, 'value': value_fn(t),
+            'missing_left': missing_left if missing_left is not None else np.zeros(t.node_count),
+        })
+        max_depth = max(max_depth, int(t.max_depth))
+    return _flatten_nodes(nodes), max_depth
+
+
+def _export_hist_predictors(predictors) -> Tuple[Dict[str, np.ndarray], int]:
+    """Flatten HistGradientBoosting TreePredictor node tables (binary: one tree per iteration)"""
+    nodes = []
+    max_depth = 0
+    for (predictor,) in predictors:
+        table = predictor.nodes
+        if table['is_categorical'].any():
+            raise ArtifactError("Categorical splits are not supported")
+        is_leaf = table['is_leaf'].astype(bool)
+        nodes.append({
+            'left': np.where(is_leaf, -1, table['left'].astype(np.int64)),
+            'right': np.where(is_leaf, -1, table['right'].astype(np.int64)),
+            'feature': table['feature_idx'], 'threshold': table['num_threshold'],
+            'value': table['value'][:, None], 'missing_left': table['missing_go_to_left'],
+        })
+        max_depth = max(max_depth, int(table['depth'].max()))
+    return _flatten_nodes(nodes), max_depth
+
+
+def _flatten_nodes(trees) -> Dict[str, np.ndarray]:
+    """Concatenate per-tree node tables, rewriting child indices to global ones"""
+    roots, features, thresholds, lefts, rights, values, missing = [], [], [], [], [], [], []
+    offset = 0
+    for t in trees:
+        left = np.asarray(t['left'], dtype=np.int64)
+        is_leaf = left < 0
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, t['feature']).astype(np.int32))
+        thresholds.append(np.asarray(t['threshold'], dtype=np.float64))
+        lefts.append(np.where(is_leaf, -1, left + offset).astype(np.int32))
+        rights.append(np.where(is_leaf, -1, np.asarray(t['right'], dtype=np.int64) + offset).astype(np.int32))
+        values.append(np.asarray(t['value'], dtype=np.float64))
+        missing.append(np.asarray(t['missing_left'], dtype=np.uint8))
+        offset += len(left)
+    return {
+        'tree_roots': np.asarray(roots, dtype=np.int32),
+        'tree_feature': np.concatenate(features),
+        'tree_threshold': np.concatenate(thresholds),
+        'tree_left': np.concatenate(lefts),
+        'tree_right': np.concatenate(rights),
+        'tree_value': np.concatenate(values),
+        'tree_missing_left': np.concatenate(missing),
+    }
+
+
+def _class_probabilities(tree):
+    value = tree.value[:, 0, :]
+    totals = value.sum(axis=1, keepdims=True)
+    return value / np.where(totals == 0, 1, totals)
+
+
+def export_model(model) -> Tuple[str, Dict[str, Any], Dict[str, np.ndarray]]:
+    """Convert a fitted estimator into (kind, params, arrays)"""
+    n_features = int(getattr(model, 'n_features_in_', 0))
+    classes = getattr(model, 'classes_', None)
+
+    # Linear model over pairwise interaction features: Pipeline(PolynomialFeatures, linear)
+    if hasattr(model, 'steps'):
+        return _export_interaction_pipeline(model)
+
+    # Histogram gradient boosting: leaf values already include the learning rate
+    if hasattr(model, '_predictors') and hasattr(model, '_baseline_prediction'):
+        if np.size(model._baseline_prediction) != 1:
+            raise ArtifactError("Only binary histogram gradient boosting models can be exported")
+        arrays, max_depth = _export_hist_predictors(model._predictors)
+        params = {'learning_rate': 1.0, 'init_raw': float(np.ravel(model._baseline_prediction)[0]),
+                  'max_depth': max_depth, 'input_dtype': 'float64'}
+        kind = 'gbdt'
+    # Gradient boosting: estimators_ is an (n_estimators, 1) array of regression trees
+    elif hasattr(model, 'estimators_') and isinstance(model.estimators_, np.ndarray) \
+            and hasattr(model, 'learning_rate'):
+        if model.estimators_.shape[1] != 1:
+            raise ArtifactError("Only binary gradient boosting models can be exported")
+        arrays, max_depth = _export_trees(model.estimators_[:, 0], lambda t: t.value[:, 0, :1])
+        init = float(model._raw_predict_init(np.zeros((1, n_features)))[0, 0])
+        params = {'learning_rate': float(model.learning_rate), 'init_raw': init, 'max_depth': max_depth,
+                  'input_dtype': 'float32'}
+        kind = 'gbdt'
+    # Random forest / extra trees / single decision tree
+    elif hasattr(model, 'estimators_') or hasattr(model, 'tree_'):
+        trees = model.estimators_ if hasattr(model, 'estimators_') else [model]
+        if any(not hasattr(t, 'tree_') or t.tree_.n_outputs != 1 for t in trees):
+            raise ArtifactError(f"Unsupported tree ensemble: {type(model).__name__}")
+        arrays, max_depth = _export_trees(trees, _class_probabilities)
+        params = {'max_depth': max_depth, 'input_dtype': 'float32'}
+        kind = 'forest'
+    # Linear models (SGD / logistic regression)
+    elif hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        if model.coef_.shape[0] != 1:
+            raise ArtifactError("Only binary linear models can be exported")
+        arrays = {
+            'linear_coef': np.asarray(model.coef_[0], dtype=np.float64),
+            'linear_intercept': np.asarray(model.intercept_, dtype=np.float64),
+        }
+        params = {'has_proba': hasattr(model, 'predict_proba')}
+        kind = 'linear'
+    else:
+        raise ArtifactError(f"Unsupported model type: {type(model).__name__}")
+
+    if classes is None:
+        raise ArtifactError("Model has no classes_ - is it fitted?")
+    arrays['classes'] = np.asarray(classes, dtype=np.int64)
+    params.update({'n_features': n_features, 'estimator': type(model).__name__})
+    return kind, params, arrays
+
+
+def _export_interaction_pipeline(pipeline) -> Tuple[str, Dict[str, Any], Dict[str, np.ndarray]]:
+    """Store PolynomialFeatures(interaction_only) terms as (i, j) index pairs, j = -1 for x_i alone"""
+    if len(pipeline.steps) != 2 or not hasattr(pipeline.steps[0][1], 'powers_'):
+        raise ArtifactError("Only Pipeline(PolynomialFeatures, linear model) can be exported")
+    expander, estimator = pipeline.steps[0][1], pipeline.steps[1][1]
+    kind, params, arrays = export_model(estimator)
+    powers = np.asarray(expander.powers_)
+    degrees = powers.sum(axis=1)
+    if kind != 'linear' or powers.max() > 1 or degrees.max() > 2 or degrees.min() < 1:
+        raise ArtifactError("Only degree-2 interaction features without bias are supported")
+
+    terms = np.full((len(powers), 2), -1, dtype=np.int32)
+    for row, power in enumerate(powers):
+        idx = np.flatnonzero(power)
+        terms[row, :len(idx)] = idx
+    arrays['linear_terms'] = terms
+    params.update({'n_features': int(expander.n_features_in_),
+                   'estimator': f"{type(expander).__name__}+{params['estimator']}"})
+    return kind, params, arrays
+
+
+def export_scaler(scaler) -> Dict[str, np.ndarray]:
+    """StandardScaler parameters as arrays (missing mean/scale become identity)"""
+    n_features = int(scaler.n_features_in_)
+    mean = getattr(scaler, 'mean_', None)
+    scale = getattr(scaler, 'scale_', None)
+    return {
+        'scaler_mean': np.asarray(mean if mean is not None else np.zeros(n_features), dtype=np.float64),
+        'scaler_scale': np.asarray(scale if scale is not None else np.ones(n_features), dtype=np.float64),
+    }
+
+
+def save_artifact(path: str, model, scaler=None, metadata: Optional[Dict[str, Any]] = None) -> str:
+    """Write model (+ scaler and metadata) to a single artifact file atomically"""
+    kind, params, arrays = export_model(model)
+    if scaler is not None:
+        arrays.update(export_scaler(scaler))
+
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        arrays[name] = array
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({
+        'format_version': FORMAT_VERSION,
+        'kind': kind,
+        'params': params,
+        'metadata': metadata or {},
+        'arrays': table,
+    }, default=str).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _align(n: int) -> int:
+    return (n + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+# ---------------------------------------------------------------------------
+# Load + inference
+# ---------------------------------------------------------------------------
+
+class ArtifactScaler:
+    """StandardScaler.transform over memory-mapped parameters"""
+
+    def __init__(self, mean: np.ndarray, scale: np.ndarray):
+        self.mean_ = mean
+        self.scale_ = scale
+        self.n_features_in_ = len(mean)
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return (X - self.mean_) / np.where(self.scale_ == 0, 1.0, self.scale_)
+
+
+class ArtifactModel:
+    """Read-only classifier evaluated directly on the artifact arrays"""
+
+    def __init__(self, kind: str, params: Dict[str, Any], arrays: Dict[str, np.ndarray]):
+        self.kind = kind
+        self.params = params
+        self.arrays = arrays
+        self.classes_ = arrays['classes']
+        self.n_features_in_ = params['n_features']
+        self.estimator = params.get('estimator', kind)
+
+    def _leaf_values(self, X) -> np.ndarray:
+        """Walk every tree for every row at once; returns (n_rows, n_trees, n_values)"""
+        a = self.arrays
+        # sklearn trees compare float32 features against float64 thresholds, HGB uses float64
+        X = np.asarray(X, dtype=self.params.get('input_dtype', 'float32'))
+        has_missing = 'tree_missing_left' in a and np.isnan(X).any()
+        roots = a['tree_roots']
+        nodes = np.repeat(roots[None, :], len(X), axis=0)
+        rows = np.arange(len(X))[:, None]
+        for _ in range(self.params['max_depth']):
+            left = a['tree_left'][nodes]
+            internal = left >= 0
+            if not internal.any():
+                break
+            values = X[rows, a['tree_feature'][nodes]]
+            go_left = values <= a['tree_threshold'][nodes]
+            if has_missing:
+                go_left = np.where(np.isnan(values), a['tree_missing_left'][nodes] == 1, go_left)
+            nodes = np.where(internal, np.where(go_left, left, a['tree_right'][nodes]), nodes)
+        return a['tree_value'][nodes]
+
+    def decision_function(self, X) -> np.ndarray:
+        if self.kind == 'gbdt':
+            leaves = self._leaf_values(X)[:, :, 0]
+            return self.params['init_raw'] + self.params['learning_rate'] * leaves.sum(axis=1)
+        if self.kind == 'linear':
+            X = np.asarray(X, dtype=np.float64)
+            terms = self.arrays.get('linear_terms')
+            if terms is not None:
+                X = X[:, terms[:, 0]] * np.where(terms[:, 1] >= 0, X[:, np.maximum(terms[:, 1], 0)], 1.0)
+            return X @ self.arrays['linear_coef'] + self.arrays['linear_intercept'][0]
+        raise AttributeError("decision_function is not available for forests")
+
+    @property
+    def predict_proba(self):
+        # Mirror sklearn: hinge-loss linear models have no predict_proba
+        if self.kind == 'linear' and not self.params.get('has_proba', True):
+            raise AttributeError("predict_proba is not available for this model")
+        return self._predict_proba
+
+    def _predict_proba(self, X) -> np.ndarray:
+        if self.kind == 'forest':
+            return self._leaf_values(X).mean(axis=1)
+        positive = 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1.0 - positive, positive])
+
+    def predict(self, X) -> np.ndarray:
+        if self.kind == 'linear' and not self.params.get('has_proba', True):
+            return self.classes_[(self.decision_function(X) > 0).astype(int)]
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def _read_header(f, path: str) -> Tuple[Dict[str, Any], int]:
+    """Parse and validate the header; returns (header, offset of the array section)"""
+    preamble = f.read(_PREAMBLE.size)
+    if len(preamble) != _PREAMBLE.size:
+        raise ArtifactError(f"Truncated model artifact: {path}")
+    magic, version, header_len = _PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise ArtifactError(f"Not a model artifact: {path}")
+    if version != FORMAT_VERSION:
+        raise ArtifactError(f"Unsupported artifact format version {version} (expected {FORMAT_VERSION})")
+    header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _align(_PREAMBLE.size + header_len)
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """Artifact header (kind, params, metadata) without mapping the arrays"""
+    with open(path, 'rb') as f:
+        return _read_header(f, path)[0]
+
+
+def load_artifact(path: str) -> Tuple[ArtifactModel, Optional[ArtifactScaler], Dict[str, Any]]:
+    """Memory-map an artifact; returns (model, scaler or None, metadata)"""
+    with open(path, 'rb') as f:
+        header, data_start = _read_header(f, path)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'])) if spec['shape'] else 1
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+                                     offset=data_start + spec['offset']).reshape(spec['shape'])
+
+    scaler = None
+    if 'scaler_mean' in arrays:
+        scaler = ArtifactScaler(arrays.pop('scaler_mean'), arrays.pop('scaler_scale'))
+    model = ArtifactModel(header['kind'], header['params'], arrays)
+    return model, scaler, header.get('metadata') or {}
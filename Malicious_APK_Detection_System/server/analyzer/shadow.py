@@ -0,0 +1,294 @@
+"""
+Shadow Model Scoring
+Candidate models score the same feature vectors as the primary model in a
+background thread; agreement, confidence drift and inference cost are
+aggregated for the report endpoint and each batch is logged as JSON lines.
+With METRICS_MULTIPROC_DIR set the report merges the statistics of all workers
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+from monitoring.metrics import SHADOW_PREDICTIONS, SHADOW_INFERENCE_SECONDS
+from monitoring.multiprocess import ProcessSnapshots, multiprocess_dir
+
+logger = logging.getLogger(__name__)
+
+# Latency samples kept per model for percentiles
+LATENCY_WINDOW = 2048
+
+
+class _ModelStats:
+    """Running comparison of one shadow model against the primary"""
+
+    # Additive fields, summed when the statistics of several processes are merged
+    TOTALS = ('scored', 'agreements', 'flips_to_malware', 'flips_to_benign', 'drift_sum',
+              'abs_drift_sum', 'errors', 'batches', 'seconds')
+
+    def __init__(self, name: str, version: str):
+        self.name = name
+        self.version = version
+        self.scored = 0
+        self.agreements = 0
+        self.flips_to_malware = 0
+        self.flips_to_benign = 0
+        self.drift_sum = 0.0
+        self.abs_drift_sum = 0.0
+        self.errors = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.row_latencies_ms = []
+
+    def record_batch(self, primary_malware: np.ndarray, primary_proba: np.ndarray,
+                     malware: np.ndarray, proba: np.ndarray, seconds: float):
+        self.scored += len(malware)
+        self.agreements += int(np.sum(malware == primary_malware))
+        self.flips_to_malware += int(np.sum(malware & ~primary_malware))
+        self.flips_to_benign += int(np.sum(~malware & primary_malware))
+        delta = proba - primary_proba
+        self.drift_sum += float(delta.sum())
+        self.abs_drift_sum += float(np.abs(delta).sum())
+        self.batches += 1
+        self.seconds += seconds
+        self.row_latencies_ms.append(seconds * 1000 / len(malware))
+        if len(self.row_latencies_ms) > LATENCY_WINDOW:
+            del self.row_latencies_ms[:len(self.row_latencies_ms) - LATENCY_WINDOW]
+
+    def to_state(self) -> Dict[str, Any]:
+        return dict(vars(self), row_latencies_ms=list(self.row_latencies_ms))
+
+    def add_state(self, state: Dict[str, Any]):
+        """Add another process's statistics of the same model"""
+        for field in self.TOTALS:
+            setattr(self, field, getattr(self, field) + state[field])
+        self.row_latencies_ms.extend(state['row_latencies_ms'])
+        if len(self.row_latencies_ms) > LATENCY_WINDOW:
+            del self.row_latencies_ms[:len(self.row_latencies_ms) - LATENCY_WINDOW]
+
+    def summary(self) -> Dict[str, Any]:
+        latencies = sorted(self.row_latencies_ms)
+        n = max(self.scored, 1)
+        return {
+            'version': self.version,
+            'scored': self.scored,
+            'agreement_rate': round(self.agreements / n, 4) if self.scored else None,
+            'flips_to_malware': self.flips_to_malware,
+            'flips_to_benign': self.flips_to_benign,
+            'mean_confidence_drift': round(self.drift_sum / n, 4) if self.scored else None,
+            'mean_abs_confidence_drift': round(self.abs_drift_sum / n, 4) if self.scored else None,
+            'errors': self.errors,
+            'inference_ms_per_row': {
+                'mean': round(self.seconds * 1000 / n, 4) if self.scored else None,
+                'p50': round(latencies[len(latencies) // 2], 4) if latencies else None,
+                'p95': round(latencies[int(len(latencies) * 0.95)], 4) if latencies else None,
+            },
+        }
+
+
+class ShadowScorer:
+    """
+    Scores primary predictions with candidate models off the request path
+    submit() never blocks: when the queue is full the sample is dropped and counted
+    """
+
+    def __init__(self, candidates: Dict[str, Any], queue_size=2000, batch_size=64,
+                 flush_interval=0.5, log_path: Optional[str] = None):
+        self.candidates = candidates  # name -> LoadedModel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log_path = log_path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._stats = {name: _ModelStats(name, loaded.version) for name, loaded in candidates.items()}
+        self._primary = {'scored': 0, 'seconds': 0.0, 'versions': {}}
+        self.dropped = 0
+        self.started_at = datetime.now().isoformat()
+        self._thread = None
+        self._thread_pid = None
+
+    def submit(self, features: List[float], primary_version: Optional[str], is_malware: bool,
+               malware_probability: float, latency_seconds: float):
+        """Queue one primary prediction for shadow scoring"""
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((features, primary_version, is_malware,
+                                    malware_probability, latency_seconds, time.time()))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                    self._thread_pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='shadow-scorer', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._score_batch(batch)
+            except Exception as e:
+                logger.error(f"Shadow scoring failed: {str(e)}")
+            snapshots = self._snapshots()
+            if snapshots is not None:
+                snapshots.write(self.state())
+
+    def _score_batch(self, batch):
+        X = np.asarray([item[0] for item in batch], dtype=np.float64)
+        primary_malware = np.array([item[2] for item in batch], dtype=bool)
+        primary_proba = np.array([item[3] for item in batch], dtype=np.float64)
+
+        with self._lock:
+            self._primary['scored'] += len(batch)
+            self._primary['seconds'] += sum(item[4] for item in batch)
+            for item in batch:
+                versions = self._primary['versions']
+                versions[item[1]] = versions.get(item[1], 0) + 1
+
+        outputs = {}
+        for name, loaded in self.candidates.items():
+            try:
+                start = time.perf_counter()
+                features = loaded.scaler.transform(X) if loaded.scaler is not None else X
+                if hasattr(loaded.model, 'predict_proba'):
+                    proba = loaded.model.predict_proba(features)[:, 1]
+                    malware = proba >= 0.5
+                else:
+                    malware = loaded.model.predict(features).astype(bool)
+                    proba = malware.astype(np.float64)
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                logger.error(f"Shadow model {name} failed: {str(e)}")
+                with self._lock:
+                    self._stats[name].errors += len(batch)
+                continue
+
+            SHADOW_INFERENCE_SECONDS.observe(elapsed, model=name)
+            agree = int(np.sum(malware == primary_malware))
+            SHADOW_PREDICTIONS.inc(agree, model=name, agreement='agree')
+            SHADOW_PREDICTIONS.inc(len(batch) - agree, model=name, agreement='disagree')
+            with self._lock:
+                self._stats[name].record_batch(primary_malware, primary_proba, malware, proba, elapsed)
+            outputs[name] = (malware, proba, elapsed)
+
+        if self.log_path:
+            self._log_batch(batch, outputs)
+
+    def _log_batch(self, batch, outputs):
+        """One JSON line per prediction with the primary and every shadow result"""
+        lines = []
+        for i, (_, version, is_malware, probability, latency, ts) in enumerate(batch):
+            record = {
+                'timestamp': datetime.fromtimestamp(ts).isoformat(),
+                'primary': {'version': version, 'is_malware': bool(is_malware),
+                            'malware_probability': round(float(probability), 4),
+                            'latency_ms': round(latency * 1000, 3)},
+                'shadow': {
+                    name: {'is_malware': bool(malware[i]),
+                           'malware_probability': round(float(proba[i]), 4),
+                           'latency_ms': round(elapsed * 1000 / len(batch), 3)}
+                    for name, (malware, proba, elapsed) in outputs.items()
+                },
+            }
+            lines.append(json.dumps(record))
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            with open(self.log_path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            logger.error(f"Failed to write shadow log: {str(e)}")
+
+    def state(self) -> Dict[str, Any]:
+        """This process's raw statistics, as merged across processes"""
+        with self._lock:
+            return {
+                'since': self.started_at,
+                'primary': {'scored': self._primary['scored'], 'seconds': self._primary['seconds'],
+                            'versions': dict(self._primary['versions'])},
+                'models': {name: stats.to_state() for name, stats in self._stats.items()},
+                'dropped': self.dropped,
+                'pending': self._queue.qsize(),
+            }
+
+    def _snapshots(self) -> Optional[ProcessSnapshots]:
+        directory = multiprocess_dir()
+        return ProcessSnapshots(directory, 'shadow', _fold_exited) if directory else None
+
+    def report(self) -> Dict[str, Any]:
+        """Agreement, confidence drift and inference cost per shadow model, over all workers"""
+        state = self.state()
+        snapshots = self._snapshots()
+        if snapshots is not None:
+            snapshots.write(state)
+            archive, live = snapshots.collect()
+            state = _merge_states([s for _, s in live] + ([archive] if archive else []))
+
+        primary_n = state['primary']['scored']
+        return {
+            'since': state['since'],
+            'primary': {
+                'scored': primary_n,
+                'versions': state['primary']['versions'],
+                'mean_inference_ms': round(state['primary']['seconds'] * 1000 / primary_n, 4)
+                                     if primary_n else None,
+            },
+            'shadow_models': {name: _stats_from_state(model).summary()
+                              for name, model in state['models'].items()},
+            'queue': {'pending': state['pending'], 'dropped': state['dropped']},
+        }
+
+
+def _stats_from_state(state: Dict[str, Any]) -> _ModelStats:
+    stats = _ModelStats(state['name'], state['version'])
+    stats.add_state(state)
+    return stats
+
+
+def _merge_states(states: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Statistics of several processes added together"""
+    merged = {'since': min(state['since'] for state in states),
+              'primary': {'scored': 0, 'seconds': 0.0, 'versions': {}},
+              'models': {}, 'dropped': 0, 'pending': 0}
+    for state in states:
+        primary = merged['primary']
+        primary['scored'] += state['primary']['scored']
+        primary['seconds'] += state['primary']['seconds']
+        for version, count in state['primary']['versions'].items():
+            primary['versions'][version] = primary['versions'].get(version, 0) + count
+        for name, model in state['models'].items():
+            if name in merged['models']:
+                stats = _stats_from_state(merged['models'][name])
+                stats.add_state(model)
+                merged['models'][name] = stats.to_state()
+            else:
+                merged['models'][name] = dict(model)
+        merged['dropped'] += state['dropped']
+        merged['pending'] += state['pending']
+    return merged
+
+
+def _fold_exited(archive: Optional[Dict[str, Any]], state: Dict[str, Any]) -> Dict[str, Any]:
+    """An exited process's statistics added to the archive (its queue died with it)"""
+    merged = _merge_states([archive, state] if archive else [state])
+    merged['pending'] = 0
+    return merged
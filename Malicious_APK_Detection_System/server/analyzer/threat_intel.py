@@ -0,0 +1,469 @@
+"""
+Local Threat Intelligence Indexes
+Indexed blocklists/allowlists for certificates, publishers, domains and IP ranges
+"""
+import bisect
+import ipaddress
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Indicator categories, each one a blocklist or allowlist
+CERT_SHA256 = 'cert_sha256'
+PUBLISHER = 'publisher'
+DOMAIN = 'domain'
+IP_RANGE = 'ip_range'
+CATEGORIES = (CERT_SHA256, PUBLISHER, DOMAIN, IP_RANGE)
+LISTS = ('block', 'allow', 'play_store')
+
+SNAPSHOT_VERSION = 1
+
+# Built-in publisher patterns (previously hard-coded in APKAnalyzer)
+DEFAULT_PLAY_STORE_PUBLISHERS = [
+    'CN=Android',
+    'CN=Google Inc',
+    'O=Google Inc',
+    'OU=Android'
+]
+
+DEFAULT_KNOWN_PUBLISHERS = [
+    'CN=Facebook',
+    'CN=Twitter',
+    'CN=Microsoft',
+    'CN=Amazon',
+    'CN=WhatsApp',
+    'O=Facebook',
+    'O=Microsoft Corporation',
+    'O=Amazon',
+    'O=Samsung',
+    'O=Xiaomi',
+    'O=Huawei'
+]
+
+_RDN_SPLIT = re.compile(r'(?<!\\)[,+]')
+
+
+class DigestSet:
+    """
+    Sorted, fixed-width digest set packed into a single bytes blob
+    Membership is a binary search, no per-item Python objects are kept
+    """
+
+    def __init__(self, digests: Iterable[bytes] = (), width: int = 32):
+        self.width = width
+        self.blob = b''.join(sorted({d for d in digests if len(d) == width}))
+
+    def __len__(self):
+        return len(self.blob) // self.width
+
+    def __contains__(self, digest: bytes) -> bool:
+        lo, hi = 0, len(self)
+        w = self.width
+        while lo < hi:
+            mid = (lo + hi) // 2
+            item = self.blob[mid * w:(mid + 1) * w]
+            if item < digest:
+                lo = mid + 1
+            elif item > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+
+class DomainTrie:
+    """Suffix trie over reversed domain labels (matches a domain and its subdomains)"""
+
+    _END = ''
+
+    def __init__(self, domains: Iterable[str] = ()):
+        self.root = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain: str):
+        labels = _normalize_domain(domain).split('.')
+        if not labels or labels == ['']:
+            return
+        node = self.root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        if self._END not in node:
+            node[self._END] = True
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def match(self, host: str) -> Optional[str]:
+        """Return the listed suffix covering host, or None"""
+        labels = _normalize_domain(host).split('.')
+        node = self.root
+        matched = []
+        for label in reversed(labels):
+            node = node.get(label)
+            if node is None:
+                return None
+            matched.append(label)
+            if self._END in node:
+                return '.'.join(reversed(matched))
+        return None
+
+
+class IPRangeSet:
+    """Merged, sorted IP ranges with O(log n) lookup"""
+
+    def __init__(self, networks: Iterable[str] = ()):
+        ranges = {4: [], 6: []}
+        for net in networks:
+            try:
+                network = ipaddress.ip_network(net.strip(), strict=False)
+            except ValueError:
+                continue
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address))
+            )
+        self.starts = {}
+        self.ends = {}
+        for version, items in ranges.items():
+            merged = _merge_ranges(items)
+            self.starts[version] = [r[0] for r in merged]
+            self.ends[version] = [r[1] for r in merged]
+
+    def __len__(self):
+        return sum(len(v) for v in self.starts.values())
+
+    def __contains__(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        starts = self.starts[ip.version]
+        idx = bisect.bisect_right(starts, int(ip)) - 1
+        return idx >= 0 and int(ip) <= self.ends[ip.version][idx]
+
+
+class PublisherSet:
+    """
+    Case-insensitive publisher DN patterns (e.g. 'O=Microsoft Corporation')
+    A pattern matches an RDN that equals it or starts with it on a word boundary
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns = {_normalize_rdn(p) for p in patterns if p.strip()}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, *dns: str) -> Optional[str]:
+        for dn in dns:
+            for rdn in _RDN_SPLIT.split(dn or ''):
+                rdn = _normalize_rdn(rdn)
+                # Check the RDN and each shorter word prefix
+                while rdn:
+                    if rdn in self.patterns:
+                        return rdn
+                    cut = rdn.rfind(' ')
+                    rdn = rdn[:cut].rstrip('.,') if cut > 0 else ''
+        return None
+
+
+class ThreatIntelIndex:
+    """Immutable set of compiled indexes, swapped as a whole on reload"""
+
+    def __init__(self, sources: Dict[str, Dict[str, Iterable[str]]], version: str = 'builtin'):
+        self.version = version
+        self.certs = {}
+        self.publishers = {}
+        self.domains = {}
+        self.ip_ranges = {}
+        for list_name in LISTS:
+            lists = sources.get(list_name, {})
+            self.certs[list_name] = DigestSet(
+                _hex_digest(h) for h in lists.get(CERT_SHA256, ()) if _hex_digest(h)
+            )
+            self.publishers[list_name] = PublisherSet(lists.get(PUBLISHER, ()))
+            self.domains[list_name] = DomainTrie(lists.get(DOMAIN, ()))
+            self.ip_ranges[list_name] = IPRangeSet(lists.get(IP_RANGE, ()))
+
+    _STRUCTURES = (('certs', DigestSet), ('publishers', PublisherSet),
+                   ('domains', DomainTrie), ('ip_ranges', IPRangeSet))
+
+    def to_state(self) -> Dict[str, Any]:
+        """Plain builtin-type representation used for snapshots"""
+        state = {'version': self.version}
+        for attr, _ in self._STRUCTURES:
+            state[attr] = {name: vars(obj) for name, obj in getattr(self, attr).items()}
+        return state
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'ThreatIntelIndex':
+        index = cls.__new__(cls)
+        index.version = state['version']
+        for attr, struct_cls in cls._STRUCTURES:
+            restored = {}
+            for name, fields in state[attr].items():
+                obj = struct_cls.__new__(struct_cls)
+                obj.__dict__.update(fields)
+                restored[name] = obj
+            setattr(index, attr, restored)
+        return index
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        return {
+            list_name: {
+                CERT_SHA256: len(self.certs[list_name]),
+                PUBLISHER: len(self.publishers[list_name]),
+                DOMAIN: len(self.domains[list_name]),
+                IP_RANGE: len(self.ip_ranges[list_name])
+            }
+            for list_name in LISTS
+        }
+
+
+class ThreatIntel:
+    """
+    Local threat-intel lookups backed by a hot-reloadable snapshot file
+    Snapshots are built with build_snapshot() from plain-text indicator lists
+    """
+
+    def __init__(self, snapshot_path=None, reload_interval=30.0):
+        self.snapshot_path = snapshot_path or os.environ.get(
+            'THREAT_INTEL_SNAPSHOT', 'intel/threat_intel.snapshot'
+        )
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._snapshot_mtime = None
+        self._next_check = 0.0
+        self._index = self._builtin_index()
+        self.maybe_reload(force=True)
+
+    @property
+    def version(self) -> str:
+        return self._index.version
+
+    def _builtin_index(self) -> ThreatIntelIndex:
+        return ThreatIntelIndex(_with_defaults({}), version='builtin')
+
+    def maybe_reload(self, force=False) -> bool:
+        """Reload the snapshot if its mtime changed (checked at most every reload_interval)"""
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = now + self.reload_interval
+            try:
+                mtime = os.path.getmtime(self.snapshot_path)
+            except OSError:
+                return False
+            if mtime == self._snapshot_mtime:
+                return False
+
+            index = load_snapshot(self.snapshot_path)
+            self._index = index  # atomic reference swap
+            self._snapshot_mtime = mtime
+            logger.info(f"Threat intel snapshot loaded (version {index.version}): {index.counts()}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to load threat intel snapshot: {str(e)}")
+            return False
+        finally:
+            self._lock.release()
+
+    def check_certificate(self, cert_sha256: str, issuer: str, subject: str) -> Dict[str, Any]:
+        """Look up a signing certificate by fingerprint and publisher DN"""
+        self.maybe_reload()
+        index = self._index
+        digest = _hex_digest(cert_sha256)
+
+        blocked_publisher = index.publishers['block'].match(issuer, subject)
+        return {
+            'blocked': bool(digest and digest in index.certs['block']) or bool(blocked_publisher),
+            'allowlisted': bool(digest and digest in index.certs['allow']),
+            'play_store': bool(digest and digest in index.certs['play_store'])
+                          or bool(index.publishers['play_store'].match(issuer, subject)),
+            'known_publisher': bool(index.publishers['allow'].match(issuer, subject)),
+            'blocked_publisher': blocked_publisher,
+            'intel_version': index.version
+        }
+
+    def check_hosts(self, hosts: Iterable[str]) -> Dict[str, Any]:
+        """Check extracted hosts against domain and IP range lists"""
+        check = self.host_check()
+        for host in hosts:
+            check.add(host)
+        return check.to_dict()
+
+    def host_check(self) -> 'HostCheck':
+        """Incremental host check bound to the current index, fed while URLs are extracted"""
+        self.maybe_reload()
+        return HostCheck(self._index)
+
+    @staticmethod
+    def _lookup_host(index: ThreatIntelIndex, host: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        The blocklist is checked first: an allowlisted parent domain (example.com)
+        must not hide a blocklisted subdomain (evil.cdn.example.com)
+        """
+        host = host.strip('[]')
+        if _is_ip(host):
+            for list_name in ('block', 'allow'):
+                if host in index.ip_ranges[list_name]:
+                    return host, list_name
+            return None, None
+        for list_name in ('block', 'allow'):
+            match = index.domains[list_name].match(host)
+            if match:
+                return match, list_name
+        return None, None
+
+
+class HostCheck:
+    """
+    Blocklist/allowlist tally over every host seen in one APK
+    Hits are counted in full; only the reported list of blocked hosts is capped
+    """
+
+    def __init__(self, index: ThreatIntelIndex, max_reported=50, max_remembered=100000):
+        self.index = index
+        self.max_reported = max_reported
+        self.max_remembered = max_remembered
+        self.blocked = []
+        self.blocked_total = 0
+        self.allowed = 0
+        self.checked = 0
+        self._seen = set()
+
+    def add(self, host: str):
+        if host in self._seen:
+            return
+        # Past the cap hosts are still checked, just no longer deduplicated
+        if len(self._seen) < self.max_remembered:
+            self._seen.add(host)
+        self.checked += 1
+
+        match, list_name = ThreatIntel._lookup_host(self.index, host)
+        if list_name == 'block':
+            self.blocked_total += 1
+            if len(self.blocked) < self.max_reported:
+                self.blocked.append({'host': host, 'indicator': match})
+        elif list_name == 'allow':
+            self.allowed += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'blocked_hosts': self.blocked,
+            'blocked_total': self.blocked_total,
+            'allowlisted_hosts': self.allowed,
+            'hosts_checked': self.checked,
+            'intel_version': self.index.version
+        }
+
+
+def build_snapshot(source_dir: str, snapshot_path: str) -> ThreatIntelIndex:
+    """
+    Compile plain-text indicator lists into a snapshot file
+    Expected files: <list>_<category>.txt, e.g. block_domain.txt, allow_cert_sha256.txt
+    One indicator per line, '#' starts a comment
+    """
+    sources = {}
+    for list_name in LISTS:
+        for category in CATEGORIES:
+            path = os.path.join(source_dir, f'{list_name}_{category}.txt')
+            if os.path.exists(path):
+                sources.setdefault(list_name, {})[category] = list(_read_indicators(path))
+
+    index = ThreatIntelIndex(_with_defaults(sources), version=time.strftime('%Y%m%d%H%M%S'))
+
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'snapshot_version': SNAPSHOT_VERSION, 'index': index.to_state()}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"Threat intel snapshot written to {snapshot_path}: {index.counts()}")
+    return index
+
+
+def load_snapshot(snapshot_path: str) -> ThreatIntelIndex:
+    """Load a compiled snapshot file"""
+    with open(snapshot_path, 'rb') as f:
+        data = pickle.load(f)
+    if data.get('snapshot_version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {data.get('snapshot_version')}")
+    return ThreatIntelIndex.from_state(data['index'])
+
+
+def _with_defaults(sources: Dict[str, Dict[str, List[str]]]) -> Dict[str, Dict[str, List[str]]]:
+    """Merge the built-in publisher patterns into the source lists"""
+    merged = {name: dict(lists) for name, lists in sources.items()}
+    play = merged.setdefault('play_store', {})
+    play[PUBLISHER] = list(play.get(PUBLISHER, [])) + DEFAULT_PLAY_STORE_PUBLISHERS
+    allow = merged.setdefault('allow', {})
+    allow[PUBLISHER] = list(allow.get(PUBLISHER, [])) + DEFAULT_KNOWN_PUBLISHERS
+    return merged
+
+
+def _read_indicators(path: str) -> Iterable[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield line
+
+
+def _hex_digest(value: str) -> Optional[bytes]:
+    try:
+        digest = bytes.fromhex(value.replace(':', '').strip())
+    except (ValueError, AttributeError):
+        return None
+    return digest if len(digest) == 32 else None
+
+
+def _normalize_domain(domain: str) -> str:
+    return domain.strip().strip('.').lower()
+
+
+def _normalize_rdn(rdn: str) -> str:
+    key, sep, value = rdn.strip().partition('=')
+    return f"{key.strip().upper()}{sep}{value.strip().rstrip('.,').upper()}"
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compile threat-intel indicator lists into a snapshot')
+    parser.add_argument('source_dir', help='Directory with <list>_<category>.txt files')
+    parser.add_argument('snapshot_path', help='Output snapshot file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_snapshot(args.source_dir, args.snapshot_path)
@@ -0,0 +1,231 @@
+"""
+Streaming URL Extraction from APK archives
+Scans ZIP entries (XML, text, DEX, resources) in fixed-size byte chunks
+"""
+import logging
+import re
+import zipfile
+from collections import Counter
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+# Characters allowed inside a URL (same set as the original str pattern)
+_URL_CHARS = rb'[^\s<>"{}|\\^`\[\]\x00-\x1f\x7f-\xff]'
+
+# Plain ASCII / UTF-8 / MUTF-8 (DEX string data, text resources)
+_URL_PATTERN = re.compile(rb'https?://' + _URL_CHARS + rb'+')
+
+# UTF-16LE (binary XML and resources.arsc string pools)
+_URL_PATTERN_UTF16 = re.compile(
+    rb'h\x00t\x00t\x00p\x00(?:s\x00)?:\x00/\x00/\x00(?:' + _URL_CHARS + rb'\x00)+'
+)
+
+# Bytes kept between chunks so a scheme cut at the boundary still matches
+_SCHEME_OVERLAP = len('https://'.encode('utf-16-le')) - 1
+
+
+# Public suffixes of two labels under which hosts are registered one level deeper
+# (a common subset of the Public Suffix List, including shared hosting platforms)
+MULTI_LABEL_SUFFIXES = frozenset({
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk', 'sch.uk', 'nhs.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'id.au', 'asn.au',
+    'co.nz', 'net.nz', 'org.nz', 'govt.nz', 'ac.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'ad.jp', 'ed.jp', 'gr.jp', 'lg.jp',
+    'co.kr', 'or.kr', 'ne.kr', 'go.kr', 'ac.kr', 're.kr',
+    'com.cn', 'net.cn', 'org.cn', 'gov.cn', 'edu.cn', 'ac.cn',
+    'com.hk', 'net.hk', 'org.hk', 'edu.hk', 'gov.hk',
+    'com.tw', 'net.tw', 'org.tw', 'edu.tw', 'gov.tw',
+    'co.in', 'net.in', 'org.in', 'firm.in', 'gen.in', 'ind.in', 'ac.in', 'gov.in', 'edu.in',
+    'com.sg', 'net.sg', 'org.sg', 'edu.sg', 'gov.sg',
+    'com.my', 'net.my', 'org.my', 'gov.my', 'edu.my',
+    'co.id', 'or.id', 'web.id', 'ac.id', 'go.id', 'my.id',
+    'co.th', 'in.th', 'or.th', 'ac.th', 'go.th',
+    'com.ph', 'net.ph', 'org.ph', 'com.vn', 'net.vn', 'org.vn', 'com.pk', 'net.pk', 'org.pk',
+    'com.br', 'net.br', 'org.br', 'gov.br', 'edu.br', 'com.mx', 'org.mx', 'gob.mx',
+    'com.ar', 'net.ar', 'org.ar', 'com.co', 'net.co', 'org.co', 'com.pe', 'com.ve', 'com.ec',
+    'co.za', 'org.za', 'net.za', 'gov.za', 'ac.za', 'com.ng', 'com.eg', 'co.ke', 'or.ke',
+    'com.tr', 'net.tr', 'org.tr', 'gov.tr', 'edu.tr', 'com.sa', 'net.sa', 'org.sa', 'co.il', 'org.il',
+    'ac.il', 'com.ua', 'net.ua', 'org.ua', 'com.ru', 'net.ru', 'org.ru', 'com.pl', 'net.pl', 'org.pl',
+    'co.at', 'or.at', 'com.es', 'co.it', 'com.gr', 'com.cy', 'com.mt',
+    'github.io', 'gitlab.io', 'appspot.com', 'herokuapp.com', 'firebaseapp.com', 'web.app',
+    'blogspot.com', 'azurewebsites.net', 'cloudfront.net', 'netlify.app', 'vercel.app',
+    'pages.dev', 'workers.dev', 'ngrok.io', '000webhostapp.com', 'repl.co',
+})
+
+
+class URLExtractor:
+    """Extract URLs from APK entries with bounded memory"""
+
+    # Entry suffixes worth scanning for embedded URLs
+    SCANNED_SUFFIXES = (
+        '.xml', '.txt', '.dex', '.arsc', '.json', '.properties',
+        '.js', '.html', '.htm', '.cfg', '.conf', '.ini'
+    )
+
+    def __init__(self, max_urls=200, max_hosts=100, max_url_length=512,
+                 chunk_size=256 * 1024, max_entry_bytes=64 * 1024 * 1024,
+                 max_total_bytes=512 * 1024 * 1024):
+        self.max_urls = max_urls
+        self.max_hosts = max_hosts
+        self.max_url_length = max_url_length
+        self.chunk_size = chunk_size
+        self.max_entry_bytes = max_entry_bytes
+        self.max_total_bytes = max_total_bytes
+
+    def extract(self, apk_path: str, host_check=None) -> Dict[str, Any]:
+        """
+        Scan an APK file and return unique URLs plus host/domain aggregates
+        With a threat_intel.HostCheck every host is checked as it is extracted, so
+        the scan continues past max_urls and the caps only bound the report
+        """
+        state = _ScanState(self.max_urls, self.max_hosts, host_check)
+
+        try:
+            with zipfile.ZipFile(apk_path, 'r') as zip_ref:
+                for info in zip_ref.infolist():
+                    if state.done:
+                        break
+                    if not self._should_scan(info):
+                        continue
+                    try:
+                        with zip_ref.open(info, 'r') as entry:
+                            self._scan_stream(entry, state)
+                    except Exception as e:
+                        logger.debug("Skipping entry %s: %s", info.filename, e)
+                    state.entries_scanned += 1
+        except Exception as e:
+            logger.warning(f"Error extracting URLs: {str(e)}")
+
+        return state.to_dict()
+
+    def _should_scan(self, info: zipfile.ZipInfo) -> bool:
+        """Check whether a ZIP entry may contain URLs"""
+        if info.is_dir():
+            return False
+        return info.filename.lower().endswith(self.SCANNED_SUFFIXES)
+
+    def _scan_stream(self, stream, state: '_ScanState'):
+        """Scan one entry chunk by chunk, carrying unfinished matches into the next chunk"""
+        tail = b''
+        entry_bytes = 0
+
+        while not state.done:
+            budget = min(self.chunk_size,
+                         self.max_entry_bytes - entry_bytes,
+                         self.max_total_bytes - state.bytes_scanned)
+            if budget <= 0:
+                state.truncated = True
+                state.budget_exhausted = True
+                break
+
+            chunk = stream.read(budget)
+            final = len(chunk) < budget
+            entry_bytes += len(chunk)
+            state.bytes_scanned += len(chunk)
+
+            buffer = tail + chunk
+            carry = self._scan_buffer(buffer, final, state)
+
+            if final:
+                break
+            tail = buffer[carry:]
+
+    def _scan_buffer(self, buffer: bytes, final: bool, state: '_ScanState') -> int:
+        """
+        Match both encodings in a buffer and feed results into the scan state
+        Returns the offset the next buffer must start from: the start of a match
+        still open at the buffer end, else enough bytes to complete a cut-off scheme
+        """
+        limit = len(buffer)
+        carry = max(limit - _SCHEME_OVERLAP, 0)
+        for pattern, encoding in ((_URL_PATTERN, 'ascii'), (_URL_PATTERN_UTF16, 'utf-16-le')):
+            width = 1 if encoding == 'ascii' else 2
+            for match in pattern.finditer(buffer):
+                # A match touching the buffer end may continue in the next chunk;
+                # once it is max_url_length long, more bytes would be cut off anyway
+                if (not final and match.end() + width > limit
+                        and match.end() - match.start() < self.max_url_length * width):
+                    carry = min(carry, match.start())
+                    continue
+                raw = match.group()
+                if encoding != 'ascii':
+                    raw = raw[::2]
+                state.add(raw[:self.max_url_length].decode('ascii', errors='ignore'))
+                if state.done:
+                    return limit
+        return carry
+
+
+class _ScanState:
+    """Bounded accumulator shared across all entries of one APK"""
+
+    def __init__(self, max_urls: int, max_hosts: int, host_check=None):
+        self.max_urls = max_urls
+        self.max_hosts = max_hosts
+        self.host_check = host_check
+        self.urls = {}  # insertion-ordered bounded set
+        self.hosts = Counter()
+        self.domains = Counter()
+        self.bytes_scanned = 0
+        self.entries_scanned = 0
+        self.truncated = False
+        self.budget_exhausted = False
+        self.done = False
+
+    def add(self, url: str):
+        url = url.rstrip('.,;:\'")')
+        if url in self.urls:
+            return
+        host = _host_of(url)
+        if host and self.host_check is not None:
+            self.host_check.add(host)
+        if len(self.urls) >= self.max_urls:
+            self.truncated = True
+            self.done = self.host_check is None
+            return
+        self.urls[url] = None
+
+        if host and (host in self.hosts or len(self.hosts) < self.max_hosts):
+            self.hosts[host] += 1
+            self.domains[registered_domain(host)] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {
+            'urls': list(self.urls),
+            'hosts': dict(self.hosts.most_common()),
+            'domains': dict(self.domains.most_common()),
+            'total_urls': len(self.urls),
+            'bytes_scanned': self.bytes_scanned,
+            'entries_scanned': self.entries_scanned,
+            'truncated': self.truncated
+        }
+        if self.host_check is not None:
+            # Hosts past the byte budgets were never seen, let alone checked
+            result['intel'] = dict(self.host_check.to_dict(), truncated=self.budget_exhausted)
+        return result
+
+
+def _host_of(url: str) -> Optional[str]:
+    """Return lower-cased host of a URL, or None if it cannot be parsed"""
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    return host.lower() if host else None
+
+
+def registered_domain(host: str) -> str:
+    """
+    Approximate the registrable domain: the last two labels, or three under a
+    MULTI_LABEL_SUFFIXES suffix (cdn.foo.co.uk -> foo.co.uk)
+    IP literals are returned unchanged
+    """
+    labels = host.split('.')
+    if len(labels) <= 2 or labels[-1].isdigit() or ':' in host:
+        return host
+    if '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
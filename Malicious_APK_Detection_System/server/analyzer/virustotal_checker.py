@@ -27,17 +27,24 @@ class VirusTotalChecker:
         """
         Check file hash against VirusTotal database
         """
+        return self.check_hashes([file_hash])[file_hash]
+    
+    def check_hashes(self, file_hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Check several hashes with one file/report request (comma-separated resources)
+        Returns a result per hash in the check_hash format
+        """
         if not self.enabled:
-            return {
+            return {h: {
                 'available': False,
                 'message': 'VirusTotal API key not configured'
-            }
+            } for h in file_hashes}
         
         try:
             # Query VirusTotal API
             params = {
                 'apikey': self.api_key,
-                'resource': file_hash
+                'resource': ','.join(file_hashes)
             }
             
             response = requests.get(
@@ -48,55 +55,79 @@ class VirusTotalChecker:
             
             if response.status_code == 200:
                 data = response.json()
-                
-                if data.get('response_code') == 1:
-                    # File found in VT database
-                    positives = data.get('positives', 0)
-                    total = data.get('total', 0)
-                    
-                    return {
-                        'available': True,
-                        'detected': positives > 0,
-                        'positives': positives,
-                        'total': total,
-                        'detection_ratio': f"{positives}/{total}",
-                        'scan_date': data.get('scan_date'),
-                        'permalink': data.get('permalink'),
-                        'scans': self._parse_scan_results(data.get('scans', {}))
-                    }
-                else:
-                    # File not found in VT database
-                    return {
-                        'available': True,
-                        'detected': False,
-                        'message': 'File not found in VirusTotal database',
-                        'positives': 0,
-                        'total': 0
-                    }
+                # A single resource is answered with an object, several with a list in request order
+                reports = data if isinstance(data, list) else [data]
+                results = {}
+                for file_hash, report in zip(file_hashes, reports):
+                    results[file_hash] = self._parse_report(report)
+                for file_hash in file_hashes[len(reports):]:
+                    results[file_hash] = {'available': False, 'error': 'Missing VirusTotal report'}
+                return results
             elif response.status_code == 204:
                 # Rate limit exceeded
-                return {
+                error = {
                     'available': False,
                     'error': 'VirusTotal rate limit exceeded'
                 }
             else:
-                return {
+                error = {
                     'available': False,
                     'error': f'VirusTotal API error: {response.status_code}'
                 }
         
         except requests.Timeout:
             logger.error("VirusTotal API timeout")
-            return {
+            error = {
                 'available': False,
                 'error': 'VirusTotal API timeout'
             }
         except Exception as e:
             logger.error(f"VirusTotal check failed: {str(e)}")
-            return {
+            error = {
                 'available': False,
                 'error': str(e)
             }
+        return {h: dict(error) for h in file_hashes}
+    
+    def _parse_report(self, data: Dict) -> Dict[str, Any]:
+        """Convert one file/report entry into the check_hash result format"""
+        if data.get('response_code') == 1:
+            # File found in VT database
+            positives = data.get('positives', 0)
+            total = data.get('total', 0)
+            
+            return {
+                'available': True,
+                'found': True,
+                'detected': positives > 0,
+                'positives': positives,
+                'total': total,
+                'detection_ratio': f"{positives}/{total}",
+                'scan_date': data.get('scan_date'),
+                'permalink': data.get('permalink'),
+                'scans': self._parse_scan_results(data.get('scans', {}))
+            }
+        elif data.get('response_code') == -2:
+            # Submitted file still queued for analysis
+            return {
+                'available': True,
+                'found': False,
+                'queued': True,
+                'detected': False,
+                'message': 'File is queued for analysis on VirusTotal',
+                'positives': 0,
+                'total': 0
+            }
+        else:
+            # File not found in VT database
+            return {
+                'available': True,
+                'found': False,
+                'detected': False,
+                'message': 'File not found in VirusTotal database',
+                'positives': 0,
+                'total': 0
+            }
     
     def _parse_scan_results(self, scans: Dict) -> List[Dict]:
         """Parse and filter scan results from multiple AV engines"""
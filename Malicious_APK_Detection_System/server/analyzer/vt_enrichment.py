@@ -0,0 +1,409 @@
+"""
+VirusTotal Enrichment Queue
+Hashes from every scan are looked up in a background thread: due hashes are
+grouped into multi-resource file/report requests within the API rate limit and
+the results are written back to the stored scans (virustotal, risk_score,
+verdict). Unknown files can be submitted for analysis and are polled until
+VirusTotal has a report. Queued hashes are kept as files in a directory shared
+by the workers of a host, so hashes of a worker that exits are adopted by
+another, and the request rate limit is shared by all forked workers
+"""
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Any, Callable, Optional
+
+from monitoring.metrics import VT_LOOKUPS, VT_REQUESTS, VT_QUEUE_DEPTH
+from scheduling.admission import pid_alive
+
+try:
+    import fcntl
+except ImportError:  # Windows: the startup sweeps of several workers are not serialised
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between scans of the queue directory for hashes of exited workers
+ADOPT_INTERVAL = 60.0
+
+# Placeholder stored with a scan until the background lookup finishes
+PENDING_RESULT = {
+    'available': False,
+    'pending': True,
+    'message': 'VirusTotal lookup queued - the stored scan is updated when the report arrives'
+}
+
+# Placeholder for a lookup skipped under load; done when the scan is re-analysed
+DEFERRED_RESULT = {
+    'available': False,
+    'deferred': True,
+    'message': 'VirusTotal lookup deferred under high load - done when the scan is re-analysed'
+}
+
+
+class _PendingHash:
+    """One queued hash and its retry / polling state"""
+
+    __slots__ = ('file_hash', 'file_path', 'due', 'errors', 'polls', 'submitted')
+
+    def __init__(self, file_hash: str, file_path: Optional[str], polls: int = 0, submitted: bool = False):
+        self.file_hash = file_hash
+        self.file_path = file_path  # kept only while the file may still be submitted
+        self.due = time.monotonic()
+        self.errors = 0
+        self.polls = polls
+        self.submitted = submitted
+
+
+class SharedRateLimit:
+    """
+    Spaces requests interval seconds apart across every process forked after it
+    was created: each caller reserves the next free slot in shared memory, then sleeps
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        self._lock = ctx.Lock()
+        self._next = ctx.RawValue('d', 0.0)
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next.value, now)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class VTEnrichmentQueue:
+    """
+    Background VirusTotal lookups for stored scans
+    apply_result(scan_result, vt_result) returns the re-scored scan that is saved back.
+    Each queued hash is <hash>.vt.<pid> in directory (polling state), with the
+    upload kept for submission as <hash>.apk.<pid>; files of workers that exited
+    are adopted. A worker starting up also re-queues stored scans still marked
+    pending that no file covers. Create the queue before forking workers: the rate
+    limit lives in shared memory
+    """
+
+    def __init__(self, checker, db_manager, apply_result: Callable[[Dict, Dict], Dict], directory: str,
+                 requests_per_minute=4, batch_size=4, submit_unknown=False, poll_interval=300,
+                 max_polls=12, max_errors=5, max_pending=10000):
+        self.checker = checker
+        self.db_manager = db_manager
+        self.apply_result = apply_result
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.request_interval = 60.0 / max(requests_per_minute, 1e-3)
+        self.rate_limit = SharedRateLimit(self.request_interval)
+        self.batch_size = batch_size
+        self.submit_unknown = submit_unknown
+        self.poll_interval = poll_interval
+        self.max_polls = max_polls
+        self.max_errors = max_errors
+        self.max_pending = max_pending
+        self._pending = {}  # file_hash -> _PendingHash
+        self._cond = threading.Condition()
+        self.stats = {'enqueued': 0, 'updated': 0, 'submitted': 0, 'dropped': 0, 'requests': 0,
+                      'adopted': 0, 'recovered': 0}
+        self._thread = None
+        self._thread_pid = None
+
+    def enqueue(self, file_hash: str, file_path: Optional[str] = None) -> bool:
+        """
+        Queue a hash for lookup
+        Returns True when the queue took over file_path (it is deleted once no longer needed)
+        """
+        kept = self._keep(file_hash, file_path) if self.submit_unknown and file_path is not None else None
+        taken = kept is not None
+        with self._cond:
+            entry = self._pending.get(file_hash)
+            if entry is not None:
+                if kept is not None and entry.file_path is None and not entry.submitted:
+                    entry.file_path, kept = kept, None
+            elif len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                logger.warning(f"VirusTotal queue full - {file_hash} not enriched")
+                if kept is not None:
+                    # Moved already: back where the caller expects to delete it
+                    shutil.move(kept, file_path)
+                return False
+            else:
+                entry = self._pending[file_hash] = _PendingHash(file_hash, kept)
+                kept = None
+                self.stats['enqueued'] += 1
+                self._save(entry)
+            VT_QUEUE_DEPTH.set(len(self._pending))
+            self._cond.notify()
+        if kept is not None:
+            # Already queued with a file (or submitted): the copy is not needed
+            os.remove(kept)
+        self.start()
+        return taken
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            status = dict(self.stats,
+                          pending=len(self._pending),
+                          awaiting_analysis=sum(1 for e in self._pending.values() if e.submitted),
+                          requests_per_minute=round(60.0 / self.request_interval, 2),
+                          batch_size=self.batch_size,
+                          submit_unknown=self.submit_unknown)
+        try:
+            status['pending_on_host'] = sum(1 for name in os.listdir(self.directory) if '.vt.' in name)
+        except OSError:
+            pass
+        return status
+
+    def start(self):
+        """Start this process's lookup thread (threads do not survive a fork)"""
+        if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+            with self._cond:
+                if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                    self._thread_pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='vt-enrichment', daemon=True)
+                    self._thread.start()
+
+    def _path(self, file_hash: str, kind: str, pid: Optional[int] = None) -> str:
+        return os.path.join(self.directory, f'{file_hash}.{kind}.{pid or os.getpid()}')
+
+    def _keep(self, file_hash: str, file_path: str) -> Optional[str]:
+        """Move an upload into the queue directory; None if it cannot be kept"""
+        path = self._path(file_hash, 'apk')
+        try:
+            shutil.move(file_path, path)
+        except OSError as e:
+            logger.error(f"Could not keep {file_path} for VirusTotal submission: {str(e)}")
+            return None
+        return path
+
+    def _save(self, entry: _PendingHash):
+        """Write the hash's polling state (replaced atomically)"""
+        path = self._path(entry.file_hash, 'vt')
+        try:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({'polls': entry.polls, 'submitted': entry.submitted}, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logger.error(f"Could not persist VirusTotal queue entry {entry.file_hash}: {str(e)}")
+
+    def _recover(self):
+        """
+        Queue stored scans still marked pending that no worker's file covers
+        (scans queued before a crash, or by a server without the queue directory)
+        """
+        with open(os.path.join(self.directory, '.recover.lock'), 'a') as lock:
+            if fcntl is not None:
+                # Workers starting together sweep one after the other and skip each other's hashes
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                covered = {name.split('.', 1)[0] for name in os.listdir(self.directory) if '.vt.' in name}
+            except OSError:
+                return
+            recovered = 0
+            for file_hash in self.db_manager.pending_virustotal(limit=self.max_pending):
+                with self._cond:
+                    if file_hash in covered or file_hash in self._pending:
+                        continue
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    entry = self._pending[file_hash] = _PendingHash(file_hash, None)
+                    self._save(entry)
+                    recovered += 1
+            with self._cond:
+                self.stats['recovered'] += recovered
+                VT_QUEUE_DEPTH.set(len(self._pending))
+        if recovered:
+            logger.info("Re-queued %d stored scans still waiting for VirusTotal", recovered,
+                        extra={'log_class': 'vt.recovered'})
+
+    def _adopt_orphans(self):
+        """Queue the hashes (and kept uploads) of workers that no longer exist"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        own = os.getpid()
+        for name in names:
+            file_hash, _, pid = name.partition('.vt.')
+            if not pid.isdigit() or int(pid) == own or pid_alive(int(pid)):
+                continue
+            with self._cond:
+                if len(self._pending) >= self.max_pending:
+                    return
+                duplicate = file_hash in self._pending
+            path = os.path.join(self.directory, name)
+            upload = self._path(file_hash, 'apk', int(pid))
+            if duplicate:
+                # Queued here as well: the orphan's entry is redundant
+                for orphan in (path, upload):
+                    try:
+                        os.remove(orphan)
+                    except OSError:
+                        pass
+                continue
+            try:
+                # Atomic: when several workers adopt at once only one rename succeeds
+                os.rename(path, self._path(file_hash, 'vt'))
+            except OSError:
+                continue
+            try:
+                with open(self._path(file_hash, 'vt')) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            kept = None
+            if os.path.exists(upload):
+                try:
+                    os.rename(upload, self._path(file_hash, 'apk'))
+                    kept = self._path(file_hash, 'apk')
+                except OSError:
+                    pass
+            with self._cond:
+                self._pending.setdefault(file_hash, _PendingHash(file_hash, kept, state.get('polls', 0),
+                                                                 state.get('submitted', False)))
+                self.stats['adopted'] += 1
+                VT_QUEUE_DEPTH.set(len(self._pending))
+                self._cond.notify()
+            logger.info("Adopted VirusTotal lookup of %s from exited worker %s", file_hash, pid,
+                        extra={'log_class': 'vt.adopted'})
+
+    def _run(self):
+        try:
+            self._recover()
+        except Exception as e:
+            logger.error(f"Re-queueing pending VirusTotal lookups failed: {str(e)}")
+        next_adopt = 0.0
+        while True:
+            if time.monotonic() >= next_adopt:
+                self._adopt_orphans()
+                next_adopt = time.monotonic() + ADOPT_INTERVAL
+            with self._cond:
+                batch = self._take_due()
+                if not batch:
+                    next_due = min((e.due for e in self._pending.values()), default=float('inf'))
+                    wait = min(next_due, next_adopt) - time.monotonic()
+                    self._cond.wait(max(wait, 0.01))
+                    continue
+            try:
+                self._lookup(batch)
+            except Exception as e:
+                logger.error(f"VirusTotal enrichment failed: {str(e)}")
+                for entry in batch:
+                    self._retry(entry)
+
+    def _take_due(self):
+        """Oldest due hashes, at most one request's worth; they stay pending while in flight"""
+        now = time.monotonic()
+        due = sorted((e for e in self._pending.values() if e.due <= now), key=lambda e: e.due)
+        batch = due[:self.batch_size]
+        for entry in batch:
+            entry.due = float('inf')
+        return batch
+
+    def _throttle(self):
+        """Space requests request_interval apart across all workers (public API: 4 requests / minute)"""
+        self.rate_limit.wait()
+        self.stats['requests'] += 1
+
+    def _lookup(self, batch):
+        self._throttle()
+        VT_REQUESTS.inc(endpoint='file/report')
+        results = self.checker.check_hashes([entry.file_hash for entry in batch])
+        for entry in batch:
+            result = results[entry.file_hash]
+            if result.get('error'):
+                VT_LOOKUPS.inc(outcome='error')
+                self._retry(entry, result)
+            elif result.get('found'):
+                VT_LOOKUPS.inc(outcome='found')
+                self._finish(entry, result)
+            elif entry.submitted or result.get('queued'):
+                VT_LOOKUPS.inc(outcome='analysing')
+                self._poll_later(entry, result)
+            elif entry.file_path is not None:
+                VT_LOOKUPS.inc(outcome='not_found')
+                self._submit(entry, result)
+            else:
+                VT_LOOKUPS.inc(outcome='not_found')
+                self._finish(entry, result)
+
+    def _submit(self, entry: _PendingHash, result: Dict[str, Any]):
+        """Upload an unknown file for analysis; its report is polled afterwards"""
+        self._throttle()
+        VT_REQUESTS.inc(endpoint='file/scan')
+        submission = self.checker.submit_file(entry.file_path)
+        if not submission.get('success'):
+            logger.warning(f"VirusTotal submission of {entry.file_hash} failed: "
+                           f"{submission.get('error') or submission.get('message')}")
+            self._finish(entry, result)
+            return
+        logger.info("Submitted %s to VirusTotal (scan_id %s)", entry.file_hash, submission.get('scan_id'),
+                    extra={'log_class': 'vt.submitted'})
+        self._discard_file(entry)
+        entry.submitted = True
+        self._save(entry)
+        self.stats['submitted'] += 1
+        self._poll_later(entry, dict(result, queued=True, permalink=submission.get('permalink'),
+                                     message='File submitted to VirusTotal for analysis'))
+
+    def _poll_later(self, entry: _PendingHash, result: Dict[str, Any]):
+        entry.polls += 1
+        if entry.polls > self.max_polls:
+            logger.warning(f"No VirusTotal report for {entry.file_hash} after {self.max_polls} polls")
+            self._finish(entry, result)
+            return
+        self._save(entry)
+        with self._cond:
+            entry.due = time.monotonic() + self.poll_interval
+            self._cond.notify()
+
+    def _retry(self, entry: _PendingHash, result: Optional[Dict[str, Any]] = None):
+        """Back off exponentially on rate limits / API errors, then give up"""
+        entry.errors += 1
+        if entry.errors >= self.max_errors:
+            logger.error(f"VirusTotal lookup of {entry.file_hash} abandoned after {entry.errors} errors")
+            self._finish(entry, result or {'available': False, 'error': 'VirusTotal lookup failed'})
+            return
+        with self._cond:
+            entry.due = time.monotonic() + self.request_interval * 2 ** entry.errors
+            self._cond.notify()
+
+    def _finish(self, entry: _PendingHash, result: Dict[str, Any]):
+        # Written back before the entry's file goes: a crash in between repeats the lookup
+        self._write_back(entry.file_hash, result)
+        with self._cond:
+            self._pending.pop(entry.file_hash, None)
+            VT_QUEUE_DEPTH.set(len(self._pending))
+        self._discard_file(entry)
+        try:
+            os.remove(self._path(entry.file_hash, 'vt'))
+        except OSError:
+            pass
+
+    def _write_back(self, file_hash: str, vt_result: Dict[str, Any]):
+        """Store the VirusTotal result with the scan and re-score it"""
+        scan_result = self.db_manager.get_scan_by_hash(file_hash)
+        if scan_result is None:
+            logger.warning(f"No stored scan for {file_hash} - VirusTotal result dropped")
+            return
+        updated = self.apply_result(scan_result, vt_result)
+        if self.db_manager.update_scan(updated):
+            self.stats['updated'] += 1
+            logger.info("VirusTotal enrichment of %s: %s -> %s (%s)", file_hash,
+                        vt_result.get('detection_ratio') or vt_result.get('message') or vt_result.get('error'),
+                        updated.get('verdict'), updated.get('risk_score'), extra={'log_class': 'vt.enriched'})
+
+    @staticmethod
+    def _discard_file(entry: _PendingHash):
+        if entry.file_path is not None:
+            try:
+                os.remove(entry.file_path)
+            except OSError:
+                pass
+            entry.file_path = None
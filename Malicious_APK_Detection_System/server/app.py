@@ -1,16 +1,35 @@
 """
 Malicious APK Detection System - Main Flask Application
 """
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 from werkzeug.utils import secure_filename
 import os
+import re
 import hashlib
 import logging
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from analyzer.apk_analyzer import APKAnalyzer
 from analyzer.ml_predictor import MalwarePredictor
 from analyzer.virustotal_checker import VirusTotalChecker
-from database.db_manager import DatabaseManager
+from analyzer.vt_enrichment import (VTEnrichmentQueue, PENDING_RESULT as VT_PENDING_RESULT,
+                                    DEFERRED_RESULT as VT_DEFERRED_RESULT)
+from database.storage import store_from_env
+from database.job_queue import job_queue_for
+from database.upload_sessions import UploadSessionStore, UploadSessionError
+from scheduling.admission import AdmissionRejected, controller_from_env
+from scheduling.priority import PRIORITIES, estimate_job
+from scheduling.degradation import TIERS, FULL, MINIMAL, ReanalysisQueue, policy_from_env
+from contextlib import nullcontext
+from monitoring.metrics import (timed, start_trace, end_trace, current_trace, render_prometheus,
+                                SCAN_SECONDS, SCANS_TOTAL, SCANS_BY_TIER, CACHE_HITS, CACHE_MISSES,
+                                ERRORS, CONTENT_TYPE as METRICS_CONTENT_TYPE)
+from monitoring.progress import ScanEventLog, scan_progress, report_progress
+from monitoring.profiler import profiler_from_env, summarize as summarize_profile
+from monitoring.log_pipeline import setup_logging, start_log_context, bind_log_context, end_log_context
 
 # Initialize Flask app
 app = Flask(__name__, 
@@ -28,22 +47,54 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('logs', exist_ok=True)
 os.makedirs('models', exist_ok=True)
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/app.log'),
-        logging.StreamHandler()
-    ]
-)
+# Setup logging: records are queued and written by a listener thread (JSON lines in logs/app.log)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize components
 apk_analyzer = APKAnalyzer()
 ml_predictor = MalwarePredictor()
 vt_checker = VirusTotalChecker()
-db_manager = DatabaseManager()
+# Scan history: SQLite at DATABASE_PATH, or PostgreSQL shared by several nodes when DATABASE_URL is set
+db_manager = store_from_env()
+# Per-node state (upload sessions, stream events) stays in SQLite, next to the scan history if that is local
+local_state_dir = (os.path.dirname(db_manager.db_path) if db_manager.backend == 'sqlite'
+                   else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'database'))
+# Resumable uploads write their chunks straight into the upload folder
+upload_sessions = UploadSessionStore(
+    os.environ.get('UPLOAD_SESSIONS_DATABASE') or os.path.join(local_state_dir, 'upload_sessions.db'),
+    app.config['UPLOAD_FOLDER'],
+    ttl=float(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24)) * 3600,
+    max_sessions_per_client=int(os.environ.get('RESUMABLE_MAX_SESSIONS_PER_CLIENT', 4)),
+    max_bytes_per_client=int(os.environ.get('RESUMABLE_MAX_RESERVED_MB_PER_CLIENT', 2048)) * 1024 * 1024
+)
+RESUMABLE_MAX_BYTES = int(os.environ.get('RESUMABLE_MAX_UPLOAD_MB', 1024)) * 1024 * 1024
+RESUMABLE_CHUNK_BYTES = int(os.environ.get('RESUMABLE_CHUNK_MB', 8)) * 1024 * 1024
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+# Stage events of streamed scans, readable from every worker
+event_log = ScanEventLog(os.environ.get('SCAN_EVENTS_DATABASE') or os.path.join(local_state_dir, 'scan_events.db'))
+# Scan jobs for the worker fleet (worker.py), next to the scan history unless JOB_QUEUE_URL is set
+job_queue = job_queue_for(db_manager)
+MAX_JOBS_PER_REQUEST = 1000
+# Opt-in stack sampling of scans; slow (or sampled) scans keep their profile, readable from every worker
+profiler = profiler_from_env(os.path.join(local_state_dir, 'profiles.db'))
+vt_queue = None  # created below, once apply_virustotal_result is defined
+# Created before the server forks so all workers share the limits
+admission = controller_from_env()
+ADMISSION_API_KEYS = frozenset(filter(None, (key.strip() for key in
+                                             os.environ.get('ADMISSION_API_KEYS', '').split(','))))
+degradation = policy_from_env(admission.queue_depth if admission is not None else None)
+reanalysis_queue = None  # created below, once reanalyze_provisional is defined
+PROVISIONAL_NOTE = 'ℹ️ Provisional result from reduced analysis under high load - it is updated automatically'
+
+
+@app.before_request
+def start_background_workers():
+    """Background threads do not survive the fork into workers, so each worker starts its own"""
+    if reanalysis_queue is not None:
+        reanalysis_queue.start()
+    if vt_queue is not None:
+        vt_queue.start()
 
 
 def allowed_file(filename):
@@ -51,6 +102,38 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
+def client_identity():
+    """
+    Admission key of the caller: its API key if it is one of ADMISSION_API_KEYS, otherwise
+    its IP address (a client must not get a fresh bucket by sending a new key every time)
+    """
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in ADMISSION_API_KEYS:
+        # Buckets and log lines get a digest, not the key itself
+        return f"key:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]}"
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and os.environ.get('ADMISSION_TRUST_PROXY', '0').lower() in ('1', 'true', 'yes'):
+        return f"ip:{forwarded.split(',')[0].strip()}"
+    return f'ip:{request.remote_addr or "unknown"}'
+
+
+def scan_priority():
+    """'interactive' or 'bulk' from X-Scan-Priority, else SCHEDULER_DEFAULT_PRIORITY"""
+    priority = (request.headers.get('X-Scan-Priority') or '').strip().lower()
+    if priority not in PRIORITIES:
+        priority = os.environ.get('SCHEDULER_DEFAULT_PRIORITY', 'bulk')
+    return priority
+
+
+def too_many_requests(rejection):
+    """429 response for a refused scan"""
+    return jsonify({
+        'error': str(rejection),
+        'reason': rejection.reason,
+        'retry_after': rejection.retry_after
+    }), 429, {'Retry-After': str(rejection.retry_after)}
+
+
 def calculate_file_hash(filepath):
     """Calculate SHA256 hash of file"""
     sha256_hash = hashlib.sha256()
@@ -69,7 +152,7 @@ def index():
 @app.route('/upload', methods=['GET'])
 def upload_page():
     """Upload page"""
-    return render_template('upload.html')
+    return render_template('upload.html', max_upload_mb=RESUMABLE_MAX_BYTES // (1024 * 1024))
 
 
 @app.route('/history')
@@ -83,118 +166,479 @@ def history():
 def scan_apk():
     """
     Main endpoint to scan uploaded APK file
+    Pass ?debug_timing=1 to include per-stage timings in the response
+    Pass ?stream=1 to get 202 with the scan_id as soon as the upload is stored: the scan
+    then runs in the background and /api/scan/<scan_id>/events streams its stages
+    """
+    return run_scan_request(receive_upload, request.content_length or app.config['MAX_CONTENT_LENGTH'])
+
+
+def run_scan_request(get_upload, upload_bytes):
+    """
+    Admission, then the scan of the upload returned by get_upload(), inline or streamed
+    get_upload returns (upload, None) or (None, (error body, status code))
     """
+    debug_timing = request.args.get('debug_timing') == '1'
+    stream = request.args.get('stream') == '1'
+    trace = start_trace()
+    scan_start = time.perf_counter()
+    outcome = 'error'
+    ticket = None
+    upload = None
+    handed_off = False
+    profile = profiler.begin() if profiler is not None else None
+    start_log_context()
+    
     try:
-        # Check if file is present
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Only APK files are allowed'}), 400
-        
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        logger.info(f"File uploaded: {unique_filename}")
+        # Decided from the headers alone, before the upload body is received
+        if admission is not None:
+            ticket = admission.admit(client_identity(), upload_bytes)
+        upload, error = get_upload()
+        if error is not None:
+            outcome = 'rejected'
+            return jsonify(error[0]), error[1]
         
-        # Calculate file hash
-        file_hash = calculate_file_hash(filepath)
-        logger.info(f"File hash: {file_hash}")
-        
-        # Check if already scanned
-        cached_result = db_manager.get_scan_by_hash(file_hash)
-        if cached_result:
-            logger.info("Returning cached result")
+        if stream:
+            # The request thread is released here; the admission ticket goes with the scan
+            event_log.append(upload['scan_id'], 'uploaded', {'filename': upload['filename'],
+                                                              'size_bytes': upload['size_bytes']})
+            submit_streamed_scan(upload, ticket, scan_priority() == 'interactive', scan_start)
+            handed_off = True
+            events_url = f"/api/scan/{upload['scan_id']}/events"
             return jsonify({
-                'status': 'success',
-                'cached': True,
-                'result': cached_result
-            })
+                'status': 'accepted',
+                'scan_id': upload['scan_id'],
+                'events_url': events_url
+            }), 202, {'Location': events_url}
         
-        # Phase 1: Static Analysis with Androguard
-        logger.info("Starting APK analysis...")
-        analysis_result = apk_analyzer.analyze(filepath)
-        
-        if not analysis_result['success']:
-            return jsonify({
-                'error': 'Failed to analyze APK',
-                'details': analysis_result.get('error', 'Unknown error')
-            }), 500
-        
-        # Phase 2: ML-based Malware Detection
-        logger.info("Running ML prediction...")
-        ml_result = ml_predictor.predict(analysis_result['features'])
-        
-        # Phase 3: VirusTotal Check
-        logger.info("Checking VirusTotal...")
-        vt_result = vt_checker.check_hash(file_hash)
-        
-        # Calculate overall risk score
-        risk_score = calculate_risk_score(analysis_result, ml_result, vt_result)
-        
-        # Determine verdict
-        verdict = determine_verdict(risk_score, ml_result)
-        
-        # Compile final result
-        scan_result = {
-            'scan_id': unique_filename,
-            'filename': filename,
-            'file_hash': file_hash,
-            'timestamp': timestamp,
-            'verdict': verdict,
-            'risk_score': risk_score,
-            'apk_info': {
-                'package_name': analysis_result.get('package_name', 'Unknown'),
-                'app_name': analysis_result.get('app_name', 'Unknown'),
-                'version_name': analysis_result.get('version_name', 'Unknown'),
-                'version_code': analysis_result.get('version_code', 'Unknown'),
-                'min_sdk': analysis_result.get('min_sdk', 'Unknown'),
-                'target_sdk': analysis_result.get('target_sdk', 'Unknown'),
-            },
-            'permissions': analysis_result.get('permissions', []),
-            'dangerous_permissions': analysis_result.get('dangerous_permissions', []),
-            'suspicious_features': analysis_result.get('suspicious_features', []),
-            'ml_prediction': {
-                'is_malware': ml_result.get('is_malware', False),
-                'confidence': ml_result.get('confidence', 0),
-                'malware_type': ml_result.get('malware_type', 'Unknown')
-            },
-            'virustotal': vt_result,
-            'recommendations': generate_recommendations(verdict, analysis_result, ml_result)
-        }
-        
-        # Save to database
-        db_manager.save_scan(scan_result)
-        
-        # Clean up uploaded file
-        try:
-            os.remove(filepath)
-        except:
-            pass
-        
-        logger.info(f"Scan completed: {verdict}")
-        
-        return jsonify({
-            'status': 'success',
-            'cached': False,
-            'result': scan_result
-        })
+        response = process_scan(upload, ticket, scan_priority() == 'interactive')
+        outcome = scan_outcome(*response)
+        if debug_timing:
+            response[0]['timing'] = {
+                'total_ms': round((time.perf_counter() - scan_start) * 1000, 3),
+                'stages': trace
+            }
+        return jsonify(response[0]), response[1]
+    
+    except AdmissionRejected as e:
+        outcome = 'throttled'
+        return too_many_requests(e)
     
     except Exception as e:
+        ERRORS.inc(stage='scan')
         logger.error(f"Error during scan: {str(e)}", exc_info=True)
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
         }), 500
+    
+    finally:
+        if not handed_off:
+            finish_scan(ticket, scan_start, outcome)
+        if profile is not None:
+            if handed_off:
+                profiler.discard(profile)  # the streamed scan thread profiles the scan itself
+            else:
+                profiler.end(profile, upload['scan_id'] if upload else None, trace, outcome)
+        end_trace()
+        end_log_context()
+
+
+def scan_outcome(body, status):
+    """Outcome label of a finished scan for the latency histogram"""
+    if body.get('cached'):
+        return 'cached'
+    return 'success' if status == 200 else 'rejected'
+
+
+def finish_scan(ticket, scan_start, outcome):
+    """Release the scan's admission ticket and record its latency"""
+    if ticket is not None:
+        admission.release(ticket)
+    elapsed = time.perf_counter() - scan_start
+    SCAN_SECONDS.observe(elapsed, outcome=outcome)
+    if degradation is not None and outcome == 'success':
+        degradation.observe_latency(elapsed)
+
+
+def receive_upload():
+    """
+    Validate and store the uploaded file
+    Returns (upload, None), or (None, (error body, status code))
+    """
+    # Check if file is present
+    if 'file' not in request.files:
+        return None, ({'error': 'No file provided'}, 400)
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return None, ({'error': 'No file selected'}, 400)
+    
+    if not allowed_file(file.filename):
+        return None, ({'error': 'Only APK files are allowed'}, 400)
+    
+    # Save uploaded file
+    filename = secure_filename(file.filename)
+    timestamp, unique_filename = new_scan_id(filename)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    with timed('upload_receive'):
+        file.save(filepath)
+    
+    logger.info("File uploaded: %s", unique_filename, extra={'log_class': 'scan.upload'})
+    return {
+        'scan_id': unique_filename,
+        'filename': filename,
+        'filepath': filepath,
+        'timestamp': timestamp,
+        'size_bytes': os.path.getsize(filepath)
+    }, None
+
+
+def new_scan_id(filename):
+    """(timestamp, scan_id); the random part keeps same-named uploads in the same second apart"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return timestamp, f"{timestamp}_{secrets.token_hex(4)}_{filename}"
+
+
+def process_scan(upload, ticket=None, interactive=False):
+    """Scan pipeline for a stored upload, returns (body dict, status code)"""
+    unique_filename, filename = upload['scan_id'], upload['filename']
+    filepath, timestamp = upload['filepath'], upload['timestamp']
+    bind_log_context(scan_id=unique_filename)
+    
+    # Calculate file hash (resumable uploads hash their chunks as they arrive)
+    file_hash = upload.get('file_hash')
+    if file_hash is None:
+        with timed('hashing'):
+            file_hash = calculate_file_hash(filepath)
+    bind_log_context(file_hash=file_hash)
+    logger.info("File hash: %s", file_hash, extra={'log_class': 'scan.hash'})
+    report_progress('hashed', file_hash=file_hash)
+    
+    # Check if already scanned
+    with timed('cache_lookup'):
+        cached_result = db_manager.get_scan_by_hash(file_hash)
+    
+    # Cheaper analysis tiers under load (scheduling/degradation.py)
+    tier = degradation.tier() if degradation is not None else FULL
+    
+    # A provisional result is only reused while the server is still degraded
+    if cached_result and not (cached_result.get('provisional') and tier == FULL):
+        CACHE_HITS.inc()
+        logger.info("Returning cached result", extra={'log_class': 'scan.cached'})
+        report_progress('cache_hit', scan_id=cached_result.get('scan_id'), verdict=cached_result.get('verdict'))
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+        return {
+            'status': 'success',
+            'cached': True,
+            'result': cached_result
+        }, 200
+    CACHE_MISSES.inc()
+    
+    try:
+        if tier == MINIMAL:
+            # ZIP listing and rules only: cheap enough to skip the analysis slot queue
+            analysis_result, ml_result = analyze_apk(filepath, tier)
+        else:
+            # Analysis and prediction are CPU-bound: only max_analyses run at once across workers,
+            # and waiting scans are ordered by estimated cost and priority
+            job = None
+            if ticket is not None and admission.scheduler is not None:
+                job = estimate_job(filepath, interactive, admission.scheduler.lanes)
+                logger.info("Scheduling %s: cost %.1f (%d entries), lane %s, %s", filename, job.cost, job.entries,
+                            admission.scheduler.lanes[job.lane][0], job.priority,
+                            extra={'log_class': 'scan.schedule'})
+            if ticket is not None:
+                report_progress('queued', queued=admission.queue_depth(),
+                                lane=admission.scheduler.lanes[job.lane][0] if job is not None else None)
+            with admission.analysis_slot(ticket, job) if ticket is not None else nullcontext():
+                analysis_result, ml_result = analyze_apk(filepath, tier)
+    except AdmissionRejected:
+        try:
+            os.remove(filepath)
+        except:
+            pass
+        raise
+    
+    if ml_result is None:
+        ERRORS.inc(stage='analysis')
+        return {
+            'error': 'Failed to analyze APK',
+            'details': analysis_result.get('error', 'Unknown error')
+        }, 500
+    
+    # Phase 3: VirusTotal Check
+    vt_result = check_virustotal(file_hash, tier)
+    report_progress('vt_done', virustotal=vt_result)
+    
+    scan_result = build_scan_result(unique_filename, filename, file_hash, timestamp,
+                                    analysis_result, ml_result, vt_result, tier)
+    
+    # Save to database
+    with timed('db_write'):
+        saved = db_manager.save_scan(scan_result)
+    if not saved:
+        ERRORS.inc(stage='db_write')
+    report_progress('saved', scan_id=unique_filename, saved=saved, verdict=scan_result['verdict'],
+                    risk_score=scan_result['risk_score'])
+    
+    # Provisional results keep the upload for a full re-analysis once load drops
+    file_kept = tier != FULL and saved and reanalysis_queue is not None and \
+        reanalysis_queue.enqueue(file_hash, filepath)
+    
+    # The enrichment queue keeps the upload when it may still be submitted to VirusTotal
+    if vt_queue is not None and saved:
+        file_kept = vt_queue.enqueue(file_hash, None if file_kept else filepath) or file_kept
+    
+    # Clean up uploaded file
+    if not file_kept:
+        try:
+            os.remove(filepath)
+        except:
+            pass
+    
+    SCANS_TOTAL.inc(verdict=scan_result['verdict'])
+    logger.info("Scan completed: %s%s", scan_result['verdict'],
+                '' if tier == FULL else f' (provisional, {TIERS[tier]} analysis)',
+                extra={'log_class': 'scan.completed', 'verdict': scan_result['verdict'],
+                       'risk_score': scan_result['risk_score'], 'tier': TIERS[tier], 'stages': current_trace()})
+    
+    return {
+        'status': 'success',
+        'cached': False,
+        'result': scan_result
+    }, 200
+
+
+_stream_executor = None
+_stream_executor_pid = None
+_stream_executor_lock = threading.Lock()
+
+
+def submit_streamed_scan(upload, ticket, interactive, scan_start):
+    """Run process_scan for a streamed upload on this worker's background scan threads"""
+    global _stream_executor, _stream_executor_pid
+    with _stream_executor_lock:
+        # Threads do not survive the fork into workers
+        if _stream_executor is None or _stream_executor_pid != os.getpid():
+            _stream_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('SCAN_STREAM_THREADS', 8)), thread_name_prefix='scan'
+            )
+            _stream_executor_pid = os.getpid()
+        _stream_executor.submit(run_streamed_scan, upload, ticket, interactive, scan_start)
+
+
+def run_streamed_scan(upload, ticket, interactive, scan_start):
+    """Background part of a streamed scan; ends its event stream with 'complete' or 'error'"""
+    outcome = 'error'
+    trace = start_trace()
+    profile = profiler.begin() if profiler is not None else None
+    start_log_context(scan_id=upload['scan_id'], file_hash=upload.get('file_hash'), streamed=True)
+    try:
+        with scan_progress(event_log, upload['scan_id']):
+            try:
+                body, status = process_scan(upload, ticket, interactive)
+                outcome = scan_outcome(body, status)
+            except AdmissionRejected as e:
+                outcome = 'throttled'
+                body, status = {'error': str(e), 'reason': e.reason, 'retry_after': e.retry_after}, 429
+            except Exception as e:
+                ERRORS.inc(stage='scan')
+                logger.error(f"Error during scan: {str(e)}", exc_info=True)
+                body, status = {'error': 'Internal server error', 'details': str(e)}, 500
+            report_progress('complete' if status == 200 else 'error', status_code=status, **body)
+    finally:
+        finish_scan(ticket, scan_start, outcome)
+        if profile is not None:
+            profiler.end(profile, upload['scan_id'], trace, outcome)
+        end_trace()
+        end_log_context()
+
+
+def analyze_apk(filepath, tier=FULL):
+    """
+    Phases 1-2 at a degradation tier
+    Returns (analysis_result, ml_result); ml_result is None when the analysis failed
+    """
+    SCANS_BY_TIER.inc(tier=TIERS[tier])
+    report_progress('analysis_started', tier=TIERS[tier])
+    if tier == MINIMAL:
+        logger.info("Starting minimal APK analysis (server under load)...", extra={'log_class': 'scan.stage'})
+        with timed('analysis'):
+            analysis_result = apk_analyzer.analyze_quick(filepath)
+        if not analysis_result['success']:
+            return analysis_result, None
+        report_analyzed(analysis_result)
+        with timed('ml'):
+            ml_result = ml_predictor.predict_rule_based(analysis_result['features'])
+        report_progress('ml_scored', ml_prediction=ml_result)
+        return analysis_result, ml_result
+    
+    # Phase 1: Static Analysis with Androguard (URL extraction only at the full tier)
+    logger.info("Starting APK analysis...", extra={'log_class': 'scan.stage'})
+    with timed('analysis'):
+        analysis_result = apk_analyzer.analyze(filepath, extract_urls=tier == FULL)
+    if not analysis_result['success']:
+        return analysis_result, None
+    report_analyzed(analysis_result)
+    
+    # Phase 2: ML-based Malware Detection
+    logger.info("Running ML prediction...", extra={'log_class': 'scan.stage'})
+    with timed('ml'):
+        ml_result = ml_predictor.predict(analysis_result['features'])
+    report_progress('ml_scored', ml_prediction=ml_result)
+    return analysis_result, ml_result
+
+
+def report_analyzed(analysis_result):
+    """Partial result for a streamed scan once static analysis is done"""
+    report_progress(
+        'analyzed',
+        dangerous_permissions=analysis_result.get('dangerous_permissions', []),
+        suspicious_features=analysis_result.get('suspicious_features', []),
+        url_summary=analysis_result.get('url_summary', {}),
+        source_verification=analysis_result.get('source_verification', {})
+    )
+
+
+def check_virustotal(file_hash, tier=FULL):
+    """VirusTotal result for a new scan: queued for background enrichment, deferred under load, or looked up"""
+    if vt_queue is not None:
+        return dict(VT_PENDING_RESULT)
+    if tier != FULL and vt_checker.enabled:
+        return dict(VT_DEFERRED_RESULT)
+    logger.info("Checking VirusTotal...", extra={'log_class': 'scan.stage'})
+    with timed('virustotal'):
+        vt_result = vt_checker.check_hash(file_hash)
+    if vt_result.get('error'):
+        ERRORS.inc(stage='virustotal')
+    return vt_result
+
+
+def build_scan_result(scan_id, filename, file_hash, timestamp, analysis_result, ml_result, vt_result,
+                      tier=FULL):
+    """Scan record stored and returned by /api/scan"""
+    # Calculate overall risk score
+    risk_components = calculate_risk_components(analysis_result, ml_result, vt_result)
+    risk_score = min(int(sum(risk_components.values())), 100)
+    
+    # Determine verdict
+    verdict = determine_verdict(risk_score, ml_result)
+    
+    # Compile final result
+    scan_result = {
+        'scan_id': scan_id,
+        'filename': filename,
+        'file_hash': file_hash,
+        'timestamp': timestamp,
+        'verdict': verdict,
+        'risk_score': risk_score,
+        'risk_components': risk_components,
+        'analysis_tier': TIERS[tier],
+        'apk_info': {
+            'package_name': analysis_result.get('package_name', 'Unknown'),
+            'app_name': analysis_result.get('app_name', 'Unknown'),
+            'version_name': analysis_result.get('version_name', 'Unknown'),
+            'version_code': analysis_result.get('version_code', 'Unknown'),
+            'min_sdk': analysis_result.get('min_sdk', 'Unknown'),
+            'target_sdk': analysis_result.get('target_sdk', 'Unknown'),
+        },
+        'permissions': analysis_result.get('permissions', []),
+        'dangerous_permissions': analysis_result.get('dangerous_permissions', []),
+        'suspicious_features': analysis_result.get('suspicious_features', []),
+        'urls': analysis_result.get('urls', []),
+        'url_summary': analysis_result.get('url_summary', {}),
+        'url_intel': analysis_result.get('url_intel', {}),
+        'source_verification': analysis_result.get('source_verification', {}),
+        'ml_prediction': {
+            'is_malware': ml_result.get('is_malware', False),
+            'confidence': ml_result.get('confidence', 0),
+            'malware_type': ml_result.get('malware_type', 'Unknown')
+        },
+        'virustotal': vt_result,
+        'recommendations': generate_recommendations(verdict, analysis_result, ml_result)
+    }
+    if tier != FULL:
+        scan_result['provisional'] = True
+        scan_result['recommendations'].insert(0, PROVISIONAL_NOTE)
+    return scan_result
+
+
+class ScanError(Exception):
+    """The APK could not be analysed; scanning it again will not help"""
+
+
+def scan_file(filepath, filename, file_hash, temporary=False):
+    """
+    Full-tier scan of a file outside a request and without admission (scan jobs):
+    analysis, ML prediction, VirusTotal and the stored result
+    Returns (scan_result, file_kept); a temporary file may be kept for VirusTotal submission
+    """
+    analysis_result, ml_result = analyze_apk(filepath, FULL)
+    if ml_result is None:
+        raise ScanError(f"Failed to analyze APK: {analysis_result.get('error', 'Unknown error')}")
+    vt_result = check_virustotal(file_hash, FULL)
+    timestamp, scan_id = new_scan_id(filename)
+    bind_log_context(scan_id=scan_id)
+    scan_result = build_scan_result(scan_id, filename, file_hash, timestamp,
+                                    analysis_result, ml_result, vt_result, FULL)
+    # An upsert on file_hash: a file scanned twice still stores one scan
+    if not db_manager.save_scan(scan_result):
+        raise RuntimeError('scan could not be saved')
+    file_kept = vt_queue is not None and vt_queue.enqueue(file_hash, filepath if temporary else None)
+    SCANS_TOTAL.inc(verdict=scan_result['verdict'])
+    return scan_result, file_kept
+
+
+def reanalyze_provisional(file_hash, filepath):
+    """
+    Full-tier re-analysis of a provisional scan, run by the re-analysis queue
+    Returns False to be retried later when no analysis slot is available
+    """
+    scan_result = db_manager.get_scan_by_hash(file_hash)
+    if scan_result is None or not scan_result.get('provisional'):
+        return True  # replaced by a full scan in the meantime
+    
+    ticket = None
+    try:
+        if admission is not None:
+            ticket = admission.admit('internal:reanalysis', os.path.getsize(filepath))
+        job = None
+        if ticket is not None and admission.scheduler is not None:
+            job = estimate_job(filepath, False, admission.scheduler.lanes)
+        with admission.analysis_slot(ticket, job) if ticket is not None else nullcontext():
+            analysis_result, ml_result = analyze_apk(filepath, FULL)
+    except AdmissionRejected:
+        return False
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+    if ml_result is None:
+        raise RuntimeError(analysis_result.get('error', 'analysis failed'))
+    
+    # Keep a VirusTotal report that arrived meanwhile
+    stored_vt = scan_result.get('virustotal') or {}
+    if vt_queue is not None and stored_vt.get('pending'):
+        vt_queue.enqueue(file_hash)
+    vt_result = stored_vt if vt_queue is not None else check_virustotal(file_hash, FULL)
+    
+    updated = build_scan_result(scan_result['scan_id'], scan_result['filename'], file_hash,
+                                scan_result['timestamp'], analysis_result, ml_result, vt_result, FULL)
+    if not db_manager.update_scan(updated):
+        raise RuntimeError('stored scan could not be updated')
+    logger.info("Re-analysed provisional scan %s (%s): %s -> %s", updated['scan_id'],
+                scan_result.get('analysis_tier'), scan_result.get('verdict'), updated['verdict'])
+    return True
+
+
+if degradation is not None:
+    reanalysis_queue = ReanalysisQueue(
+        degradation, reanalyze_provisional, os.path.join(app.config['UPLOAD_FOLDER'], 'provisional')
+    )
 
 
 def calculate_risk_score(analysis_result, ml_result, vt_result):
@@ -202,36 +646,91 @@ def calculate_risk_score(analysis_result, ml_result, vt_result):
     Calculate overall risk score (0-100)
     Enhanced with source verification
     """
-    score = 0
+    components = calculate_risk_components(analysis_result, ml_result, vt_result)
+    return min(int(sum(components.values())), 100)
+
+
+def calculate_risk_components(analysis_result, ml_result, vt_result):
+    """
+    Points contributed by each signal; stored with the scan so the VirusTotal
+    part can be replaced once a background lookup finishes
+    """
+    components = {}
     
     # ML model prediction weight (35% - reduced from 40%)
-    if ml_result.get('is_malware'):
-        score += ml_result.get('confidence', 0) * 35
+    components['ml'] = ml_result.get('confidence', 0) * 35 if ml_result.get('is_malware') else 0
     
     # Dangerous permissions weight (20%)
     dangerous_perms = len(analysis_result.get('dangerous_permissions', []))
-    score += min(dangerous_perms * 4, 20)
+    components['permissions'] = min(dangerous_perms * 4, 20)
     
     # Suspicious features weight (15% - reduced from 20%)
     suspicious_features = len(analysis_result.get('suspicious_features', []))
-    score += min(suspicious_features * 5, 15)
+    components['suspicious_features'] = min(suspicious_features * 5, 15)
     
     # VirusTotal detections weight (15% - reduced from 20%)
-    if vt_result.get('detected'):
-        detection_ratio = vt_result.get('positives', 0) / max(vt_result.get('total', 1), 1)
-        score += detection_ratio * 15
+    components['virustotal'] = virustotal_risk_points(vt_result)
     
     # Source verification weight (15% - NEW)
     source_info = analysis_result.get('source_verification', {})
-    if not source_info.get('verified', True):  # Default True if not present
-        score += 15  # Add 15 points for unverified source
+    # Add 15 points for unverified source (default True if not present)
+    components['source'] = 15 if not source_info.get('verified', True) else 0
     
     # Additional penalties for certificate warnings
     warnings = source_info.get('warnings', [])
-    warning_penalty = min(len(warnings) * 3, 10)  # +3 per warning, max 10
-    score += warning_penalty
+    components['certificate_warnings'] = min(len(warnings) * 3, 10)  # +3 per warning, max 10
     
-    return min(int(score), 100)
+    # Hosts on the threat-intel blocklist, counted over every extracted URL
+    components['blocklisted_hosts'] = blocklisted_host_points(analysis_result.get('url_intel', {}))
+    
+    return components
+
+
+def blocklisted_host_points(url_intel):
+    """Risk points for blocklisted hosts (+10 per host, max 20)"""
+    blocked = url_intel.get('blocked_total', len(url_intel.get('blocked_hosts', [])))
+    return min(blocked * 10, 20)
+
+
+def virustotal_risk_points(vt_result):
+    """Risk points from VirusTotal detections (max 15)"""
+    if vt_result.get('detected'):
+        detection_ratio = vt_result.get('positives', 0) / max(vt_result.get('total', 1), 1)
+        return detection_ratio * 15
+    return 0
+
+
+def apply_virustotal_result(scan_result, vt_result):
+    """Stored scan re-scored with a VirusTotal result from the enrichment queue"""
+    components = dict(scan_result.get('risk_components') or {'base': scan_result.get('risk_score', 0)})
+    components['virustotal'] = virustotal_risk_points(vt_result)
+    risk_score = min(int(sum(components.values())), 100)
+    verdict = determine_verdict(risk_score, scan_result.get('ml_prediction', {}))
+    
+    updated = dict(scan_result, virustotal=vt_result, risk_components=components,
+                   risk_score=risk_score, verdict=verdict)
+    if verdict != scan_result.get('verdict'):
+        analysis_view = {
+            'dangerous_permissions': scan_result.get('dangerous_permissions', []),
+            'source_verification': scan_result.get('source_verification', {}),
+            'url_intel': scan_result.get('url_intel', {})
+        }
+        updated['recommendations'] = generate_recommendations(verdict, analysis_view,
+                                                              scan_result.get('ml_prediction', {}))
+        if scan_result.get('provisional'):
+            updated['recommendations'].insert(0, PROVISIONAL_NOTE)
+    return updated
+
+
+if vt_checker.enabled and os.environ.get('VT_ENRICHMENT', 'async').lower() != 'sync':
+    vt_queue = VTEnrichmentQueue(
+        vt_checker, db_manager, apply_virustotal_result,
+        directory=os.path.join(app.config['UPLOAD_FOLDER'], 'virustotal'),
+        requests_per_minute=float(os.environ.get('VT_REQUESTS_PER_MINUTE', 4)),
+        batch_size=int(os.environ.get('VT_BATCH_SIZE', 4)),
+        submit_unknown=os.environ.get('VT_SUBMIT_UNKNOWN', '0').lower() in ('1', 'true', 'yes'),
+        poll_interval=float(os.environ.get('VT_POLL_INTERVAL', 300))
+    )
 
 
 def determine_verdict(risk_score, ml_result):
@@ -291,9 +790,211 @@ def generate_recommendations(verdict, analysis_result, ml_result):
     if 'Certificate expired' in warnings:
         recommendations.append('⚠️ EXPIRED certificate - This APK may be outdated or tampered')
     
+    url_intel = analysis_result.get('url_intel', {})
+    if url_intel.get('blocked_hosts'):
+        blocked = ', '.join(hit['host'] for hit in url_intel['blocked_hosts'][:3])
+        recommendations.append(f'🚨 App contacts blocklisted hosts ({blocked})')
+    if url_intel.get('truncated'):
+        recommendations.append('URL scan stopped at its size limit - not every host was checked')
+    
     return recommendations
 
 
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Open a resumable upload: JSON {"filename", "size", "sha256" (optional)}
+    Chunks are then PUT to upload_url with Content-Range: bytes <first>-<last>/<total>,
+    in order, and finalize_url starts the scan
+    """
+    body = request.get_json(silent=True) or {}
+    filename = secure_filename(str(body.get('filename') or ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Only APK files are allowed'}), 400
+    try:
+        size = int(body.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size (bytes) is required'}), 400
+    if size <= 0:
+        return jsonify({'error': 'size must be positive'}), 400
+    if size > RESUMABLE_MAX_BYTES:
+        return jsonify({'error': f'File too large. Maximum size is {RESUMABLE_MAX_BYTES // (1024 * 1024)} MB'}), 413
+    
+    client = client_identity()
+    if admission is not None:
+        # Opening a session is charged like a scan and checked against the upload bytes in flight;
+        # the bytes it reserves on disk are bounded by the per-client session limits
+        try:
+            admission.release(admission.admit(client, size))
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+    
+    timestamp, scan_id = new_scan_id(filename)
+    try:
+        session = upload_sessions.create(scan_id, filename, timestamp, size, body.get('sha256'), client=client)
+    except UploadSessionError as e:
+        return upload_session_error(e)
+    view = upload_session_view(session)
+    return jsonify(view), 201, {'Location': view['upload_url']}
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Upload progress: resume by PUTting from the received offset"""
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    return jsonify(upload_session_view(session))
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Write one chunk of a resumable upload in place"""
+    match = CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+    if match is None:
+        return jsonify({'error': 'Content-Range: bytes <first>-<last>/<total> is required'}), 400
+    first, last = int(match.group(1)), int(match.group(2))
+    if last < first or request.content_length != last - first + 1:
+        return jsonify({'error': 'Body length does not match Content-Range'}), 400
+    
+    # Each chunk costs a rate token and holds its bytes in flight while it is written
+    ticket = None
+    if admission is not None:
+        try:
+            ticket = admission.admit(client_identity(), last - first + 1)
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+    try:
+        with timed('upload_chunk'):
+            session = upload_sessions.write_chunk(upload_id, first, last - first + 1, request.stream)
+    except UploadSessionError as e:
+        return upload_session_error(e)
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+    return jsonify(upload_session_view(session))
+
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Discard a resumable upload and its data"""
+    if not upload_sessions.abort(upload_id):
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    return jsonify({'status': 'aborted'})
+
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Scan a fully received upload; responds like /api/scan, including ?stream=1"""
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    
+    def completed_upload():
+        try:
+            completed = upload_sessions.complete(upload_id)
+        except UploadSessionError as e:
+            return None, ({'error': str(e), 'received': e.received}, e.status)
+        logger.info("Resumable upload complete: %s", completed['scan_id'], extra={'log_class': 'scan.upload'})
+        return {
+            'scan_id': completed['scan_id'],
+            'filename': completed['filename'],
+            'filepath': completed['filepath'],
+            'timestamp': completed['timestamp'],
+            'size_bytes': completed['size'],
+            'file_hash': completed['file_hash']
+        }, None
+    
+    return run_scan_request(completed_upload, session['size'])
+
+
+def upload_session_view(session):
+    """Public fields of an upload session"""
+    return {
+        'upload_id': session['upload_id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'received': session['received'],
+        'complete': session['received'] == session['size'],
+        'chunk_size': RESUMABLE_CHUNK_BYTES,
+        'expires_in': session['expires_in'],
+        'upload_url': f"/api/uploads/{session['upload_id']}",
+        'finalize_url': f"/api/uploads/{session['upload_id']}/finalize"
+    }
+
+
+def upload_session_error(error):
+    """Error response of a chunk request; received tells the client where to resume"""
+    return jsonify({'error': str(error), 'received': error.received}), error.status
+
+
+@app.route('/api/scan/<scan_id>/events')
+def scan_events(scan_id):
+    """
+    Server-sent events of a streamed scan: stage events with partial results, then
+    'complete' (the /api/scan response body) or 'error'. Resumes after Last-Event-ID
+    """
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        after = 0
+    events = event_log.stream(scan_id, after, max_seconds=float(os.environ.get('SCAN_EVENTS_MAX_STREAM', 25)))
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/jobs', methods=['POST'])
+def enqueue_jobs():
+    """
+    Queue APK URLs for the scan workers: {"jobs": [{"source": url, "file_hash": sha256,
+    "priority": n}, ...]}. A file already queued or scanned (same SHA-256) is not queued again.
+    Workers fetch the URLs, so this needs the admin token; workers refuse non-public hosts
+    """
+    if not admin_authorized():
+        return admin_forbidden()
+    if admission is not None:
+        try:
+            admission.throttle(client_identity())
+        except AdmissionRejected as e:
+            return too_many_requests(e)
+    data = request.get_json(silent=True) or {}
+    jobs = data.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({'error': 'Expected a non-empty "jobs" list'}), 400
+    if len(jobs) > MAX_JOBS_PER_REQUEST:
+        return jsonify({'error': f'At most {MAX_JOBS_PER_REQUEST} jobs per request'}), 400
+    for job in jobs:
+        # Local paths are for the worker CLI only; over HTTP they would let callers read worker files
+        if not isinstance(job, dict) or not str(job.get('source', '')).startswith(('http://', 'https://')):
+            return jsonify({'error': 'Every job needs an http(s) "source" URL'}), 400
+        if job.get('file_hash') and not re.fullmatch(r'[0-9a-fA-F]{64}', str(job['file_hash'])):
+            return jsonify({'error': f"Invalid SHA-256: {job['file_hash']}"}), 400
+        if not isinstance(job.get('priority', 0), int):
+            return jsonify({'error': '"priority" must be an integer'}), 400
+    queued = job_queue.enqueue({key: job[key] for key in ('source', 'file_hash', 'filename', 'priority')
+                                if job.get(key) is not None} for job in jobs)
+    return jsonify({'status': 'accepted', 'submitted': len(jobs), 'queued': queued}), 202
+
+
+@app.route('/api/jobs/status')
+def jobs_status():
+    """Job counts per state, oldest waiting job and the latest dead letters"""
+    if not admin_authorized():
+        return admin_forbidden()
+    return jsonify(dict(job_queue.status(), backend=job_queue.backend))
+
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """State of one job; job_id is the file's SHA-256 when it was known at submission"""
+    if not admin_authorized():
+        return admin_forbidden()
+    job = job_queue.get(job_id.lower())
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+
 @app.route('/api/stats')
 def get_stats():
     """Get statistics"""
@@ -301,10 +1002,97 @@ def get_stats():
     return jsonify(stats)
 
 
+@app.route('/api/shadow/report')
+def shadow_report():
+    """Agreement, confidence drift and inference cost of shadow models vs the primary"""
+    return jsonify(ml_predictor.shadow_report())
+
+
+@app.route('/api/virustotal/status')
+def virustotal_status():
+    """Background VirusTotal enrichment queue state"""
+    if vt_queue is None:
+        return jsonify({'enabled': False, 'mode': 'sync' if vt_checker.enabled else 'disabled'})
+    return jsonify(dict(vt_queue.status(), enabled=True, mode='async'))
+
+
+@app.route('/api/admission/status')
+def admission_status():
+    """Shared admission state: running analyses, queue, upload bytes in flight, limits"""
+    if admission is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(admission.status(), enabled=True))
+
+
+@app.route('/api/degradation/status')
+def degradation_status():
+    """Current analysis tier, load pressure and the provisional re-analysis queue of this worker"""
+    if degradation is None:
+        return jsonify({'enabled': False, 'tier': TIERS[FULL]})
+    return jsonify(dict(degradation.status(), enabled=True,
+                        reanalysis=reanalysis_queue.status() if reanalysis_queue is not None else None))
+
+
+def admin_authorized():
+    """Admin endpoints need X-Admin-Token to match ADMIN_TOKEN; without ADMIN_TOKEN they are closed"""
+    token = os.environ.get('ADMIN_TOKEN')
+    return bool(token) and secrets.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+
+def admin_forbidden():
+    """403 response of an admin endpoint"""
+    if not os.environ.get('ADMIN_TOKEN'):
+        return jsonify({'error': 'Admin endpoints are disabled: set ADMIN_TOKEN'}), 403
+    return jsonify({'error': 'Admin token required'}), 403
+
+
+@app.route('/api/admin/profiles')
+def list_profiles():
+    """Kept scan profiles, newest first; ?scan_id= for the profiles of one scan"""
+    if not admin_authorized():
+        return admin_forbidden()
+    if profiler is None:
+        return jsonify({'enabled': False, 'profiles': []})
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify(dict(profiler.status(), enabled=True,
+                        profiles=profiler.store.list(limit, request.args.get('scan_id'))))
+
+
+@app.route('/api/admin/profiles/<profile_id>')
+def get_profile(profile_id):
+    """
+    One profile: stage timings and the modules / functions most often on the stack;
+    ?format=collapsed returns the stacks for flamegraph.pl or speedscope
+    """
+    if not admin_authorized():
+        return admin_forbidden()
+    stored = profiler.store.get(profile_id) if profiler is not None else None
+    if stored is None:
+        return jsonify({'error': 'Unknown profile'}), 404
+    if request.args.get('format') == 'collapsed':
+        return Response(stored['collapsed'] + '\n', mimetype='text/plain')
+    collapsed = stored.pop('collapsed')
+    return jsonify(dict(stored, summary=summarize_profile(collapsed),
+                        collapsed_url=f'/api/admin/profiles/{profile_id}?format=collapsed'))
+
+
+def reload_model():
+    """Reload the served model from disk and return its version (SIGHUP, in the server master)"""
+    ml_predictor.maybe_reload(force=True)
+    return ml_predictor.model_version
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text-format metrics"""
+    return Response(render_prometheus(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
+
+
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Handle file too large error"""
-    return jsonify({'error': 'File too large. Maximum size is 100 MB'}), 413
+    return jsonify({'error': 'File too large. Maximum size is 100 MB - upload larger files in chunks '
+                             'through /api/uploads'}), 413
 
 
 @app.errorhandler(500)
@@ -315,5 +1103,7 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
+    from launcher import main
     logger.info("Starting Malicious APK Detection System...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # This module runs as __main__: hand over its own app and model, not a re-imported copy
+    main(wsgi_app=app, reload_model=reload_model)
@@ -5,15 +5,25 @@ import sqlite3
 import json
 import logging
 import os
-from datetime import datetime
-from typing import Dict, List, Any, Optional
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+from .storage import ScanStore, COPY_BATCH_SIZE, scan_columns
 
 logger = logging.getLogger(__name__)
 
+# Format of CURRENT_TIMESTAMP (UTC), which created_at is compared against
+SQLITE_TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+# Scans whose stored VirusTotal result is the background-lookup placeholder
+VT_PENDING_SQL = "json_extract(result_json, '$.virustotal.pending') = 1"
+
 
-class DatabaseManager:
+class DatabaseManager(ScanStore):
     """Manages SQLite database for scan history"""
     
+    backend = 'sqlite'
+    
     def __init__(self, db_path='database/scans.db'):
         # Ensure absolute path
         if not os.path.isabs(db_path):
@@ -64,6 +74,12 @@ class DatabaseManager:
                 ON scans(verdict)
             ''')
             
+            # Partial index of scans awaiting VirusTotal enrichment
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_vt_pending
+                ON scans(created_at) WHERE {VT_PENDING_SQL}
+            ''')
+            
             conn.commit()
             conn.close()
             logger.info(f"Database initialized at {self.db_path}")
@@ -95,12 +111,67 @@ class DatabaseManager:
             
             conn.commit()
             conn.close()
-            logger.info(f"Scan saved: {scan_result.get('scan_id')}")
+            logger.info("Scan saved: %s", scan_result.get('scan_id'), extra={'log_class': 'db.save'})
             return True
         except Exception as e:
             logger.error(f"Failed to save scan: {str(e)}")
             return False
     
+    def save_scans(self, scan_results: List[Dict[str, Any]],
+                   created_at: Optional[List[datetime]] = None) -> int:
+        """Save many scan results in one transaction"""
+        if not scan_results:
+            return 0
+        try:
+            rows = []
+            for i, scan_result in enumerate(scan_results):
+                when = created_at[i] if created_at else None
+                if when is None:
+                    when = datetime.now(timezone.utc)
+                elif when.tzinfo is not None:
+                    when = when.astimezone(timezone.utc)
+                rows.append(scan_columns(scan_result) + (json.dumps(scan_result), when.strftime(SQLITE_TIMESTAMP)))
+            
+            conn = sqlite3.connect(self.db_path)
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO scans 
+                    (scan_id, filename, file_hash, timestamp, verdict, risk_score, 
+                     package_name, app_name, result_json, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+            conn.close()
+            logger.info(f"Saved {len(rows)} scans")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Failed to save scans: {str(e)}")
+            return 0
+    
+    def update_scan(self, scan_result: Dict[str, Any]) -> bool:
+        """Rewrite the stored result (and verdict / risk score) of an existing scan"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE scans
+                SET verdict = ?, risk_score = ?, result_json = ?
+                WHERE file_hash = ?
+            ''', (
+                scan_result.get('verdict'),
+                scan_result.get('risk_score'),
+                json.dumps(scan_result),
+                scan_result.get('file_hash')
+            ))
+            
+            updated = cursor.rowcount
+            conn.commit()
+            conn.close()
+            return updated > 0
+        except Exception as e:
+            logger.error(f"Failed to update scan: {str(e)}")
+            return False
+    
     def get_scan_by_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
         """Get scan result by file hash (for caching)"""
         try:
@@ -134,7 +205,7 @@ class DatabaseManager:
                 SELECT scan_id, filename, verdict, risk_score, 
                        package_name, app_name, timestamp
                 FROM scans
-                ORDER BY created_at DESC
+                ORDER BY created_at DESC, id DESC
                 LIMIT ?
             ''', (limit,))
             
@@ -219,3 +290,45 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Failed to delete old scans: {str(e)}")
             return 0
+    
+    def iter_scans(self, batch_size: int = COPY_BATCH_SIZE) -> Iterator[Tuple[Dict[str, Any], datetime]]:
+        """Every stored (scan_result, created_at), oldest first"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            last_id = 0
+            while True:
+                rows = conn.execute('''
+                    SELECT id, result_json, created_at FROM scans
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                for row_id, result_json, created_at in rows:
+                    last_id = row_id
+                    when = datetime.strptime(created_at, SQLITE_TIMESTAMP).replace(tzinfo=timezone.utc)
+                    yield json.loads(result_json), when
+        finally:
+            conn.close()
+    
+    def pending_virustotal(self, limit: int = 1000) -> List[str]:
+        """Hashes of scans still waiting for their VirusTotal result, newest first"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                rows = conn.execute(f'''
+                    SELECT file_hash FROM scans
+                    WHERE {VT_PENDING_SQL}
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                ''', (limit,)).fetchall()
+            finally:
+                conn.close()
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error(f"Failed to list scans pending VirusTotal: {str(e)}")
+            return []
+    
+    def describe(self) -> str:
+        return f"SQLite {self.db_path}"
@@ -0,0 +1,679 @@
+"""
+Scan Job Queue
+Durable queue of APKs to scan, shared by the scan workers (worker.py) on any
+number of hosts. A job moves through
+    queued -> leased -> done
+                     -> queued (after a failure, with backoff) -> ... -> dead
+A worker leases a job for lease_seconds and renews the lease while it runs;
+a job whose worker died is leased again once the lease runs out. Jobs are
+keyed by the file's SHA-256 and results are saved by it, so a job that runs
+twice still stores one scan. The queue lives in PostgreSQL next to the scans
+table, in Redis (or a Redis-compatible server) given by JOB_QUEUE_URL, or in a
+SQLite file shared by the workers of one host
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Any, Iterable, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+STATES = ('queued', 'leased', 'done', 'dead')
+
+JOB_COLUMNS = ('job_id', 'file_hash', 'source', 'filename', 'priority', 'state', 'attempts', 'max_attempts',
+               'lease_owner', 'lease_until', 'available_at', 'last_error', 'scan_id', 'verdict',
+               'created_at', 'updated_at')
+
+# Longest wait before a failed job is tried again
+MAX_RETRY_DELAY = 3600.0
+
+# Serialises creation of the PostgreSQL table when several workers start at once
+SCHEMA_LOCK_KEY = 0x4A4F4253
+
+REDIS_SCHEMES = ('redis://', 'rediss://', 'unix://')
+
+
+def job_key(source: str, file_hash: Optional[str] = None) -> str:
+    """A job is identified by the SHA-256 of its file, or of its source when that is not known yet"""
+    if file_hash:
+        return file_hash.lower()
+    return 'src-' + hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def default_filename(source: str) -> str:
+    """Last path segment of a path or URL (without its query)"""
+    path = urlsplit(source).path if source.startswith(('http://', 'https://')) else source
+    return os.path.basename(path.rstrip('/')) or 'download.apk'
+
+
+class ScanJobQueue:
+    """
+    Queue operations shared by the backends; subclasses run the statements
+    Times are Unix timestamps from the caller's clock, so hosts need synchronised clocks
+    (leases last minutes, so a few seconds of skew do not matter)
+    """
+
+    backend = None
+
+    def __init__(self, retry_delay: float = 30.0, max_attempts: int = 3):
+        self.retry_delay = float(retry_delay)
+        self.max_attempts = max(int(max_attempts), 1)
+
+    def enqueue(self, jobs: Iterable[Dict[str, Any]]) -> int:
+        """
+        Add jobs ({'source', optional 'file_hash', 'filename', 'priority', 'max_attempts'});
+        returns how many were new. A job that is already known (in any state) is left alone
+        """
+        now = time.time()
+        rows = []
+        for job in jobs:
+            file_hash = job.get('file_hash').lower() if job.get('file_hash') else None
+            rows.append((
+                job_key(job['source'], file_hash), file_hash, job['source'],
+                job.get('filename') or default_filename(job['source']),
+                int(job.get('priority', 0)), int(job.get('max_attempts') or self.max_attempts), now, now, now
+            ))
+        return self._insert(rows) if rows else 0
+
+    def fail(self, job: Dict[str, Any], owner: str, error: str, retry: bool = True) -> Optional[str]:
+        """
+        Record a failed attempt of a leased job: queued again after an exponential backoff,
+        or dead once max_attempts is used up (or retry is False). Returns the new state,
+        None when the lease was lost
+        """
+        now = time.time()
+        if retry and job['attempts'] < job['max_attempts']:
+            delay = min(self.retry_delay * 2 ** max(job['attempts'] - 1, 0), MAX_RETRY_DELAY)
+            state, available_at = 'queued', now + delay
+        else:
+            state, available_at = 'dead', now
+        if not self._finish(job['job_id'], owner, state, available_at, str(error)[:2000], None, None, now):
+            return None
+        log = logger.error if state == 'dead' else logger.warning
+        log(f"Job {job['job_id']} attempt {job['attempts']}/{job['max_attempts']} failed: {error}"
+            f"{' - dead-lettered' if state == 'dead' else ''}")
+        return state
+
+    def complete(self, job: Dict[str, Any], owner: str, scan_id: Optional[str], verdict: Optional[str]) -> bool:
+        """Mark a leased job done; False if the lease was lost (another worker may have it by now)"""
+        now = time.time()
+        return self._finish(job['job_id'], owner, 'done', now, None, scan_id, verdict, now)
+
+    # Backend statements
+
+    def claim(self, owner: str, limit: int = 1, lease_seconds: float = 120.0) -> List[Dict[str, Any]]:
+        """
+        Lease up to limit runnable jobs, highest priority first. Jobs whose lease ran
+        out are taken over, or dead-lettered when that was their last attempt
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, job_ids: List[str], owner: str, lease_seconds: float = 120.0) -> List[str]:
+        """Extend the leases of job_ids; returns the ones still held by owner"""
+        raise NotImplementedError
+
+    def release(self, job_id: str, owner: str) -> bool:
+        """Give a leased job back untried (e.g. on shutdown); the attempt is not counted"""
+        raise NotImplementedError
+
+    def requeue_dead(self, job_ids: Optional[List[str]] = None) -> int:
+        """Queue dead-lettered jobs (all of them by default) again with fresh attempts"""
+        raise NotImplementedError
+
+    def purge_done(self, days: float = 30) -> int:
+        """Forget jobs finished more than days ago (the scans stay)"""
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def status(self, dead_letters: int = 20) -> Dict[str, Any]:
+        """Job counts per state, age of the oldest runnable job and the latest dead letters"""
+        raise NotImplementedError
+
+    def _insert(self, rows: List[tuple]) -> int:
+        raise NotImplementedError
+
+    def _finish(self, job_id, owner, state, available_at, error, scan_id, verdict, now) -> bool:
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(ScanJobQueue):
+    """Job queue in a SQLite file, for workers on one host"""
+
+    backend = 'sqlite'
+
+    def __init__(self, db_path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS scan_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    file_hash TEXT,
+                    source TEXT NOT NULL,
+                    filename TEXT,
+                    priority INTEGER DEFAULT 0,
+                    state TEXT DEFAULT 'queued',
+                    attempts INTEGER DEFAULT 0,
+                    max_attempts INTEGER,
+                    lease_owner TEXT,
+                    lease_until REAL DEFAULT 0,
+                    available_at REAL,
+                    last_error TEXT,
+                    scan_id TEXT,
+                    verdict TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_jobs_runnable '
+                         'ON scan_jobs(state, priority DESC, available_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread and process (connections must not cross a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit; claims open their own write transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _insert(self, rows: List[tuple]) -> int:
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT OR IGNORE INTO scan_jobs
+                (job_id, file_hash, source, filename, priority, max_attempts, available_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            added = conn.total_changes - before
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return added
+
+    def claim(self, owner: str, limit: int = 1, lease_seconds: float = 120.0) -> List[Dict[str, Any]]:
+        now = time.time()
+        conn = self._connect()
+        # BEGIN IMMEDIATE takes the write lock first, so two workers cannot pick the same rows
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('''
+                UPDATE scan_jobs SET state = 'dead', lease_owner = NULL, updated_at = ?,
+                       last_error = 'Lease expired on the last attempt (worker lost)'
+                WHERE state = 'leased' AND lease_until < ? AND attempts >= max_attempts
+            ''', (now, now))
+            rows = conn.execute(f'''
+                UPDATE scan_jobs
+                SET state = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+                WHERE job_id IN (
+                    SELECT job_id FROM scan_jobs
+                    WHERE (state = 'queued' AND available_at <= ?) OR (state = 'leased' AND lease_until < ?)
+                    ORDER BY priority DESC, available_at
+                    LIMIT ?
+                )
+                RETURNING {', '.join(JOB_COLUMNS)}
+            ''', (owner, now + lease_seconds, now, now, now, limit)).fetchall()
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return sorted((dict(row) for row in rows), key=lambda job: (-job['priority'], job['available_at']))
+
+    def heartbeat(self, job_ids: List[str], owner: str, lease_seconds: float = 120.0) -> List[str]:
+        if not job_ids:
+            return []
+        rows = self._connect().execute(f'''
+            UPDATE scan_jobs SET lease_until = ?
+            WHERE job_id IN ({', '.join('?' * len(job_ids))}) AND lease_owner = ? AND state = 'leased'
+            RETURNING job_id
+        ''', (time.time() + lease_seconds, *job_ids, owner)).fetchall()
+        return [row[0] for row in rows]
+
+    def release(self, job_id: str, owner: str) -> bool:
+        return self._connect().execute('''
+            UPDATE scan_jobs SET state = 'queued', lease_owner = NULL, lease_until = 0,
+                   attempts = MAX(attempts - 1, 0), updated_at = ?
+            WHERE job_id = ? AND lease_owner = ? AND state = 'leased'
+        ''', (time.time(), job_id, owner)).rowcount > 0
+
+    def requeue_dead(self, job_ids: Optional[List[str]] = None) -> int:
+        now = time.time()
+        query = "UPDATE scan_jobs SET state = 'queued', attempts = 0, available_at = ?, updated_at = ? " \
+                "WHERE state = 'dead'"
+        params = [now, now]
+        if job_ids:
+            query += f" AND job_id IN ({', '.join('?' * len(job_ids))})"
+            params += list(job_ids)
+        return self._connect().execute(query, params).rowcount
+
+    def purge_done(self, days: float = 30) -> int:
+        return self._connect().execute("DELETE FROM scan_jobs WHERE state = 'done' AND updated_at < ?",
+                                       (time.time() - days * 86400,)).rowcount
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute('SELECT * FROM scan_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def status(self, dead_letters: int = 20) -> Dict[str, Any]:
+        conn = self._connect()
+        counts = dict(conn.execute('SELECT state, COUNT(*) FROM scan_jobs GROUP BY state').fetchall())
+        oldest = conn.execute("SELECT MIN(available_at) FROM scan_jobs WHERE state = 'queued'").fetchone()[0]
+        dead = conn.execute('''
+            SELECT job_id, source, attempts, last_error, updated_at FROM scan_jobs
+            WHERE state = 'dead' ORDER BY updated_at DESC LIMIT ?
+        ''', (dead_letters,)).fetchall()
+        return job_status(counts, oldest, [dict(row) for row in dead])
+
+    def _finish(self, job_id, owner, state, available_at, error, scan_id, verdict, now) -> bool:
+        return self._connect().execute('''
+            UPDATE scan_jobs
+            SET state = ?, lease_owner = NULL, lease_until = 0, available_at = ?, last_error = ?,
+                scan_id = COALESCE(?, scan_id), verdict = COALESCE(?, verdict), updated_at = ?
+            WHERE job_id = ? AND lease_owner = ? AND state = 'leased'
+        ''', (state, available_at, error, scan_id, verdict, now, job_id, owner)).rowcount > 0
+
+
+class PostgresJobQueue(ScanJobQueue):
+    """
+    Job queue in the PostgreSQL scan database, for workers on many hosts
+    Claims use FOR UPDATE SKIP LOCKED, so concurrent workers take different jobs without waiting
+    """
+
+    backend = 'postgresql'
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        with store._connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS scan_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    file_hash TEXT,
+                    source TEXT NOT NULL,
+                    filename TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    lease_owner TEXT,
+                    lease_until DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    available_at DOUBLE PRECISION NOT NULL,
+                    last_error TEXT,
+                    scan_id TEXT,
+                    verdict TEXT,
+                    created_at DOUBLE PRECISION,
+                    updated_at DOUBLE PRECISION
+                )
+            ''')
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_scan_jobs_queued ON scan_jobs (priority DESC, available_at) "
+                        "WHERE state = 'queued'")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_scan_jobs_leased ON scan_jobs (lease_until) "
+                        "WHERE state = 'leased'")
+
+    def _execute(self, query: str, params=(), fetch: bool = False):
+        with self.store._connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            if fetch:
+                columns = [c.name for c in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+            return cur.rowcount
+
+    def _insert(self, rows: List[tuple]) -> int:
+        from psycopg2.extras import execute_values
+        with self.store._connection() as conn, conn.cursor() as cur:
+            inserted = execute_values(cur, '''
+                INSERT INTO scan_jobs
+                (job_id, file_hash, source, filename, priority, max_attempts, available_at, created_at, updated_at)
+                VALUES %s
+                ON CONFLICT (job_id) DO NOTHING
+                RETURNING job_id
+            ''', rows, page_size=1000, fetch=True)
+        return len(inserted)
+
+    def claim(self, owner: str, limit: int = 1, lease_seconds: float = 120.0) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self.store._connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                UPDATE scan_jobs SET state = 'dead', lease_owner = NULL, updated_at = %s,
+                       last_error = 'Lease expired on the last attempt (worker lost)'
+                WHERE state = 'leased' AND lease_until < %s AND attempts >= max_attempts
+            ''', (now, now))
+            cur.execute(f'''
+                UPDATE scan_jobs j
+                SET state = 'leased', lease_owner = %s, lease_until = %s, attempts = j.attempts + 1, updated_at = %s
+                FROM (
+                    SELECT job_id FROM scan_jobs
+                    WHERE (state = 'queued' AND available_at <= %s) OR (state = 'leased' AND lease_until < %s)
+                    ORDER BY priority DESC, available_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) picked
+                WHERE j.job_id = picked.job_id
+                RETURNING {', '.join('j.' + c for c in JOB_COLUMNS)}
+            ''', (owner, now + lease_seconds, now, now, now, limit))
+            jobs = [dict(zip(JOB_COLUMNS, row)) for row in cur.fetchall()]
+        return sorted(jobs, key=lambda job: (-job['priority'], job['available_at']))
+
+    def heartbeat(self, job_ids: List[str], owner: str, lease_seconds: float = 120.0) -> List[str]:
+        if not job_ids:
+            return []
+        rows = self._execute('''
+            UPDATE scan_jobs SET lease_until = %s
+            WHERE job_id = ANY(%s) AND lease_owner = %s AND state = 'leased'
+            RETURNING job_id
+        ''', (time.time() + lease_seconds, list(job_ids), owner), fetch=True)
+        return [row['job_id'] for row in rows]
+
+    def release(self, job_id: str, owner: str) -> bool:
+        return self._execute('''
+            UPDATE scan_jobs SET state = 'queued', lease_owner = NULL, lease_until = 0,
+                   attempts = GREATEST(attempts - 1, 0), updated_at = %s
+            WHERE job_id = %s AND lease_owner = %s AND state = 'leased'
+        ''', (time.time(), job_id, owner)) > 0
+
+    def requeue_dead(self, job_ids: Optional[List[str]] = None) -> int:
+        now = time.time()
+        query = "UPDATE scan_jobs SET state = 'queued', attempts = 0, available_at = %s, updated_at = %s " \
+                "WHERE state = 'dead'"
+        params = [now, now]
+        if job_ids:
+            query += ' AND job_id = ANY(%s)'
+            params.append(list(job_ids))
+        return self._execute(query, params)
+
+    def purge_done(self, days: float = 30) -> int:
+        return self._execute("DELETE FROM scan_jobs WHERE state = 'done' AND updated_at < %s",
+                             (time.time() - days * 86400,))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._execute('SELECT * FROM scan_jobs WHERE job_id = %s', (job_id,), fetch=True)
+        return rows[0] if rows else None
+
+    def status(self, dead_letters: int = 20) -> Dict[str, Any]:
+        with self.store._connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT state, COUNT(*) FROM scan_jobs GROUP BY state')
+            counts = dict(cur.fetchall())
+            cur.execute("SELECT MIN(available_at) FROM scan_jobs WHERE state = 'queued'")
+            oldest = cur.fetchone()[0]
+            cur.execute('''
+                SELECT job_id, source, attempts, last_error, updated_at FROM scan_jobs
+                WHERE state = 'dead' ORDER BY updated_at DESC LIMIT %s
+            ''', (dead_letters,))
+            dead = [dict(zip(('job_id', 'source', 'attempts', 'last_error', 'updated_at'), row))
+                    for row in cur.fetchall()]
+        return job_status(counts, oldest, dead)
+
+    def _finish(self, job_id, owner, state, available_at, error, scan_id, verdict, now) -> bool:
+        return self._execute('''
+            UPDATE scan_jobs
+            SET state = %s, lease_owner = NULL, lease_until = 0, available_at = %s, last_error = %s,
+                scan_id = COALESCE(%s, scan_id), verdict = COALESCE(%s, verdict), updated_at = %s
+            WHERE job_id = %s AND lease_owner = %s AND state = 'leased'
+        ''', (state, available_at, error, scan_id, verdict, now, job_id, owner)) > 0
+
+
+class RedisJobQueue(ScanJobQueue):
+    """
+    Job queue in Redis or a Redis-compatible server (Valkey, KeyDB), for a fleet without
+    a shared PostgreSQL database. Each job is a hash; sorted sets index the queued jobs by
+    available_at, the leases by expiry and finished jobs by time. State changes run in
+    WATCH/MULTI transactions on the job hashes, so two workers never hold the same lease.
+    A claim picks the highest priority among the earliest due jobs (CLAIM_SCAN per job asked for)
+    """
+
+    backend = 'redis'
+
+    CLAIM_SCAN = 8
+    CHUNK = 500
+    INT_FIELDS = ('priority', 'attempts', 'max_attempts')
+    FLOAT_FIELDS = ('lease_until', 'available_at', 'created_at', 'updated_at')
+
+    def __init__(self, url: str, prefix: str = 'scanjobs:', **kwargs):
+        super().__init__(**kwargs)
+        import redis
+        # redis-py opens new connections after a fork by itself
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self._watch_error = redis.WatchError
+        self.prefix = prefix
+        self.index = {state: f'{prefix}{state}' for state in STATES}
+
+    def _key(self, job_id: str) -> str:
+        return f'{self.prefix}job:{job_id}'
+
+    def _load(self, job_ids: List[str]) -> List[Optional[Dict[str, Any]]]:
+        pipe = self.redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hgetall(self._key(job_id))
+        jobs = []
+        for fields in pipe.execute():
+            if not fields:
+                jobs.append(None)
+                continue
+            job = {column: fields.get(column) for column in JOB_COLUMNS}
+            for column in self.INT_FIELDS:
+                job[column] = int(job[column] or 0)
+            for column in self.FLOAT_FIELDS:
+                job[column] = float(job[column] or 0)
+            jobs.append(job)
+        return jobs
+
+    def _transact(self, job_ids: List[str], apply):
+        """
+        apply(pipe, jobs) queues the writes for the current state of job_ids (job_id -> job
+        or None) and returns the result; retried when another worker changed one of them meanwhile
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        while True:
+            with self.redis.pipeline() as pipe:
+                try:
+                    pipe.watch(*[self._key(job_id) for job_id in job_ids])
+                    # Read over a second connection in one round trip; the WATCH above still covers it
+                    jobs = dict(zip(job_ids, self._load(job_ids)))
+                    pipe.multi()
+                    result = apply(pipe, jobs)
+                    pipe.execute()
+                    return result
+                except self._watch_error:
+                    continue
+
+    def _move(self, pipe, job_id: str, state: str, score: float, fields: Dict[str, Any], clear=()):
+        """Queue the writes that put a job into state, indexed by score"""
+        pipe.hset(self._key(job_id), mapping=dict(fields, state=state))
+        if clear:
+            pipe.hdel(self._key(job_id), *clear)
+        for other, key in self.index.items():
+            if other != state:
+                pipe.zrem(key, job_id)
+        pipe.zadd(self.index[state], {job_id: score})
+
+    def _in_chunks(self, job_ids: List[str], apply) -> int:
+        """_transact() over CHUNK jobs at a time; apply returns a count"""
+        return sum(self._transact(job_ids[i:i + self.CHUNK], apply) for i in range(0, len(job_ids), self.CHUNK))
+
+    def _insert(self, rows: List[tuple]) -> int:
+        by_id = {}
+        for row in rows:
+            by_id.setdefault(row[0], row)
+
+        def apply(pipe, jobs):
+            added = 0
+            for job_id, job in jobs.items():
+                if job is not None:
+                    continue
+                _, file_hash, source, filename, priority, max_attempts, available_at, created_at, _ = by_id[job_id]
+                fields = {'job_id': job_id, 'source': source, 'filename': filename, 'priority': priority,
+                          'attempts': 0, 'max_attempts': max_attempts, 'lease_until': 0,
+                          'available_at': available_at, 'created_at': created_at, 'updated_at': created_at}
+                if file_hash:
+                    fields['file_hash'] = file_hash
+                self._move(pipe, job_id, 'queued', available_at, fields)
+                added += 1
+            return added
+
+        return self._in_chunks(list(by_id), apply)
+
+    def claim(self, owner: str, limit: int = 1, lease_seconds: float = 120.0) -> List[Dict[str, Any]]:
+        now = time.time()
+        scan = max(limit * self.CLAIM_SCAN, 32)
+        candidates = (self.redis.zrangebyscore(self.index['leased'], '-inf', now, start=0, num=scan) +
+                      self.redis.zrangebyscore(self.index['queued'], '-inf', now, start=0, num=scan))
+        if not candidates:
+            return []
+
+        def apply(pipe, jobs):
+            runnable = []
+            for job_id, job in jobs.items():
+                if job is None:
+                    # Index entry of a purged job
+                    for key in self.index.values():
+                        pipe.zrem(key, job_id)
+                elif job['state'] == 'leased' and job['lease_until'] < now:
+                    if job['attempts'] >= job['max_attempts']:
+                        self._move(pipe, job_id, 'dead', now, {
+                            'lease_until': 0, 'updated_at': now,
+                            'last_error': 'Lease expired on the last attempt (worker lost)'
+                        }, clear=('lease_owner',))
+                    else:
+                        runnable.append(job)
+                elif job['state'] == 'queued' and job['available_at'] <= now:
+                    runnable.append(job)
+            runnable.sort(key=lambda job: (-job['priority'], job['available_at']))
+            claimed = runnable[:limit]
+            for job in claimed:
+                job.update(state='leased', lease_owner=owner, lease_until=now + lease_seconds,
+                           attempts=job['attempts'] + 1, updated_at=now)
+                self._move(pipe, job['job_id'], 'leased', job['lease_until'], {
+                    'lease_owner': owner, 'lease_until': job['lease_until'],
+                    'attempts': job['attempts'], 'updated_at': now
+                })
+            return claimed
+
+        return self._transact(candidates, apply)
+
+    def heartbeat(self, job_ids: List[str], owner: str, lease_seconds: float = 120.0) -> List[str]:
+        if not job_ids:
+            return []
+        lease_until = time.time() + lease_seconds
+
+        def apply(pipe, jobs):
+            held = [job_id for job_id, job in jobs.items()
+                    if job is not None and job['state'] == 'leased' and job['lease_owner'] == owner]
+            for job_id in held:
+                pipe.hset(self._key(job_id), 'lease_until', lease_until)
+                pipe.zadd(self.index['leased'], {job_id: lease_until})
+            return held
+
+        return self._transact(job_ids, apply)
+
+    def release(self, job_id: str, owner: str) -> bool:
+        def apply(pipe, jobs):
+            job = jobs[job_id]
+            if job is None or job['state'] != 'leased' or job['lease_owner'] != owner:
+                return False
+            self._move(pipe, job_id, 'queued', job['available_at'], {
+                'lease_until': 0, 'attempts': max(job['attempts'] - 1, 0), 'updated_at': time.time()
+            }, clear=('lease_owner',))
+            return True
+
+        return self._transact([job_id], apply)
+
+    def requeue_dead(self, job_ids: Optional[List[str]] = None) -> int:
+        now = time.time()
+
+        def apply(pipe, jobs):
+            dead = [job_id for job_id, job in jobs.items() if job is not None and job['state'] == 'dead']
+            for job_id in dead:
+                self._move(pipe, job_id, 'queued', now, {'attempts': 0, 'available_at': now, 'updated_at': now})
+            return len(dead)
+
+        return self._in_chunks(list(job_ids) if job_ids else self.redis.zrange(self.index['dead'], 0, -1), apply)
+
+    def purge_done(self, days: float = 30) -> int:
+        cutoff = time.time() - days * 86400
+
+        def apply(pipe, jobs):
+            old = [job_id for job_id, job in jobs.items()
+                   if job is None or (job['state'] == 'done' and job['updated_at'] < cutoff)]
+            for job_id in old:
+                pipe.delete(self._key(job_id))
+                pipe.zrem(self.index['done'], job_id)
+            return len(old)
+
+        return self._in_chunks(self.redis.zrangebyscore(self.index['done'], '-inf', cutoff), apply)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._load([job_id])[0]
+
+    def status(self, dead_letters: int = 20) -> Dict[str, Any]:
+        pipe = self.redis.pipeline(transaction=False)
+        for state in STATES:
+            pipe.zcard(self.index[state])
+        pipe.zrange(self.index['queued'], 0, 0, withscores=True)
+        pipe.zrevrange(self.index['dead'], 0, dead_letters - 1)
+        *counts, oldest, dead_ids = pipe.execute()
+        dead = [{column: job[column] for column in ('job_id', 'source', 'attempts', 'last_error', 'updated_at')}
+                for job in self._load(dead_ids) if job is not None]
+        return job_status(dict(zip(STATES, counts)), oldest[0][1] if oldest else None, dead)
+
+    def _finish(self, job_id, owner, state, available_at, error, scan_id, verdict, now) -> bool:
+        def apply(pipe, jobs):
+            job = jobs[job_id]
+            if job is None or job['state'] != 'leased' or job['lease_owner'] != owner:
+                return False
+            fields = {'lease_until': 0, 'available_at': available_at, 'updated_at': now}
+            clear = ['lease_owner']
+            if error is None:
+                clear.append('last_error')
+            else:
+                fields['last_error'] = error
+            if scan_id is not None:
+                fields['scan_id'] = scan_id
+            if verdict is not None:
+                fields['verdict'] = verdict
+            self._move(pipe, job_id, state, available_at if state == 'queued' else now, fields, clear)
+            return True
+
+        return self._transact([job_id], apply)
+
+
+def job_status(counts: Dict[str, int], oldest_queued: Optional[float], dead: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'jobs': {state: counts.get(state, 0) for state in STATES},
+        'oldest_queued_seconds': round(max(time.time() - oldest_queued, 0), 1) if oldest_queued else None,
+        'dead_letters': dead,
+    }
+
+
+def job_queue_for(store, location: Optional[str] = None) -> ScanJobQueue:
+    """
+    The job queue of a scan store. location (default JOB_QUEUE_URL) is a redis:// URL
+    or a SQLite path; without one the queue is a table in the store's PostgreSQL database,
+    or for a SQLite history the file scan_jobs.db beside it
+    """
+    options = dict(retry_delay=float(os.environ.get('JOB_RETRY_DELAY', 30)),
+                   max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 3)))
+    location = location or os.environ.get('JOB_QUEUE_URL')
+    if location and location.startswith(REDIS_SCHEMES):
+        return RedisJobQueue(location, prefix=os.environ.get('JOB_QUEUE_PREFIX', 'scanjobs:'), **options)
+    if location:
+        return SQLiteJobQueue(location, **options)
+    if store.backend == 'postgresql':
+        return PostgresJobQueue(store, **options)
+    return SQLiteJobQueue(os.path.join(os.path.dirname(store.db_path), 'scan_jobs.db'), **options)
@@ -0,0 +1,330 @@
+"""
+PostgreSQL Scan Store
+Scan history in PostgreSQL, so several API nodes share one history and result
+cache. Connections come from a pool per process; saves are upserts on file_hash
+and bulk saves stream the rows in with COPY. Requires psycopg2
+"""
+import io
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+import psycopg2
+import psycopg2.pool
+
+from .storage import ScanStore, COPY_BATCH_SIZE, scan_columns
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('scan_id', 'filename', 'file_hash', 'timestamp', 'verdict', 'risk_score',
+           'package_name', 'app_name', 'result_json')
+
+# Columns rewritten when a file_hash is saved again (SQLite's INSERT OR REPLACE)
+UPSERT_SET = ', '.join(f'{c} = EXCLUDED.{c}' for c in COLUMNS if c != 'file_hash')
+
+# JSON escapes of NUL, which jsonb rejects (an even run of backslashes before it is not part of the escape)
+JSON_NUL = re.compile(r'(?<!\\)((?:\\\\)*)\\u0000')
+
+# Serialises schema creation when several nodes start at once
+SCHEMA_LOCK_KEY = 0x41504B53
+
+# Scans whose stored VirusTotal result is the background-lookup placeholder
+VT_PENDING_SQL = "(result_json -> 'virustotal' ->> 'pending') = 'true'"
+
+
+def to_json(scan_result: Dict[str, Any]) -> str:
+    return JSON_NUL.sub(r'\1', json.dumps(scan_result))
+
+
+def row_values(scan_result: Dict[str, Any]) -> Tuple:
+    """Values for COLUMNS; PostgreSQL text cannot hold NUL, which names from a manifest may contain"""
+    columns = tuple(v.replace('\x00', '') if isinstance(v, str) else v for v in scan_columns(scan_result))
+    return columns + (to_json(scan_result),)
+
+
+def copy_field(value) -> str:
+    """A value in COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class PostgresScanStore(ScanStore):
+    """
+    Scan history in PostgreSQL
+    Each process opens its own pool on first use (connections must not cross a
+    fork); callers beyond max_connections wait for a free connection
+    """
+
+    backend = 'postgresql'
+
+    def __init__(self, dsn: str, min_connections: int = 1, max_connections: int = 8):
+        self.dsn = dsn
+        self.min_connections = max(int(min_connections), 0)
+        self.max_connections = max(int(max_connections), 1)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._init_database()
+
+    def _init_database(self):
+        """Create the schema over a one-off connection, so no pooled connection is opened before a fork"""
+        try:
+            conn = psycopg2.connect(self.dsn)
+            try:
+                with conn, conn.cursor() as cur:
+                    cur.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+                    cur.execute('''
+                        CREATE TABLE IF NOT EXISTS scans (
+                            id BIGSERIAL PRIMARY KEY,
+                            scan_id TEXT UNIQUE,
+                            filename TEXT,
+                            file_hash TEXT UNIQUE,
+                            timestamp TEXT,
+                            verdict TEXT,
+                            risk_score INTEGER,
+                            package_name TEXT,
+                            app_name TEXT,
+                            result_json JSONB,
+                            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        )
+                    ''')
+                    cur.execute('CREATE INDEX IF NOT EXISTS idx_verdict ON scans (verdict)')
+                    cur.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON scans (created_at, id)')
+                    cur.execute(f'CREATE INDEX IF NOT EXISTS idx_vt_pending ON scans (created_at) '
+                                f'WHERE {VT_PENDING_SQL}')
+                    cur.execute('SHOW server_encoding')
+                    encoding = cur.fetchone()[0]
+            finally:
+                conn.close()
+            if encoding != 'UTF8':
+                # jsonb only stores non-ASCII text (e.g. emoji in recommendations) in a UTF8 database
+                logger.warning(f"Database encoding is {encoding}, not UTF8 - "
+                               f"results with non-ASCII text will fail to save")
+            logger.info(f"Database initialized at {self.describe()}")
+        except Exception as e:
+            logger.error(f"Database initialization failed: {str(e)}")
+
+    def _get_pool(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    # The parent's pool (if any) is dropped without closing: its sockets belong to the parent
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.min_connections, self.max_connections,
+                                                                      self.dsn)
+                    self._slots = threading.BoundedSemaphore(self.max_connections)
+                    self._pool_pid = os.getpid()
+        return self._pool, self._slots
+
+    @contextmanager
+    def _connection(self):
+        """A pooled connection inside a transaction (committed on success, rolled back on error)"""
+        pool, slots = self._get_pool()
+        with slots:
+            conn = pool.getconn()
+            broken = False
+            try:
+                with conn:
+                    yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                pool.putconn(conn, close=broken or conn.closed != 0)
+
+    def save_scan(self, scan_result: Dict[str, Any]) -> bool:
+        """Save scan result to database"""
+        try:
+            row = row_values(scan_result)
+            with self._connection() as conn, conn.cursor() as cur:
+                # scan_id is unique too: like INSERT OR REPLACE, drop another scan holding it
+                cur.execute('DELETE FROM scans WHERE scan_id = %s AND file_hash IS DISTINCT FROM %s',
+                            (row[0], row[2]))
+                cur.execute(f'''
+                    INSERT INTO scans ({', '.join(COLUMNS)})
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (file_hash) DO UPDATE SET {UPSERT_SET}, created_at = now()
+                ''', row)
+            logger.info("Scan saved: %s", scan_result.get('scan_id'), extra={'log_class': 'db.save'})
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save scan: {str(e)}")
+            return False
+
+    def save_scans(self, scan_results: List[Dict[str, Any]],
+                   created_at: Optional[List[datetime]] = None) -> int:
+        """COPY the results into a temporary table, then upsert them with one statement"""
+        if not scan_results:
+            return 0
+        try:
+            buffer = io.StringIO()
+            for i, scan_result in enumerate(scan_results):
+                fields = (i,) + row_values(scan_result) + (created_at[i] if created_at else None,)
+                buffer.write('\t'.join(copy_field(v) for v in fields) + '\n')
+            buffer.seek(0)
+
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    CREATE TEMPORARY TABLE scans_incoming (
+                        ord INTEGER, scan_id TEXT, filename TEXT, file_hash TEXT, timestamp TEXT,
+                        verdict TEXT, risk_score INTEGER, package_name TEXT, app_name TEXT,
+                        result_json JSONB, created_at TIMESTAMPTZ
+                    ) ON COMMIT DROP
+                ''')
+                cur.copy_expert(f"COPY scans_incoming (ord, {', '.join(COLUMNS)}, created_at) FROM STDIN",
+                                buffer)
+                cur.execute('''
+                    DELETE FROM scans s USING scans_incoming i
+                    WHERE s.scan_id = i.scan_id AND s.file_hash IS DISTINCT FROM i.file_hash
+                ''')
+                # The last result per file_hash wins; rows are inserted in input order so ids follow it
+                cur.execute(f'''
+                    INSERT INTO scans ({', '.join(COLUMNS)}, created_at)
+                    SELECT {', '.join(COLUMNS)}, COALESCE(created_at, now())
+                    FROM (
+                        SELECT DISTINCT ON (file_hash) * FROM scans_incoming
+                        ORDER BY file_hash, ord DESC
+                    ) latest
+                    ORDER BY ord
+                    ON CONFLICT (file_hash) DO UPDATE SET {UPSERT_SET}, created_at = EXCLUDED.created_at
+                ''')
+            logger.info(f"Saved {len(scan_results)} scans")
+            return len(scan_results)
+        except Exception as e:
+            logger.error(f"Failed to save scans: {str(e)}")
+            return 0
+
+    def update_scan(self, scan_result: Dict[str, Any]) -> bool:
+        """Rewrite the stored result (and verdict / risk score) of an existing scan"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    UPDATE scans
+                    SET verdict = %s, risk_score = %s, result_json = %s
+                    WHERE file_hash = %s
+                ''', (scan_result.get('verdict'), scan_result.get('risk_score'), to_json(scan_result),
+                      scan_result.get('file_hash')))
+                return cur.rowcount > 0
+        except Exception as e:
+            logger.error(f"Failed to update scan: {str(e)}")
+            return False
+
+    def get_scan_by_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Get scan result by file hash (for caching)"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('SELECT result_json FROM scans WHERE file_hash = %s', (file_hash,))
+                row = cur.fetchone()
+            # psycopg2 decodes jsonb into Python objects
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Failed to get scan by hash: {str(e)}")
+            return None
+
+    def get_recent_scans(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Get recent scans"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    SELECT scan_id, filename, verdict, risk_score,
+                           package_name, app_name, timestamp
+                    FROM scans
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ''', (limit,))
+                rows = cur.fetchall()
+            keys = ('scan_id', 'filename', 'verdict', 'risk_score', 'package_name', 'app_name', 'timestamp')
+            return [dict(zip(keys, row)) for row in rows]
+        except Exception as e:
+            logger.error(f"Failed to get recent scans: {str(e)}")
+            return []
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Get statistics about scans"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    SELECT COUNT(*),
+                           COUNT(*) FILTER (WHERE verdict = 'Malicious'),
+                           COUNT(*) FILTER (WHERE verdict = 'Suspicious'),
+                           COUNT(*) FILTER (WHERE verdict = 'Safe'),
+                           AVG(risk_score)
+                    FROM scans
+                ''')
+                total_scans, malicious, suspicious, safe, avg_risk = cur.fetchone()
+            return {
+                'total_scans': total_scans,
+                'malicious': malicious,
+                'suspicious': suspicious,
+                'safe': safe,
+                'average_risk_score': round(float(avg_risk or 0), 2)
+            }
+        except Exception as e:
+            logger.error(f"Failed to get statistics: {str(e)}")
+            return {
+                'total_scans': 0,
+                'malicious': 0,
+                'suspicious': 0,
+                'safe': 0,
+                'average_risk_score': 0
+            }
+
+    def delete_old_scans(self, days: int = 30) -> int:
+        """Delete scans older than specified days"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('DELETE FROM scans WHERE created_at < now() - make_interval(days => %s)', (days,))
+                deleted = cur.rowcount
+            logger.info(f"Deleted {deleted} old scans")
+            return deleted
+        except Exception as e:
+            logger.error(f"Failed to delete old scans: {str(e)}")
+            return 0
+
+    def iter_scans(self, batch_size: int = COPY_BATCH_SIZE) -> Iterator[Tuple[Dict[str, Any], datetime]]:
+        """Every stored (scan_result, created_at), oldest first"""
+        # Keyset pagination: an upsert keeps the row's id, so ids are not in scan order
+        after = (datetime.min.replace(tzinfo=timezone.utc), 0)
+        while True:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    SELECT id, result_json, created_at FROM scans
+                    WHERE (created_at, id) > (%s, %s)
+                    ORDER BY created_at, id
+                    LIMIT %s
+                ''', after + (batch_size,))
+                rows = cur.fetchall()
+            if not rows:
+                return
+            for row_id, result_json, created_at in rows:
+                after = (created_at, row_id)
+                yield result_json, created_at
+
+    def pending_virustotal(self, limit: int = 1000) -> List[str]:
+        """Hashes of scans still waiting for their VirusTotal result, newest first"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(f'''
+                    SELECT file_hash FROM scans
+                    WHERE {VT_PENDING_SQL}
+                    ORDER BY created_at DESC
+                    LIMIT %s
+                ''', (limit,))
+                return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Failed to list scans pending VirusTotal: {str(e)}")
+            return []
+
+    def describe(self) -> str:
+        url = urlsplit(self.dsn)
+        return f"PostgreSQL {url.hostname or 'localhost'}:{url.port or 5432}{url.path}"
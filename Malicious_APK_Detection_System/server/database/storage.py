@@ -0,0 +1,151 @@
+"""
+Scan History Storage
+Interface shared by the scan history backends:
+    SQLite      DatabaseManager (db_manager.py), a single file for one node
+    PostgreSQL  PostgresScanStore (postgres_store.py), shared by several nodes
+The backend is picked from DATABASE_URL by store_from_env(). Run as
+    python -m database.storage copy <from> <to>
+to move the scan history between backends (run from server/)
+"""
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Rows per transaction when copying history between backends
+COPY_BATCH_SIZE = 1000
+
+POSTGRES_SCHEMES = ('postgresql://', 'postgres://')
+
+
+class ScanStore:
+    """
+    Scan history, keyed by file_hash (one row per APK, the latest scan wins)
+    Methods log failures and return a default instead of raising, so a storage
+    outage degrades the API instead of failing it
+    """
+
+    backend = None
+
+    def save_scan(self, scan_result: Dict[str, Any]) -> bool:
+        """Insert or replace the scan of scan_result['file_hash']"""
+        raise NotImplementedError
+
+    def save_scans(self, scan_results: List[Dict[str, Any]],
+                   created_at: Optional[List[datetime]] = None) -> int:
+        """
+        save_scan() for many results in one transaction; returns the rows written
+        created_at (parallel to scan_results) keeps the original scan times when copying history
+        """
+        raise NotImplementedError
+
+    def update_scan(self, scan_result: Dict[str, Any]) -> bool:
+        """Rewrite the stored result (and verdict / risk score) of an existing scan"""
+        raise NotImplementedError
+
+    def get_scan_by_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Get scan result by file hash (for caching)"""
+        raise NotImplementedError
+
+    def get_recent_scans(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Summaries of the latest scans, newest first"""
+        raise NotImplementedError
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Scan count per verdict and average risk score"""
+        raise NotImplementedError
+
+    def delete_old_scans(self, days: int = 30) -> int:
+        """Delete scans older than specified days"""
+        raise NotImplementedError
+
+    def iter_scans(self, batch_size: int = COPY_BATCH_SIZE) -> Iterator[Tuple[Dict[str, Any], datetime]]:
+        """Every stored (scan_result, created_at), oldest first"""
+        raise NotImplementedError
+
+    def pending_virustotal(self, limit: int = 1000) -> List[str]:
+        """Hashes of scans still waiting for their VirusTotal result, newest first"""
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        """Where the history is stored, without credentials"""
+        raise NotImplementedError
+
+
+def open_store(location: str, min_connections: int = 1, max_connections: int = 8) -> ScanStore:
+    """A postgresql:// URL opens PostgreSQL; anything else is a SQLite path"""
+    if location.startswith(POSTGRES_SCHEMES):
+        from .postgres_store import PostgresScanStore
+        return PostgresScanStore(location, min_connections=min_connections, max_connections=max_connections)
+    from .db_manager import DatabaseManager
+    return DatabaseManager(location)
+
+
+def store_from_env() -> ScanStore:
+    """PostgreSQL when DATABASE_URL is set, otherwise SQLite at DATABASE_PATH"""
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        if not url.startswith(POSTGRES_SCHEMES):
+            raise ValueError('DATABASE_URL must be a postgresql:// URL (use DATABASE_PATH for SQLite)')
+        return open_store(
+            url,
+            min_connections=int(os.environ.get('DATABASE_POOL_MIN', 1)),
+            max_connections=int(os.environ.get('DATABASE_POOL_MAX', 8))
+        )
+    return open_store(os.environ.get('DATABASE_PATH', 'database/scans.db'))
+
+
+def scan_columns(scan_result: Dict[str, Any]) -> Tuple:
+    """(scan_id, filename, file_hash, timestamp, verdict, risk_score, package_name, app_name) of a result"""
+    apk_info = scan_result.get('apk_info') or {}
+    return (
+        scan_result.get('scan_id'),
+        scan_result.get('filename'),
+        scan_result.get('file_hash'),
+        scan_result.get('timestamp'),
+        scan_result.get('verdict'),
+        scan_result.get('risk_score'),
+        apk_info.get('package_name'),
+        apk_info.get('app_name'),
+    )
+
+
+def copy_scans(source: ScanStore, target: ScanStore, batch_size: int = COPY_BATCH_SIZE) -> Tuple[int, int]:
+    """Copy the whole history of source into target, keeping scan times; returns (read, written)"""
+    read = copied = 0
+    batch, times = [], []
+    for scan_result, created_at in source.iter_scans(batch_size):
+        read += 1
+        batch.append(scan_result)
+        times.append(created_at)
+        if len(batch) >= batch_size:
+            copied += target.save_scans(batch, times)
+            batch, times = [], []
+            logger.info(f"Copied {copied} scans")
+    if batch:
+        copied += target.save_scans(batch, times)
+    return read, copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scan history storage tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+    copy = sub.add_parser('copy', help='Copy the scan history from one backend to another')
+    copy.add_argument('source', help='SQLite path or postgresql:// URL')
+    copy.add_argument('target', help='SQLite path or postgresql:// URL')
+    copy.add_argument('--batch-size', type=int, default=COPY_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    source, target = open_store(args.source), open_store(args.target)
+    read, copied = copy_scans(source, target, args.batch_size)
+    print(f"Copied {copied} of {read} scans from {source.describe()} to {target.describe()}")
+    return 0 if copied == read else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Resumable Upload Sessions
+Chunked uploads for large APKs: a session is opened with the file size, chunks are
+PUT in order and written in place into the final upload file, and SHA-256 is
+computed as the chunks arrive. Session state is kept in SQLite so any worker can
+take the next chunk; sessions idle for longer than the TTL are expired with their files.
+Each client may hold a limited number of open sessions and reserved bytes
+"""
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Read size when copying a chunk from the request body to disk
+BLOCK_SIZE = 256 * 1024
+
+# Seconds between sweeps for expired sessions
+EXPIRE_INTERVAL = 300.0
+
+
+class UploadSessionError(Exception):
+    """A chunk or finalize request that cannot be applied; received is the offset to resume from"""
+
+    def __init__(self, message: str, status: int, received: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+class UploadSessionStore:
+    """
+    Upload sessions shared by all workers
+    A chunk must start at the received offset. While it is written the session is
+    leased to that request, so two requests cannot interleave bytes in one file
+    """
+
+    def __init__(self, db_path: str, directory: str, ttl: float = 86400.0, lease_seconds: float = 300.0,
+                 max_sessions_per_client: int = 4, max_bytes_per_client: int = 2 * 1024 * 1024 * 1024):
+        self.db_path = db_path
+        self.directory = directory
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self.max_sessions_per_client = max_sessions_per_client
+        self.max_bytes_per_client = max_bytes_per_client
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hashers = {}  # upload_id -> (offset, sha256 of the bytes before offset), per process
+        self._expired_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    upload_id TEXT PRIMARY KEY,
+                    scan_id TEXT,
+                    filename TEXT,
+                    filepath TEXT,
+                    timestamp TEXT,
+                    size INTEGER,
+                    received INTEGER DEFAULT 0,
+                    sha256 TEXT,
+                    lease TEXT,
+                    lease_until REAL DEFAULT 0,
+                    updated_at REAL,
+                    client TEXT
+                )
+            ''')
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(upload_sessions)')}
+            if 'client' not in columns:
+                # Session databases created before per-client limits
+                conn.execute('ALTER TABLE upload_sessions ADD COLUMN client TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_client ON upload_sessions(client)')
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread and process (connections must not cross a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def create(self, scan_id: str, filename: str, timestamp: str, size: int,
+               sha256: Optional[str] = None, client: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Open a session; the upload file is created at its full size (sparse where supported)
+        Refused with 429 when the client already holds max_sessions_per_client open
+        sessions or the new one would take it past max_bytes_per_client reserved bytes
+        """
+        self.expire()
+        upload_id = secrets.token_urlsafe(16)
+        filepath = os.path.join(self.directory, scan_id)
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                # The write lock is taken first, so concurrent creates see each other's sessions
+                conn.execute('BEGIN IMMEDIATE')
+                if client is not None:
+                    sessions, reserved = conn.execute('''
+                        SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_sessions
+                        WHERE client = ? AND updated_at >= ?
+                    ''', (client, now - self.ttl)).fetchone()
+                    if sessions >= self.max_sessions_per_client:
+                        raise UploadSessionError(f'At most {self.max_sessions_per_client} open uploads per client', 429)
+                    if reserved + size > self.max_bytes_per_client:
+                        raise UploadSessionError('Open uploads of this client would exceed '
+                                                 f'{self.max_bytes_per_client // (1024 * 1024)} MB', 429)
+                conn.execute('''
+                    INSERT INTO upload_sessions
+                    (upload_id, scan_id, filename, filepath, timestamp, size, received, sha256, updated_at, client)
+                    VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)
+                ''', (upload_id, scan_id, filename, filepath, timestamp, size, sha256, now, client))
+                with open(filepath, 'wb') as f:
+                    f.truncate(size)
+        except OSError:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            raise
+        logger.info("Upload session %s opened for %s (%s bytes)", upload_id, scan_id, size,
+                    extra={'log_class': 'upload.session'})
+        return self.get(upload_id)
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        self.expire()
+        row = self._connect().execute('SELECT * FROM upload_sessions WHERE upload_id = ?',
+                                      (upload_id,)).fetchone()
+        if row is None:
+            return None
+        session = dict(row)
+        session['expires_in'] = max(int(session['updated_at'] + self.ttl - time.time()), 0)
+        return session
+
+    def write_chunk(self, upload_id: str, start: int, length: int, stream) -> Dict[str, Any]:
+        """
+        Copy length bytes from stream to offset start of the upload file
+        A body that ends early still keeps the bytes that arrived, so a retry
+        resumes from them; a repeated chunk that is already stored is a no-op
+        """
+        session = self._require(upload_id)
+        received, size = session['received'], session['size']
+        if start < 0 or length < 0 or start + length > size:
+            raise UploadSessionError('Chunk outside the declared file size', 416, received)
+        if start + length <= received:
+            return session
+        if start != received:
+            raise UploadSessionError(f'Chunk must start at byte {received}', 409, received)
+
+        lease = secrets.token_hex(8)
+        conn = self._connect()
+        with conn:
+            claimed = conn.execute('''
+                UPDATE upload_sessions SET lease = ?, lease_until = ?
+                WHERE upload_id = ? AND received = ? AND lease_until < ?
+            ''', (lease, time.time() + self.lease_seconds, upload_id, received, time.time())).rowcount
+        if not claimed:
+            raise UploadSessionError('Another request is writing this upload', 409, self._received(upload_id))
+
+        hasher = self._hasher(session)
+        written = 0
+        try:
+            with open(session['filepath'], 'r+b') as f:
+                f.seek(start)
+                while written < length:
+                    block = stream.read(min(BLOCK_SIZE, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    hasher.update(block)
+                    written += len(block)
+        finally:
+            # Also when the connection dropped mid-chunk: the bytes written so far are kept
+            with conn:
+                conn.execute('''
+                    UPDATE upload_sessions SET received = ?, lease = NULL, lease_until = 0, updated_at = ?
+                    WHERE upload_id = ? AND lease = ?
+                ''', (start + written, time.time(), upload_id, lease))
+            with self._lock:
+                self._hashers[upload_id] = (start + written, hasher)
+        return self.get(upload_id)
+
+    def complete(self, upload_id: str) -> Dict[str, Any]:
+        """
+        Close a fully received session and return it with its sha256 digest
+        The upload file then belongs to the caller
+        """
+        session = self._require(upload_id)
+        if session['received'] != session['size']:
+            raise UploadSessionError(f"Upload incomplete: {session['received']} of {session['size']} bytes",
+                                     409, session['received'])
+        if session['lease']:
+            raise UploadSessionError('A chunk is still being written', 409, session['received'])
+        digest = self._hasher(session).hexdigest()
+        if session['sha256'] and session['sha256'].lower() != digest:
+            self.abort(upload_id)
+            raise UploadSessionError('SHA-256 of the received file does not match the declared one', 422)
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (upload_id,))
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        return dict(session, file_hash=digest)
+
+    def abort(self, upload_id: str) -> bool:
+        session = self.get(upload_id)
+        if session is None:
+            return False
+        self._discard(session)
+        return True
+
+    def expire(self):
+        """Remove sessions idle for longer than the TTL, at most every EXPIRE_INTERVAL"""
+        now = time.time()
+        if now - self._expired_at < EXPIRE_INTERVAL:
+            return
+        self._expired_at = now
+        try:
+            rows = self._connect().execute(
+                'SELECT upload_id, filepath FROM upload_sessions WHERE updated_at < ? AND lease_until < ?',
+                (now - self.ttl, now)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not expire upload sessions: {str(e)}")
+            return
+        for row in rows:
+            self._discard(dict(row))
+        if rows:
+            logger.info(f"Expired {len(rows)} stale upload session(s)")
+
+    def _discard(self, session: Dict[str, Any]):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (session['upload_id'],))
+        with self._lock:
+            self._hashers.pop(session['upload_id'], None)
+        try:
+            os.remove(session['filepath'])
+        except OSError:
+            pass
+
+    def _require(self, upload_id: str) -> Dict[str, Any]:
+        session = self.get(upload_id)
+        if session is None:
+            raise UploadSessionError('Unknown or expired upload', 404)
+        return session
+
+    def _received(self, upload_id: str) -> Optional[int]:
+        session = self.get(upload_id)
+        return session['received'] if session else None
+
+    def _hasher(self, session: Dict[str, Any]):
+        """SHA-256 of the first `received` bytes, re-read from disk if another process took the earlier chunks"""
+        with self._lock:
+            offset, hasher = self._hashers.get(session['upload_id'], (None, None))
+        if offset == session['received']:
+            return hasher
+        hasher = hashlib.sha256()
+        remaining = session['received']
+        with open(session['filepath'], 'rb') as f:
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        return hasher
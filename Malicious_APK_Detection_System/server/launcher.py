@@ -0,0 +1,163 @@
+"""
+Production Server Launcher
+Pre-fork WSGI serving with gunicorn: the master imports the app (and with it
+the ML model) once, then forks worker processes that each run a thread pool.
+A worker is recycled after a number of scans to bound androguard's memory
+growth, and SIGHUP replaces all workers gracefully. Where gunicorn is not
+available (e.g. Windows) a threaded Werkzeug server is used instead.
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+
+from monitoring.metrics import REGISTRY
+from monitoring.multiprocess import ProcessSnapshots
+
+logger = logging.getLogger(__name__)
+
+# Requests counted towards WORKER_MAX_SCANS
+SCAN_PATHS = ('/api/scan',)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run the APK scanner web server')
+    parser.add_argument('--mode', choices=['prefork', 'dev'], default=os.environ.get('SERVER_MODE', 'prefork'),
+                        help='prefork: gunicorn workers; dev: single-process Werkzeug server')
+    parser.add_argument('--bind', default=os.environ.get('WEB_BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)),
+                        help='Worker processes (analysis is CPU-bound: one per core)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 4)),
+                        help='Request threads per worker')
+    parser.add_argument('--max-scans', type=int, default=int(os.environ.get('WORKER_MAX_SCANS', 200)),
+                        help='Recycle a worker after this many scans (0 = never)')
+    parser.add_argument('--max-scans-jitter', type=int,
+                        default=int(os.environ.get('WORKER_MAX_SCANS_JITTER', 20)),
+                        help='Random extra scans per worker so workers do not restart together')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('WEB_TIMEOUT', 300)),
+                        help='Seconds a busy worker may stay silent before it is killed')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 60)),
+                        help='Seconds in-flight scans get to finish on reload / recycle')
+    return parser
+
+
+def gunicorn_options(args, reload_model=None):
+    """
+    gunicorn settings (including the server hooks) for the parsed arguments
+    reload_model() refreshes the model of the served app on SIGHUP and returns its version
+    """
+    max_scans, jitter = args.max_scans, args.max_scans_jitter
+
+    def post_fork(server, worker):
+        worker.scans = 0
+        worker.max_scans = max_scans + random.randint(0, max(jitter, 0)) if max_scans > 0 else 0
+        # Counts inherited from the master are already in the master's metrics file
+        REGISTRY.reset()
+        REGISTRY.start_flusher()
+
+    def worker_exit(server, worker):
+        REGISTRY.write_snapshot()
+
+    def post_request(worker, req, environ, resp):
+        if req.method != 'POST' or req.path not in SCAN_PATHS:
+            return
+        worker.scans += 1
+        if worker.max_scans and worker.scans >= worker.max_scans and worker.alive:
+            # Finishes in-flight requests, then the master forks a fresh worker
+            worker.log.info(f"Recycling worker {worker.pid} after {worker.scans} scans")
+            worker.alive = False
+
+    def on_reload(server):
+        # New workers are forked from the master, so refresh its preloaded model first
+        if reload_model is None:
+            server.log.info("SIGHUP: replacing workers")
+            return
+        server.log.info(f"SIGHUP: replacing workers (model version {reload_model()})")
+        REGISTRY.write_snapshot(gauges=False)
+
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'preload_app': True,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'post_fork': post_fork,
+        'post_request': post_request,
+        'worker_exit': worker_exit,
+        'on_reload': on_reload,
+    }
+
+
+def serve_prefork(args, wsgi_app=None, reload_model=None):
+    from gunicorn.app.base import BaseApplication
+
+    if wsgi_app is None:
+        # Imported here, in the master: the reload hook must belong to the module that is served
+        import app as app_module
+        wsgi_app, reload_model = app_module.app, app_module.reload_model
+
+    class _Application(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options(args, reload_model).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return wsgi_app
+
+    created = prepare_multiprocess_dir()
+    logger.info(f"Starting {args.workers} worker(s) x {args.threads} thread(s) on {args.bind} "
+                f"(recycle after {args.max_scans or 'unlimited'} scans)")
+    try:
+        _Application().run()
+    finally:
+        if created:
+            shutil.rmtree(os.environ['METRICS_MULTIPROC_DIR'], ignore_errors=True)
+
+
+def prepare_multiprocess_dir() -> bool:
+    """
+    Point the workers at a fresh METRICS_MULTIPROC_DIR (a temporary one unless set)
+    so /metrics and the shadow report merge all of them; True if it was created here
+    """
+    directory = os.environ.get('METRICS_MULTIPROC_DIR')
+    created = not directory
+    if created:
+        directory = os.environ['METRICS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='apk-metrics-')
+    else:
+        # Files of a previous run would be added to this one
+        for name in ('metrics', 'shadow'):
+            ProcessSnapshots(directory, name, None).clear()
+    # Counts of the app import (model load) belong to the master
+    REGISTRY.write_snapshot(gauges=False)
+    return created
+
+
+def serve_dev(args, wsgi_app=None):
+    """Single-process threaded Werkzeug server; debugger and reloader only with FLASK_DEBUG=1"""
+    if wsgi_app is None:
+        from app import app as wsgi_app
+    host, _, port = args.bind.rpartition(':')
+    debug = os.environ.get('FLASK_DEBUG', '0').lower() in ('1', 'true', 'yes')
+    wsgi_app.run(debug=debug, host=host or '0.0.0.0', port=int(port), threaded=True)
+
+
+def main(argv=None, wsgi_app=None, reload_model=None):
+    """wsgi_app and reload_model come from the caller's app module; by default `app` is imported"""
+    args = build_parser().parse_args(argv)
+    if args.mode == 'prefork':
+        try:
+            import gunicorn  # noqa: F401
+            import fcntl  # noqa: F401
+        except ImportError:
+            logger.warning("gunicorn is not available on this platform - using the threaded dev server")
+        else:
+            return serve_prefork(args, wsgi_app, reload_model)
+    return serve_dev(args, wsgi_app)
+
+
+if __name__ == '__main__':
+    main()
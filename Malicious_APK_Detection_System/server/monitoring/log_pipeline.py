@@ -0,0 +1,247 @@
+"""
+Logging Pipeline
+Log records never do I/O on the thread that logs them: a QueueHandler puts them
+on a bounded in-memory queue (dropping and counting records when it is full) and
+a QueueListener thread per process writes them out - as JSON lines to a file
+rotated by size and time, and as text to the console. Records carry the fields
+of the current log context (scan_id, file_hash, ...) and any extra= fields such
+as stage durations. High-volume message classes (extra={'log_class': ...}) can
+be sampled down to one record in N
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+from monitoring.metrics import LOG_RECORDS_DROPPED
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# LogRecord attributes that are not extra= fields
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'log_context', 'log_class', 'sampled'
+}
+
+_log_context = contextvars.ContextVar('log_context', default=None)
+
+
+def start_log_context(**fields) -> Dict[str, Any]:
+    """Begin a log context for the current request/context; its fields go on every record"""
+    context = {key: value for key, value in fields.items() if value is not None}
+    _log_context.set(context)
+    return context
+
+
+def bind_log_context(**fields):
+    """Add fields (e.g. file_hash once it is known) to the current log context, if any"""
+    context = _log_context.get()
+    if context is not None:
+        context.update((key, value) for key, value in fields.items() if value is not None)
+
+
+def end_log_context():
+    _log_context.set(None)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, context and extra fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        entry.update(getattr(record, 'log_context', None) or {})
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if getattr(record, 'log_class', None):
+            entry['class'] = record.log_class
+        if getattr(record, 'sampled', None):
+            entry['sampled'] = record.sampled  # one record kept per this many
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one record in N of each configured message class (extra={'log_class': ...})"""
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = {name: int(rate) for name, rate in rates.items() if int(rate) > 1}
+        self._counts = dict.fromkeys(self.rates, 0)
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, 'log_class', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            count = self._counts[record.log_class]
+            self._counts[record.log_class] = count + 1
+        if count % rate:
+            LOG_RECORDS_DROPPED.inc(reason='sampled')
+            return False
+        record.sampled = rate
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records instead of waiting when the queue is full, and
+    starts a fresh queue and listener in each process (threads do not survive a fork)
+    """
+
+    def __init__(self, make_handlers, max_queue: int = 10000):
+        super().__init__(queue.Queue(max_queue))
+        self.make_handlers = make_handlers
+        self.max_queue = max_queue
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.max_queue)
+            self.listener = logging.handlers.QueueListener(self.queue, *self.make_handlers(),
+                                                           respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Write out the queued records and stop the listener (at exit)"""
+        with self._start_lock:
+            if self.listener is not None and self._pid == os.getpid():
+                try:
+                    self.listener.stop()
+                except queue.Full:
+                    pass  # no room for the stop sentinel: the daemon thread ends with the process
+                for handler in self.listener.handlers:
+                    handler.close()
+            self.listener, self._pid = None, None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Copy of the record with its message merged and its context captured on the logging thread"""
+        prepared = logging.makeLogRecord(vars(record))
+        prepared.msg = record.getMessage()
+        prepared.args = None
+        if record.exc_info:
+            prepared.exc_text = logging.Formatter().formatException(record.exc_info)
+            prepared.exc_info = None
+        context = _log_context.get()
+        if context:
+            prepared.log_context = dict(context)
+        # Mutable extra= values (e.g. a trace that keeps growing) are copied as they are now
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and isinstance(value, (list, dict)):
+                setattr(prepared, key, value.copy())
+        return prepared
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason='queue_full')
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Rotates at the interval boundary and whenever the file would grow past max_bytes.
+    Several processes can share the file: one that finds it already rotated by
+    another reopens it instead of rotating again
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 0, when: str = 'midnight', backup_count: int = 14):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        super().__init__(filename, when=when, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        if self.stream is None:
+            self.stream = self._open()
+        if self._rotated_elsewhere():
+            self.stream.close()
+            self.stream = self._open()
+            self.rolloverAt = self.computeRollover(int(time.time()))
+        if super().shouldRollover(record):
+            return 1
+        if self.max_bytes > 0:
+            self.stream.seek(0, 2)
+            return int(self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes)
+        return 0
+
+    def _rotated_elsewhere(self) -> bool:
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except OSError:
+            return True
+
+    def rotation_filename(self, default_name: str) -> str:
+        """A second rotation within one interval gets a .1, .2, ... suffix instead of replacing the first"""
+        name = super().rotation_filename(default_name)
+        candidate, n = name, 1
+        while os.path.exists(candidate):
+            candidate, n = f'{name}.{n}', n + 1
+        return candidate
+
+
+def parse_rates(spec: str) -> Dict[str, int]:
+    """'scan.hash=10,db.save=100' -> {'scan.hash': 10, 'db.save': 100}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = int(rate)
+    return rates
+
+
+def setup_logging(log_file: Optional[str] = None, level: Optional[str] = None) -> NonBlockingQueueHandler:
+    """
+    Route the root logger through the queue: JSON (LOG_FORMAT=json, default) or text lines to
+    log_file, text to the console. Configured from LOG_* variables; returns the queue handler
+    """
+    log_file = log_file or os.environ.get('LOG_FILE') or 'logs/app.log'
+    level = (level or os.environ.get('LOG_LEVEL') or 'INFO').upper()
+
+    def make_handlers():
+        file_handler = SizeAndTimeRotatingFileHandler(
+            log_file,
+            max_bytes=int(float(os.environ.get('LOG_MAX_MB', 100)) * 1024 * 1024),
+            when=os.environ.get('LOG_ROTATE_WHEN', 'midnight'),
+            backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 14))
+        )
+        file_handler.setFormatter(JsonFormatter() if os.environ.get('LOG_FORMAT', 'json').lower() == 'json'
+                                  else logging.Formatter(TEXT_FORMAT))
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+        return file_handler, console
+
+    handler = NonBlockingQueueHandler(make_handlers, max_queue=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    handler.addFilter(SamplingFilter(parse_rates(os.environ.get('LOG_SAMPLING', ''))))
+    handler.start()
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.stop)
+    return handler
@@ -0,0 +1,448 @@
+"""
+In-process metrics: counters, histograms and per-request timing traces
+Rendered in Prometheus text exposition format by the /metrics endpoint
+With METRICS_MULTIPROC_DIR set, every worker process writes its values to a
+file there and /metrics merges the files of all workers (monitoring/multiprocess.py)
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Tuple
+
+from monitoring.multiprocess import ProcessSnapshots, multiprocess_dir
+
+# Seconds between the snapshot writes of a worker process in multi-process mode
+FLUSH_INTERVAL = 5.0
+
+# Latency buckets in seconds (1 ms .. 2 min)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _Metric:
+    """Base class for labelled metrics"""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        body = ','.join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return '{' + body + '}'
+
+    def render(self, values: Optional[Dict] = None) -> List[str]:
+        """This process's values, or values merged from all processes"""
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.metric_type}'
+        ]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value) -> List[str]:
+        return [f'{self.name}{self._format_labels(key)} {_format_number(value)}']
+
+    def snapshot(self) -> List[list]:
+        """[[label values, value], ...] as written to the process's file"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshots: List[List[list]]) -> Dict:
+        """Values of several processes summed per label set"""
+        merged = {}
+        for items in snapshots:
+            for key, value in items:
+                key = tuple(key)
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down
+    Across processes, merge='sum' adds the values of live processes, 'max' takes the
+    largest and 'latest' the most recently set one (for values every worker reads
+    from shared memory)
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), merge: str = 'sum'):
+        super().__init__(name, documentation, labelnames)
+        self.merge_mode = merge
+        self._updated = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+            self._updated[key] = time.time()
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self._updated[key] = time.time()
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(key), value, self._updated.get(key, 0)] for key, value in self._values.items()]
+
+    def merge(self, snapshots: List[List[list]]) -> Dict:
+        merged, updated = {}, {}
+        for items in snapshots:
+            for key, value, ts in items:
+                key = tuple(key)
+                if key not in merged:
+                    merged[key], updated[key] = value, ts
+                elif self.merge_mode == 'sum':
+                    merged[key] += value
+                elif self.merge_mode == 'max':
+                    merged[key] = max(merged[key], value)
+                elif ts > updated[key]:
+                    merged[key], updated[key] = value, ts
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._updated.clear()
+
+
+class Histogram(_Metric):
+    """Cumulative bucket histogram"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            state['counts'][idx] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_value(self, key, value) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value['counts']):
+            cumulative += count
+            labels = self._format_labels(key, ('le', _format_number(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = self._format_labels(key, ('le', '+Inf'))
+        lines.append(f'{self.name}_bucket{labels} {value["count"]}')
+        lines.append(f'{self.name}_sum{self._format_labels(key)} {_format_number(value["sum"])}')
+        lines.append(f'{self.name}_count{self._format_labels(key)} {value["count"]}')
+        return lines
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(key), {'counts': list(state['counts']), 'sum': state['sum'], 'count': state['count']}]
+                    for key, state in self._values.items()]
+
+    def merge(self, snapshots: List[List[list]]) -> Dict:
+        merged = {}
+        for items in snapshots:
+            for key, state in items:
+                key = tuple(key)
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = {'counts': list(state['counts']), 'sum': state['sum'], 'count': state['count']}
+                    continue
+                total['counts'] = [a + b for a, b in zip(total['counts'], state['counts'])]
+                total['sum'] += state['sum']
+                total['count'] += state['count']
+        return merged
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), merge='sum') -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, merge))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        merged = self._merge_processes(metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(merged.get(metric.name) if merged is not None else None))
+        return '\n'.join(lines) + '\n'
+
+    # Multi-process mode (METRICS_MULTIPROC_DIR): one snapshot file per process
+
+    def _snapshots(self) -> Optional[ProcessSnapshots]:
+        directory = multiprocess_dir()
+        return ProcessSnapshots(directory, 'metrics', self._fold_exited) if directory else None
+
+    def snapshot(self, gauges: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics
+                if gauges or not isinstance(metric, Gauge)}
+
+    def write_snapshot(self, gauges: bool = True):
+        """
+        Write this process's values for the other workers' /metrics
+        The pre-fork master writes without gauges: only its counters are its own
+        """
+        snapshots = self._snapshots()
+        if snapshots is not None:
+            snapshots.write(self.snapshot(gauges))
+
+    def reset(self):
+        """Forget inherited values in a freshly forked worker (the master's file keeps them)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def start_flusher(self, interval: float = FLUSH_INTERVAL):
+        """Write this process's snapshot every interval seconds from a daemon thread"""
+        if multiprocess_dir() is None or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        self._flusher = threading.Thread(target=self._flush_loop, args=(interval,),
+                                         name='metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.write_snapshot()
+
+    def _merge_processes(self, metrics: List[_Metric]) -> Optional[Dict[str, Dict]]:
+        snapshots = self._snapshots()
+        if snapshots is None:
+            return None
+        snapshots.write(self.snapshot())
+        archive, live = snapshots.collect()
+        states = [state for _, state in live]
+        merged = {}
+        for metric in metrics:
+            parts = [state[metric.name] for state in states if metric.name in state]
+            if archive and metric.name in archive and not isinstance(metric, Gauge):
+                parts.append(archive[metric.name])
+            merged[metric.name] = metric.merge(parts)
+        return merged
+
+    def _fold_exited(self, archive: Optional[Dict[str, Any]], state: Dict[str, Any]) -> Dict[str, Any]:
+        """Add an exited process's counters and histograms to the archive (its gauges are gone with it)"""
+        archive = dict(archive or {})
+        for name, items in state.items():
+            metric = self._metrics.get(name)
+            if metric is None or isinstance(metric, Gauge):
+                continue
+            merged = metric.merge([archive.get(name, []), items])
+            archive[name] = [[list(key), value] for key, value in merged.items()]
+        return archive
+
+
+# Process-wide registry and the scan pipeline metrics
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'apk_scan_stage_seconds', 'Time spent in each scan pipeline stage', ('stage',)
+)
+SCAN_SECONDS = REGISTRY.histogram(
+    'apk_scan_request_seconds', 'End-to-end /api/scan latency', ('outcome',)
+)
+SCANS_TOTAL = REGISTRY.counter(
+    'apk_scans_total', 'Completed scans by verdict', ('verdict',)
+)
+CACHE_HITS = REGISTRY.counter(
+    'apk_scan_cache_hits_total', 'Scans answered from the result cache'
+)
+CACHE_MISSES = REGISTRY.counter(
+    'apk_scan_cache_misses_total', 'Scans that required full analysis'
+)
+FALLBACKS = REGISTRY.counter(
+    'apk_scan_fallbacks_total', 'Degraded code paths taken', ('component',)
+)
+ERRORS = REGISTRY.counter(
+    'apk_scan_errors_total', 'Errors by pipeline stage', ('stage',)
+)
+MODEL_RELOADS = REGISTRY.counter(
+    'apk_model_reloads_total', 'Model hot-reload events by outcome', ('outcome',)
+)
+MODEL_PREDICTIONS = REGISTRY.counter(
+    'apk_model_predictions_total', 'ML predictions served per model version', ('version',)
+)
+STUDENT_PREDICTIONS = REGISTRY.counter(
+    'apk_student_predictions_total', 'Distilled student predictions served or handed to the teacher',
+    ('outcome',)
+)
+SHADOW_PREDICTIONS = REGISTRY.counter(
+    'apk_shadow_predictions_total', 'Shadow model predictions by agreement with the primary',
+    ('model', 'agreement')
+)
+SHADOW_INFERENCE_SECONDS = REGISTRY.histogram(
+    'apk_shadow_inference_seconds', 'Shadow model batch inference time', ('model',)
+)
+VT_REQUESTS = REGISTRY.counter(
+    'apk_virustotal_requests_total', 'VirusTotal API requests by endpoint', ('endpoint',)
+)
+VT_LOOKUPS = REGISTRY.counter(
+    'apk_virustotal_lookups_total', 'Background VirusTotal hash lookups by outcome', ('outcome',)
+)
+VT_QUEUE_DEPTH = REGISTRY.gauge(
+    'apk_virustotal_queue_depth', 'Hashes waiting for VirusTotal enrichment'
+)
+ADMISSION_DECISIONS = REGISTRY.counter(
+    'apk_admission_decisions_total', 'Scan admission decisions (rejections by reason)', ('outcome', 'reason')
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    'apk_admission_wait_seconds', 'Time admitted scans queued for an analysis slot', ('outcome',)
+)
+ACTIVE_ANALYSES = REGISTRY.gauge(
+    'apk_active_analyses', 'Analyses running across all workers', merge='latest'
+)
+INFLIGHT_UPLOAD_BYTES = REGISTRY.gauge(
+    'apk_inflight_upload_bytes', 'Upload bytes reserved by admitted scans across all workers', merge='latest'
+)
+LANE_WAIT_SECONDS = REGISTRY.histogram(
+    'apk_scheduler_wait_seconds', 'Time scans waited for an analysis slot by lane and priority',
+    ('lane', 'priority')
+)
+DEGRADATION_TIER = REGISTRY.gauge(
+    'apk_degradation_tier', 'Current analysis tier (0 = full, 1 = reduced, 2 = minimal)', merge='max'
+)
+SCANS_BY_TIER = REGISTRY.counter(
+    'apk_scans_by_tier_total', 'Analyses run per degradation tier', ('tier',)
+)
+REANALYSES = REGISTRY.counter(
+    'apk_reanalyses_total', 'Provisional scans re-analysed at the full tier by outcome', ('outcome',)
+)
+REANALYSIS_QUEUE_DEPTH = REGISTRY.gauge(
+    'apk_reanalysis_queue_depth', 'Provisional scans waiting for full re-analysis'
+)
+PROFILES_CAPTURED = REGISTRY.counter(
+    'apk_profiles_captured_total', 'Scan stack-sample profiles kept, by reason (slow or sampled)', ('reason',)
+)
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'apk_log_records_dropped_total', 'Log records not written: sampled out or the log queue was full', ('reason',)
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Per-request trace (list of stage timings) for ?debug_timing=1
+_current_trace = contextvars.ContextVar('scan_trace', default=None)
+
+
+def start_trace() -> List[Dict[str, Any]]:
+    """Begin collecting stage timings for the current request/context"""
+    trace = []
+    _current_trace.set(trace)
+    return trace
+
+
+def end_trace():
+    _current_trace.set(None)
+
+
+def current_trace() -> Optional[List[Dict[str, Any]]]:
+    return _current_trace.get()
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block, feed the stage histogram and the active trace"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append({'stage': stage, 'ms': round(elapsed * 1000, 3)})
+
+
+def render_prometheus() -> str:
+    return REGISTRY.render()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,116 @@
+"""
+Multi-process State Files
+Each pre-forked worker keeps its metrics and shadow statistics in memory; with
+METRICS_MULTIPROC_DIR set it also writes them as one JSON file per process, and
+readers (/metrics, the shadow report) merge every file so any worker answers for
+all of them. Files of exited processes are folded into an archive file, so
+counters of recycled workers are kept while the directory stays small
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = 'archive'
+
+
+def multiprocess_dir() -> Optional[str]:
+    """Directory shared by the worker processes of this host, or None in single-process mode"""
+    return os.environ.get('METRICS_MULTIPROC_DIR') or None
+
+
+class ProcessSnapshots:
+    """
+    <name>.<pid>.json per process plus <name>.archive.json for exited ones
+    combine(archived, state) folds an exited process's state into the archive
+    """
+
+    def __init__(self, directory: str, name: str, combine: Callable[[Optional[Dict], Dict], Dict]):
+        self.directory = directory
+        self.name = name
+        self.combine = combine
+        self._write_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, suffix) -> str:
+        return os.path.join(self.directory, f'{self.name}.{suffix}.json')
+
+    def write(self, state: Dict[str, Any], suffix=None):
+        """Atomically replace this process's file (or the archive)"""
+        path = self._path(suffix or os.getpid())
+        with self._write_lock:
+            tmp = f'{path}.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning(f"Could not write {path}: {str(e)}")
+
+    def collect(self) -> Tuple[Optional[Dict[str, Any]], List[Tuple[int, Dict[str, Any]]]]:
+        """(archive of exited processes, [(pid, state) of live ones])"""
+        live, exited = [], []
+        prefix, suffix = f'{self.name}.', '.json'
+        for entry in os.listdir(self.directory):
+            if not entry.startswith(prefix) or not entry.endswith(suffix):
+                continue
+            pid = entry[len(prefix):-len(suffix)]
+            if not pid.isdigit():
+                continue
+            state = _read(os.path.join(self.directory, entry))
+            if state is None:
+                continue
+            (live if _alive(int(pid)) else exited).append((int(pid), state))
+        if exited:
+            self._archive(exited)
+        return _read(self._path(ARCHIVE)), live
+
+    def clear(self):
+        """Remove every file of this name (a new server run starts from zero)"""
+        for entry in os.listdir(self.directory):
+            if entry.startswith(f'{self.name}.'):
+                try:
+                    os.remove(os.path.join(self.directory, entry))
+                except OSError:
+                    pass
+
+    def _archive(self, exited: List[Tuple[int, Dict[str, Any]]]):
+        import fcntl
+        with open(os.path.join(self.directory, f'.{self.name}.lock'), 'a') as lock:
+            # Readers in other workers may fold the same exited files at the same time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = _read(self._path(ARCHIVE))
+            folded = []
+            for pid, state in exited:
+                if os.path.exists(self._path(pid)):
+                    archive = self.combine(archive, state)
+                    folded.append(pid)
+            if not folded:
+                return
+            self.write(archive, ARCHIVE)
+            for pid in folded:
+                try:
+                    os.remove(self._path(pid))
+                except OSError:
+                    pass
+
+
+def _read(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,301 @@
+"""
+Sampling Profiler
+Stack samples of in-flight scans, taken by one background thread per process
+from sys._current_frames(). A scan's samples are kept - as collapsed stacks
+(flamegraph.pl / speedscope input) together with its stage timings - when it ran
+longer than the latency threshold or was picked by the sampling ratio, and are
+dropped otherwise. Kept profiles go to a small SQLite store that the admin
+endpoints of every worker read, linked to the scan_id
+"""
+import json
+import logging
+import os
+import random
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from typing import Dict, List, Any, Optional
+
+from monitoring.metrics import PROFILES_CAPTURED
+
+logger = logging.getLogger(__name__)
+
+# Frames kept per sample (the outermost ones are dropped beyond this)
+MAX_DEPTH = 128
+
+# Distinct stacks kept per scan; further new stacks are counted under one truncated entry
+MAX_STACKS = 5000
+
+TRUNCATED_STACK = '[more stacks truncated]'
+
+
+class ProfileSession:
+    """Samples of one scan running on one thread"""
+
+    __slots__ = ('thread_id', 'started', 'sampled', 'stacks', 'samples')
+
+    def __init__(self, thread_id: int, sampled: bool):
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.sampled = sampled
+        self.stacks = StackCounter()
+        self.samples = 0
+
+
+class SamplingProfiler:
+    """
+    Samples the threads of open sessions every interval seconds; the thread only
+    runs while a session is open. Sessions are begun and ended on the scan's thread
+    """
+
+    def __init__(self, store: 'ProfileStore', interval: float = 0.01, threshold: float = 2.0,
+                 sample_ratio: float = 0.0):
+        self.store = store
+        self.interval = max(float(interval), 0.001)
+        self.threshold = float(threshold)
+        self.sample_ratio = min(max(float(sample_ratio), 0.0), 1.0)
+        self._sessions = {}  # id(session) -> session
+        self._pending = []  # profiles waiting to be written by the sampler thread
+        self._labels = {}  # code object -> frame label
+        self._cond = threading.Condition()
+        self._thread = None
+        self._thread_pid = None
+        self.stats = {'sessions': 0, 'kept': 0, 'samples': 0, 'write_errors': 0}
+
+    def begin(self) -> ProfileSession:
+        """Start sampling the calling thread"""
+        session = ProfileSession(threading.get_ident(), random.random() < self.sample_ratio)
+        self._ensure_thread()
+        with self._cond:
+            self._sessions[id(session)] = session
+            self.stats['sessions'] += 1
+            self._cond.notify()
+        return session
+
+    def end(self, session: ProfileSession, scan_id: Optional[str], stages: Optional[List[Dict[str, Any]]] = None,
+            outcome: Optional[str] = None) -> Optional[str]:
+        """
+        Stop sampling; returns the id of the profile when it is kept (slow or sampled).
+        The profile is written by the sampler thread, never on the scan's thread
+        """
+        elapsed = time.perf_counter() - session.started
+        with self._cond:
+            self._sessions.pop(id(session), None)
+        if elapsed >= self.threshold:
+            reason = 'slow'
+        elif session.sampled:
+            reason = 'sampled'
+        else:
+            return None
+        profile_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}"
+        with self._cond:
+            self._pending.append({
+                'profile_id': profile_id,
+                'scan_id': scan_id,
+                'created_at': time.time(),
+                'duration_ms': round(elapsed * 1000, 3),
+                'reason': reason,
+                'outcome': outcome,
+                'pid': os.getpid(),
+                'samples': session.samples,
+                'interval_ms': round(self.interval * 1000, 3),
+                'stages': list(stages or []),
+                'collapsed': session.stacks,
+            })
+            self.stats['kept'] += 1
+            self._cond.notify()
+        PROFILES_CAPTURED.inc(reason=reason)
+        return profile_id
+
+    def discard(self, session: ProfileSession):
+        """Stop sampling without keeping anything (the scan continues elsewhere)"""
+        with self._cond:
+            self._sessions.pop(id(session), None)
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            active = len(self._sessions)
+        return dict(self.stats, active=active, interval_ms=round(self.interval * 1000, 3),
+                    threshold_ms=round(self.threshold * 1000, 3), sample_ratio=self.sample_ratio)
+
+    def _ensure_thread(self):
+        """Threads do not survive a fork, so each worker process starts its own"""
+        if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+            with self._cond:
+                if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                    self._thread_pid = os.getpid()
+                    self._sessions.clear()
+                    self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._sessions and not self._pending:
+                    self._cond.wait()
+                sessions = list(self._sessions.values())
+                pending, self._pending = self._pending, []
+            if sessions:
+                self._sample(sessions)
+            for profile in pending:
+                self._write(profile)
+            if sessions:
+                time.sleep(self.interval)
+
+    def _sample(self, sessions: List[ProfileSession]):
+        frames = sys._current_frames()
+        for session in sessions:
+            frame = frames.get(session.thread_id)
+            if frame is None:
+                continue
+            stack = self._collapse(frame)
+            if stack not in session.stacks and len(session.stacks) >= MAX_STACKS:
+                stack = TRUNCATED_STACK
+            session.stacks[stack] += 1
+            session.samples += 1
+        self.stats['samples'] += len(sessions)
+
+    def _collapse(self, frame) -> str:
+        """'outermost;...;innermost' with module:function labels"""
+        labels = []
+        while frame is not None and len(labels) < MAX_DEPTH:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                name = getattr(code, 'co_qualname', code.co_name)
+                label = f"{frame.f_globals.get('__name__', '?')}:{name}".replace(';', ':').replace(' ', '_')
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def _write(self, profile: Dict[str, Any]):
+        try:
+            self.store.save(profile)
+        except sqlite3.Error as e:
+            self.stats['write_errors'] += 1
+            logger.warning(f"Could not store profile {profile['profile_id']}: {str(e)}")
+
+
+class ProfileStore:
+    """Kept profiles in SQLite, the newest max_profiles of them"""
+
+    def __init__(self, db_path: str, max_profiles: int = 500):
+        self.db_path = db_path
+        self.max_profiles = max_profiles
+        self._local = threading.local()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS profiles (
+                    profile_id TEXT PRIMARY KEY,
+                    scan_id TEXT,
+                    created_at REAL,
+                    duration_ms REAL,
+                    reason TEXT,
+                    outcome TEXT,
+                    pid INTEGER,
+                    samples INTEGER,
+                    interval_ms REAL,
+                    stages TEXT,
+                    collapsed TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_profiles_scan_id ON profiles(scan_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_profiles_created ON profiles(created_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread and process (connections must not cross a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def save(self, profile: Dict[str, Any]):
+        collapsed = '\n'.join(f'{stack} {count}' for stack, count in profile['collapsed'].most_common())
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                INSERT INTO profiles (profile_id, scan_id, created_at, duration_ms, reason, outcome, pid,
+                                      samples, interval_ms, stages, collapsed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (profile['profile_id'], profile['scan_id'], profile['created_at'], profile['duration_ms'],
+                  profile['reason'], profile['outcome'], profile['pid'], profile['samples'],
+                  profile['interval_ms'], json.dumps(profile['stages']), collapsed))
+            conn.execute('''
+                DELETE FROM profiles WHERE profile_id IN (
+                    SELECT profile_id FROM profiles ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_profiles,))
+
+    def list(self, limit: int = 50, scan_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Newest profiles first, without their stacks"""
+        query = ('SELECT profile_id, scan_id, created_at, duration_ms, reason, outcome, pid, samples '
+                 'FROM profiles')
+        params = []
+        if scan_id:
+            query += ' WHERE scan_id = ?'
+            params.append(scan_id)
+        query += ' ORDER BY created_at DESC LIMIT ?'
+        params.append(limit)
+        return [dict(row) for row in self._connect().execute(query, params).fetchall()]
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute('SELECT * FROM profiles WHERE profile_id = ?', (profile_id,)).fetchone()
+        if row is None:
+            return None
+        profile = dict(row)
+        profile['stages'] = json.loads(profile['stages'] or '[]')
+        return profile
+
+
+def summarize(collapsed: str, top: int = 15) -> Dict[str, Any]:
+    """
+    Share of samples in which each module and function was on the stack (inclusive),
+    e.g. androguard.core.apk vs analyzer.url_extractor vs sklearn.ensemble._forest,
+    and in which a function was the one running (self)
+    """
+    modules, functions, leaves = StackCounter(), StackCounter(), StackCounter()
+    total = 0
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not stack or not count.isdigit():
+            continue
+        count = int(count)
+        total += count
+        frames = stack.split(';')
+        leaves[frames[-1]] += count
+        frames = set(frames)
+        functions.update({frame: count for frame in frames})
+        modules.update({module: count for module in {frame.split(':', 1)[0] for frame in frames}})
+
+    def shares(counter):
+        return [{'name': name, 'samples': count, 'percent': round(100.0 * count / total, 1)}
+                for name, count in counter.most_common(top)]
+
+    if not total:
+        return {'samples': 0, 'modules': [], 'functions': [], 'self': []}
+    return {'samples': total, 'modules': shares(modules), 'functions': shares(functions), 'self': shares(leaves)}
+
+
+def profiler_from_env(db_path: str) -> Optional[SamplingProfiler]:
+    """SamplingProfiler configured from PROFILER_* variables, None unless PROFILER_ENABLED=1"""
+    if os.environ.get('PROFILER_ENABLED', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    store = ProfileStore(os.environ.get('PROFILER_DATABASE') or db_path,
+                         max_profiles=int(os.environ.get('PROFILER_MAX_PROFILES', 500)))
+    return SamplingProfiler(
+        store,
+        interval=float(os.environ.get('PROFILER_INTERVAL_MS', 10)) / 1000,
+        threshold=float(os.environ.get('PROFILER_THRESHOLD_MS', 2000)) / 1000,
+        sample_ratio=float(os.environ.get('PROFILER_SAMPLE_RATIO', 0))
+    )
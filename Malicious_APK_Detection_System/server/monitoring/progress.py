@@ -0,0 +1,154 @@
+"""
+Scan Progress Events
+Stage events of a scan (uploaded, hashed, manifest parsed, ML scored, ...) with
+partial results, kept in a small SQLite log so a server-sent-events stream on any
+worker can follow a scan running on another. Code reports events through
+report_progress(), which is a no-op unless the scan is being streamed
+"""
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A stream ends after one of these; 'complete' carries the /api/scan response body
+TERMINAL_EVENTS = ('complete', 'error')
+
+# Seconds between deletions of events of old scans
+PURGE_INTERVAL = 300.0
+
+_current_progress = contextvars.ContextVar('scan_progress', default=None)
+
+
+class ScanEventLog:
+    """
+    Append-only event log per scan_id
+    Events are only needed while a client follows the scan, so the log skips
+    fsync and keeps them for retention seconds
+    """
+
+    def __init__(self, db_path: str, retention: float = 3600.0):
+        self.db_path = db_path
+        self.retention = retention
+        self._local = threading.local()
+        self._purged_at = 0.0
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS scan_events (
+                    scan_id TEXT,
+                    seq INTEGER,
+                    event TEXT,
+                    data TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (scan_id, seq)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_events_created ON scan_events(created_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread and process (connections must not cross a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def append(self, scan_id: str, event: str, data: Optional[Dict[str, Any]] = None) -> int:
+        """Store an event and return its sequence number (1, 2, ...)"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            seq = conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM scan_events WHERE scan_id = ?',
+                               (scan_id,)).fetchone()[0]
+            conn.execute('INSERT INTO scan_events (scan_id, seq, event, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                         (scan_id, seq, event, json.dumps(data or {}, default=str), now))
+        if now - self._purged_at > PURGE_INTERVAL:
+            self._purged_at = now
+            self.purge(now - self.retention)
+        return seq
+
+    def read(self, scan_id: str, after: int = 0) -> List[Tuple[int, str, Dict[str, Any]]]:
+        """Events of scan_id after sequence number after, oldest first"""
+        rows = self._connect().execute(
+            'SELECT seq, event, data FROM scan_events WHERE scan_id = ? AND seq > ? ORDER BY seq',
+            (scan_id, after)
+        ).fetchall()
+        return [(seq, event, json.loads(data)) for seq, event, data in rows]
+
+    def purge(self, before: float) -> int:
+        try:
+            conn = self._connect()
+            with conn:
+                return conn.execute('DELETE FROM scan_events WHERE created_at < ?', (before,)).rowcount
+        except sqlite3.Error as e:
+            logger.warning(f"Could not purge scan events: {str(e)}")
+            return 0
+
+    def stream(self, scan_id: str, after: int = 0, poll_interval: float = 0.2, max_seconds: float = 25.0,
+               keepalive: float = 10.0, wait_for_start: float = 10.0) -> Iterator[str]:
+        """
+        text/event-stream body: events after `after` until a terminal event
+        Ends after max_seconds so a request thread is not held for a whole analysis;
+        EventSource then reconnects with Last-Event-ID and resumes
+        """
+        yield 'retry: 1000\n\n'
+        start = last_sent = time.monotonic()
+        while True:
+            events = self.read(scan_id, after)
+            for seq, event, data in events:
+                after = seq
+                yield format_sse(event, data, seq)
+                if event in TERMINAL_EVENTS:
+                    return
+            now = time.monotonic()
+            if events:
+                last_sent = now
+            elif after == 0 and now - start > wait_for_start:
+                yield format_sse('error', {'error': 'Unknown scan'})
+                return
+            elif now - last_sent >= keepalive:
+                last_sent = now
+                yield ': keep-alive\n\n'
+            if now - start >= max_seconds:
+                return
+            time.sleep(poll_interval)
+
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, default=str)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+@contextmanager
+def scan_progress(log: Optional[ScanEventLog], scan_id: str):
+    """Send report_progress() calls made in this context to the scan's event log"""
+    token = _current_progress.set((log, scan_id) if log is not None else None)
+    try:
+        yield
+    finally:
+        _current_progress.reset(token)
+
+
+def report_progress(event: str, **data):
+    """Record a stage event for the scan being streamed, if any"""
+    current = _current_progress.get()
+    if current is None:
+        return
+    log, scan_id = current
+    try:
+        log.append(scan_id, event, data)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not record {event} for {scan_id}: {str(e)}")
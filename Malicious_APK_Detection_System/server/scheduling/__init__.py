@@ -0,0 +1 @@
+# Scheduling Package
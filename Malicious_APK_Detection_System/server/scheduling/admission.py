@@ -0,0 +1,326 @@
+"""
+Admission Control for /api/scan
+Per-client token buckets (API key or client IP), a cap on concurrent analyses
+and a cap on upload bytes in flight. The state lives in shared memory created
+before the server forks, so the limits hold across all worker processes
+"""
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from monitoring.metrics import (timed, ADMISSION_DECISIONS, ADMISSION_WAIT_SECONDS,
+                                ACTIVE_ANALYSES, INFLIGHT_UPLOAD_BYTES, LANE_WAIT_SECONDS)
+from scheduling.priority import LaneScheduler, ScanJob, lanes_from_env, INTERACTIVE_WEIGHT
+
+logger = logging.getLogger(__name__)
+
+# Waiters re-check for leases of dead workers this often
+RECLAIM_INTERVAL = 1.0
+
+
+class AdmissionRejected(Exception):
+    """Request refused; retry_after is the suggested wait in seconds"""
+
+    def __init__(self, reason: str, retry_after: int, message: str):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """An admitted request, holding one lease slot until released"""
+
+    __slots__ = ('slot', 'nbytes', 'client', 'analysing')
+
+    def __init__(self, slot: int, nbytes: int, client: str):
+        self.slot = slot
+        self.nbytes = nbytes
+        self.client = client
+        self.analysing = False
+
+
+class AdmissionController:
+    """
+    Decides whether a scan request may start
+    admit() runs before the upload body is read; analysis_slot() bounds the
+    CPU-heavy part and queues for at most queue_timeout seconds; with lanes,
+    waiting scans are ordered by a LaneScheduler instead of whoever wakes first
+    """
+
+    def __init__(self, rate=1.0, burst=20, max_analyses=None, max_inflight_bytes=512 * 1024 * 1024,
+                 max_queued=32, queue_timeout=10.0, max_requests=256, bucket_slots=4096, lanes=None,
+                 interactive_weight=INTERACTIVE_WEIGHT):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_analyses = int(max_analyses or os.cpu_count() or 1)
+        self.max_inflight_bytes = int(max_inflight_bytes)
+        self.max_queued = int(max_queued)
+        self.queue_timeout = float(queue_timeout)
+        self.max_requests = int(max_requests)
+        self.bucket_slots = int(bucket_slots)
+
+        # Fork-inherited shared memory; every field is guarded by _lock
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        self._lock = ctx.Lock()
+        # Waiters for an analysis slot sleep here, across processes
+        self._slot_freed = ctx.Condition(self._lock)
+        self._lease_pid = ctx.RawArray('i', self.max_requests)  # owner process, 0 = free
+        self._lease_bytes = ctx.RawArray('q', self.max_requests)
+        self._lease_analysing = ctx.RawArray('b', self.max_requests)
+        # Running totals of the lease table
+        self._admitted = ctx.RawValue('i', 0)
+        self._inflight = ctx.RawValue('q', 0)
+        self._analysing = ctx.RawValue('i', 0)
+        # Hashed client slots: (tokens, last refill); clients sharing a slot share a bucket
+        self._buckets = ctx.RawArray('d', 2 * self.bucket_slots)
+        self._queued = ctx.RawValue('i', 0)
+        self._avg_analysis_seconds = ctx.RawValue('d', 1.0)
+        self.scheduler = LaneScheduler(lanes, self.max_requests, ctx, interactive_weight) if lanes else None
+
+    def admit(self, client: str, nbytes: int) -> Ticket:
+        """Take a token from the client's bucket and reserve nbytes of upload capacity"""
+        now = time.monotonic()
+        rejection = None
+        with self._lock:
+            bucket = self._bucket_index(client)
+            tokens = self._tokens_locked(bucket, now)
+
+            if (self._admitted.value >= self.max_requests or self._analysing.value >= self.max_analyses
+                    or self._inflight.value + nbytes > self.max_inflight_bytes):
+                # Leases of crashed / killed workers are freed before refusing
+                self._reclaim_dead()
+            inflight = self._inflight.value
+
+            if tokens < 1:
+                rejection = AdmissionRejected('client_rate', math.ceil((1 - tokens) / self.rate),
+                                              'Scan rate limit exceeded for this client')
+            elif self._analysing.value >= self.max_analyses and self._queued.value >= self.max_queued:
+                rejection = AdmissionRejected('queue_full', self._retry_after_locked(),
+                                              'Server is at capacity')
+            elif self._admitted.value >= self.max_requests:
+                rejection = AdmissionRejected('requests', self._retry_after_locked(),
+                                              'Too many scans in progress')
+            elif inflight > 0 and inflight + nbytes > self.max_inflight_bytes:
+                # A single upload larger than the cap is still admitted when nothing else is in flight
+                rejection = AdmissionRejected('upload_bytes', self._retry_after_locked(),
+                                              'Too many upload bytes in flight')
+            else:
+                tokens -= 1
+                slot = self._lease_pid[:].index(0)
+                self._lease_pid[slot] = os.getpid()
+                self._lease_bytes[slot] = nbytes
+                self._lease_analysing[slot] = 0
+                self._admitted.value += 1
+                self._inflight.value += nbytes
+                inflight += nbytes
+            self._buckets[2 * bucket] = tokens
+            self._buckets[2 * bucket + 1] = now
+
+        if rejection is not None:
+            ADMISSION_DECISIONS.inc(outcome='rejected', reason=rejection.reason)
+            logger.info("Scan rejected (%s) for %s, retry after %ss", rejection.reason, client, rejection.retry_after,
+                        extra={'log_class': 'admission.rejected'})
+            raise rejection
+        ADMISSION_DECISIONS.inc(outcome='admitted', reason='')
+        INFLIGHT_UPLOAD_BYTES.set(inflight)
+        return Ticket(slot, nbytes, client)
+
+    def throttle(self, client: str):
+        """Take a token from the client's bucket only, for requests that do not run a scan here"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket_index(client)
+            tokens = self._tokens_locked(bucket, now)
+            allowed = tokens >= 1
+            self._buckets[2 * bucket] = tokens - 1 if allowed else tokens
+            self._buckets[2 * bucket + 1] = now
+        if not allowed:
+            ADMISSION_DECISIONS.inc(outcome='rejected', reason='client_rate')
+            logger.info("Request rejected (client_rate) for %s", client, extra={'log_class': 'admission.rejected'})
+            raise AdmissionRejected('client_rate', math.ceil((1 - tokens) / self.rate),
+                                    'Request rate limit exceeded for this client')
+
+    @contextmanager
+    def analysis_slot(self, ticket: Ticket, job: Optional[ScanJob] = None):
+        """Hold one of max_analyses slots for the analysis; queues up to queue_timeout"""
+        with timed('admission_wait'):
+            self._acquire_analysis(ticket, job)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release_analysis(ticket, time.perf_counter() - start)
+
+    def release(self, ticket: Ticket):
+        """Free the request's lease (upload bytes and, if still held, its analysis slot)"""
+        with self._lock:
+            self._free_lease(ticket.slot)
+            inflight, analysing = self._inflight.value, self._analysing.value
+        INFLIGHT_UPLOAD_BYTES.set(inflight)
+        ACTIVE_ANALYSES.set(analysing)
+
+    def queue_depth(self) -> int:
+        """Admitted scans currently waiting for an analysis slot"""
+        return self._queued.value
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'admitted_requests': self._admitted.value,
+                'active_analyses': self._analysing.value,
+                'queued': self._queued.value,
+                'inflight_upload_bytes': self._inflight.value,
+                'avg_analysis_seconds': round(self._avg_analysis_seconds.value, 3),
+                'limits': {
+                    'rate_per_client': self.rate,
+                    'burst': self.burst,
+                    'max_analyses': self.max_analyses,
+                    'max_inflight_bytes': self.max_inflight_bytes,
+                    'max_queued': self.max_queued,
+                    'queue_timeout': self.queue_timeout,
+                },
+                'lanes': self.scheduler.status() if self.scheduler is not None else None,
+            }
+
+    def _acquire_analysis(self, ticket: Ticket, job: Optional[ScanJob]):
+        scheduler = self.scheduler if job is not None else None
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        queued = False
+        try:
+            with self._lock:
+                if scheduler is not None:
+                    scheduler.enqueue(ticket.slot, job)
+                try:
+                    next_reclaim = start + RECLAIM_INTERVAL
+                    while True:
+                        if self._analysing.value < self.max_analyses and (
+                                scheduler is None or scheduler.next_slot(self._lease_pid) == ticket.slot):
+                            if scheduler is not None:
+                                scheduler.dispatch(ticket.slot)
+                            self._lease_analysing[ticket.slot] = 1
+                            self._analysing.value += 1
+                            ticket.analysing = True
+                            analysing = self._analysing.value
+                            if scheduler is not None and analysing < self.max_analyses:
+                                # Another slot is still free: wake the new head of the queue now, not at the next reclaim tick
+                                self._slot_freed.notify_all()
+                            break
+                        now = time.monotonic()
+                        if now >= deadline:
+                            ADMISSION_DECISIONS.inc(outcome='rejected', reason='analysis_slots')
+                            raise AdmissionRejected('analysis_slots', self._retry_after_locked(),
+                                                    f'No analysis slot free within {self.queue_timeout:g}s')
+                        if now >= next_reclaim:
+                            # A dead worker may hold a slot or sit at the head of the queue
+                            self._reclaim_dead()
+                            next_reclaim = now + RECLAIM_INTERVAL
+                            continue
+                        if not queued:
+                            self._queued.value += 1
+                            queued = True
+                        self._slot_freed.wait(min(deadline, next_reclaim) - now)
+                finally:
+                    if queued:
+                        self._queued.value -= 1
+                    if scheduler is not None and not ticket.analysing:
+                        scheduler.remove(ticket.slot)
+                        # The head of the queue may have changed
+                        self._slot_freed.notify_all()
+        finally:
+            waited = time.monotonic() - start
+            if queued:
+                ADMISSION_WAIT_SECONDS.observe(waited, outcome='started' if ticket.analysing else 'timeout')
+        if scheduler is not None:
+            LANE_WAIT_SECONDS.observe(waited, lane=scheduler.lanes[job.lane][0], priority=job.priority)
+        ACTIVE_ANALYSES.set(analysing)
+
+    def _release_analysis(self, ticket: Ticket, seconds: float):
+        with self._lock:
+            if ticket.analysing and self._lease_analysing[ticket.slot]:
+                self._lease_analysing[ticket.slot] = 0
+                self._analysing.value -= 1
+                self._slot_freed.notify_all()
+            ticket.analysing = False
+            # Moving average of analysis time, used for Retry-After estimates
+            avg = self._avg_analysis_seconds
+            avg.value = 0.9 * avg.value + 0.1 * seconds
+            analysing = self._analysing.value
+        ACTIVE_ANALYSES.set(analysing)
+
+    def _free_lease(self, slot: int):
+        """Clear one lease and its share of the totals (caller holds _lock)"""
+        if not self._lease_pid[slot]:
+            return
+        if self._lease_analysing[slot]:
+            self._analysing.value -= 1
+        self._admitted.value -= 1
+        self._inflight.value -= self._lease_bytes[slot]
+        self._lease_pid[slot] = 0
+        self._lease_bytes[slot] = 0
+        self._lease_analysing[slot] = 0
+        if self.scheduler is not None:
+            self.scheduler.remove(slot)
+        self._slot_freed.notify_all()
+
+    def _reclaim_dead(self):
+        """Free leases whose worker process no longer exists (caller holds _lock)"""
+        own_pid = os.getpid()
+        alive = {own_pid: True}
+        for i in range(self.max_requests):
+            pid = self._lease_pid[i]
+            if not pid:
+                continue
+            if pid not in alive:
+                alive[pid] = pid_alive(pid)
+            if not alive[pid]:
+                logger.warning(f"Releasing admission lease of exited worker {pid}")
+                self._free_lease(i)
+
+    def _retry_after_locked(self) -> int:
+        """Seconds until the current backlog has likely drained"""
+        backlog = (self._queued.value + self.max_analyses) / self.max_analyses
+        return max(1, math.ceil(self._avg_analysis_seconds.value * backlog))
+
+    def _tokens_locked(self, bucket: int, now: float) -> float:
+        """Tokens in a bucket after refilling it up to now (caller holds _lock)"""
+        last = self._buckets[2 * bucket + 1]
+        return self.burst if last == 0 else min(self.burst, self._buckets[2 * bucket] + (now - last) * self.rate)
+
+    def _bucket_index(self, client: str) -> int:
+        digest = hashlib.blake2b(client.encode('utf-8', 'replace'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % self.bucket_slots
+
+
+def pid_alive(pid: int) -> bool:
+    """Whether a process exists (it may belong to another user)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def controller_from_env() -> Optional[AdmissionController]:
+    """AdmissionController configured from ADMISSION_* variables (None when disabled)"""
+    if os.environ.get('ADMISSION_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    return AdmissionController(
+        rate=float(os.environ.get('ADMISSION_RATE', 1.0)),
+        burst=float(os.environ.get('ADMISSION_BURST', 20)),
+        max_analyses=int(os.environ.get('ADMISSION_MAX_ANALYSES') or 0) or None,
+        max_inflight_bytes=int(float(os.environ.get('ADMISSION_MAX_UPLOAD_MB', 512)) * 1024 * 1024),
+        max_queued=int(os.environ.get('ADMISSION_MAX_QUEUED', 32)),
+        queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+        lanes=lanes_from_env(),
+        interactive_weight=float(os.environ.get('SCHEDULER_INTERACTIVE_WEIGHT', INTERACTIVE_WEIGHT))
+    )
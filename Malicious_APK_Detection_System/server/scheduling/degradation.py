@@ -0,0 +1,250 @@
+"""
+Load-Aware Degradation
+Under overload scans step down to cheaper analysis tiers instead of queueing
+until they time out:
+    full     androguard, URL extraction, certificate checks, model, VirusTotal
+    reduced  androguard and model without URL extraction; VirusTotal deferred
+    minimal  ZIP listing only (fallback analysis) with rule-based scoring
+Degraded results are provisional: their uploads are kept and re-analysed at the
+full tier once the server is back at the full tier and nothing is queued
+"""
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional
+
+from monitoring.metrics import DEGRADATION_TIER, REANALYSES, REANALYSIS_QUEUE_DEPTH
+from scheduling.admission import pid_alive
+
+logger = logging.getLogger(__name__)
+
+TIERS = ('full', 'reduced', 'minimal')
+FULL, REDUCED, MINIMAL = range(len(TIERS))
+
+# Pressure below this fraction of the thresholds lets the tier step back up
+RELAX_PRESSURE = 0.5
+
+# Seconds between checks for uploads left behind by exited workers
+ADOPT_INTERVAL = 60.0
+
+
+class DegradationPolicy:
+    """
+    Picks the analysis tier from queue depth and recent scan latency
+    pressure = max(queued / queue_high, latency / latency_target); pressure >= 1
+    degrades to reduced and >= 2 to minimal at once, while recovery goes one tier
+    per cooldown and only below RELAX_PRESSURE. State is shared across workers
+    """
+
+    def __init__(self, queue_high=8, latency_target=5.0, cooldown=15.0, latency_halflife=30.0,
+                 queue_depth: Optional[Callable[[], int]] = None):
+        self.queue_high = max(int(queue_high), 1)
+        self.latency_target = float(latency_target)
+        self.cooldown = float(cooldown)
+        self.latency_halflife = float(latency_halflife)
+        self.queue_depth = queue_depth or (lambda: 0)
+
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        self._lock = ctx.Lock()
+        self._tier = ctx.RawValue('i', FULL)
+        self._changed_at = ctx.RawValue('d', 0.0)
+        # Moving average of scan latency and when it was last updated (CLOCK_MONOTONIC is system-wide)
+        self._latency = ctx.RawValue('d', 0.0)
+        self._latency_at = ctx.RawValue('d', 0.0)
+
+    def observe_latency(self, seconds: float):
+        """Feed the end-to-end time of an analysed (not cached) scan"""
+        with self._lock:
+            latency = self._decayed_latency(time.monotonic())
+            self._latency.value = seconds if latency == 0 else 0.8 * latency + 0.2 * seconds
+            self._latency_at.value = time.monotonic()
+
+    def pressure(self) -> float:
+        with self._lock:
+            return self._pressure_locked(time.monotonic())
+
+    def tier(self) -> int:
+        """Tier for a scan starting now"""
+        now = time.monotonic()
+        with self._lock:
+            pressure = self._pressure_locked(now)
+            current = self._tier.value
+            target = MINIMAL if pressure >= 2 else REDUCED if pressure >= 1 else FULL
+            if target > current:
+                new = target
+            elif (current > FULL and pressure < RELAX_PRESSURE
+                  and now - self._changed_at.value >= self.cooldown):
+                new = current - 1
+            else:
+                new = current
+            if new != current:
+                self._tier.value = new
+                self._changed_at.value = now
+        if new != current:
+            logger.warning(f"Analysis tier {TIERS[current]} -> {TIERS[new]} (pressure {pressure:.2f})")
+        DEGRADATION_TIER.set(new)
+        return new
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'tier': TIERS[self._tier.value],
+                'pressure': round(self._pressure_locked(now), 3),
+                'queued': self.queue_depth(),
+                'latency_seconds': round(self._decayed_latency(now), 3),
+                'seconds_in_tier': round(now - self._changed_at.value, 1) if self._changed_at.value else None,
+                'thresholds': {
+                    'queue_high': self.queue_high,
+                    'latency_target': self.latency_target,
+                    'cooldown': self.cooldown,
+                },
+            }
+
+    def _pressure_locked(self, now: float) -> float:
+        return max(self.queue_depth() / self.queue_high, self._decayed_latency(now) / self.latency_target)
+
+    def _decayed_latency(self, now: float) -> float:
+        """The average fades while no scans finish, so an idle server recovers"""
+        if not self._latency_at.value:
+            return 0.0
+        return self._latency.value * math.pow(0.5, (now - self._latency_at.value) / self.latency_halflife)
+
+
+class ReanalysisQueue:
+    """
+    Full re-analysis of provisional scans, in a background thread per worker
+    reanalyze(file_hash, path) returns False to be retried later (e.g. when it
+    could not get an analysis slot). Uploads wait in directory as <hash>.apk.<pid>; files
+    of workers that exited are adopted, so a restart does not lose them
+    """
+
+    def __init__(self, policy: DegradationPolicy, reanalyze: Callable[[str, str], bool], directory: str,
+                 max_pending=1000, idle_interval=2.0):
+        self.policy = policy
+        self.reanalyze = reanalyze
+        self.directory = directory
+        self.max_pending = max_pending
+        self.idle_interval = idle_interval
+        os.makedirs(directory, exist_ok=True)
+        self._pending = OrderedDict()  # file_hash -> kept upload
+        self._cond = threading.Condition()
+        self.stats = {'enqueued': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'adopted': 0}
+        self._thread = None
+        self._thread_pid = None
+
+    def enqueue(self, file_hash: str, file_path: str) -> bool:
+        """Take over file_path until the scan has been re-analysed; False if the queue is full"""
+        with self._cond:
+            if file_hash in self._pending:
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                logger.warning(f"Re-analysis queue full - {file_hash} stays provisional")
+                return False
+            path = os.path.join(self.directory, f'{file_hash}.apk.{os.getpid()}')
+            try:
+                os.replace(file_path, path)
+            except OSError as e:
+                logger.error(f"Could not keep {file_path} for re-analysis: {str(e)}")
+                return False
+            self._pending[file_hash] = path
+            self.stats['enqueued'] += 1
+            REANALYSIS_QUEUE_DEPTH.set(len(self._pending))
+            self._cond.notify()
+        self.start()
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            return dict(self.stats, pending=len(self._pending))
+
+    def start(self):
+        """Start this process's re-analysis thread (threads do not survive a fork)"""
+        if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+            with self._cond:
+                if self._thread is None or self._thread_pid != os.getpid() or not self._thread.is_alive():
+                    self._thread_pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='reanalysis', daemon=True)
+                    self._thread.start()
+
+    def _adopt_orphans(self):
+        """Queue the kept uploads of workers that no longer exist"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        own = os.getpid()
+        for name in names:
+            file_hash, _, pid = name.partition('.apk.')
+            if not pid.isdigit() or int(pid) == own or pid_alive(int(pid)):
+                continue
+            path = os.path.join(self.directory, name)
+            claimed = os.path.join(self.directory, f'{file_hash}.apk.{own}')
+            try:
+                # Atomic: when several workers adopt at once only one rename succeeds
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with self._cond:
+                self._pending.setdefault(file_hash, claimed)
+                self.stats['adopted'] += 1
+                REANALYSIS_QUEUE_DEPTH.set(len(self._pending))
+            logger.info("Adopted provisional scan %s of exited worker %s", file_hash, pid,
+                        extra={'log_class': 'reanalysis.adopted'})
+
+    def _run(self):
+        next_adopt = 0.0
+        while True:
+            if time.monotonic() >= next_adopt:
+                self._adopt_orphans()
+                next_adopt = time.monotonic() + ADOPT_INTERVAL
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(ADOPT_INTERVAL)
+                    continue
+            # Only spare capacity is used: full tier and no scans waiting for a slot
+            if self.policy.tier() != FULL or self.policy.queue_depth() > 0:
+                time.sleep(self.idle_interval)
+                continue
+            with self._cond:
+                file_hash, path = next(iter(self._pending.items()))
+            try:
+                done = self.reanalyze(file_hash, path)
+            except Exception as e:
+                logger.error(f"Re-analysis of {file_hash} failed: {str(e)}", exc_info=True)
+                done = None
+            with self._cond:
+                if done is False:
+                    # Not now: to the back of the queue
+                    self._pending.move_to_end(file_hash)
+                else:
+                    self._pending.pop(file_hash, None)
+                REANALYSIS_QUEUE_DEPTH.set(len(self._pending))
+            if done is False:
+                REANALYSES.inc(outcome='retry')
+                time.sleep(self.idle_interval)
+                continue
+            outcome = 'completed' if done else 'failed'
+            self.stats[outcome] += 1
+            REANALYSES.inc(outcome=outcome)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def policy_from_env(queue_depth: Optional[Callable[[], int]] = None) -> Optional[DegradationPolicy]:
+    """DegradationPolicy configured from DEGRADE_* variables (None when disabled)"""
+    if os.environ.get('DEGRADE_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    return DegradationPolicy(
+        queue_high=int(os.environ.get('DEGRADE_QUEUE_HIGH', 8)),
+        latency_target=float(os.environ.get('DEGRADE_LATENCY_TARGET', 5)),
+        cooldown=float(os.environ.get('DEGRADE_COOLDOWN', 15)),
+        queue_depth=queue_depth
+    )
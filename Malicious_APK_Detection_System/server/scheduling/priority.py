@@ -0,0 +1,183 @@
+"""
+Size-Aware Scan Scheduling
+Orders the scans waiting for an analysis slot. A scan's cost is estimated from
+the upload size and the entry count in its ZIP central directory, and the cost
+picks a lane (small / medium / large apps). Lanes take turns by weight, so
+typical apps are not stuck behind a run of large games while large apps still
+get their share; interactive uploads get a larger share than bulk ingestion,
+but bulk scans are never starved
+"""
+import math
+import os
+import struct
+from typing import Dict, Any, List, Optional, Tuple
+
+# (name, upper cost bound, weight); a lane with weight w gets w dispatches per round
+DEFAULT_LANES = (('small', 16.0, 4), ('medium', 64.0, 2), ('large', math.inf, 1))
+
+# Androguard time per ZIP entry relative to per-MB time (measured on synthetic APKs)
+ENTRIES_PER_MB = 250
+
+PRIORITIES = ('interactive', 'bulk')
+
+# Interactive scans of a lane are dispatched this many times as often as its bulk scans
+INTERACTIVE_WEIGHT = 4.0
+
+_EOCD = b'PK\x05\x06'
+_EOCD_SIZE = 22
+_ZIP64_LOCATOR = b'PK\x06\x07'
+_ZIP64_EOCD = b'PK\x06\x06'
+
+
+class ScanJob:
+    """Cost estimate and lane of one scan"""
+
+    __slots__ = ('size_bytes', 'entries', 'cost', 'lane', 'interactive')
+
+    def __init__(self, size_bytes: int, entries: Optional[int], cost: float, lane: int, interactive: bool):
+        self.size_bytes = size_bytes
+        self.entries = entries
+        self.cost = cost
+        self.lane = lane
+        self.interactive = interactive
+
+    @property
+    def priority(self) -> str:
+        return 'interactive' if self.interactive else 'bulk'
+
+
+def zip_entry_count(path: str) -> Optional[int]:
+    """Total entries from the end of central directory record; None if it is not a ZIP"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            # The record is the last 22 bytes plus a comment of up to 64 KB
+            tail_size = min(size, _EOCD_SIZE + 0xFFFF)
+            f.seek(size - tail_size)
+            tail = f.read(tail_size)
+            pos = tail.rfind(_EOCD)
+            if pos < 0 or pos + _EOCD_SIZE > len(tail):
+                return None
+            entries = struct.unpack_from('<H', tail, pos + 10)[0]
+            if entries != 0xFFFF:
+                return entries
+            # ZIP64: the locator just before the record points at the ZIP64 record
+            locator = pos - 20
+            if locator < 0 or tail[locator:locator + 4] != _ZIP64_LOCATOR:
+                return None
+            f.seek(struct.unpack_from('<Q', tail, locator + 8)[0])
+            record = f.read(56)
+            if len(record) < 56 or record[:4] != _ZIP64_EOCD:
+                return None
+            return struct.unpack_from('<Q', record, 32)[0]
+    except (OSError, struct.error):
+        return None
+
+
+def estimate_job(path: str, interactive: bool, lanes=DEFAULT_LANES) -> ScanJob:
+    """Cost in MB-equivalents of analysis time, and the first lane whose bound it is under"""
+    size_bytes = os.path.getsize(path)
+    entries = zip_entry_count(path)
+    cost = size_bytes / (1024 * 1024) + (entries or 0) / ENTRIES_PER_MB
+    lane = next((i for i, (_, bound, _) in enumerate(lanes) if cost < bound), len(lanes) - 1)
+    return ScanJob(size_bytes, entries, cost, lane, interactive)
+
+
+def lanes_from_env() -> Optional[Tuple]:
+    """
+    Lanes from SCHEDULER_* variables (None when SCHEDULER_ENABLED=0)
+    SCHEDULER_LANE_LIMITS are the cost bounds of all but the last lane
+    """
+    if os.environ.get('SCHEDULER_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    names = [name for name, _, _ in DEFAULT_LANES]
+    limits = os.environ.get('SCHEDULER_LANE_LIMITS')
+    weights = os.environ.get('SCHEDULER_LANE_WEIGHTS')
+    limits = [float(x) for x in limits.split(',')] if limits else [b for _, b, _ in DEFAULT_LANES[:-1]]
+    weights = [float(x) for x in weights.split(',')] if weights else [w for _, _, w in DEFAULT_LANES]
+    if len(weights) != len(limits) + 1 or len(weights) > len(names):
+        raise ValueError('SCHEDULER_LANE_WEIGHTS needs one weight more than SCHEDULER_LANE_LIMITS '
+                         f'(at most {len(names)} lanes)')
+    if len(weights) < len(names):
+        names = names[:len(weights) - 1] + [names[-1]]
+    return tuple(zip(names, limits + [math.inf], weights))
+
+
+class LaneScheduler:
+    """
+    Weighted turns between lanes for the waiters of AdmissionController
+    Stride scheduling over one queue per lane and priority: each dispatch advances
+    its queue's pass by 1/weight and the queue with the lowest pass goes next, oldest
+    waiter first. A queue's weight is its lane's weight, times interactive_weight for
+    interactive scans, so priority is a larger share rather than a strict order.
+    State is in shared memory indexed by the admission lease slot; every method
+    expects the admission lock to be held
+    """
+
+    def __init__(self, lanes, n_slots: int, ctx, interactive_weight: float = INTERACTIVE_WEIGHT):
+        self.lanes = tuple(lanes)
+        self.n_slots = n_slots
+        self.interactive_weight = max(float(interactive_weight), 1.0)
+        self._wait_lane = ctx.RawArray('b', n_slots)  # lane + 1, 0 = not waiting
+        self._wait_interactive = ctx.RawArray('b', n_slots)
+        self._wait_seq = ctx.RawArray('q', n_slots)
+        # Queue q = 2 * lane + (0 interactive, 1 bulk)
+        self._waiting = ctx.RawArray('i', 2 * len(self.lanes))
+        self._pass = ctx.RawArray('d', 2 * len(self.lanes))
+        self._dispatched = ctx.RawArray('q', 2 * len(self.lanes))  # per lane: interactive, bulk
+        self._vtime = ctx.RawValue('d', 0.0)
+        self._seq = ctx.RawValue('q', 0)
+
+    def enqueue(self, slot: int, job: ScanJob):
+        queue = 2 * job.lane + (0 if job.interactive else 1)
+        if not self._waiting[queue]:
+            # An idle queue rejoins at the current virtual time instead of cashing in saved turns
+            self._pass[queue] = max(self._pass[queue], self._vtime.value)
+        self._seq.value += 1
+        self._wait_seq[slot] = self._seq.value
+        self._wait_interactive[slot] = 1 if job.interactive else 0
+        self._wait_lane[slot] = job.lane + 1
+        self._waiting[queue] += 1
+
+    def next_slot(self, lease_pid) -> Optional[int]:
+        """Lease slot of the waiter that should get the next analysis slot"""
+        best, best_key = None, None
+        for i in range(self.n_slots):
+            lane = self._wait_lane[i] - 1
+            if lane < 0 or not lease_pid[i]:
+                continue
+            queue = self._queue(i, lane)
+            key = (self._pass[queue], queue, self._wait_seq[i])
+            if best_key is None or key < best_key:
+                best, best_key = i, key
+        return best
+
+    def dispatch(self, slot: int):
+        lane = self._wait_lane[slot] - 1
+        if lane < 0:
+            return
+        queue = self._queue(slot, lane)
+        weight = self.lanes[lane][2] * (self.interactive_weight if self._wait_interactive[slot] else 1.0)
+        self._vtime.value = max(self._vtime.value, self._pass[queue])
+        self._pass[queue] += 1.0 / weight
+        self._dispatched[queue] += 1
+        self.remove(slot)
+
+    def remove(self, slot: int):
+        lane = self._wait_lane[slot] - 1
+        if lane >= 0:
+            self._waiting[self._queue(slot, lane)] -= 1
+            self._wait_lane[slot] = 0
+
+    def _queue(self, slot: int, lane: int) -> int:
+        return 2 * lane + (0 if self._wait_interactive[slot] else 1)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [{
+            'lane': name,
+            'max_cost': None if math.isinf(bound) else bound,
+            'weight': weight,
+            'waiting': {'interactive': self._waiting[2 * lane], 'bulk': self._waiting[2 * lane + 1]},
+            'dispatched': {'interactive': self._dispatched[2 * lane], 'bulk': self._dispatched[2 * lane + 1]},
+        } for lane, (name, bound, weight) in enumerate(self.lanes)]
@@ -0,0 +1,466 @@
+"""
+Scan Worker
+Pulls APKs from the shared scan job queue (database/job_queue.py) and runs the
+scan pipeline of the API server on them: static analysis, ML prediction,
+VirusTotal and the stored result. Any number of workers on any number of hosts
+can share one queue - PostgreSQL (DATABASE_URL), Redis (JOB_QUEUE_URL) or, on a
+single host, the SQLite queue beside the scan history. Run from server/:
+    python worker.py run --processes 4
+    python worker.py enqueue /shared/feed/*.apk https://crawler.example/app.apk
+    python worker.py status
+    python worker.py requeue-dead
+Job sources are paths every worker can read (shared storage) or http(s) URLs
+"""
+import argparse
+import glob
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from typing import Dict, Any, Optional
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from werkzeug.utils import secure_filename
+
+from monitoring.log_pipeline import start_log_context, bind_log_context, end_log_context
+from monitoring.metrics import start_trace, end_trace, CACHE_HITS
+
+logger = logging.getLogger('worker')
+
+URL_SCHEMES = ('http://', 'https://')
+
+# Redirects followed per download; every target is checked like the source URL
+MAX_REDIRECTS = 5
+
+# Longest sleep between claims while the queue is empty
+MAX_IDLE_SECONDS = 10.0
+
+# Exit status of a worker process that stopped after --max-jobs and is to be replaced
+RECYCLE_EXIT_CODE = 3
+
+
+class JobError(Exception):
+    """A job that cannot succeed on a retry (bad source, hash mismatch, unparseable APK)"""
+
+
+class ScanWorker:
+    """
+    Claims jobs one batch at a time and scans them in this process. A heartbeat
+    thread renews the leases of the claimed jobs; a job whose lease was lost is
+    still saved (results are keyed by SHA-256) but not marked done by this worker
+    """
+
+    def __init__(self, queue, pipeline, owner: Optional[str] = None, batch_size: int = 1,
+                 lease_seconds: float = 120.0, heartbeat_interval: Optional[float] = None,
+                 download_dir: Optional[str] = None, max_download_bytes: int = 1024 * 1024 * 1024,
+                 idle_seconds: float = 1.0):
+        self.queue = queue
+        self.app = pipeline
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.batch_size = max(int(batch_size), 1)
+        self.lease_seconds = float(lease_seconds)
+        self.heartbeat_interval = heartbeat_interval or self.lease_seconds / 4
+        self.download_dir = download_dir or tempfile.gettempdir()
+        self.max_download_bytes = max_download_bytes
+        self.idle_seconds = idle_seconds
+        self.stop_event = threading.Event()
+        self.stats = {'done': 0, 'cached': 0, 'retried': 0, 'dead': 0, 'lost': 0}
+        self.recycled = False
+        self._held = set()
+        self._held_lock = threading.Lock()
+
+    def run(self, max_jobs: int = 0, exit_when_empty: bool = False) -> Dict[str, int]:
+        """Work until stopped, after max_jobs jobs (0 = no limit), or once the queue is drained"""
+        heartbeat = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        heartbeat.start()
+        processed = 0
+        idle = self.idle_seconds
+        logger.info(f"Worker {self.owner} started ({self.queue.backend} queue)")
+        try:
+            while not self.stop_event.is_set():
+                limit = self.batch_size if not max_jobs else min(self.batch_size, max_jobs - processed)
+                jobs = self.queue.claim(self.owner, limit, self.lease_seconds)
+                if not jobs:
+                    if exit_when_empty and self._drained():
+                        break
+                    self.stop_event.wait(idle)
+                    idle = min(idle * 2, MAX_IDLE_SECONDS)
+                    continue
+                idle = self.idle_seconds
+                with self._held_lock:
+                    self._held.update(job['job_id'] for job in jobs)
+                for job in jobs:
+                    if self.stop_event.is_set():
+                        # Not started: hand it to another worker straight away
+                        self.queue.release(job['job_id'], self.owner)
+                    else:
+                        self.process(job)
+                        processed += 1
+                    with self._held_lock:
+                        self._held.discard(job['job_id'])
+                if max_jobs and processed >= max_jobs:
+                    self.recycled = True
+                    break
+        finally:
+            self.stop_event.set()
+            heartbeat.join(timeout=5)
+        logger.info(f"Worker {self.owner} stopping after {processed} jobs: {self.stats}")
+        return self.stats
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _drained(self) -> bool:
+        jobs = self.queue.status(dead_letters=0)['jobs']
+        return jobs['queued'] == 0 and jobs['leased'] == 0
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.heartbeat_interval):
+            with self._held_lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                renewed = set(self.queue.heartbeat(held, self.owner, self.lease_seconds))
+            except Exception as e:
+                logger.warning(f"Lease renewal failed: {e}")
+                continue
+            for job_id in set(held) - renewed:
+                logger.warning(f"Lost the lease of job {job_id}")
+
+    def process(self, job: Dict[str, Any]):
+        """Scan one leased job and record the outcome in the queue"""
+        profiler = self.app.profiler
+        trace = start_trace()
+        start_log_context(job_id=job['job_id'], file_hash=job['file_hash'])
+        profile = profiler.begin() if profiler is not None else None
+        scan_id, state = None, 'error'
+        try:
+            scan_id, verdict, cached = self.scan(job)
+        except JobError as e:
+            state = self.queue.fail(job, self.owner, str(e), retry=False)
+        except Exception as e:
+            logger.debug(f"Job {job['job_id']} failed", exc_info=True)
+            state = self.queue.fail(job, self.owner, f'{type(e).__name__}: {e}')
+        else:
+            state = 'done' if self.queue.complete(job, self.owner, scan_id, verdict) else None
+            if state is not None:
+                self.stats['cached' if cached else 'done'] += 1
+                logger.info("Job %s: %s%s", job['job_id'], verdict, ' (cached)' if cached else '',
+                            extra={'log_class': 'worker.job'})
+        finally:
+            if profile is not None:
+                profiler.end(profile, scan_id, trace, state or 'lost')
+            end_trace()
+            end_log_context()
+        if state is None:
+            self.stats['lost'] += 1
+            logger.warning(f"Job {job['job_id']} finished after its lease was lost - left to its new owner")
+        elif state == 'queued':
+            self.stats['retried'] += 1
+        elif state == 'dead':
+            self.stats['dead'] += 1
+
+    def scan(self, job: Dict[str, Any]):
+        """Returns (scan_id, verdict, cached); a stored full scan of the same SHA-256 is reused"""
+        if job['file_hash']:
+            cached = self._stored_scan(job['file_hash'])
+            if cached is not None:
+                return cached['scan_id'], cached['verdict'], True
+
+        filepath, temporary = self.fetch(job)
+        keep_file = False
+        try:
+            file_hash = self.app.calculate_file_hash(filepath)
+            bind_log_context(file_hash=file_hash)
+            if job['file_hash'] and file_hash != job['file_hash']:
+                raise JobError(f"SHA-256 of the file is {file_hash}, expected {job['file_hash']}")
+            cached = self._stored_scan(file_hash)
+            if cached is not None:
+                return cached['scan_id'], cached['verdict'], True
+
+            # Background work: always the full analysis tier, with no admission slot
+            filename = secure_filename(job['filename'] or '') or 'download.apk'
+            try:
+                scan_result, keep_file = self.app.scan_file(filepath, filename, file_hash, temporary)
+            except self.app.ScanError as e:
+                raise JobError(str(e))
+            return scan_result['scan_id'], scan_result['verdict'], False
+        finally:
+            if temporary and not keep_file:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    def _stored_scan(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        cached = self.app.db_manager.get_scan_by_hash(file_hash)
+        if cached and not cached.get('provisional'):
+            CACHE_HITS.inc()
+            return cached
+        return None
+
+    def fetch(self, job: Dict[str, Any]):
+        """(path, temporary) of the job's APK: downloaded for a URL, used in place for a path"""
+        source = job['source']
+        if not source.startswith(URL_SCHEMES):
+            path = source[len('file://'):] if source.startswith('file://') else source
+            if not os.path.isfile(path):
+                # Possibly not (yet) visible on this host's mount: retried
+                raise FileNotFoundError(f'{path} not found on {socket.gethostname()}')
+            return path, False
+
+        os.makedirs(self.download_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix='job_', suffix='.apk', dir=self.download_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f, self._download(source) as response:
+                if response.status_code in (404, 410):
+                    raise JobError(f'{source}: HTTP {response.status_code}')
+                response.raise_for_status()
+                size = 0
+                for chunk in response.iter_content(1024 * 1024):
+                    size += len(chunk)
+                    if size > self.max_download_bytes:
+                        raise JobError(f'{source} is larger than {self.max_download_bytes // (1024 * 1024)} MB')
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, True
+
+    def _download(self, url: str):
+        """
+        Streamed GET of a public URL. Redirects are followed here, not by requests,
+        so that each target is checked before it is requested
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = pinned_get(url, check_public_url(url))
+            if not response.is_redirect:
+                return response
+            url = urljoin(url, response.headers['Location'])
+            response.close()
+        raise JobError(f'More than {MAX_REDIRECTS} redirects')
+
+
+def check_public_url(url: str) -> Optional[str]:
+    """
+    Refuse URLs whose host resolves to a loopback, private, link-local or reserved
+    address (jobs must not reach internal services or cloud metadata endpoints),
+    unless JOB_ALLOW_PRIVATE_SOURCES=1
+    Returns the checked address to connect to (None when private sources are allowed)
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise JobError(f'Not an http(s) URL: {url}')
+    if os.environ.get('JOB_ALLOW_PRIVATE_SOURCES', '0').lower() in ('1', 'true', 'yes'):
+        return None
+    # A resolver failure raises OSError and is retried
+    addresses = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+                                   proto=socket.IPPROTO_TCP)
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%', 1)[0])
+        if getattr(address, 'ipv4_mapped', None):
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise JobError(f'{parts.hostname} resolves to a non-public address')
+    return sockaddr[0].split('%', 1)[0]
+
+
+def pinned_get(url: str, address: Optional[str]):
+    """
+    Streamed GET of url from the address check_public_url() approved. Resolving
+    the host again could return a different (internal) address, so the URL is
+    rewritten to the address; Host, TLS SNI and certificate checks keep the name.
+    Proxy and .netrc settings from the environment are ignored
+    """
+    import requests
+    session = requests.Session()
+    session.trust_env = False
+    headers = {}
+    parts = urlsplit(url)
+    if address is not None:
+        host = f'[{address}]' if ':' in address else address
+        url = urlunsplit(parts._replace(netloc=f'{host}:{parts.port}' if parts.port else host))
+        headers['Host'] = parts.netloc.rsplit('@', 1)[-1]
+        if parts.scheme == 'https':
+            session.mount('https://', _pinned_tls_adapter(parts.hostname))
+    return session.get(url, headers=headers, stream=True, timeout=(10, 60), allow_redirects=False)
+
+
+def _pinned_tls_adapter(hostname: str):
+    """HTTPAdapter sending SNI for, and verifying the certificate against, hostname"""
+    from requests.adapters import HTTPAdapter
+
+    class PinnedTLSAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['server_hostname'] = hostname
+            kwargs['assert_hostname'] = hostname
+            super().init_poolmanager(*args, **kwargs)
+
+    return PinnedTLSAdapter()
+
+
+def load_pipeline():
+    """
+    The API server's scan pipeline and stores (importing app loads the model once)
+    Workers use scan_file(), ScanError, calculate_file_hash(), db_manager and profiler
+    """
+    import app
+    return app
+
+
+def job_queue(pipeline=None):
+    from database.job_queue import job_queue_for
+    if pipeline is not None:
+        return job_queue_for(pipeline.db_manager)
+    from database.storage import store_from_env
+    return job_queue_for(store_from_env())
+
+
+def worker_process(queue, pipeline, options: Dict[str, Any], max_jobs: int, exit_when_empty: bool):
+    """Body of one forked worker process; exits with RECYCLE_EXIT_CODE after max_jobs"""
+    worker = ScanWorker(queue, pipeline, **options)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run(max_jobs=max_jobs, exit_when_empty=exit_when_empty)
+    sys.exit(RECYCLE_EXIT_CODE if worker.recycled else 0)
+
+
+def run(args) -> int:
+    # app sets up the queued JSON log; workers write their own file unless LOG_FILE says otherwise
+    os.environ.setdefault('LOG_FILE', 'logs/worker.log')
+    pipeline = load_pipeline()
+    queue = job_queue(pipeline)
+    options = dict(batch_size=args.batch_size, lease_seconds=args.lease, download_dir=args.download_dir,
+                   max_download_bytes=args.max_download_mb * 1024 * 1024)
+    if args.processes <= 1:
+        worker = ScanWorker(queue, pipeline, **options)
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+        try:
+            # One process: recycling would only restart the loop
+            worker.run(exit_when_empty=args.exit_when_empty)
+        except KeyboardInterrupt:
+            worker.stop()
+        return 0
+
+    # Forked after the model is loaded, like the pre-fork web server; a process that
+    # exits after --max-jobs (bounding androguard's memory growth) is replaced
+    context = multiprocessing.get_context('fork')
+    stopping = threading.Event()
+
+    def spawn():
+        process = context.Process(target=worker_process, name='scan-worker',
+                                  args=(queue, pipeline, options, args.max_jobs, args.exit_when_empty))
+        process.start()
+        return process
+
+    def shutdown(*_):
+        stopping.set()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: finish the current job, release the rest
+
+    processes = [spawn() for _ in range(args.processes)]
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    logger.info(f"Started {args.processes} worker processes")
+    while processes:
+        for process in list(processes):
+            process.join(timeout=1)
+            if process.is_alive():
+                continue
+            processes.remove(process)
+            if process.exitcode not in (0, RECYCLE_EXIT_CODE):
+                logger.warning(f"Worker process {process.pid} exited with {process.exitcode}")
+            if not stopping.is_set() and not (args.exit_when_empty and process.exitcode == 0):
+                processes.append(spawn())
+    return 0
+
+
+def enqueue(args) -> int:
+    queue = job_queue()
+    jobs = []
+    for source in args.sources:
+        if source.startswith(URL_SCHEMES):
+            paths = [source]
+        else:
+            paths = sorted(glob.glob(os.path.join(source, '**', '*.apk'), recursive=True)) \
+                if os.path.isdir(source) else [source]
+            paths = [os.path.abspath(path) for path in paths]
+        jobs.extend({'source': path, 'priority': args.priority} for path in paths)
+    added = queue.enqueue(jobs)
+    print(f"Queued {added} new jobs ({len(jobs) - added} already known)")
+    return 0
+
+
+def status(args) -> int:
+    print(json.dumps(job_queue().status(dead_letters=args.dead_letters), indent=2))
+    return 0
+
+
+def requeue_dead(args) -> int:
+    print(f"Requeued {job_queue().requeue_dead(args.job_ids or None)} dead jobs")
+    return 0
+
+
+def purge(args) -> int:
+    print(f"Removed {job_queue().purge_done(args.days)} finished jobs")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Distributed APK scan worker')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Scan queued jobs')
+    run_parser.add_argument('--processes', type=int,
+                            default=int(os.environ.get('JOB_WORKER_PROCESSES') or os.cpu_count() or 1),
+                            help='Worker processes on this host (analysis is CPU-bound: one per core)')
+    run_parser.add_argument('--batch-size', type=int, default=int(os.environ.get('JOB_BATCH_SIZE', 1)),
+                            help='Jobs claimed at once per process')
+    run_parser.add_argument('--lease', type=float, default=float(os.environ.get('JOB_LEASE_SECONDS', 120)),
+                            help='Lease length in seconds, renewed every quarter of it')
+    run_parser.add_argument('--max-jobs', type=int, default=int(os.environ.get('JOB_WORKER_MAX_JOBS', 200)),
+                            help='Replace a worker process after this many jobs (0 = never)')
+    run_parser.add_argument('--download-dir', default=os.environ.get('JOB_DOWNLOAD_DIR'),
+                            help='Where APKs from URLs are downloaded (default: temp dir)')
+    run_parser.add_argument('--max-download-mb', type=int,
+                            default=int(os.environ.get('JOB_MAX_DOWNLOAD_MB', 1024)))
+    run_parser.add_argument('--exit-when-empty', action='store_true',
+                            help='Stop once no job is queued or leased (batch runs, benchmarks)')
+    run_parser.set_defaults(func=run)
+
+    enqueue_parser = sub.add_parser('enqueue', help='Queue APK paths, directories or URLs')
+    enqueue_parser.add_argument('sources', nargs='+')
+    enqueue_parser.add_argument('--priority', type=int, default=0, help='Higher runs first')
+    enqueue_parser.set_defaults(func=enqueue)
+
+    status_parser = sub.add_parser('status', help='Job counts and the latest dead letters')
+    status_parser.add_argument('--dead-letters', type=int, default=20)
+    status_parser.set_defaults(func=status)
+
+    requeue_parser = sub.add_parser('requeue-dead', help='Queue dead-lettered jobs again')
+    requeue_parser.add_argument('job_ids', nargs='*', help='Default: all of them')
+    requeue_parser.set_defaults(func=requeue_dead)
+
+    purge_parser = sub.add_parser('purge', help='Forget finished jobs (the scans stay)')
+    purge_parser.add_argument('--days', type=float, default=30)
+    purge_parser.set_defaults(func=purge)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())